@@ -0,0 +1,1400 @@
+#########################################################################################
+#
+# PTCLMmkdata_prog
+#
+# Top level class to define the PTCLMmkdata program. Parse's arguments and has methods to
+# create the datasets for a site. The PTCLMmkdata script is a thin wrapper around this
+# class, other Python programs can call make_site_data to create the datasets for many
+# sites in one process (reusing the site catalog and namelist defaults between sites).
+#
+#  Usage from Python:
+#
+#   from PTCLMmkdata_prog import make_site_data, PTCLMmkdataError
+#
+#   result = make_site_data( "US-UMB", cesm_input="/glade/p/cesmdata/cseg/inputdata" )
+#   print( result.surffile )
+#
+#  The keyword arguments are the dest names of the PTCLMmkdata command line options
+#  (crop, pftgrid, mydatadir, clmnmlusecase, debug, quiet etc.). Errors raise
+#  PTCLMmkdataError.
+#
+#########################################################################################
+import os, time, re, sys, glob, shutil, stat, threading
+# Only what is needed to get the version and parse the command line is imported here,
+# the other modules are imported where they are first used to keep startup fast
+from ptclmversion import ptclmversion
+
+class PTCLMmkdataError( Exception ):
+#----------------------------------------------------------------------------------------
+# Error raised when PTCLMmkdata can NOT create the datasets for a site
+#----------------------------------------------------------------------------------------
+   pass
+
+class PTCLMmkdata_result:
+#----------------------------------------------------------------------------------------
+# Result of creating the datasets for a site
+#----------------------------------------------------------------------------------------
+   # Class data
+   site                    = ""     # Site code
+   data_dir                = ""     # Directory the datasets were created in
+   domainfile              = ""     # Data domain file (in data_dir)
+   surffile                = ""     # Surface dataset
+   logfile                 = ""     # Log file from creating the surface dataset
+   landuse_timeseries_file = None   # Landuse timeseries file (None if NOT transient)
+   shell_commands          = ""     # Script with the xmlchange commands for the case
+   user_nl_clm             = ""     # Namelist file for the case
+   tracefile               = None   # Trace of the stages (None if NOT traced)
+   ensemble_dirs           = {}     # Directory for each ensemble member, keyed by member (with --ensemble)
+   walltime                = 0.0    # Time to create the datasets (seconds)
+
+class PTCLMmkdata_prog:
+#----------------------------------------------------------------------------------------
+# Class to handle command line input to the program and create the datasets for a site
+#----------------------------------------------------------------------------------------
+   # Class data
+   name          = "PTCLMmkdata"
+   description   = 'Python script to create datasets to run single point simulations with tower site data.'
+   defSitesGroup = "PTCLMDATA"      # default site group name
+   ptclm_dir     = os.path.dirname( os.path.abspath( __file__ ) )
+   clmnmlusecase = "2000_control"
+   infohelp      = "\n\n Use --help option for help on usage.\n"
+   cmdline       = ""
+   plev          = 1
+   parser        = None
+   options       = None
+   stages        = None
+   failed_stages = []     # Stages that failed in the last run (so a rerun can say where it resumes from)
+   data_dir      = None
+   statusfile    = "PTCLMmkdata.status"   # File in the site directory with the status of the site
+   # Objects shared by all sites run in this process, keyed by their files
+   catalogs      = {}
+   nmldefaults   = {}
+   shared_lock   = threading.Lock()   # So sites run in threads make each shared object just once
+   have_modules  = {}     # If the python modules for the built-in tools are available (checked once)
+
+   # --  Error function ---------------------------------
+   def error( self, desc ):
+       "error function, raises an exception with the message"
+       # An error in a stage is raised again by the stage graph, after it cancels the other stages
+       raise PTCLMmkdataError( desc )
+
+   def usage_error( self, desc ):
+       "error in the options given, uses the parser to report it from the command line"
+       if ( self.parser != None ):
+          self.parser.error( desc )
+       self.error( desc )
+
+   def get_version( self ):
+       "Return the PTCLM version"
+       return( ptclmversion().Get( self, self.ptclm_dir+"/ChangeLog" ) )
+
+   def get_parser( self ):
+      "Return the parser for the command line options"
+      from optparse import OptionParser, OptionGroup
+
+      base_ctsm = os.path.abspath(self.ptclm_dir+"/../.." )
+      mydatadir = self.ptclm_dir+"/mydatafiles"
+      sdate     = time.strftime( "%y%m%d" )
+      tagvers   = self.get_version()
+      parser = OptionParser( prog=self.name, usage="%prog [options] -d inputdatadir -s sitename", \
+                             description=self.description, version=tagvers )
+      required = OptionGroup( parser, "Required Options" )
+      required.add_option("-d", "--cesmdata", dest="cesm_input", default=" ", \
+                        help="Location of CCSM input data")
+      required.add_option("-s", "--site", dest="mysite", default="none", \
+                        help="Site-code to run, FLUXNET code (-s list to list valid names)"+\
+                             " or a comma seperated list of site-codes (-s all to run every valid site)")
+      parser.add_option_group(required)
+      options  = OptionGroup( parser, "Configure and Run Options" )
+      options.add_option("--crop", dest="crop", \
+                        action="store_true", help = \
+                        "Create datasets and run with prognostic crop on")
+      options.add_option("--no-crop", dest="crop", \
+                        action="store_false", default=False, help = \
+                        "Create datasets and run without prognostic crop on (DEFAULT)")
+      options.add_option("--ctsm_root", dest="base_ctsm", \
+                        default=base_ctsm, help = \
+                        "Root CTSM directory (top level directory CTSM src bld doc cime_config subdirs)")
+      options.add_option("--cime_root", dest="base_cime", \
+                        default=" ", help = \
+                        "Root CIME directory (top level directory of CIME infrastructure with " \
+                        + " scripts, doc, utils, tools, src, config subdirs)")
+      options.add_option("--debug", dest="debug", action="store_true", default=False, \
+                        help="Flag to turn on debug mode so won't run, but display what would happen")
+      options.add_option("--sdate", dest="sdate", default=sdate, \
+                        help="Use entered date string in all files"+\
+                             " (use the given date string in place of the current date:"+sdate+")" )
+      options.add_option("--clmnmlusecase", dest="clmnmlusecase", default=self.clmnmlusecase, \
+                        help="CTSM namelist use case to use (default:"+self.clmnmlusecase+")" )
+      options.add_option("--list", dest="list", default=False, action="store_true", \
+                        help="List all valid: sites")
+      options.add_option("--mydatadir", dest="mydatadir", default=mydatadir \
+                        ,help="Directory of where to put your data files (files will be under subdirectories for each site)"+\
+                              " (default: "+mydatadir+")" )
+      options.add_option("--donot_use_tower_yrs",action="store_false",\
+                        dest="use_tower_yrs",default=True,\
+                        help="Do NOT use the data years that correspond to the tower years "+\
+                             "(when you plan on using global forcing)" )
+      options.add_option("--quiet", action="store_true", \
+                        dest="quiet", default=False, \
+                        help="Print minimul information on what the script is doing")
+      options.add_option("--cycle_forcing", action="store_true", \
+                        dest="cycle_forcing", default=False, \
+                        help="Cycle over the forcing data rather than do one run through (modifies start/end year to get this to work)")
+      options.add_option("--verbose", action="store_true", \
+                        dest="verbose", default=False, \
+                        help="Print out extra information on what the script is doing")
+      options.add_option("--jobs", dest="jobs", type="int", default=1, \
+                        help="Number of sites to run at the same time when a list of sites is given"+\
+                             " (or ensemble members with --ensemble) (default: 1)")
+      options.add_option("--no_trace", dest="trace", action="store_false", default=True, \
+                        help="Do NOT write a trace of the time and resources used by each stage"+\
+                             " (to PTCLMmkdata_trace.jsonl in the site directory)")
+      options.add_option("--merge_traces", dest="merge_traces", default=" ", \
+                        help="When a list of sites is given, merge the traces from each site into this"+\
+                             " Chrome trace file and summarize the time spent in each stage")
+      parser.add_option_group(options)
+
+      indatgengroup = OptionGroup( parser, "Input data generation options", \
+                        "These are options having to do with generation of input datasets.  " )
+      parser.add_option_group(indatgengroup)
+      indatgengroup.add_option("--pftgrid", dest="pftgrid", help = \
+                        "Use pft information from global gridded file (rather than site data)", \
+                        action="store_true", default=False)
+      indatgengroup.add_option("--soilgrid", dest="soilgrid", help = \
+                        "Use soil information from global gridded file (rather than site data)",\
+                         action="store_true", default=False)
+      indatgengroup.add_option("--map_gdate", dest="map_gdate", default=sdate, \
+                        help="Use existing mapping files with the given date string rather than create new ones with current date"+\
+                             " (if mapping files do NOT exist with this date, the script will abort)" )
+      indatgengroup.add_option("--map_cache_dir", dest="map_cache_dir", default=" ", \
+                        help="Directory of the cache of mapping files shared between sites and runs"+\
+                             " (default: map_cache under the mydatadir directory)" )
+      indatgengroup.add_option("--map_cache_size", dest="map_cache_size", type="float", default=1000.0, \
+                        help="Maximum size of the mapping file cache in MB, least recently used"+\
+                             " mapping files are removed beyond this (default: 1000)" )
+      indatgengroup.add_option("--no_map_cache", dest="use_map_cache", action="store_false", default=True, \
+                        help="Do NOT reuse or save mapping files in the mapping file cache" )
+      indatgengroup.add_option("--rerun_all_stages", dest="rerun_all_stages", action="store_true", default=False, \
+                        help="Rerun all stages of dataset creation even if the stage manifest in the site directory"+\
+                             " shows they are up to date" )
+      indatgengroup.add_option("--stages", dest="stages", default="all", \
+                        help="Comma seperated list of the stages to run (with the stages they depend on, which are skipped"+\
+                             " if the stage manifest shows they are up to date), so the stages can be run in seperate jobs."+\
+                             " The case files are only finished when all the stages are run"+\
+                             " (stages: noocean,domain,mapping,sitepft,sitesoil,landuse,mksurfdata,ensemble) (default: all)" )
+      indatgengroup.add_option("--use_mknoocnmap", dest="use_mknoocnmap", action="store_true", default=False, \
+                        help="Use mknoocnmap.pl (and NCL) to create the SCRIP grid and map for the point, rather than"+\
+                             " writing them directly (they are always created with mknoocnmap.pl if netCDF4 is NOT available)" )
+      indatgengroup.add_option("--use_gen_domain", dest="use_gen_domain", action="store_true", default=False, \
+                        help="Use the CIME gen_domain tool to create the domain file, rather than writing it directly"+\
+                             " (it is always created with gen_domain if netCDF4 is NOT available)" )
+      indatgengroup.add_option("--use_mkmapdata", dest="use_mkmapdata", action="store_true", default=False, \
+                        help="Use mkmapdata.sh (and ESMF) to create the mapping files for the surface dataset, rather than"+\
+                             " writing them directly (they are always created with mkmapdata.sh if netCDF4 is NOT available)" )
+      indatgengroup.add_option("--use_cnvrt_trnsyrs", dest="use_cnvrt_trnsyrs", action="store_true", default=False, \
+                        help="Use cnvrt_trnsyrs2_landuse_timeseries_txtfile.pl to create the landuse timeseries text file,"+\
+                             " rather than writing it directly (it is always created with it if numpy is NOT available)" )
+      indatgengroup.add_option("--ensemble", dest="ensemble", default=" ", \
+                        help="Create an ensemble of surface datasets that differ in the PFT or soil settings, from a table file"+\
+                             " (CSV with member,soil_snd,soil_cly,pft_frc,pft_idx columns) or a sampling spec"+\
+                             " (for example: n=20,seed=1,soil_snd=20:80,soil_cly=5:40). The other files are created once,"+\
+                             " and each member gets a subdirectory with it's surface dataset and user_nl_clm" )
+      indatgengroup.add_option("--surfdata_overlay", dest="surfdata_overlay", default=" ", \
+                        help="Overlay the site PFT and soil values onto this existing surface dataset (from a previous run"+\
+                             " or created with --pftgrid --soilgrid) rather than running mksurfdata.pl (needs numpy and"+\
+                             " netCDF4, and can NOT be used for transient cases)" )
+      indatgengroup.add_option("--mksurfdata_opts", dest="mksurfdata_opts", help = \
+                        "Options to send directly to mksurfdata_map",\
+                         default="")
+      versiongroup  = OptionGroup( parser, tagvers )
+      parser.add_option_group(versiongroup)
+      return( parser )
+
+   def parse_cmdline_args( self, argv=None ):
+      "Parse the command line arguments for PTCLMmkdata"
+      if ( argv == None ): argv = sys.argv
+      self.cmdline = ""
+      for arg in argv:
+          self.cmdline = self.cmdline+arg+" "
+      self.parser = self.get_parser()
+      (options, args) = self.parser.parse_args( argv[1:] )
+      if len(args) != 0:
+          self.parser.error("incorrect number of arguments")
+      self._set_options( options )
+
+   def set_options( self, site, **opts ):
+      "Set the options to create datasets for a site, keyword arguments are the dest names of the command line options"
+      self.parser = None
+      options = self.get_parser().get_default_values()
+      for name in opts:
+         if ( not hasattr( options, name ) ):
+            self.error( "Unknown option: "+name )
+         setattr( options, name, opts[name] )
+      options.mysite = site
+      self.cmdline = "make_site_data( "+site
+      for name in sorted(opts):
+         self.cmdline = self.cmdline+", "+name+"="+repr(opts[name])
+      self.cmdline = self.cmdline+" ) "
+      self._set_options( options )
+
+   def _set_options( self, options ):
+      "Check the options and set the print level"
+      self.options = options
+      self.mysite  = options.mysite
+      if ( options.list ):
+         self.mysite = "list"
+      if ( self.mysite == "none" ): self.usage_error("sitename is a required argument, set it to a valid value"+self.infohelp )
+      if ( options.verbose and options.quiet ):
+         self.usage_error( "options quiet and verbose are mutually exclusive"+self.infohelp )
+
+      if (   options.verbose ): self.plev = 2
+      elif ( options.quiet   ): self.plev = 0
+      else:                     self.plev = 1
+
+   def get_catalog( self ):
+      "Return the catalog of the site, pft and soil data (shared by all sites run in this process)"
+      # The site, pft and soil data files are compiled into a catalog that is saved under mydatadir
+      self.SitesGroup = self.defSitesGroup
+      self.siteDir    = self.ptclm_dir+"/"+"PTCLM_sitedata"
+      dbfile = os.path.abspath(self.options.mydatadir)+"/"+self.SitesGroup+"_sitecatalog.db"
+      with self.shared_lock:
+         if ( dbfile not in self.catalogs ):
+            from sitecatalog import sitecatalog
+            catalog = sitecatalog()
+            catalog.Initialize( self, self.siteDir, group=self.SitesGroup, dbfile=dbfile )
+            self.catalogs[dbfile] = catalog
+         return( self.catalogs[dbfile] )
+
+   def get_SiteList( self ):
+      "Return the list of sites given (more than one if a comma seperated list or all)"
+      if ( self.options == None ):
+         self.error( "parse_cmdline_args or set_options was NOT run first" )
+      mysite  = self.mysite
+      catalog = self.get_catalog()
+      if ( mysite == "all" ):
+         return( [ site["site_code"] for site in catalog.Sites( self ) ] )
+      if ( mysite.find(",") == -1 ):
+         return( [ mysite ] )
+      if ( mysite.find(" ") != -1 or mysite.find(",,") != -1 or mysite.startswith(",") or mysite.endswith(",") ):
+         self.usage_error( "Site list has empty site names or white space, just use comma's to seperate sites: "+mysite+self.infohelp )
+      sitelist = mysite.split(",")
+      for site in sitelist:
+         if ( catalog.Get( self, site ) == None ):
+            self.usage_error( "Entered site is NOT in the list of valid sites: "+site )
+         # The same site run twice at once would write over it's own output directory
+         if ( sitelist.count( site ) > 1 ):
+            self.usage_error( "Site is given more than once in the site list: "+site )
+      return( sitelist )
+
+   ### SOME FUNCTIONS    ###################################################################
+
+   def system( self, cmd, cwd=None ):
+        "system function with error checking and debug prining (commands are run in the data directory unless cwd is given)"
+        options = self.options
+
+        if self.plev>0: print( "Run command: "+cmd )
+
+        # Check if this is a command to always do regardless of debug
+        cmdsallow = [ "create_newcase", "mkdir", "mv", "cat", "touch", "mksurfdata.pl" ]
+        allowed_cmd = False
+        for allow_cmd in cmdsallow:
+           if ( cmd.find( allow_cmd ) > 0 ):
+             allowed_cmd = True
+
+        # Error check that command exists
+        if ( not options.debug or allowed_cmd ):
+           firstspace = cmd.find(" ");
+           if ( firstspace == -1 ):
+              justcmd = cmd
+           else:
+              justcmd = cmd[:firstspace]
+
+           if ( justcmd.find("/") != -1 ):
+              if ( not os.path.exists(justcmd) ):
+                 self.error( "Error command does NOT exist: "+justcmd );
+           else:
+              if ( shutil.which( justcmd ) == None ):
+                 self.error( "Error command is NOT in path: "+justcmd )
+
+        # Now actually run the command (in the data directory)
+        if ( cwd == None ): cwd = self.data_dir
+        if ( not options.debug or allowed_cmd ):
+           if ( options.debug and cmd.find( "mksurfdata.pl" ) > 0):
+              rcode = self.stages.Call( self, cmd+" --debug --allownofile", cwd=cwd )
+           else:
+              rcode = self.stages.Call( self, cmd, cwd=cwd )
+        else: rcode = 0
+        if ( rcode != 0 ):
+           self.error( "Error running command: "+cmd )
+
+   def get_nmldefaults( self ):
+       "return the XML database of namelist defaults (read once and then queried in-process)"
+       csmdata = ""
+       if ( self.cesm_input != " " ): csmdata = self.cesm_input
+       key = ( self.abs_base_ctsm, csmdata )
+       with self.shared_lock:
+          if ( key not in self.nmldefaults ):
+             from namelistdefaults import namelistdefaults
+             nmldefaults = namelistdefaults()
+             nmldefaults.Initialize( self, self.abs_base_ctsm, csmdata=csmdata, \
+                                     indexfile=self.mydata_dir+"/namelist_defaults_index.pickle" )
+             self.nmldefaults[key] = nmldefaults
+          return( self.nmldefaults[key] )
+
+   def queryFilename( self, queryopts, filetype ):
+       "query the XML database to get a filename"
+       # Same rules as queryDefaultNamelist.pl
+       query    = "-silent -justvalue "+queryopts
+       filename = self.get_nmldefaults().QueryArgs( self, query, filetype )
+       if ( (filename == None) or (filename == "") ):
+          print( "Query = "+query+" -var "+filetype )
+          self.error( "Trouble finding file from XML database: "+filetype )
+       return( filename )
+
+   def mapping_gridfiles( self ):
+       "return the raw grid files to create mapping files from (keyed by name), or None if any are NOT found"
+       from namelistdefaults import namelistdefaults
+       from pointmap import pointmap
+       for xmlfile in namelistdefaults.defaults[0:1] + [ namelistdefaults.definition ]:
+          if ( not os.path.exists( self.abs_base_ctsm+"/"+xmlfile ) ): return( None )
+       nmldefaults = self.get_nmldefaults()
+       gridfiles   = {}
+       for name in pointmap.mapgrids:
+          ( hgrid, qopts ) = pointmap().GridQuery( name )
+          gridfile = nmldefaults.Query( self, "scripgriddata", res=hgrid, options=qopts, justvalue=True )
+          if ( gridfile == None ): return( None )
+          if ( not gridfile.startswith( "/" ) ): gridfile = self.cesm_input+"/"+gridfile
+          if ( not os.path.exists( gridfile ) ):
+             if self.plev>0: print( "Raw grid file does NOT exist: "+gridfile )
+             return( None )
+          gridfiles[name] = gridfile
+       return( gridfiles )
+
+   def setup_case_files( self ):
+        "Setup the user_nl_clm and shell_commands files"
+
+        filex = self.data_dir+"/shell_commands"
+        output = open( filex,'w')
+        output.write("# shell commands to execute xmlchange commands written by PTCLMmkdata:\n")
+        output.write("# "+self.cmdline+"\n")
+        output.close()
+        os.chmod( filex, os.stat( filex ).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH )
+        usernlclm = self.data_dir+"/user_nl_clm"
+        output = open( usernlclm,'w')
+        output.write("! user_nl_clm namelist options written by PTCLMmkdata:\n")
+        output.write("! "+self.cmdline+"\n")
+        output.close()
+        return( filex, usernlclm )
+
+   def xmlchange_env_value( self, filex, var, value, note="", append=False ):
+        'Function to set the value of a variable in one of the env_*.xml files'
+        change = "./xmlchange"
+        if ( append ):
+           change = change + " --append"
+        cmd = change+" "+var+"="+value
+        output = open( filex,'a')
+        if ( note != "" ):
+           output.write("# "+note+"\n")
+        output.write(cmd+"\n")
+        output.close()
+
+   def write_datm_namelistdefaults_file( self, dir ):
+        "Write namelist_defaults_datm.xml file"
+        datm_src_dir = self.data_dir+"/SourceMods/src.datm";
+        os.makedirs( datm_src_dir, exist_ok=True )
+        file = datm_src_dir+"/namelist_defaults_datm.xml"
+        output = open( file,'w')
+        filestrings = ( '<?xml version="1.0"?>', \
+        ' ', \
+        '<?xml-stylesheet type="text/xsl" href="namelist_defaults.xsl"?>', \
+        ' ', \
+        '<namelist_defaults>', \
+        ' ', \
+        '</namelist_defaults>' )
+        # write out file
+        for line in filestrings:
+           output.write(line+"\n")
+           # Add data directory for files
+           if ( line.find( "<namelist_defaults>" ) != -1 ):
+              output.write('\n')
+              value = '<strm_datdir stream="CLM1PT.CLM_USRDAT">'+dir+'</strm_datdir>\n'
+              output.write(value)
+
+        output.close()
+
+   def use_builtin( self, tool, external, module="netCDF4" ):
+        "Return True if the built-in replacement for the tool should be used rather than running it"
+        if ( external ): return( False )
+        if ( module not in self.have_modules ):
+           try:
+              __import__( module )
+              self.have_modules[module] = True
+           except ImportError:
+              self.have_modules[module] = False
+        if ( not self.have_modules[module] and self.plev>0 ):
+           print( module+" python module is NOT available, so run "+tool )
+        return( self.have_modules[module] )
+
+   def find_filename_created( self, wildcard, desc ):
+        "Find the filename of the file that was just created"
+
+        if ( not self.options.debug ):
+           # If NOT debug mode, get the newest file that matches
+           filenames = glob.glob( wildcard )
+           if ( len(filenames) == 0 ): self.error( "filename does NOT exist:"+wildcard )
+           filename  = max( filenames, key=os.path.getmtime )
+        else:
+           # For debug mode, create a file with current date replacing any wildcards
+           filename = wildcard.replace( "*", self.options.sdate )
+           open( filename, "a" ).close()
+
+        print( desc+" = "+filename )
+        return( filename )
+
+   def write_status( self, data_dir, status, desc="" ):
+        "Write the status of the site (RUNNING, PASS or FAIL) to the status file in the site directory"
+        output = open( data_dir+"/"+self.statusfile+".tmp", "w" )
+        output.write( status+" "+time.strftime( "%Y-%m-%d %H:%M:%S" )+" "+desc+"\n" )
+        output.close()
+        os.rename( data_dir+"/"+self.statusfile+".tmp", data_dir+"/"+self.statusfile )
+
+   def read_status( self, data_dir ):
+        "Return the status of the site from the status file in the site directory (None if there isn't one)"
+        if ( not os.path.exists( data_dir+"/"+self.statusfile ) ):
+           return( None )
+        infile = open( data_dir+"/"+self.statusfile, "r" )
+        line   = infile.readline()
+        infile.close()
+        if ( line.strip() == "" ):
+           return( None )
+        return( line.split()[0] )
+
+   def read_status_description( self, data_dir ):
+        "Return the description given with the status of the site (after the date)"
+        if ( not os.path.exists( data_dir+"/"+self.statusfile ) ):
+           return( "" )
+        infile = open( data_dir+"/"+self.statusfile, "r" )
+        line   = infile.readline()
+        infile.close()
+        items  = line.split( None, 3 )
+        if ( len(items) < 4 ):
+           return( "" )
+        return( items[3].strip() )
+
+   def print_site( self, site ):
+        "Print out the information for a site"
+        print( " site = %9s name: %-55s Region: %12s Campaign: %s" % \
+               ( site["site_code"], site["name"], site["state"], site["campaign"] ) )
+
+   ### RUN A LIST OF SITES ##############################################################
+
+   def site_list_args( self, args ):
+        "Remove the site, jobs and merge_traces options from a list of command line arguments"
+        siteargs = []
+        skip     = False
+        for arg in args:
+           name = arg.split("=")[0]
+           if ( skip ):
+              skip = False
+           elif ( name.startswith("--") and len(name) > 2 and \
+                  ("--site".startswith(name) or "--jobs".startswith(name) or "--merge_traces".startswith(name)) ):
+              # Skip the value as well when it is NOT given with an equal sign
+              skip = (arg.find("=") == -1)
+           elif ( arg == "-s" ):
+              skip = True
+           elif ( not (arg.startswith("-s") and not arg.startswith("--")) ):
+              siteargs.append( arg )
+        return( siteargs )
+
+   def run_site( self, site, args, data_dir ):
+        "Run PTCLMmkdata for a single site, with output going to a log file in the site directory"
+        import subprocess
+        if ( not os.path.exists( data_dir ) ): os.makedirs( data_dir )
+        logfile = data_dir+"/PTCLMmkdata.log"
+        log     = open( logfile, "w" )
+        cmd     = [ sys.executable, self.ptclm_dir+"/PTCLMmkdata" ] + args + [ "-s", site ]
+        rcode   = subprocess.call( cmd, stdout=log, stderr=subprocess.STDOUT )
+        log.close()
+        # If the site was killed it can't write that it failed itself
+        if ( rcode != 0 and self.read_status( data_dir ) != "FAIL" ):
+           self.write_status( data_dir, "FAIL", "exit status = "+str(rcode) )
+        return( rcode, logfile )
+
+   def run_site_list( self, sitelist, args ):
+        "Run each site in the list as a seperate PTCLMmkdata process, and summarize the results"
+        import concurrent.futures
+        options    = self.options
+        if ( options.cesm_input == " " ):
+            self.usage_error( "inputdatadir is a required argument, set it to the directory where you have your inputdata"+self.infohelp )
+        if ( options.jobs < 1 ):
+            self.usage_error( "jobs must be one or greater"+self.infohelp )
+        mydata_dir = os.path.abspath( options.mydatadir )
+        args       = self.site_list_args( args )
+        if self.plev>0: print( "Run "+str(len(sitelist))+" sites with "+str(options.jobs)+" at a time\n" )
+        results = {}
+        # Each site is run in it's own process, the threads in the pool just wait for them
+        with concurrent.futures.ThreadPoolExecutor( max_workers=options.jobs ) as pool:
+           futures = {}
+           for site in sitelist:
+              data_dir = mydata_dir+"/1x1pt_"+site
+              futures[pool.submit( self.run_site, site, args, data_dir )] = site
+           for future in concurrent.futures.as_completed( futures ):
+              site = futures[future]
+              results[site] = future.result()
+              if self.plev>0: print( "Finished site: "+site+" exit status = "+str(results[site][0]) )
+
+        nfail = 0
+        print( "\nSummary of sites run:\n" )
+        for site in sitelist:
+           (rcode, logfile) = results[site]
+           if ( rcode == 0 ):
+              status = "PASS"
+           else:
+              status = "FAIL"
+              nfail += 1
+           print( " %-4s %9s log: %s" % ( status, site, logfile ) )
+        print( "\nNumber of sites that PASS = "+str(len(sitelist)-nfail) )
+        print( "Number of sites that FAIL = "+str(nfail) )
+        if ( options.merge_traces != " " ):
+           self.merge_site_traces( sitelist, os.path.abspath( options.merge_traces ) )
+        return( nfail )
+
+   def merge_site_traces( self, sitelist, outfile ):
+        "Merge the traces from a list of sites into one file, and print the time spent in each stage"
+        from stagetrace import stagetrace
+        mydata_dir = os.path.abspath( self.options.mydatadir )
+        tracefiles = []
+        for site in sitelist:
+           tracefile = mydata_dir+"/1x1pt_"+site+"/"+stagetrace.filename
+           if ( os.path.exists( tracefile ) ):
+              tracefiles.append( tracefile )
+           else:
+              print( "No trace for site: "+site )
+        summary = stagetrace().Merge( self, tracefiles, outfile )
+        print( "\nMerged traces from "+str(len(tracefiles))+" sites into: "+outfile+"\n" )
+        print( " %-12s %6s %12s %12s %12s %14s" % ( "stage", "count", "wall(s)", "child cpu(s)", "max rss(MB)", "output(MB)" ) )
+        for stage in sorted( summary, key=lambda stage: summary[stage]["wall"], reverse=True ):
+           total = summary[stage]
+           print( " %-12s %6d %12.2f %12.2f %12.1f %14.2f" % ( stage, total["count"], total["wall"], total["child_cpu"], \
+                  total["maxrss_kb"]/1024.0, total["output_bytes"]/1048576.0 ) )
+
+   ### CREATE THE DATASETS FOR A SITE ###################################################
+
+   def Run( self ):
+      "Create the datasets for the site, returns a PTCLMmkdata_result (or None if just listing the sites or running some stages)"
+      self.data_dir      = None
+      self.failed_stages = []
+      try:
+         return( self.create_datasets() )
+      except Exception as err:
+         # Mark the site as failed once it's directory is setup, with the stage that failed.
+         # Stages that completed are in the stage manifest, so a rerun starts from the stage that failed
+         if ( self.data_dir != None and os.path.isdir( self.data_dir ) ):
+            desc = str(err).split("\n")[0]
+            if ( len(self.failed_stages) > 0 ): desc = "stage "+self.failed_stages[0]+": "+desc
+            self.write_status( self.data_dir, "FAIL", desc )
+         raise
+
+   def create_datasets( self ):
+      "Create the datasets for the site (use Run which records the status of the site)"
+      if ( self.options == None ):
+         self.error( "parse_cmdline_args or set_options was NOT run first" )
+      options = self.options
+      plev    = self.plev
+      mysite  = self.mysite
+      start   = time.time()
+      catalog = self.get_catalog()
+      if ( mysite == "all" or mysite.find(",") != -1 ):
+         self.error( "Run creates datasets for a single site, use run_site_list for a list of sites: "+mysite )
+
+      version = self.get_version()
+      if plev>0: print( "---------------- PTCLMmkdata version "+str(version)+"-----------------------------\n" )
+      if plev>0: print( "   "+self.cmdline+"\n" )
+      if plev>0: print( "   OPTIONS:\n" )
+      if plev>0: print( "Site name:\t\t\t\t\t\t"+mysite+"\n" )
+
+      base_ctsm = options.base_ctsm
+      if base_ctsm == " ":
+          #assume base directory is three levels up from where PTCLM script
+          #  is executed, if not specified
+          base_ctsm = os.path.abspath( self.ptclm_dir+"/../../.." )
+
+      self.abs_base_ctsm = os.path.abspath( base_ctsm )
+      if plev>0: print( "Root CTSM directory:\t\t\t\t\t"+self.abs_base_ctsm )
+
+      base_cime = options.base_cime
+      if base_cime == " ":
+          #assume base directory is tunder the CTSM directory
+          #  is executed, if not specified
+          base_cime = os.path.abspath( self.abs_base_ctsm+"/cime" )
+
+      abs_base_cime = os.path.abspath( base_cime )
+      if plev>0: print( "Root CIME directory:\t\t\t\t\t"+abs_base_cime )
+
+      if plev>0: print( "** Surface data file will be built using site-level data " +
+                "when available unless otherwise specified ** \n" )
+      if plev>0: print( "\tExtract PFT data from gridded files:\t\t"+str(options.pftgrid) )
+      if plev>0: print( "\tExtract soil data from gridded files:\t\t"+str(options.soilgrid) )
+
+      ###### END SET OPTIONS BASED ON INPUT FROM PARSER  ######################################
+
+      ########## GET SITE LAT, LON, AND TOWER MET YEARS #######################################
+
+      #get lat/lon, start/end years from sitedata file
+      sitedata = self.SitesGroup+"_sitedata.txt"
+      self.soildata = self.SitesGroup+"_soildata.txt"
+      self.pftdata  = self.SitesGroup+"_pftdata.txt"
+      if plev>0: print( "\nOpen Site data file: "+self.siteDir+"/"+sitedata+"\n" )
+
+      # Exit early for list options
+      if ( mysite == "list" ):
+        self.print_site( catalog.Header( self ) )
+        for site in catalog.Sites( self ):
+           self.print_site( site )
+        return( None )
+
+      site = catalog.Get( self, mysite )
+      if ( site == None ):
+        self.usage_error( "Entered site is NOT in the list of valid sites: "+mysite )
+      self.site = site
+      if plev>1: self.print_site( site )
+      lon=site["lon"]
+      if (lon < 0):
+          lon=360.0+site["lon"]
+      self.lon  = lon
+      self.lat  = site["lat"]
+      startyear = site["startyear"]
+      endyear   = site["endyear"]
+      alignyear = site["alignyear"]
+      timestep  = site["timestep"]
+
+      # inputdata directory -- set after list options
+      self.cesm_input = options.cesm_input
+      if self.cesm_input == " ":
+         self.usage_error( "inputdatadir is a required argument, set it to the directory where you have your inputdata"+self.infohelp )
+      if plev>0: print( "CESM input data directory:\t\t\t\t"+self.cesm_input )
+      #define data and utility directories
+      mask          = "navy"
+      clmusrdatname = "1x1pt_"+mysite
+      clmusrdat     = " -usrname "+clmusrdatname
+      self.clmres   = clmusrdatname
+      self.clmmask  = "navy"
+
+      self.clm_tools   = self.abs_base_ctsm+'/tools'
+      if ( not os.path.exists( self.clm_tools ) ):
+         self.error( "clm tools directory does NOT exist: "+self.clm_tools )
+      self.gen_dom_dir = abs_base_cime+'/tools/mapping/gen_domain_files'
+      # gen_domain is only needed when the domain file is NOT written directly
+      if ( options.use_gen_domain and not os.path.exists( self.gen_dom_dir ) ):
+         self.error( "generate domain directory does NOT exist: "+self.gen_dom_dir )
+      mkmapgrd_dir = self.clm_tools+'/mkmapgrids'
+      if ( not os.path.exists( mkmapgrd_dir ) ):
+         self.error( "make map grid directory does NOT exist: "+mkmapgrd_dir )
+      self.mkmapdat_dir = self.clm_tools+'/mkmapdata'
+      if ( not os.path.exists( self.mkmapdat_dir ) ):
+         self.error( "make map data directory does NOT exist: "+self.mkmapdat_dir )
+      self.clm_input = self.cesm_input+'/lnd/clm2'
+
+      self.mydata_dir = os.path.abspath( options.mydatadir )
+      self.data_dir   = self.mydata_dir+"/"+clmusrdatname
+      data_dir        = self.data_dir
+      if ( not os.path.exists( data_dir ) ): os.makedirs( data_dir )
+      self.write_status( data_dir, "RUNNING" )
+
+      if plev>0: print( "----------------------------------------------------------------\n" )
+
+      ############# WRITE OUT README FILE ON DATA ##############################################
+
+      clmnmlusecase = options.clmnmlusecase
+
+      filen = data_dir+"/README.PTCLM"
+      if plev>0: print( "Write "+filen+" with command line" )
+      output = open( filen,'w')
+      output.write(self.cmdline+"\n")
+      output.close()
+
+      ############# GET SIM_YEAR, RCP and SIM_YEAR_RANGE based on USE-CASE ####################
+      ############# CLM configure ensures naming conventions are followed  ####################
+      ############# And setup Query options based on them #####################################
+
+      self.actual_sim_year_range = None
+      if (   clmnmlusecase.endswith("_transient") ):
+           transient = re.search('^([0-9]+-[0-9]+)_*(.*)_(transient$)',   clmnmlusecase )
+           if ( transient ):
+              sim_year_range = transient.group(1)
+              sim_year       = re.search( '^([0-9]+)-',    transient.group(1) ).group(1)
+           elif ( clmnmlusecase.startswith("20thC_") ):
+              sim_year_range = "1850-2000"
+              sim_year       = "1850"
+           else:
+              self.error( "Can not parse use-case name, does not follow conventions: "+clmnmlusecase )
+
+           if ( sim_year_range == "1850-2000" ): self.actual_sim_year_range = "1850-2015"
+           else:                                 self.actual_sim_year_range = sim_year_range
+      elif ( clmnmlusecase.endswith("_control") ):
+           control        = re.search( '^([0-9]+)_', clmnmlusecase )
+           if ( not control ):      self.error( "Can NOT parse use-case name does NOT follow conventions: "+clmnmlusecase )
+           sim_year       = control.group(1)
+           if ( sim_year == None ): self.error( "Trouble finding sim_year from:"+clmnmlusecase )
+           sim_year       = str(sim_year)
+           sim_year_range = "constant"
+      elif ( clmnmlusecase.endswith("_pd") or clmnmlusecase == "UNSET" ):
+           sim_year       = "2000"
+           sim_year_range = "constant"
+      else:
+           self.error( "Can not parse use-case name:, does not follow conventions: "+clmnmlusecase )
+      self.sim_year       = sim_year
+      self.sim_year_range = sim_year_range
+
+      self.landuse_timeseries_type = "hist"
+
+      qoptionsbase   = " -options mask="+mask
+
+      qoptions       = qoptionsbase+",sim_year="+sim_year+",sim_year_range="+sim_year_range;
+      self.queryOpts = " -onlyfiles -res "+self.clmres+clmusrdat+qoptions
+
+      #
+      # If you are trying to cycle the forcing years you need to be careful about
+      # the number of years cycling over and taking leap years into account.
+      #
+      if ( options.cycle_forcing ):
+          numyears = endyear - startyear + 1
+          numfour = int(numyears/4)
+          # If have three years or less (numfour = 0) just repeat first year
+          # unless first year is leap year then use next year.
+          # Since just using one year that is not a leap year endyear is startyear
+          if (numfour == 0):
+            if (startyear % 4 == 0):
+              startyear = startyear + 1
+
+            endyear  = startyear
+          else:
+            endyear = startyear + numfour * 4 - 1
+
+          # Use alignyear from file for cycle_forcing case
+      else:
+          # When NOT cycling forcing, use start year for the align year
+          alignyear = startyear
+
+      if (options.crop == True):
+         self.mkcrop = " -crop"
+      else:
+         self.mkcrop = " -no-crop"
+
+      ####### ANY OTHER LAST SETTINGS BEFORE CREATING DATASETS ################################
+
+      #####  ENV XML CHANGES ##################################################################
+      filex, usernlclm = self.setup_case_files( )
+
+      if ( clmusrdatname != "" ):
+         self.xmlchange_env_value( filex, "CLM_USRDAT_NAME", clmusrdatname )
+
+      if(options.use_tower_yrs):
+          self.xmlchange_env_value( filex, "DATM_CLMNCEP_YR_START", str(startyear) )
+          self.xmlchange_env_value( filex, "DATM_CLMNCEP_YR_END",   str(endyear) )
+
+      self.xmlchange_env_value( filex, "MPILIB", "mpi-serial", note="Comment this out if NINST_LND is greater than 1 (see: http://bugs.cgd.ucar.edu/show_bug.cgi?id=2521)" )
+
+      ############# BEGIN CREATE POINT DATASETS ###############################################
+
+      if plev>0: print("Making input files for the point (this may take a while if creating transient datasets)")
+
+      from stagemanifest import stagemanifest
+      from stagegraph    import stagegraph
+      # Each stage is recorded in the manifest, and skipped on a rerun if it's inputs have NOT changed
+      self.manifest = stagemanifest()
+      self.manifest.Initialize( self, data_dir, record=(not options.debug), skip=(not options.rerun_all_stages) )
+
+      if ( sim_year_range == "constant" ):
+         self.mksrfyears = sim_year
+      else:
+         self.mksrfyears = sim_year_range
+      self.mapdir    = data_dir
+      self.map_gdate = options.map_gdate
+      self.overlay   = None
+      if ( options.surfdata_overlay != " " ):
+         if ( sim_year_range != "constant" ):
+            self.usage_error( "surfdata_overlay can NOT be used for transient cases"+self.infohelp )
+         self.overlay = os.path.abspath( options.surfdata_overlay )
+         if ( not os.path.exists( self.overlay ) ):
+            self.error( "Surface dataset to overlay does NOT exist: "+self.overlay )
+      self.ensemble  = None
+      if ( options.ensemble != " " ):
+         from ensemble import ensemble
+         self.ensemble = ensemble()
+         self.ensemble.Initialize( self, options.ensemble )
+         if ( options.jobs < 1 ):
+            self.usage_error( "jobs must be one or greater"+self.infohelp )
+
+      # The stages are run as a graph, each stage starts as soon as the stages it depends on are done:
+      #
+      #   noocean --+--> domain
+      #             +--> mapping --+
+      #   sitepft -----------------+--> mksurfdata
+      #   sitesoil ----------------+
+      #   landuse -----------------+--> ensemble (with --ensemble, mksurfdata for each member)
+      #
+      # With --surfdata_overlay the mapping stage is NOT needed, as the site values are
+      # overlaid on an existing surface dataset rather than running mksurfdata
+      # Commands are run through the graph, so they can be cancelled if a stage fails, and traced
+      trace = None
+      if ( options.trace ):
+         from stagetrace import stagetrace
+         trace = stagetrace()
+         trace.Initialize( self, data_dir, mysite )
+      self.stages = stagegraph()
+      self.stages.Initialize( self, trace=trace )
+      self.stages.Add( self, "noocean",    self.stage_noocean )
+      self.stages.Add( self, "domain",     self.stage_domain,     depends=["noocean"] )
+      surfdepends = [ "sitepft", "sitesoil", "landuse" ]
+      if ( self.overlay == None ):
+         self.stages.Add( self, "mapping",    self.stage_mapping,    depends=["noocean"] )
+         surfdepends = [ "mapping" ] + surfdepends
+      self.stages.Add( self, "sitepft",    self.stage_sitepft )
+      self.stages.Add( self, "sitesoil",   self.stage_sitesoil )
+      self.stages.Add( self, "landuse",    self.stage_landuse )
+      self.stages.Add( self, "mksurfdata", self.stage_mksurfdata, depends=surfdepends )
+      if ( self.ensemble != None ):
+         self.stages.Add( self, "ensemble", self.stage_ensemble, depends=surfdepends )
+      # With --stages only some of the stages are run (a later run picks up the others from the manifest)
+      allstages = list( self.stages.order )
+      runstages = allstages
+      if ( options.stages != "all" ):
+         runstages = self.stages.Select( self, options.stages.split(",") )
+      try:
+         self.stages.Run( self )
+      finally:
+         if ( trace != None ): trace.Close()
+         self.failed_stages = list( self.stages.failed )
+         self.stages = None
+      if ( len(runstages) < len(allstages) ):
+         if plev>0: print( "Stages run: "+",".join(runstages)+" (run the other stages to finish the case files)\n" )
+         self.write_status( data_dir, "RUNNING", "stages done: "+",".join(runstages) )
+         return( None )
+
+      ####### END CREATE POINT DATASETS #######################################################
+
+      ###### SET ENV_RUN.XML VALUES ###########################################################
+
+      self.xmlchange_env_value( filex, "ATM_DOMAIN_PATH", data_dir   )
+      self.xmlchange_env_value( filex, "LND_DOMAIN_PATH", data_dir   )
+      self.xmlchange_env_value( filex, "ATM_DOMAIN_FILE", self.domainfile )
+      self.xmlchange_env_value( filex, "LND_DOMAIN_FILE", self.domainfile )
+      self.xmlchange_env_value( filex, "CLM_BLDNML_OPTS", "'-mask "+mask+self.mkcrop+"'", append=True );
+
+      self.xmlchange_env_value( filex, "CALENDAR",        "GREGORIAN" )
+      self.xmlchange_env_value( filex, "DOUT_S",          "FALSE" )
+      self.hist_nhtfrq = 0
+      self.hist_mfilt  = 1200
+
+      atm_ncpl = int((60 // timestep) * 24)
+      self.xmlchange_env_value( filex,    "ATM_NCPL", str(atm_ncpl) )
+      if(options.use_tower_yrs):
+         self.xmlchange_env_value( filex, "RUN_STARTDATE", str(alignyear)+"-01-01" )
+         self.xmlchange_env_value( filex, "DATM_CLMNCEP_YR_ALIGN", str(alignyear) )
+
+      self.xmlchange_env_value( filex, "DIN_LOC_ROOT",         self.cesm_input )
+      self.xmlchange_env_value( filex, "DIN_LOC_ROOT_CLMFORC", self.mydata_dir )
+
+      ####  NAMELIST DEFAULTS FILE MODIFICATIONS ##############################################
+      datm_dir = data_dir+"/CLM1PT_data"
+      if ( os.path.isdir(datm_dir) ):
+         self.write_datm_namelistdefaults_file( datm_dir )
+
+      ####  SET NAMELIST OPTIONS ##############################################################
+      self.write_user_nl_clm( usernlclm, self.surffile, self.landuse_timeseries_file )
+      if plev>1: print( open( usernlclm, "r" ).read(), end="" )
+
+      ####  ENSEMBLE MEMBER FILES ###########################################################
+      ensemble_dirs = {}
+      if ( self.ensemble != None ):
+         ensemble_dirs = self.write_ensemble_files( filex )
+
+      ###### END SET Spinup and ENV_RUN.XML VALUES ############################################
+
+      if plev>0: print( "Data created successfully in "+data_dir+"\n" )
+
+      result = PTCLMmkdata_result()
+      result.site                    = mysite
+      result.data_dir                = data_dir
+      result.domainfile              = data_dir+"/"+self.domainfile
+      result.surffile                = self.surffile
+      result.logfile                 = self.logfile
+      result.landuse_timeseries_file = self.landuse_timeseries_file
+      result.shell_commands          = filex
+      result.user_nl_clm             = usernlclm
+      if ( trace != None ): result.tracefile = trace.tracefile
+      result.ensemble_dirs           = ensemble_dirs
+      result.walltime                = time.time() - start
+      self.write_status( data_dir, "PASS", "%.1f seconds" % result.walltime )
+      return( result )
+
+   def write_user_nl_clm( self, usernlclm, surffile, landuse_timeseries_file ):
+        "Add the namelist options for the datasets created to the user_nl_clm file"
+        output = open(usernlclm,'a')
+        output.write(   " fsurdat = '"+surffile+"'\n" )
+        if (self.sim_year_range != "constant"):
+           output.write(   " flanduse_timeseries = "+landuse_timeseries_file+"\n" )
+        output.write(   " hist_nhtfrq = "+str(self.hist_nhtfrq)+"\n" )
+        output.write(   " hist_mfilt  = "+str(self.hist_mfilt)+"\n" )
+        output.close()
+
+   def write_ensemble_files( self, filex ):
+        "Write the case files for each ensemble member in it's directory, returns the directories keyed by member"
+        ensemble_dirs = {}
+        surffiles     = {}
+        for member in self.ensemble.Members( self ):
+           name      = member["member"]
+           member_dir = self.data_dir+"/"+name
+           # The member directory is a user-mods directory, with the same shell_commands as the site
+           shutil.copy( filex, member_dir+"/shell_commands" )
+           usernlclm = member_dir+"/user_nl_clm"
+           output = open( usernlclm,'w')
+           output.write("! user_nl_clm namelist options written by PTCLMmkdata for ensemble member "+name+":\n")
+           output.write("! "+self.cmdline+"\n")
+           output.close()
+           ( surffile, logfile, landuse_timeseries_file ) = self.ensemble_files[name]
+           self.write_user_nl_clm( usernlclm, surffile, landuse_timeseries_file )
+           ensemble_dirs[name] = member_dir
+           surffiles[name]     = surffile
+        self.ensemble.Write( self, self.data_dir+"/PTCLMmkdata_ensemble.csv", surffiles )
+        if self.plev>0: print( "Wrote case files for "+str(len(ensemble_dirs))+" ensemble members in "+self.data_dir )
+        return( ensemble_dirs )
+
+   ### STAGES TO CREATE THE DATASETS ####################################################
+
+   def stage_noocean( self ):
+        "make map grid file and atm to ocean map"
+        clmres       = self.clmres
+        builtin      = self.use_builtin( "mknoocnmap.pl", self.options.use_mknoocnmap )
+        stage_inputs = { "lat":self.lat, "lon":self.lon, "res":clmres, "builtin":builtin }
+        if ( builtin ):
+           stage_files = [ self.ptclm_dir+"/pointgrids.py" ]
+        else:
+           stage_files = [ self.mkmapdat_dir+"/mknoocnmap.pl" ]
+        if ( self.manifest.UpToDate( self, "noocean", stage_inputs, stage_files ) ):
+           stage_outputs      = self.manifest.Outputs( self, "noocean" )
+           self.mapfile       = stage_outputs["mapfile"]
+           self.scripgridfile = stage_outputs["scripgridfile"]
+           if self.plev>0: print( "Map and SCRIP grid files for the point are up to date: "+self.mapfile+" "+self.scripgridfile )
+           return( [ self.mapfile, self.scripgridfile ] )
+        if self.plev>0: print( "Creating map file for a point with no ocean" )
+        print( "lat="+str(self.lat) )
+        if ( builtin ):
+           # The grid and map for a single point are written directly (without starting NCL)
+           from pointgrids import pointgrids
+           grids = pointgrids()
+           grids.Initialize( self )
+           point = { "res":clmres, "lat":self.lat, "lon":self.lon, "dir":self.data_dir }
+           files = grids.WriteNoOcean( self, [ point ], self.options.sdate )[0]
+           self.mapfile       = files["mapfile"]
+           self.scripgridfile = files["scripgridfile"]
+           print( "mapfile = "+self.mapfile )
+           print( "scripgridfile = "+self.scripgridfile )
+        else:
+           ptstr = str(self.lat)+","+str(self.lon)
+           if ( shutil.which( "ncl" ) == None ): self.error( "ncl is NOT in path" )  # check for ncl
+           self.system(self.mkmapdat_dir+"/mknoocnmap.pl -p "+ptstr+" -name "+clmres+" > "+self.data_dir+"/mknoocnmap.log")
+           self.mapfile = self.find_filename_created( self.data_dir+"/map_"+clmres+"_noocean_to_"+clmres+"_"+"nomask_aave_da_*.nc", "mapfile" )
+           if self.plev>0: print( "mapfile = ", self.mapfile )
+           self.scripgridfile  = self.find_filename_created( self.data_dir+"/SCRIPgrid_"+clmres+"_nomask_c*.nc", "scripgridfile" )
+           if self.plev>0: print( "scripgridfile = ", self.scripgridfile )
+        self.manifest.Record( self, "noocean", stage_inputs, stage_files, \
+                              { "mapfile":self.mapfile, "scripgridfile":self.scripgridfile } )
+        return( [ self.mapfile, self.scripgridfile ] )
+
+   def stage_domain( self ):
+        "make domain file needed by datm"
+        clmres       = self.clmres
+        builtin      = self.use_builtin( "gen_domain", self.options.use_gen_domain )
+        stage_inputs = { "res":clmres, "mask":self.clmmask, "builtin":builtin }
+        if ( builtin ):
+           stage_files = [ self.ptclm_dir+"/pointgrids.py", self.mapfile ]
+        else:
+           stage_files = [ self.gen_dom_dir+"/gen_domain", self.mapfile ]
+        if ( self.manifest.UpToDate( self, "domain", stage_inputs, stage_files ) ):
+           self.domainfile = os.path.basename( self.manifest.Outputs( self, "domain" )["domainfile"] )
+           if self.plev>0: print( "Data domain is up to date: "+self.domainfile )
+           return( [ self.data_dir+"/"+self.domainfile ] )
+        if self.plev>0: print( "Creating data domain" )
+        # In debug mode the map is empty if mknoocnmap.pl didn't run, so there is nothing to write it from
+        if ( builtin and os.path.getsize( self.mapfile ) > 0 ):
+           # The domain files for a point are written directly (without running gen_domain)
+           from pointgrids import pointgrids
+           grids = pointgrids()
+           grids.Initialize( self )
+           files = grids.WriteDomains( self, self.mapfile, self.clmmask, clmres, self.data_dir, self.options.sdate, \
+                                       comment="Written by PTCLMmkdata" )
+           domainfile = files["lnd"]
+           print( "domainfile = "+domainfile )
+        else:
+           if ( not os.path.exists( self.gen_dom_dir ) ):
+              self.error( "generate domain directory does NOT exist: "+self.gen_dom_dir )
+           cmd = self.gen_dom_dir+"/gen_domain -m "+self.mapfile+" -o "+self.clmmask+" -l "+clmres+" -c 'Running gen_domain from PTCLMmkdata' > "+self.data_dir+"/gen_domain.log"
+           self.system(cmd);
+           domainfile = self.find_filename_created( self.data_dir+"/domain.lnd."+clmres+"_"+self.clmmask+".*.nc", "domainfile" )
+        self.domainfile = os.path.basename( domainfile )
+        self.manifest.Record( self, "domain", stage_inputs, stage_files, { "domainfile":domainfile } )
+        return( [ domainfile ] )
+
+   def stage_mapping( self ):
+        "make mapping files needed for mksurfdata_map"
+        options      = self.options
+        clmres       = self.clmres
+        mapdir       = self.mapdir
+        # mkmapdata.sh is run if the raw grid files can NOT be found
+        builtin      = self.use_builtin( "mkmapdata.sh", options.use_mkmapdata )
+        gridfiles    = self.mapping_gridfiles()
+        builtin      = ( builtin and gridfiles != None )
+        stage_inputs = { "res":clmres, "builtin":builtin }
+        if ( builtin ):
+           stage_files = [ self.ptclm_dir+"/pointmap.py", self.scripgridfile ]
+        else:
+           stage_files = [ self.mkmapdat_dir+"/mkmapdata.sh", self.scripgridfile ]
+        if ( options.map_gdate != options.sdate ):
+           mksrfmapfile  = self.find_filename_created( mapdir+"/map_*"+"_c"+options.map_gdate+".nc", "mksrfmapfile" )
+           if ( not os.path.exists( mksrfmapfile ) ): self.error( "mapping files with gdate of "+ \
+                options.map_gdate+" do NOT exist, bad value for --map_gdate option"     )
+           return( [] )
+        if ( self.manifest.UpToDate( self, "mapping", stage_inputs, stage_files ) ):
+           # Use the date of the existing mapping files
+           self.map_gdate = self.manifest.Outputs( self, "mapping" )["gdate"]
+           if self.plev>0: print( "\n\nMapping files for surface dataset are up to date with date: "+self.map_gdate )
+           return( self.manifest.Outputs( self, "mapping" )["mapfiles"] )
+        # Mapping files only depend on the point and the raw grids mapped from, so reuse them from the
+        # cache if they are there (the cache is only used when the raw grids are known)
+        mapfiles = []
+        use_map_cache = ( options.use_map_cache and not options.debug and gridfiles != None )
+        if ( use_map_cache ):
+           from mapcache import mapcache
+           map_cache_dir = options.map_cache_dir
+           if ( map_cache_dir == " " ): map_cache_dir = self.mydata_dir+"/map_cache"
+           mcache = mapcache()
+           mcache.Initialize( self, map_cache_dir, maxsize=options.map_cache_size )
+           mapkey   = mcache.Key( self, self.lat, self.lon, list( gridfiles.values() ) )
+           mapfiles = mcache.Restore( self, mapkey, mapdir, clmres, options.sdate )
+        if ( len(mapfiles) > 0 ):
+           if self.plev>0: print( "\n\nReuse "+str(len(mapfiles))+" mapping files for surface dataset from cache: "+map_cache_dir )
+        elif ( builtin and not options.debug ):
+           # The mapping files to the point are written directly (without running ESMF)
+           if self.plev>0: print( "\n\nCreate mapping files for surface dataset from "+str(len(gridfiles))+" raw grids:" )
+           from pointmap import pointmap
+           pmap = pointmap()
+           pmap.Initialize( self )
+           for mapfile in pmap.WriteMaps( self, gridfiles, self.scripgridfile, clmres, mapdir, options.sdate ):
+              if self.plev>0: print( "mapfile = "+mapfile )
+           if ( use_map_cache ):
+              mcache.Store( self, mapkey, mapdir, clmres, options.sdate )
+        else:
+           # mkmapdata.sh remembers where it is (although it starts over for a new date)
+           if self.plev>0: print( "\n\nRe-create mapping files for surface dataset:" )
+           cmd = self.mkmapdat_dir+"/mkmapdata.sh --gridfile "+self.scripgridfile+" --res "+clmres+" --gridtype regional -v > "+mapdir+"/mkmapdata.log";
+           self.system(cmd);
+           if ( use_map_cache ):
+              mcache.Store( self, mapkey, mapdir, clmres, options.sdate )
+        if ( not options.debug ):
+           mapfiles = glob.glob( mapdir+"/map_*_to_"+clmres+"_nomask_aave_da_c"+self.map_gdate+".nc" )
+           self.manifest.Record( self, "mapping", stage_inputs, stage_files, { "mapfiles":sorted(mapfiles) }, { "gdate":self.map_gdate } )
+        return( mapfiles )
+
+   # --- use site-level data for mksurfdata_map when available ----
+   def stage_sitepft( self ):
+        "PFT information for the site"
+        site = self.site
+        self.pft_frac = None
+        self.pft_code = None
+        if (self.options.pftgrid == True):
+           self.pftopts=""
+           return( [] )
+        if self.plev>0: print( "Replacing PFT information in surface data file" )
+        pft_frac=[0,0,0,0,0]
+        pft_code=[0,0,0,0,0]
+        if ( site["pft"] == None ):
+           self.error( "Did NOT find input sitename:"+self.mysite+" in pftdata:"+self.pftdata+ \
+                       " run with pftgrid instead")
+        if self.plev>1: print( " site = %9s" % self.mysite )
+        pftfile = self.data_dir+"/tempsitePFT.txt"
+        if ( not self.manifest.UpToDate( self, "sitepft", { "pft":site["pft"] } ) ):
+           output=open(pftfile,"w")
+           output.write(' '.join(site["pft"]))
+           output.close()
+           self.manifest.Record( self, "sitepft", { "pft":site["pft"] }, outputs={ "pftfile":pftfile } )
+        for thispft in range(0,5):
+            pft_frac[thispft]=float(site["pft"][2*thispft])
+            pft_code[thispft]=int(site["pft"][1+2*thispft])
+        # Find index of first zero
+        for i in range(0,len(pft_frac)):
+           if ( pft_frac[i] == 0.0 ):
+              nzero = i
+              break
+        self.pft_frac = pft_frac[0:nzero]
+        self.pft_code = pft_code[0:nzero]
+        self.pftopts=" -pft_frc \""+str(pft_frac[0:nzero])+'"' \
+                        " -pft_idx \""+str(pft_code[0:nzero]) +'"' + self.mkcrop
+        return( [ pftfile ] )
+
+   def stage_sitesoil( self ):
+        "Read in the soil conditions for the site"
+        site = self.site
+        self.sandpct = None
+        self.claypct = None
+        if (self.options.soilgrid == True):
+           self.soilopts=""
+           return( [] )
+        #soil information
+        if self.plev>0: print( "Replacing soil information in surface data file" )
+        if ( site["soil"] == None ):
+           self.error( "Did NOT find input sitename:"+self.mysite+" in soildata:"+self.soildata+ \
+                       " run with soilgrid instead")
+        if self.plev>1: print( " site = %9s" % self.mysite )
+        soilfile = self.data_dir+"/tempsitesoil.txt"
+        if ( not self.manifest.UpToDate( self, "sitesoil", { "soil":site["soil"] } ) ):
+           output=open(soilfile,"w")
+           output.write(' '.join(site["soil"]))
+           output.close()
+           self.manifest.Record( self, "sitesoil", { "soil":site["soil"] }, outputs={ "soilfile":soilfile } )
+        # The first three items are NOT used
+        soil_depth = float(site["soil"][0])  # This is ignored
+        n_layers   = int(site["soil"][1])    # This is ignored
+        layer_depth = float(site["soil"][2]) # This is ignored
+        sandpct     = float(site["soil"][3])
+        claypct     = float(site["soil"][4])
+        if self.plev>0: print( " sandpct="+str(sandpct)+" claypct="+str(claypct) )
+        self.sandpct = sandpct
+        self.claypct = claypct
+        self.soilopts=" -soil_cly "+str(claypct)+" -soil_snd "+str(sandpct)
+        return( [ soilfile ] )
+
+   def stage_landuse( self ):
+        "create dynamic pft input file"
+        self.landuse_timeseries_outfile = None
+        if (self.options.pftgrid == True) or (self.sim_year_range == "constant"):
+           self.dynpftopts = ""
+           return( [] )
+        if self.plev>0: print( "Creating site-specific dynamics PFTs and harvesting" )
+
+        landuse_timeseries_site_filename = self.site["dynpftfile"]
+
+        # only set dynpft file if the file exists
+        if ( landuse_timeseries_site_filename == None ):
+           self.error( "Transition PFT file does NOT exist for this site, create one, use --pftgrid, or choose a non transient use-case" )
+        if self.plev>0: print( "Transition PFT file exists, so using it for changes in PFT" )
+        # Convert the file from transition years format to mksurfdata_map landuse_timeseries_ format
+        cnvrt        = "cnvrt_trnsyrs2_landuse_timeseries_txtfile.pl"
+        builtin      = self.use_builtin( cnvrt, self.options.use_cnvrt_trnsyrs, module="numpy" )
+        outfile      = self.data_dir+"/landuse_timeseries_"+self.mysite+".txt"
+        stage_inputs = { "sim_year_range":self.sim_year_range, "builtin":builtin }
+        if ( builtin ):
+           stage_files = [ self.ptclm_dir+"/landusetimeseries.py", landuse_timeseries_site_filename ]
+        else:
+           stage_files = [ self.siteDir+"/"+cnvrt, landuse_timeseries_site_filename ]
+        if ( self.manifest.UpToDate( self, "landuse", stage_inputs, stage_files ) ):
+           if self.plev>0: print( "Landuse timeseries text file is up to date: "+outfile )
+        else:
+           if ( builtin ):
+              from landusetimeseries import landusetimeseries
+              lu = landusetimeseries()
+              lu.Initialize( self )
+              lu.Write( self, { self.mysite:landuse_timeseries_site_filename }, { self.mysite:outfile }, self.sim_year_range )
+           else:
+              self.system( self.siteDir+"/"+cnvrt+" "+landuse_timeseries_site_filename+" "+self.sim_year_range+" > "+outfile )
+           self.manifest.Record( self, "landuse", stage_inputs, stage_files, { "outfile":outfile } )
+        self.landuse_timeseries_outfile = outfile
+        self.dynpftopts = " -dynpft "+outfile
+        return( [ outfile ] )
+
+   def stage_mksurfdata( self ):
+        "Now run mksurfdata_map"
+        if ( self.overlay != None ):
+           if self.plev>0: print( "\n\nOverlay site values on surface dataset:\t"+self.overlay )
+           ( self.surffile, self.logfile, self.landuse_timeseries_file ) = \
+                self.overlay_surfdata( "mksurfdata", self.data_dir, self.site_settings() )
+        else:
+           if self.plev>0: print( "\n\nRe-create surface dataset:\t" )
+           ( self.surffile, self.logfile, self.landuse_timeseries_file ) = \
+                self.mksurfdata( "mksurfdata", self.data_dir, self.soilopts+self.pftopts )
+        return( [ self.surffile, self.logfile, self.landuse_timeseries_file ] )
+
+   def stage_ensemble( self ):
+        "Run mksurfdata_map for each ensemble member in it's own directory (options.jobs at a time)"
+        import concurrent.futures
+        members = self.ensemble.Members( self )
+        if self.plev>0: print( "\n\nCreate surface datasets for "+str(len(members))+" ensemble members:\t" )
+        self.ensemble_files = {}
+        # The commands the members run are added to this stage in the trace
+        trace = self.stages.trace
+        stage = None
+        if ( trace != None ): stage = trace.Running()
+        def run_member( func, *args ):
+           if ( stage != None ): trace.Join( self, stage )
+           return( func( *args ) )
+        with concurrent.futures.ThreadPoolExecutor( max_workers=self.options.jobs ) as pool:
+           futures = {}
+           for member in members:
+              member_dir = self.data_dir+"/"+member["member"]
+              if ( not os.path.exists( member_dir ) ): os.makedirs( member_dir )
+              if ( self.overlay != None ):
+                 settings = self.ensemble.Settings( self, member, self.site_settings() )
+                 futures[pool.submit( run_member, self.overlay_surfdata, "ensemble:"+member["member"], member_dir, settings )] = member["member"]
+              else:
+                 siteopts = self.ensemble.Options( self, member, self.soilopts, self.pftopts )
+                 futures[pool.submit( run_member, self.mksurfdata, "ensemble:"+member["member"], member_dir, siteopts )] = member["member"]
+           for future in concurrent.futures.as_completed( futures ):
+              self.ensemble_files[futures[future]] = future.result()
+        outputs = []
+        for name in sorted( self.ensemble_files ):
+           outputs = outputs + list( self.ensemble_files[name] )
+        return( outputs )
+
+   def site_settings( self ):
+        "Return the site PFT and soil settings (None for the ones that come from the gridded data)"
+        return( { "pft_frc":self.pft_frac, "pft_idx":self.pft_code, "soil_snd":self.sandpct, "soil_cly":self.claypct } )
+
+   def overlay_surfdata( self, stage, out_dir, settings ):
+        "Overlay the settings on the surface dataset given, returns the surface, log and (no) landuse timeseries files"
+        stage_inputs = { "settings":settings }
+        stage_files  = [ self.ptclm_dir+"/surfoverlay.py", self.overlay ]
+        if ( self.manifest.UpToDate( self, stage, stage_inputs, stage_files ) ):
+           stage_outputs = self.manifest.Outputs( self, stage )
+           if self.plev>0: print( "Surface dataset is up to date: "+stage_outputs["surffile"] )
+           return( stage_outputs["surffile"], stage_outputs["logfile"], None )
+        from surfoverlay import surfoverlay
+        overlay  = surfoverlay()
+        overlay.Initialize( self )
+        surffile = out_dir+"/"+overlay.Filename( self.clmres, self.sim_year, self.options.sdate )
+        overlay.Write( self, self.overlay, surffile, pft_frc=settings["pft_frc"], pft_idx=settings["pft_idx"], \
+                       soil_snd=settings["soil_snd"], soil_cly=settings["soil_cly"] )
+        print( "surface file = "+surffile )
+        logfile  = surffile[:-3]+".log"
+        output   = open( logfile, "w" )
+        output.write( "Site values overlaid by PTCLMmkdata on: "+self.overlay+"\n" )
+        for name in sorted( settings ):
+           output.write( " "+name+" = "+str(settings[name])+"\n" )
+        output.close()
+        self.manifest.Record( self, stage, stage_inputs, stage_files, { "surffile":surffile, "logfile":logfile } )
+        return( surffile, logfile, None )
+
+   def mksurfdata( self, stage, out_dir, siteopts ):
+        "Run mksurfdata_map in out_dir with the given site options, returns the surface, log and landuse timeseries files"
+        clmres   = self.clmres
+        sim_year = self.sim_year
+        mksurfopts = "-res usrspec -usr_gname "+clmres+" -usr_gdate "+self.map_gdate+ \
+                     " -usr_mapdir "+self.mapdir+" -dinlc "+self.cesm_input+" -y "+self.mksrfyears+ \
+                     siteopts+self.dynpftopts+" "+self.options.mksurfdata_opts
+        stage_inputs = { "opts":mksurfopts }
+        stage_files  = [ self.clm_tools+"/mksurfdata_map/mksurfdata.pl" ] + \
+                       sorted( glob.glob( self.mapdir+"/map_*_to_"+clmres+"_nomask_aave_da_c"+self.map_gdate+".nc" ) )
+        if ( self.dynpftopts != "" ): stage_files.append( self.landuse_timeseries_outfile )
+        if ( self.manifest.UpToDate( self, stage, stage_inputs, stage_files ) ):
+           stage_outputs = self.manifest.Outputs( self, stage )
+           if self.plev>0: print( "Surface dataset is up to date: "+stage_outputs["surffile"] )
+           return( stage_outputs["surffile"], stage_outputs["logfile"], stage_outputs["landuse_timeseries_file"] )
+        self.system(self.clm_tools+"/mksurfdata_map/mksurfdata.pl "+mksurfopts+" > "+out_dir+"/mksurfdata_map.log", cwd=out_dir)
+
+        surffile = self.find_filename_created( out_dir+"/surfdata_"+clmres+"*_simyr"+sim_year+"_*.nc",  "surface file"     )
+        logfile  = self.find_filename_created( out_dir+"/surfdata_"+clmres+"*_simyr"+sim_year+"_*.log", "surface log file" )
+        landuse_timeseries_file = None
+        if ( self.sim_year_range != "constant" ):
+           landuse_timeseries_file = self.find_filename_created( out_dir+"/landuse.timeseries_"+clmres+"_"+ \
+                                     self.landuse_timeseries_type+"*_simyr"+self.actual_sim_year_range+"_*.nc", \
+                                     "landuse_timeseries_file" )
+        self.manifest.Record( self, stage, stage_inputs, stage_files, \
+                              { "surffile":surffile, "logfile":logfile, \
+                                "landuse_timeseries_file":landuse_timeseries_file } )
+        return( surffile, logfile, landuse_timeseries_file )
+
+def make_site_data( site, **opts ):
+   "Create the datasets for a site, returning a PTCLMmkdata_result (raises PTCLMmkdataError on failure)"
+   prog = PTCLMmkdata_prog()
+   prog.set_options( site, **opts )
+   return( prog.Run() )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile
+
+class test_PTCLMmkdata_prog(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = PTCLMmkdata_prog()
+       self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(PTCLMmkdataError, self.prog.Run )
+       self.assertRaises(PTCLMmkdataError, self.prog.get_SiteList )
+       self.assertRaises(PTCLMmkdataError, self.prog.set_options, "US-UMB", zztop=True )
+       self.assertRaises(PTCLMmkdataError, self.prog.set_options, "US-UMB", quiet=True, verbose=True )
+       self.assertRaises(PTCLMmkdataError, make_site_data, "none" )
+
+   def test_parse( self ):
+       "test parsing the command line"
+       self.prog.parse_cmdline_args( [ "PTCLMmkdata", "-s", "US-UMB", "-d", self.tmpdir, "--crop", "--quiet" ] )
+       self.assertEqual( self.prog.options.mysite,     "US-UMB" )
+       self.assertEqual( self.prog.options.cesm_input, self.tmpdir )
+       self.assertTrue(  self.prog.options.crop )
+       self.assertEqual( self.prog.plev, 0 )
+       self.assertEqual( self.prog.options.stages, "all" )
+       self.assertEqual( self.prog.site_list_args( [ "-s", "US-UMB", "--jobs=4", "-d", self.tmpdir, "-sUS-Ha1", "--crop" ] ), \
+                         [ "-d", self.tmpdir, "--crop" ] )
+
+   def test_sitelist( self ):
+       "test getting the list of sites"
+       self.prog.set_options( "US-UMB,US-Ha1", mydatadir=self.tmpdir, quiet=True )
+       self.assertEqual( self.prog.get_SiteList(), [ "US-UMB", "US-Ha1" ] )
+       self.prog.set_options( "all", mydatadir=self.tmpdir, quiet=True )
+       self.assertGreater( len(self.prog.get_SiteList()), 2 )
+       # The catalog is shared by objects in the same process
+       prog = PTCLMmkdata_prog()
+       prog.set_options( "US-UMB", mydatadir=self.tmpdir, quiet=True )
+       self.assertTrue( prog.get_catalog() is self.prog.get_catalog() )
+       prog.set_options( "US-UMB,zztop", mydatadir=self.tmpdir, quiet=True )
+       self.assertRaises(PTCLMmkdataError, prog.get_SiteList )
+       self.assertRaises(PTCLMmkdataError, prog.Run )
+       prog.set_options( "US-UMB,US-Ha1,US-UMB", mydatadir=self.tmpdir, quiet=True )
+       self.assertRaises(PTCLMmkdataError, prog.get_SiteList )
+
+   def test_threads( self ):
+       "test that sites run in threads can use the catalog made in another thread"
+       import concurrent.futures
+       self.prog.set_options( "US-UMB", mydatadir=self.tmpdir, quiet=True )
+       catalog = self.prog.get_catalog()
+       def sitelist( site ):
+          prog = PTCLMmkdata_prog()
+          prog.set_options( site+",US-UMB", mydatadir=self.tmpdir, quiet=True )
+          return( ( prog.get_catalog() is catalog, prog.get_SiteList() ) )
+       sites = [ "US-Ha1", "US-Blo", "BR-Sa1", "CA-Let" ]
+       with concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as pool:
+          results = list( pool.map( sitelist, sites ) )
+       self.assertEqual( results, [ ( True, [ site, "US-UMB" ] ) for site in sites ] )
+
+   def test_status( self ):
+       "test the status file for a site"
+       self.assertEqual( self.prog.read_status( self.tmpdir ), None )
+       self.prog.write_status( self.tmpdir, "RUNNING" )
+       self.assertEqual( self.prog.read_status( self.tmpdir ), "RUNNING" )
+       self.prog.write_status( self.tmpdir, "FAIL", "exit status = -6" )
+       self.assertEqual( self.prog.read_status( self.tmpdir ), "FAIL" )
+       self.assertEqual( self.prog.read_status_description( self.tmpdir ), "exit status = -6" )
+       # A site that fails after it's directory is setup is marked as failed
+       for tooldir in [ "tools/mkmapgrids", "tools/mkmapdata", "tools/mapping/gen_domain_files" ]:
+          os.makedirs( self.tmpdir+"/"+tooldir )
+       self.assertRaises(PTCLMmkdataError, make_site_data, "US-UMB", cesm_input=self.tmpdir, \
+                         base_ctsm=self.tmpdir, base_cime=self.tmpdir, mydatadir=self.tmpdir, clmnmlusecase="zztop", quiet=True )
+       self.assertEqual( self.prog.read_status( self.tmpdir+"/1x1pt_US-UMB" ), "FAIL" )
+
+   def test_badsite( self ):
+       "test errors for bad sites or input data"
+       self.assertRaises(PTCLMmkdataError, make_site_data, "zztop", mydatadir=self.tmpdir, quiet=True )
+       self.assertRaises(PTCLMmkdataError, make_site_data, "US-UMB", mydatadir=self.tmpdir, quiet=True )
+       self.assertRaises(PTCLMmkdataError, make_site_data, "US-UMB", cesm_input=self.tmpdir, \
+                         base_ctsm=self.tmpdir, mydatadir=self.tmpdir, quiet=True )
+
+if __name__ == '__main__':
+     unittest.main()
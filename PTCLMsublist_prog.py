@@ -8,6 +8,8 @@
 #########################################################################################
 import os, sys
 from batchque import batchque
+from jobmonitor import jobmonitor
+from ptclmversion import ptclmversion
 
 class PTCLMsublist_prog:
 #----------------------------------------------------------------------------------------
@@ -26,7 +28,28 @@ class PTCLMsublist_prog:
    wall         = "02:00:00"
    parse_args   = False
    ptclm_opts   = ""
+   array        = True
+   sites_per_job = 1
+   node_memory  = 100.0     # Memory on a node to pack sites into (GB)
+   site_runtime = 1800.0    # Expected runtime of a site that hasn't been run before (seconds)
+   site_memory  = 8.0       # Expected memory of a site that hasn't been run before (GB)
+   mydatadir    = "mydatafiles"
+   local_cpus   = os.cpu_count()
+   wait         = False
+   wait_interval = 60.0     # Seconds between checks of the batch queue for jobs that completed
+   retries      = 0         # Number of times failed sites are resubmitted
+   retry        = 0         # Number of times failed sites have been resubmitted so far
+   rerun_complete = False
+   split_stages = False
+   # Jobs the stages of a site are split into with --split_stages, each waits for the job before it to complete
+   # successfully. Only the mapping stage needs the memory of a whole node, the other stages are small and go to
+   # a shared queue (a wall of None uses the --wall option)
+   stage_jobs   = [ { "name":"prep",     "stages":"domain,sitepft,sitesoil,landuse", "profile":"shared", "wall":"00:30:00" }, \
+                    { "name":"mapping",  "stages":"mapping",                         "profile":"bigmem", "wall":None       }, \
+                    { "name":"surfdata", "stages":"all",                             "profile":"shared", "wall":"01:00:00" } ]
+   ptclm_cmd    = "./PTCLMmkdata"
    que          = batchque()
+   monitor      = jobmonitor()
    setup        = False
 
    # --  Error function ---------------------------------
@@ -56,19 +79,34 @@ class PTCLMsublist_prog:
       options.add_option("--wall", dest="wall", default=self.wall, \
                         help="Wall clock time to submit in queue for")
       options.add_option("--mach", dest="mach", default=self.mach, \
-                        help="Machine name to use for batch submital")
+                        help="Machine name to use for batch submital (local to run the jobs on this machine)")
+      options.add_option("--local_cpus", dest="local_cpus", type="int", default=self.local_cpus, \
+                        help="Number of processors to run jobs on for the local machine (default: "+str(self.local_cpus)+")")
+      options.add_option("--no_array", dest="array", action="store_false", default=self.array, \
+                        help="Submit a seperate batch job for each site rather than one array job for the list")
+      options.add_option("--sites_per_job", dest="sites_per_job", type="int", default=self.sites_per_job, \
+                        help="Number of sites to pack into each batch job and run at the same time"+\
+                             " (sites are packed by their runtime and memory from earlier runs)")
+      options.add_option("--node_memory", dest="node_memory", type="float", default=self.node_memory, \
+                        help="Memory (GB) available to the sites packed into a batch job")
+      options.add_option("--wait", dest="wait", action="store_true", default=self.wait, \
+                        help="Wait for the jobs to complete, showing the exit status of each as it completes"+\
+                             " (always done for the local machine)")
+      options.add_option("--wait_interval", dest="wait_interval", type="float", default=self.wait_interval, \
+                        help="Seconds between checks of the batch queue for jobs that completed (with --wait)")
+      options.add_option("--retries", dest="retries", type="int", default=self.retries, \
+                        help="Number of times to resubmit sites that fail (implies --wait), a resubmitted site"+\
+                             " starts from the stage that failed")
+      options.add_option("--rerun_complete", dest="rerun_complete", action="store_true", default=self.rerun_complete, \
+                        help="Submit sites that already completed with their output files in place"+\
+                             " (by default they are skipped)")
+      options.add_option("--split_stages", dest="split_stages", action="store_true", default=self.split_stages, \
+                        help="Submit the stages of each site as a chain of jobs, each waiting for the one before it:"+\
+                             " the mapping stage on a big-memory node and the other stages in a shared queue"+\
+                             " (each site gets it's own chain, array jobs are NOT used)")
       parser.add_option_group(options)
-      stdout    = os.popen("pwd")
-      cwd       = os.path.abspath( stdout.read().rstrip( ) )
-      tagvers = ""
-      clog = open( cwd+"/ChangeLog", "r" );
-      for line in clog:
-         if ( line.find("Tag: ",0) == 0 ): 
-            n = line.count("")
-            tagvers = line[5:n-2]
-            break
-
-      clog.close
+      cwd       = os.getcwd()
+      tagvers   = ptclmversion().Get( self, cwd+"/ChangeLog" )
       versiongroup    = OptionGroup( parser, tagvers )
       parser.add_option_group(versiongroup)
       (options, args) = parser.parse_args()
@@ -81,14 +119,41 @@ class PTCLMsublist_prog:
       self.options      = options.options
       self.ctsmdir      = options.ctsm_root
       self.inputdir     = options.inputdir
+      self.array        = options.array
+      self.local_cpus   = options.local_cpus
+      self.sites_per_job = options.sites_per_job
+      self.node_memory  = options.node_memory
+      self.wait         = options.wait
+      self.wait_interval = options.wait_interval
+      self.retries      = options.retries
+      self.rerun_complete = options.rerun_complete
+      self.split_stages = options.split_stages
       # Initialize batch que object, will abort if bad machine
-      self.que.Initialize( self, mach=self.mach, account=self.account )
+      self.que.Initialize( self, mach=self.mach, account=self.account, maxcpus=self.local_cpus )
       # Error checking
       if ( not os.path.isdir(self.ctsmdir) ):
          self.error( "CTSM_root directory does NOT exist: "+self.ctsmdir )
       if ( not os.path.isdir(self.inputdir) ):
          self.error( "CESM inputdata directory does NOT exist: "+self.inputdir )
 
+      if ( self.sites_per_job < 1 ):
+         self.error( "sites_per_job must be one or greater" )
+      if ( self.node_memory <= 0.0 ):
+         self.error( "node_memory must be greater than zero" )
+      if ( self.wait_interval <= 0.0 ):
+         self.error( "wait_interval must be greater than zero" )
+      if ( self.retries < 0 ):
+         self.error( "retries can NOT be negative" )
+      if ( self.split_stages and self.sites_per_job > 1 ):
+         self.error( "split_stages can NOT be used with sites_per_job greater than one" )
+      # Failed sites can only be found by waiting for the jobs
+      if ( self.retries > 0 ):
+         self.wait = True
+      # PTCLMmkdata puts the sites in mydatadir (where the traces of earlier runs are)
+      mydatadir = self.PTCLMOption( "--mydatadir" )
+      if ( mydatadir != None ):
+         self.mydatadir = mydatadir
+
       # Get site list from csv formatted string list
       if ( self.sitelistcsv.find( " " ) != -1 ):
          self.error( "Site list has white space in it, just use comma's to seperate sites: "+self.sitelistcsv )
@@ -99,6 +164,18 @@ class PTCLMsublist_prog:
       # Flag that parsing was accomplished
       self.parse_args   = True
 
+   def PTCLMOption( self, name ):
+      "Return the value of an option with a value in the PTCLM options (given as --name value or --name=value), None if NOT given"
+      import shlex
+      value = None
+      opts  = shlex.split( self.options )
+      for i, opt in enumerate( opts ):
+         if ( opt == name and i+1 < len(opts) ):
+            value = opts[i+1]
+         elif ( opt.startswith( name+"=" ) ):
+            value = opt[len(name)+1:]
+      return( value )
+
    def ctsm_root( self ):
       "Return the CTSM_ROOT directory"
       if ( not self.parse_args ):
@@ -116,24 +193,266 @@ class PTCLMsublist_prog:
       if ( not self.parse_args ):
          self.error( "parse_cmdline_args was NOT run first" )
 
-      self.que.Initialize( self, self.mach, self.account )
+      self.que.Initialize( self, self.mach, self.account, maxcpus=self.local_cpus )
+      self.monitor = jobmonitor()
+      self.monitor.Initialize( self, self.que, interval=self.wait_interval )
       self.setup = True
 
 
+   def JobName( self, name ):
+      "Return the name of a batch job, jobs that resubmit failed sites get the retry number added"
+      if ( self.retry > 0 ):
+         return( name+"_retry"+str(self.retry) )
+      return( name )
+
    def Submit( self, site, submit=True ):
       "Submit the PTCLMmkdata job to the batch queue"
       if ( not self.setup ):
          self.error( "Initialize was NOT run first" )
 
-      jobcommand = "./PTCLMmkdata --ctsm_root "+self.ctsmdir+" -s "+site+" -d "+self.inputdir+" "+self.options
+      jobcommand = self.ptclm_cmd+" --ctsm_root "+self.ctsmdir+" -s "+site+" -d "+self.inputdir+" "+self.options
       print( jobcommand );
-      bsub = self.que.Submit( self, jobcommand, jobname="PTCLM_"+site, submit=submit, wall=self.wall )
+      bsub = self.que.Submit( self, jobcommand, jobname=self.JobName("PTCLM_"+site), submit=submit, wall=self.wall )
+      if ( submit ): self.monitor.AddSubmitted( self, names=[ site ] )
       return( bsub )
 
+   def SubmitList( self, sitelist, submit=True ):
+      "Submit PTCLMmkdata for a list of sites to the batch queue as one array job"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+
+      if ( len(sitelist) == 1 ):
+         return( self.Submit( sitelist[0], submit=submit ) )
+      # Each task of the array gets it's site from the manifest
+      jobcommand = self.ptclm_cmd+" --ctsm_root "+self.ctsmdir+" -s $"+self.que.taskvar+" -d "+self.inputdir+" "+self.options
+      print( jobcommand );
+      bsub = self.que.SubmitArray( self, jobcommand, sitelist, jobname=self.JobName("PTCLM_sites"), submit=submit, wall=self.wall )
+      if ( submit ): self.monitor.AddSubmitted( self, names=sitelist )
+      return( bsub )
+
+   def StageJobs( self ):
+      "Return the list of jobs the stages of a site are split into"
+      # The mapping stage isn't run when site values are overlaid on an existing surface dataset
+      if ( self.PTCLMOption( "--surfdata_overlay" ) != None ):
+         return( [ job for job in self.stage_jobs if job["stages"] != "mapping" ] )
+      return( list( self.stage_jobs ) )
+
+   def SubmitStages( self, sitelist, submit=True ):
+      "Submit PTCLMmkdata for a list of sites as a chain of jobs for the stages, returns the list of submit commands"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+
+      # A chain of jobs for each site (NOT array jobs, as a stage of an array would wait for every
+      # site in the stage before it, so one failed site would hold back all of the others)
+      bsubs = []
+      for site in sitelist:
+         depends = []
+         jobs    = self.StageJobs()
+         for job in jobs:
+            wall = job["wall"]
+            if ( wall == None ): wall = self.wall
+            jobcommand = self.ptclm_cmd+" --ctsm_root "+self.ctsmdir+" -s "+site+" -d "+self.inputdir+ \
+                         " --stages "+job["stages"]+" "+self.options
+            print( jobcommand );
+            bsubs.append( self.que.Submit( self, jobcommand, jobname=self.JobName("PTCLM_"+site+"_"+job["name"]), \
+                                           submit=submit, wall=wall, profile=job["profile"], depends=depends ) )
+            if ( submit ):
+               # Every job of the chain is monitored, the last one finishes the site (the jobs
+               # after a failed job are NOT run, and are handed back as soon as it fails)
+               if ( job is jobs[-1] ):
+                  name = site
+               else:
+                  name = site+":"+job["name"]
+               self.monitor.AddSubmitted( self, names=[ name ], after=depends )
+               depends = self.que.Get_DependIDs( self )
+      return( bsubs )
+
+   def SiteEstimate( self, site ):
+      "Return the expected runtime (seconds) and memory (GB) of a site, from the trace of it's last run"
+      from stagetrace import stagetrace
+      tracefile = self.mydatadir+"/1x1pt_"+site+"/"+stagetrace.filename
+      if ( not os.path.exists( tracefile ) ):
+         return( self.site_runtime, self.site_memory )
+      usage = stagetrace().Usage( self, tracefile )
+      return( usage["wall"], usage["maxrss_kb"]/1048576.0 )
+
+   def PackSites( self, sitelist ):
+      "Pack the list of sites into jobs of up to sites_per_job sites that fit in the node memory"
+      if ( not self.parse_args ):
+         self.error( "parse_cmdline_args was NOT run first" )
+      estimates = {}
+      for site in sitelist:
+         estimates[site] = self.SiteEstimate( site )
+         if ( estimates[site][1] > self.node_memory ):
+            self.error( "Site "+site+" is expected to use more memory than node_memory: "+str(estimates[site][1]) )
+      # The sites in a job run at the same time, so the job takes as long as it's longest site.
+      # Taking the longest sites first puts sites with similar runtimes together (first fit decreasing)
+      packs = []
+      for site in sorted( sitelist, key=lambda site: estimates[site][0], reverse=True ):
+         for pack in packs:
+            if ( len(pack["sites"]) < self.sites_per_job and pack["memory"]+estimates[site][1] <= self.node_memory ):
+               break
+         else:
+            pack = { "sites":[], "memory":0.0 }
+            packs.append( pack )
+         pack["sites"].append( site )
+         pack["memory"] += estimates[site][1]
+      return( [ pack["sites"] for pack in packs ] )
+
+   def SubmitPacked( self, sitelist, submit=True ):
+      "Submit PTCLMmkdata for a list of sites packed several to a batch job, returns the list of submit commands"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+
+      packs = self.PackSites( sitelist )
+      ncpus = max( [ len(pack) for pack in packs ] )
+      print( "Pack "+str(len(sitelist))+" sites into "+str(len(packs))+" jobs:" )
+      for pack in packs:
+         print( "   "+",".join(pack) )
+      # Each site writes it's status to PTCLMmkdata.status in it's directory, so failures in a job can be seen
+      if ( self.array and len(packs) > 1 ):
+         jobcommand = self.ptclm_cmd+" --ctsm_root "+self.ctsmdir+" -s $"+self.que.taskvar+" --jobs "+str(ncpus)+ \
+                      " -d "+self.inputdir+" "+self.options
+         print( jobcommand );
+         tasks = [ ",".join(pack) for pack in packs ]
+         bsub = self.que.SubmitArray( self, jobcommand, tasks, jobname=self.JobName("PTCLM_packed"), submit=submit, \
+                                      wall=self.wall, ncpus=ncpus )
+         if ( submit ): self.monitor.AddSubmitted( self, names=tasks )
+         return( [ bsub ] )
+      bsubs = []
+      for n, pack in enumerate( packs ):
+         jobcommand = self.ptclm_cmd+" --ctsm_root "+self.ctsmdir+" -s "+",".join(pack)+" --jobs "+str(len(pack))+ \
+                      " -d "+self.inputdir+" "+self.options
+         print( jobcommand );
+         bsubs.append( self.que.Submit( self, jobcommand, jobname=self.JobName("PTCLM_pack"+str(n+1)), submit=submit, \
+                                        wall=self.wall, ncpus=len(pack) ) )
+         if ( submit ): self.monitor.AddSubmitted( self, names=[ ",".join(pack) ] )
+      return( bsubs )
+
+   def SubmitSites( self, sitelist ):
+      "Submit the list of sites, as chains of jobs for the stages, packed jobs, an array job or a job for each site"
+      if ( self.split_stages ):
+          print( "Submit a chain of jobs for the stages of sites: "+",".join(sitelist)+"\n" )
+          self.SubmitStages( sitelist )
+      elif ( self.sites_per_job > 1 ):
+          self.SubmitPacked( sitelist )
+      elif ( self.array ):
+          print( "Submit array job for sites: "+",".join(sitelist)+"\n" )
+          self.SubmitList( sitelist )
+      else:
+          for site in sitelist:
+              print( "Submit for site: "+site+"\n" )
+              self.Submit( site )
+
+   def SiteDir( self, site ):
+      "Return the directory PTCLMmkdata creates the datasets for a site in"
+      return( self.mydatadir+"/1x1pt_"+site )
+
+   def SiteStatus( self, site ):
+      "Return the status PTCLMmkdata gave the site (RUNNING, PASS, FAIL or None if it hasn't been run) and it's description"
+      from PTCLMmkdata_prog import PTCLMmkdata_prog
+      mkdata = PTCLMmkdata_prog()
+      return( mkdata.read_status( self.SiteDir( site ) ), mkdata.read_status_description( self.SiteDir( site ) ) )
+
+   def SiteComplete( self, site ):
+      "Return True if the site passed and the output files of it's stages are still in place"
+      from stagemanifest import stagemanifest
+      if ( self.SiteStatus( site )[0] != "PASS" ):
+         return( False )
+      # Without a stage manifest (PTCLMmkdata run with --debug) the status is all there is to go on
+      if ( not os.path.exists( self.SiteDir( site )+"/"+stagemanifest.filename ) ):
+         return( True )
+      manifest = stagemanifest()
+      manifest.Initialize( self, self.SiteDir( site ) )
+      return( manifest.OutputsInPlace( self ) )
+
+   def SkipComplete( self, sitelist ):
+      "Return the list of sites without the sites that are already complete"
+      if ( self.rerun_complete ):
+         return( list( sitelist ) )
+      complete = [ site for site in sitelist if self.SiteComplete( site ) ]
+      if ( len(complete) > 0 ):
+         print( "Skip sites that are already complete (use --rerun_complete to submit them): "+",".join(complete)+"\n" )
+      return( [ site for site in sitelist if site not in complete ] )
+
+   def FailedSites( self, sitelist ):
+      "Return the sites in the list that failed, from the status of each site and the exit status of their jobs"
+      jobstatus = {}
+      for job in self.monitor.jobs.values():
+         # The exit status of a job with several sites can't say which of them failed, the jobs
+         # of a chain (with --split_stages) are named site:stage and any of them can fail the site
+         name = job["name"].split( ":" )[0]
+         if ( job["name"].find( "," ) == -1 and jobstatus.get( name ) in [ 0, None ] ):
+            jobstatus[name] = job.get( "status" )
+      failed = []
+      for site in sitelist:
+         # A site killed in the middle of a stage is left RUNNING, and a site never started has no status
+         if ( self.SiteStatus( site )[0] != "PASS" or jobstatus.get( site ) not in [ 0, None ] ):
+            failed.append( site )
+      return( failed )
+
+   def Run( self ):
+      "Submit the sites that are NOT complete, waiting and resubmitting failed sites if asked, returns the number that failed"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      sitelist = self.SkipComplete( self.get_SiteList() )
+      if ( len(sitelist) == 0 ):
+         print( "All sites are complete, nothing to submit" )
+         return( 0 )
+      self.SubmitSites( sitelist )
+      # Jobs run on the local machine are always waited for, so their exit status can be shown
+      if ( not self.wait and self.mach != "local" ):
+         return( 0 )
+      while ( True ):
+         self.Wait()
+         failed = self.FailedSites( sitelist )
+         if ( len(failed) == 0 or self.retry >= self.retries ):
+            break
+         self.retry += 1
+         print( "\nResubmit failed sites (retry "+str(self.retry)+" of "+str(self.retries)+"):\n" )
+         for site in failed:
+            ( status, desc ) = self.SiteStatus( site )
+            print( "   "+site+": "+str(status)+" "+desc )
+         print( "" )
+         self.monitor = jobmonitor()
+         self.monitor.Initialize( self, self.que, interval=self.wait_interval )
+         self.SubmitSites( failed )
+         sitelist = failed
+      if ( len(failed) > 0 ):
+         print( "\nSites that failed: "+",".join(failed) )
+      return( len(failed) )
+
+   def Wait( self ):
+      "Wait for the jobs submitted to complete, showing each one as it completes, returns the number that failed"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      failed = []
+      def show( job ):
+         if ( job.get("lost") ):
+            # The batch system no longer knows the job and it never wrote it's output
+            status = "lost"
+            failed.append( job["name"] )
+         elif ( job.get("not_run") ):
+            # A job it depends on failed (and is counted as failed), so it was NOT run
+            status = "skip"
+         elif ( job["status"] == None ):
+            status = "   ?"
+         else:
+            status = "%4d" % job["status"]
+            if ( job["status"] != 0 ): failed.append( job["name"] )
+         print( " "+status+" "+job["name"]+" ("+job["outfile"]+")" )
+         sys.stdout.flush()
+      print( "\nWaiting for "+str(self.monitor.Pending())+" jobs, exit status of each as it completes:\n" )
+      sys.stdout.flush()
+      self.monitor.Wait( self, callback=show )
+      if ( len(failed) > 0 ):
+         print( "\nJobs that failed: "+" ".join(failed) )
+      return( len(failed) )
+
 #
 # Unit testing for above classes
 #
-import unittest
+import unittest, tempfile, shutil, json
 
 class test_PTCLMsublist_prog(unittest.TestCase):
 
@@ -150,6 +469,7 @@ class test_PTCLMsublist_prog(unittest.TestCase):
      self.assertRaises(SystemExit, self.prog.ctsm_root )
      self.assertRaises(SystemExit, self.prog.Initialize )
      self.assertRaises(SystemExit, self.prog.Submit, "US-UMB" )
+     self.assertRaises(SystemExit, self.prog.SubmitList, [ "US-UMB", "US-Ha1" ] )
      # Test that doing stuff after parse_args before Initialize fails
      self.prog = PTCLMsublist_prog()
      sys.argv[1:] = [ ]
@@ -200,6 +520,77 @@ class test_PTCLMsublist_prog(unittest.TestCase):
      print( "expect:"+checkstring+":end" )
      self.assertTrue( bsub == checkstring )
 
+   def test_local( self ):
+     sitelist = [ "US-UMB", "US-Ha1" ]
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--mach", "local", "--local_cpus", "2" ]
+     self.prog.parse_cmdline_args( )
+     self.prog.Initialize( )
+     self.assertEqual( self.prog.que.maxcpus, 2 )
+     bsub = self.prog.SubmitList( sitelist, submit=False )
+     self.assertTrue( bsub.startswith( "for i in `seq 1 2`" ) )
+     os.system( "/bin/rm -f "+self.prog.que.jobscript+" "+self.prog.que.manifest )
+     self.assertEqual( self.prog.monitor.Pending(), 0 )
+
+   def test_wait( self ):
+     tmpdir = tempfile.mkdtemp()
+     sitelist = [ "US-UMB", "US-Ha1", "BR-Sa1" ]
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--mach", "local", "--local_cpus", "3", "--wait", "--wait_interval", "0.5" ]
+     self.prog.parse_cmdline_args( )
+     self.assertTrue( self.prog.wait )
+     self.prog.Initialize( )
+     # Stand-in for PTCLMmkdata, that fails for one site
+     self.prog.que.SubmitArray( self.prog, "test $TASK != US-Ha1", sitelist, curdir=tmpdir, jobname="PTCLM_sites" )
+     self.prog.monitor.AddSubmitted( self.prog, names=sitelist )
+     self.assertEqual( self.prog.Wait( ), 1 )
+     self.assertEqual( self.prog.monitor.Pending(), 0 )
+     self.prog.que.SubmitCleanup( self.prog, rmout=True )
+     shutil.rmtree( tmpdir )
+     sys.argv[1:] = [ "--wait_interval", "0" ]
+     self.assertRaises(SystemExit, PTCLMsublist_prog().parse_cmdline_args )
+
+   def test_retry( self ):
+     tmpdir = tempfile.mkdtemp()
+     sitelist = [ "US-UMB", "US-Ha1", "BR-Sa1" ]
+     # Stand-in for PTCLMmkdata that writes the status of the site, US-Ha1 fails the first time it's run
+     # and BR-Sa1 is killed before it can write that it failed
+     ptclm = open( tmpdir+"/PTCLMmkdata", "w" )
+     ptclm.write( "#!/bin/sh\n" + \
+                  "while [ $# -gt 0 ]; do case $1 in -s) site=$2;; --mydatadir) mydatadir=$2;; esac; shift; done\n" + \
+                  "mkdir -p $mydatadir/1x1pt_$site; echo run >> $mydatadir/$site.runs\n" + \
+                  "if [ $site = BR-Sa1 ]; then echo RUNNING > $mydatadir/1x1pt_$site/PTCLMmkdata.status; kill -9 $$; fi\n" + \
+                  "if [ $site = US-Ha1 -a ! -f $mydatadir/$site.failed ]; then\n" + \
+                  "   touch $mydatadir/$site.failed\n" + \
+                  "   echo FAIL 2019-01-01 00:00:00 stage mapping: mkmapdata failed > $mydatadir/1x1pt_$site/PTCLMmkdata.status; exit 1\n" + \
+                  "fi\n" + \
+                  "echo PASS 2019-01-01 00:00:00 > $mydatadir/1x1pt_$site/PTCLMmkdata.status\n" )
+     ptclm.close()
+     os.chmod( tmpdir+"/PTCLMmkdata", 0o755 )
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--mach", "local", "--local_cpus", "3", "--retries", "2", \
+                      "-o", "--mydatadir "+tmpdir ]
+     self.prog.parse_cmdline_args( )
+     self.assertTrue( self.prog.wait )
+     self.prog.Initialize( )
+     self.prog.ptclm_cmd = tmpdir+"/PTCLMmkdata"
+     # Only the sites that failed are resubmitted, until the retries run out
+     self.assertEqual( self.prog.Run( ), 1 )
+     self.assertEqual( self.prog.retry, 2 )
+     runs = {}
+     for site in sitelist:
+        infile = open( tmpdir+"/"+site+".runs", "r" )
+        runs[site] = len( infile.read().split() )
+        infile.close()
+     self.assertEqual( runs, { "US-UMB":1, "US-Ha1":2, "BR-Sa1":3 } )
+     self.assertEqual( self.prog.SiteStatus( "BR-Sa1" ), ( "RUNNING", "" ) )
+     self.assertTrue( self.prog.SiteComplete( "US-Ha1" ) )
+     # Complete sites are skipped
+     self.assertEqual( self.prog.SkipComplete( sitelist ), [ "BR-Sa1" ] )
+     self.prog.rerun_complete = True
+     self.assertEqual( self.prog.SkipComplete( sitelist ), sitelist )
+     os.system( "/bin/rm -f PTCLM_sites*."+str(os.getpid())+".* PTCLM_BR-Sa1_retry2."+str(os.getpid())+".*" )
+     shutil.rmtree( tmpdir )
+     sys.argv[1:] = [ "--retries", "-1" ]
+     self.assertRaises(SystemExit, PTCLMsublist_prog().parse_cmdline_args )
+
    def test_sitelist( self ):
      sitelistcsv = "US-UMB,US-Ha1"
      sitelist    = [ "US-UMB", "US-Ha1" ]
@@ -208,6 +599,161 @@ class test_PTCLMsublist_prog(unittest.TestCase):
      self.prog.Initialize( )
      slist = self.prog.get_SiteList( )
      self.assertTrue( slist == sitelist )
+
+   def test_array( self ):
+     sitelist = [ "US-UMB", "US-Ha1", "BR-Sa1" ]
+     sys.argv[1:] = [ "-l", ",".join(sitelist) ]
+     self.prog.parse_cmdline_args( )
+     self.prog.Initialize( )
+     bsub = self.prog.SubmitList( self.prog.get_SiteList( ), submit=False )
+     jobid = str(os.getpid())
+     checkstring = "qsub  -o PTCLM_sites."+jobid+".^array_index^.stdout.out  -N PTCLM_sites  -J 1-3  -l walltime=02:00:00  " + \
+                   "-A P93300606 -l select=3:ncpus=1:mpiprocs=1:mem=109GB -q regular " + \
+                   "-V -m ae -j oe  "+os.getcwd()+"/PTCLM_sites."+jobid+".job"
+     print( "bsubcm:"+bsub+":end" )
+     print( "expect:"+checkstring+":end" )
+     self.assertTrue( bsub == checkstring )
+     manifest = open( self.prog.que.manifest, "r" )
+     self.assertEqual( manifest.read().split(), sitelist )
+     manifest.close()
+     for task in range(1, len(sitelist)+1):
+        os.system( "touch "+self.prog.que.Get_OutFilename( self.prog, task ) )
+     self.prog.que.SubmitCleanup( self.prog, rmout=True )
+     # A single site is submitted as a regular job
+     bsub = self.prog.SubmitList( [ "US-UMB" ], submit=False )
+     self.assertTrue( bsub.find( "-J" ) == -1 )
+     os.system( "/bin/rm -f "+self.prog.que.jobscript )
+
+   def test_stages( self ):
+     sitelist = [ "US-UMB", "US-Ha1" ]
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--split_stages" ]
+     self.prog.parse_cmdline_args( )
+     self.assertTrue( self.prog.split_stages )
+     self.prog.Initialize( )
+     # A chain of jobs for each site even with array jobs on, the mapping stage gets the big-memory node
+     self.assertTrue( self.prog.array )
+     bsubs = self.prog.SubmitStages( sitelist, submit=False )
+     self.assertEqual( len(bsubs), 6 )
+     self.assertTrue( bsubs[0].find( "-q share" ) != -1 and bsubs[0].find( "walltime=00:30:00" ) != -1 )
+     self.assertTrue( bsubs[1].find( "mem=109GB -q regular" ) != -1 and bsubs[1].find( "walltime=02:00:00" ) != -1 )
+     self.assertTrue( bsubs[2].find( "-q share" ) != -1 and bsubs[2].find( "PTCLM_US-UMB_surfdata" ) != -1 )
+     self.assertTrue( bsubs[5].find( "PTCLM_US-Ha1_surfdata" ) != -1 )
+     for bsub in bsubs:
+        self.assertTrue( bsub.find( "-J" ) == -1 )
+     job = open( self.prog.que.jobscript, "r" )
+     self.assertTrue( job.read().find( "-s US-Ha1 -d "+self.prog.inputdir+" --stages all" ) != -1 )
+     job.close()
+     pid = str(os.getpid())
+     os.system( "/bin/rm -f PTCLM_US-*_*."+pid+".job" )
+     # Without the mapping stage for an overlay
+     self.prog.options = "--surfdata_overlay=surfdata.nc"
+     bsubs = self.prog.SubmitStages( sitelist, submit=False )
+     self.assertEqual( len(bsubs), 4 )
+     self.assertTrue( bsubs[3].find( "PTCLM_US-Ha1_surfdata" ) != -1 )
+     self.assertTrue( bsubs[1].find( "mem=109GB" ) == -1 )
+     os.system( "/bin/rm -f PTCLM_US-*_*."+pid+".job" )
+     sys.argv[1:] = [ "--split_stages", "--sites_per_job", "2" ]
+     self.assertRaises(SystemExit, PTCLMsublist_prog().parse_cmdline_args )
+
+   def test_split( self ):
+     tmpdir = tempfile.mkdtemp()
+     sitelist = [ "US-UMB", "US-Ha1" ]
+     # Stand-in for PTCLMmkdata that records the stages run, US-Ha1 fails in the first job
+     ptclm = open( tmpdir+"/PTCLMmkdata", "w" )
+     ptclm.write( "#!/bin/sh\n" + \
+                  "while [ $# -gt 0 ]; do case $1 in -s) site=$2;; --mydatadir) mydatadir=$2;; --stages) stages=$2;; esac; shift; done\n" + \
+                  "mkdir -p $mydatadir/1x1pt_$site; echo $stages >> $mydatadir/$site.runs\n" + \
+                  "if [ $site = US-Ha1 ]; then echo FAIL 2019-01-01 00:00:00 > $mydatadir/1x1pt_$site/PTCLMmkdata.status; exit 1; fi\n" + \
+                  "if [ $stages = all ]; then echo PASS 2019-01-01 00:00:00 > $mydatadir/1x1pt_$site/PTCLMmkdata.status; fi\n" )
+     ptclm.close()
+     os.chmod( tmpdir+"/PTCLMmkdata", 0o755 )
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--mach", "local", "--local_cpus", "2", "--split_stages", \
+                      "-o", "--mydatadir "+tmpdir ]
+     self.prog.parse_cmdline_args( )
+     self.prog.Initialize( )
+     self.prog.ptclm_cmd = tmpdir+"/PTCLMmkdata"
+     # The stages of a site run in order, and the jobs after a failed job are NOT run
+     self.assertEqual( self.prog.Run( ), 1 )
+     runs = {}
+     for site in sitelist:
+        infile = open( tmpdir+"/"+site+".runs", "r" )
+        runs[site] = infile.read().split()
+        infile.close()
+     self.assertEqual( runs, { "US-UMB":[ "domain,sitepft,sitesoil,landuse", "mapping", "all" ], \
+                               "US-Ha1":[ "domain,sitepft,sitesoil,landuse" ] } )
+     # Every job of each chain is monitored, the jobs of US-Ha1 after it's failed job are NOT run
+     jobs = {}
+     for job in self.prog.monitor.jobs.values():
+        jobs[job["name"]] = job
+     self.assertEqual( sorted( jobs.keys() ), [ "US-Ha1", "US-Ha1:mapping", "US-Ha1:prep", "US-UMB", "US-UMB:mapping", "US-UMB:prep" ] )
+     self.assertEqual( jobs["US-Ha1:prep"]["status"], 1 )
+     for name in [ "US-Ha1:mapping", "US-Ha1" ]:
+        self.assertTrue( jobs[name].get("not_run") or jobs[name]["status"] == 1 )
+     self.assertEqual( self.prog.FailedSites( sitelist ), [ "US-Ha1" ] )
+     os.system( "/bin/rm -f PTCLM_US-*_*."+str(os.getpid())+".*" )
+     shutil.rmtree( tmpdir )
+
+   def write_trace( self, mydatadir, site, wall, maxrss_gb ):
+     "Write a trace for a site that took the given time and memory"
+     os.makedirs( mydatadir+"/1x1pt_"+site )
+     trace = open( mydatadir+"/1x1pt_"+site+"/PTCLMmkdata_trace.jsonl", "w" )
+     event = { "name":"mksurfdata", "cat":"stage", "ph":"X", "ts":0, "dur":int(wall*1.e6), "pid":1, "tid":1, \
+               "args":{ "maxrss_kb":int(maxrss_gb*1048576), "self_maxrss_kb":0 } }
+     trace.write( json.dumps( event )+"\n" )
+     trace.close()
+
+   def test_pack( self ):
+     tmpdir = tempfile.mkdtemp()
+     self.write_trace( tmpdir, "US-UMB", 3000.0, 40.0 )
+     self.write_trace( tmpdir, "US-Ha1", 2900.0, 40.0 )
+     self.write_trace( tmpdir, "BR-Sa1",  100.0,  2.0 )
+     self.write_trace( tmpdir, "BR-Sa3",  200.0,  2.0 )
+     self.write_trace( tmpdir, "CA-Let",  150.0, 30.0 )
+     sitelist = [ "BR-Sa1", "US-UMB", "CA-Let", "BR-Sa3", "US-Ha1" ]
+     sys.argv[1:] = [ "-l", ",".join(sitelist), "--sites_per_job", "3", "-o", "--mydatadir "+tmpdir ]
+     self.prog.parse_cmdline_args( )
+     self.prog.Initialize( )
+     # The long sites go together, and the memory of a job fits in a node
+     packs = self.prog.PackSites( sitelist )
+     self.assertEqual( packs, [ [ "US-UMB", "US-Ha1", "BR-Sa3" ], [ "CA-Let", "BR-Sa1" ] ] )
+     self.prog.node_memory = 80.0
+     self.assertEqual( self.prog.PackSites( sitelist ), [ [ "US-UMB", "US-Ha1" ], [ "BR-Sa3", "CA-Let", "BR-Sa1" ] ] )
+     self.prog.node_memory = 20.0
+     self.assertRaises(SystemExit, self.prog.PackSites, sitelist )
+     # Sites that haven't been run use the default estimates
+     self.prog.node_memory = 100.0
+     self.assertEqual( self.prog.PackSites( [ "US-NR1", "US-FPe", "CA-Man", "BR-Sa1" ] ), [ [ "US-NR1", "US-FPe", "CA-Man" ], [ "BR-Sa1" ] ] )
+     # One array job with a task for each pack
+     bsubs = self.prog.SubmitPacked( sitelist, submit=False )
+     self.assertEqual( len(bsubs), 1 )
+     self.assertTrue( bsubs[0].find( "ncpus=3" ) != -1 )
+     manifest = open( self.prog.que.manifest, "r" )
+     self.assertEqual( manifest.read().split(), [ "US-UMB,US-Ha1,BR-Sa3", "CA-Let,BR-Sa1" ] )
+     manifest.close()
+     os.system( "/bin/rm -f "+self.prog.que.jobscript+" "+self.prog.que.manifest )
+     # Or a job for each pack
+     self.prog.array = False
+     bsubs = self.prog.SubmitPacked( sitelist, submit=False )
+     self.assertEqual( len(bsubs), 2 )
+     self.assertTrue( bsubs[1].find( "ncpus=2" ) != -1 )
+     os.system( "/bin/rm -f PTCLM_pack1."+str(os.getpid())+".job PTCLM_pack2."+str(os.getpid())+".job" )
+     shutil.rmtree( tmpdir )
+     sys.argv[1:] = [ "--sites_per_job", "0" ]
+     self.assertRaises(SystemExit, PTCLMsublist_prog().parse_cmdline_args )
+
+   def test_ptclm_options( self ):
+     # Options given to PTCLMmkdata are found with or without an equal sign
+     for opts in [ "--mydatadir /tmp/sitedata --quiet", "--quiet --mydatadir=/tmp/sitedata" ]:
+        prog = PTCLMsublist_prog()
+        sys.argv[1:] = [ "-o", opts ]
+        prog.parse_cmdline_args( )
+        self.assertEqual( prog.mydatadir, "/tmp/sitedata" )
+        self.assertEqual( prog.SiteDir( "US-UMB" ), "/tmp/sitedata/1x1pt_US-UMB" )
+        self.assertEqual( prog.PTCLMOption( "--surfdata_overlay" ), None )
+     prog = PTCLMsublist_prog()
+     sys.argv[1:] = [ "-o", "--verbose" ]
+     prog.parse_cmdline_args( )
+     self.assertEqual( prog.mydatadir, PTCLMsublist_prog.mydatadir )
        
 
 if __name__ == '__main__':
@@ -3,9 +3,15 @@
 # batchque.py
 #
 # Python class to handle batch submission of single-processor command-line jobs.
+# A list of tasks can also be submitted as one array job, with a manifest file giving
+# the task for each index of the array. The "local" machine runs the jobs in a pool of
+# processes on the current machine (rather than a batch system) with the same output
+# files, killing jobs that go over their wallclock time. Jobs can be submitted with a
+# resource profile (so small jobs don't hold a big-memory node), and can depend on jobs
+# submitted before them, so they only start once those complete successfully.
 #
 #########################################################################################
-import os, sys
+import os, sys, re, json, time, signal, threading
 
 class batchque:
 #----------------------------------------------------------------------------------------
@@ -17,6 +23,11 @@ class batchque:
    account   = ""
    submit    = False
    jobscript = ""
+   manifest  = ""
+   jobid     = ""          # Job id the batch system gave the job submitted
+   ntasks    = 0           # Number of tasks in the array job submitted (0 if NOT an array job)
+   taskvar   = "TASK"      # Shell variable the job command gets the task from the manifest in
+   maxcpus   = 1           # Number of processors the local machine runs jobs on
    #
    # hash's keyed off the list of machines known
    #
@@ -27,52 +38,261 @@ class batchque:
    # edison(PBS):        -l=tasks, processors per node, and wallclock time, -q=queue name, -V=use ALL env variables, 
    #                     -m=mail options (ae send mail on submit and exit)
    # -j oe on edison and -oo on yellowstone (without -e/-eo means combine stderr and stdout
-   opts    = { 'yellowstone':"-n 1 -R 'span[ptile=15]' -q geyser -N -a poe ", \
-               'cheyenne'   :"-l select=3:ncpus=1:mpiprocs=1:mem=109GB -q regular -V -m ae -j oe ", \
-               'edison'     :"-l nodes=1:ppn=1 -q regular -V -m ae -j oe " }
+   # local:              runs jobs on this machine, so none of the batch options are used
+   # (%(ncpus)d is replaced by the number of processors asked for, one unless several jobs are packed together)
+   opts    = { 'yellowstone':"-n %(ncpus)d -R 'span[ptile=15]' -q geyser -N -a poe ", \
+               'cheyenne'   :"-l select=3:ncpus=%(ncpus)d:mpiprocs=1:mem=109GB -q regular -V -m ae -j oe ", \
+               'edison'     :"-l nodes=1:ppn=%(ncpus)d -q regular -V -m ae -j oe ", \
+               'local'      :"" }
+   # Resource profiles to submit with in place of the basic options above, so each job can ask for
+   # the queue and memory it needs. bigmem is a whole node with all of it's memory, shared is a small
+   # part of a node in a queue shared with other jobs
+   profiles = { 'bigmem':opts, \
+                'shared':{ 'yellowstone':"-n %(ncpus)d -R 'span[ptile=15]' -q caldera -N -a poe ", \
+                           'cheyenne'   :"-l select=1:ncpus=%(ncpus)d:mpiprocs=1:mem=10GB -q share -V -m ae -j oe ", \
+                           'edison'     :"-l nodes=1:ppn=%(ncpus)d -q shared -V -m ae -j oe ", \
+                           'local'      :"" } }
    # batch submission command
-   bsub      = { 'yellowstone':"bsub",   'cheyenne':"qsub"         , 'edison':"qsub" }
+   bsub      = { 'yellowstone':"bsub",   'cheyenne':"qsub"         , 'edison':"qsub"         , 'local':"/bin/sh" }
    # Option to give file for standard output
-   bs_stdout = { 'yellowstone':" -oo ",  'cheyenne':" -o "         , 'edison':" -o "   }
+   bs_stdout = { 'yellowstone':" -oo ",  'cheyenne':" -o "         , 'edison':" -o "         , 'local':""  }
    # Option to give job name to use
-   bs_jobnam = { 'yellowstone':" -J ",   'cheyenne':" -N "         , 'edison':" -N "   }
+   bs_jobnam = { 'yellowstone':" -J ",   'cheyenne':" -N "         , 'edison':" -N "         , 'local':""  }
    # Option to give current directory to use
-   bs_curdir = { 'yellowstone':" -cwd ", 'cheyenne':""             , 'edison':" -d "   }
+   bs_curdir = { 'yellowstone':" -cwd ", 'cheyenne':""             , 'edison':" -d "         , 'local':""  }
    # Option to give account name to use
-   bs_accnt  = { 'yellowstone':" -P ",   'cheyenne':" -A "         , 'edison':""    }
+   bs_accnt  = { 'yellowstone':" -P ",   'cheyenne':" -A "         , 'edison':""             , 'local':""  }
    # If jobcommand needs to be script file
-   bs_script = { 'yellowstone':False,    'cheyenne':True           , 'edison':True   }
+   bs_script = { 'yellowstone':False,    'cheyenne':True           , 'edison':True           , 'local':True }
    # Option to give wallclock time to use
-   bs_wtime  = { 'yellowstone':" -W ",   'cheyenne':" -l walltime=", 'edison':" -l walltime=" }
+   bs_wtime  = { 'yellowstone':" -W ",   'cheyenne':" -l walltime=", 'edison':" -l walltime=", 'local':""  }
+   # Option to give the range of indices for an array job (LSF gives it in the job name)
+   bs_array  = { 'yellowstone':"",       'cheyenne':" -J "         , 'edison':" -t "         , 'local':""  }
+   # Environment variable with the index of the array task being run
+   bs_arrenv = { 'yellowstone':"LSB_JOBINDEX", 'cheyenne':"PBS_ARRAY_INDEX", 'edison':"PBS_ARRAYID", \
+                 'local':"BATCHQUE_ARRAY_INDEX" }
+   # String in the output filename that is replaced with the array index (if empty "-index" is
+   # added to the end of the output filename instead)
+   bs_arridx = { 'yellowstone':"%I",     'cheyenne':"^array_index^", 'edison':""         , 'local':"%I" }
+   # Regular expression to get the job id from what the submission command prints
+   bs_jobid  = { 'yellowstone':"Job <([0-9]+)>", 'cheyenne':"^([0-9]+\\S*)", 'edison':"^([0-9]+\\S*)", 'local':"" }
+   # Option to make a job wait for other jobs to complete successfully (%s is the list of job ids),
+   # -ti on LSF ends the job if a job it depends on fails (rather than leaving it pending forever)
+   bs_depend = { 'yellowstone':" -w '%s' -ti ", 'cheyenne':" -W depend=afterok:%s ", 'edison':" -W depend=afterok:%s ", 'local':"" }
+   # Condition for each job id in the list of jobs depended on, and what goes between them
+   bs_depjob = { 'yellowstone':"done(%s)", 'cheyenne':"%s"           , 'edison':"%s"           , 'local':"" }
+   bs_depsep = { 'yellowstone':" && ",   'cheyenne':":"            , 'edison':":"            , 'local':"" }
+   # Command to get the status of a list of jobs (including finished jobs)
+   bs_query  = { 'yellowstone':"bjobs -a -noheader -o 'jobid jobindex stat exit_code delimiter=\",\"'", \
+                 'cheyenne'   :"qstat -x -f -F json", 'edison':"qstat -f", 'local':"" }
+   # Type of batch system, which gives the format the status query prints
+   bs_qtype  = { 'yellowstone':"lsf",    'cheyenne':"pbspro"       , 'edison':"torque"       , 'local':"local" }
 
-   def Initialize( self, prog, mach="cheyenne", account="" ):
-      "Initialize the batchque"
+   def Initialize( self, prog, mach="cheyenne", account="", maxcpus=None ):
+      "Initialize the batchque (maxcpus is the number of processors to run jobs on for the local machine)"
       if ( self.bsub.get(mach) == None ):
          print( "List of valid machines: "+str(self.bsub.keys()) )
          prog.error( "Machine NOT in list of valid machines for batch queue: "+mach )
 
       self.mach    = mach
+      # There's no account to charge when running locally
+      if ( mach == "local" ): account = ""
       if ( self.bs_accnt[mach] == "" and account != "" ):
          prog.error( "Account entered but this machine does NOT have an account option: "+mach )
 
       self.account = account
+      if ( mach == "local" ):
+         import concurrent.futures
+         if ( maxcpus == None ): maxcpus = os.cpu_count()
+         if ( maxcpus < 1 ):
+            prog.error( "Number of processors to run local jobs on must be one or greater" )
+         self.maxcpus  = maxcpus
+         self.freecpus = maxcpus
+         self.cpus     = threading.Condition()
+         self.jobs     = {}
+         self.pool     = concurrent.futures.ThreadPoolExecutor( max_workers=maxcpus )
 
       self.setup   = True
       self.submit  = False
  
-   def Get_OutFilename( self, prog ):
-       "Get the output log filename"
+   def Get_OutFilename( self, prog, task=None ):
+       "Get the output log filename (for an array job give the task index starting at 1)"
        if ( not self.setup ):
           prog.error( "Trying to get the output filename and Initialize was NOT run first!" )
        if ( not self.submit ):
           prog.error( "Trying to get the output filename and Submit was NOT run first!" )
 
-       return( self.stdout )
+       if ( self.ntasks == 0 ):
+          if ( task != None ):
+             prog.error( "Trying to get the output filename for a task and an array job was NOT submitted!" )
+          return( self.stdout )
+       if ( task == None or task < 1 or task > self.ntasks ):
+          prog.error( "Trying to get the output filename for an array job without a valid task index: "+str(task) )
+       return( self._task_outfile( task ) )
 
-   def Submit( self, prog, jobcommand, curdir=os.getcwd(), jobname="batchjob", wall="4:00", submit=True ):
-       "Get the command to submit the job to the batch queue"
+   def Get_JobID( self, prog, task=None ):
+       "Get the job id of the job submitted (for an array job give the task index starting at 1)"
+       outfile = self.Get_OutFilename( prog, task )
+       if ( self.mach == "local" ):
+          # Local jobs are known by their output file
+          return( os.path.abspath( outfile ) )
+       if ( self.jobid == "" ):
+          prog.error( "The job id is NOT known, the job was NOT submitted or the id could NOT be read" )
+       if ( task == None ):
+          return( self.jobid )
+       # Array tasks are job[index] for LSF and job[index].server for PBS
+       if ( self.jobid.find( "[]" ) != -1 ):
+          return( self.jobid.replace( "[]", "["+str(task)+"]" ) )
+       return( self.jobid+"["+str(task)+"]" )
+
+   def Get_DependIDs( self, prog ):
+       "Get the list of job ids for a later job to depend on, so it waits for all of the job submitted"
+       if ( not self.setup or not self.submit ):
+          prog.error( "Trying to get the job ids to depend on and Initialize and Submit were NOT run first!" )
+       if ( self.mach == "local" ):
+          # Each task of a local array job is run on it's own
+          if ( self.ntasks == 0 ):
+             return( [ self.Get_JobID( prog ) ] )
+          return( [ self.Get_JobID( prog, task ) for task in range(1, self.ntasks+1) ] )
+       if ( self.jobid == "" ):
+          prog.error( "The job id is NOT known, the job was NOT submitted or the id could NOT be read" )
+       # A dependency on an array job waits for all of it's tasks
+       return( [ self.jobid ] )
+
+   def _submit_opts( self, prog, profile, depends, ncpus ):
+       "Return the options for the resource profile (None for the basic options) and the jobs to depend on"
+       opts = ""
+       if ( len(depends) > 0 ):
+          for jobid in depends:
+             if ( self.mach == "local" ):
+                if ( jobid not in self.jobs ):
+                   prog.error( "Job depends on a job that was NOT submitted to run on the local machine: "+str(jobid) )
+             elif ( str(jobid).strip() == "" or str(jobid).find(" ") != -1 ):
+                prog.error( "Bad job id to depend on: "+repr(jobid) )
+          if ( self.mach != "local" ):
+             jobs  = self.bs_depsep[self.mach].join( [ self.bs_depjob[self.mach] % jobid for jobid in depends ] )
+             opts += self.bs_depend[self.mach] % jobs
+       if ( profile == None ):
+          popts = self.opts[self.mach]
+       elif ( profile in self.profiles ):
+          popts = self.profiles[profile][self.mach]
+       else:
+          print( "List of valid resource profiles: "+str(list(self.profiles.keys())) )
+          prog.error( "Resource profile NOT in list of valid profiles: "+str(profile) )
+       opts += popts % { "ncpus":ncpus }+" "
+       return( opts )
+
+   def _batch_submit( self, prog, cmd ):
+       "Run the batch submission command, saving the job id it gives"
+       import subprocess
+       proc = subprocess.run( cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True )
+       print( proc.stdout, end="" )
+       if ( proc.returncode != 0 ):
+          prog.error( "Batch submit returns an error" )
+       jobid = re.search( self.bs_jobid[self.mach], proc.stdout, re.MULTILINE )
+       if ( jobid == None ):
+          self.jobid = ""
+       else:
+          self.jobid = jobid.group(1)
+
+   def Query( self, prog, jobids ):
+       "Get the state (QUEUED, RUNNING or DONE) and exit status of a list of jobs with one call to the batch system"
+       if ( not self.setup ):
+          prog.error( "Initialize was NOT run first!" )
+       states = {}
+       if ( len(jobids) == 0 ):
+          return( states )
+       if ( self.bs_qtype[self.mach] == "local" ):
+          for jobid in jobids:
+             job = self.jobs.get( jobid )
+             if ( job == None ): continue
+             if ( job.done() ):
+                states[jobid] = ( "DONE", job.result() )
+             elif ( job.running() ):
+                states[jobid] = ( "RUNNING", None )
+             else:
+                states[jobid] = ( "QUEUED", None )
+          return( states )
+       import subprocess, shlex
+       cmd  = self.bs_query[self.mach]+" "+" ".join( [ shlex.quote(jobid) for jobid in jobids ] )
+       # Jobs the batch system no longer knows about give errors, so the exit status isn't checked
+       proc = subprocess.run( cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True )
+       return( self.Parse_Query( prog, proc.stdout ) )
+
+   def Parse_Query( self, prog, output ):
+       "Parse what the batch system query prints into the state and exit status of each job"
+       states = {}
+       qtype  = self.bs_qtype[self.mach]
+       if ( qtype == "pbspro" ):
+          if ( output.strip() == "" ): return( states )
+          try:
+             jobs = json.loads( output ).get( "Jobs", {} )
+          except ValueError:
+             prog.error( "Trouble reading the job status from qstat: "+output[:200] )
+          for jobid in jobs:
+             state = jobs[jobid].get( "job_state", "" )
+             if ( state in [ "F", "X" ] ):
+                states[jobid] = ( "DONE", jobs[jobid].get( "Exit_status" ) )
+             elif ( state in [ "R", "E", "B", "U" ] ):
+                states[jobid] = ( "RUNNING", None )
+             else:
+                states[jobid] = ( "QUEUED", None )
+       elif ( qtype == "torque" ):
+          jobid = None
+          for line in output.split( "\n" ):
+             if ( line.startswith( "Job Id:" ) ):
+                jobid = line.split( ":", 1 )[1].strip()
+                states[jobid] = ( "QUEUED", None )
+             elif ( jobid != None and line.find( "=" ) != -1 ):
+                ( key, value ) = [ item.strip() for item in line.split( "=", 1 ) ]
+                if ( key == "job_state" ):
+                   if ( value == "C" ):
+                      states[jobid] = ( "DONE", states[jobid][1] )
+                   elif ( value in [ "R", "E" ] ):
+                      states[jobid] = ( "RUNNING", None )
+                elif ( key == "exit_status" ):
+                   states[jobid] = ( states[jobid][0], int(value) )
+       elif ( qtype == "lsf" ):
+          for line in output.split( "\n" ):
+             items = line.strip().split( "," )
+             if ( len(items) != 4 ): continue
+             ( jobid, index, state, exitcode ) = items
+             if ( index not in [ "0", "-", "" ] ):
+                jobid = jobid+"["+index+"]"
+             if ( state in [ "DONE", "EXIT" ] ):
+                if ( exitcode.isdigit() ):
+                   states[jobid] = ( "DONE", int(exitcode) )
+                elif ( state == "DONE" ):
+                   states[jobid] = ( "DONE", 0 )
+                else:
+                   states[jobid] = ( "DONE", None )
+             elif ( state in [ "PEND", "PSUSP" ] ):
+                states[jobid] = ( "QUEUED", None )
+             else:
+                states[jobid] = ( "RUNNING", None )
+       return( states )
+
+   def _task_outfile( self, task ):
+       "Return the output filename the batch system uses for a task of an array job"
+       if ( self.bs_arridx[self.mach] != "" ):
+          return( self.stdout.replace( self.bs_arridx[self.mach], str(task) ) )
+       return( self.stdout+"-"+str(task) )
+
+   def Get_OutFilenames( self, prog ):
+       "Get the list of output log filenames (one for each task of an array job)"
+       if ( self.ntasks == 0 ):
+          return( [ self.Get_OutFilename( prog ) ] )
+       return( [ self.Get_OutFilename( prog, task ) for task in range(1, self.ntasks+1) ] )
+
+   def Submit( self, prog, jobcommand, curdir=os.getcwd(), jobname="batchjob", wall="4:00", submit=True, ncpus=1, \
+               profile=None, depends=[] ):
+       "Get the command to submit the job to the batch queue (depends is a list of job ids it waits for)"
        if ( not self.setup ):
           prog.error( "Initialize was NOT run first!" )
+       if ( ncpus < 1 ):
+          prog.error( "Number of processors must be one or greater" )
+       if ( self.mach == "local" ):
+          self.Wall_Seconds( prog, wall )
 
        if ( not os.path.exists(curdir) ):
           prog.error( "Input current directory does NOT exist: "+curdir )
@@ -82,6 +302,7 @@ class batchque:
        pid    = str(os.getpid())
        stdout = str(jobname)+"."+pid+".stdout.out"
        self.stdout = stdout
+       self.ntasks = 0
        opts += self.bs_stdout[self.mach]+stdout+" "
        opts += self.bs_jobnam[self.mach]+str(jobname)+" "
        if ( self.bs_curdir[self.mach] != "" ):
@@ -89,7 +310,7 @@ class batchque:
        opts += self.bs_wtime[self.mach]+wall+" "
        if ( self.account != ""  and self.bs_accnt[self.mach] != "" ):
           opts += self.bs_accnt[self.mach]+self.account+" "
-       opts +=  self.opts[self.mach]+" "
+       opts +=  self._submit_opts( prog, profile, depends, ncpus )
        if ( self.bs_script[self.mach] ):
           self.jobscript = jobname+"."+pid+".job"
           if ( os.path.exists( self.jobscript ) ):
@@ -103,39 +324,204 @@ class batchque:
           cmd  += " "+opts+self.jobscript
        else:
           cmd  += " "+opts+jobcommand
+       if ( self.mach == "local" ):
+          cmd   = self.bsub[self.mach]+" "+os.path.abspath(self.jobscript)+" > "+stdout+" 2>&1"
 
        if ( os.path.exists( self.stdout ) ):
          os.system( "/bin/rm "+self.stdout )
-       if ( submit ):
-          status = os.system( cmd )
-          if ( status != 0 ):
-             prog.error( "Batch submit returns an error" )
+       if ( submit and self.mach == "local" ):
+          self._local_submit( prog, wall, ncpus, [ 0 ], depends )
+       elif ( submit ):
+          self._batch_submit( prog, cmd )
+
+       self.submit = True
+
+       return( cmd )
+
+   def SubmitArray( self, prog, jobcommand, tasks, curdir=os.getcwd(), jobname="batchjob", wall="4:00", submit=True, ncpus=1, \
+                    profile=None, depends=[] ):
+       "Get the command to submit a list of tasks as one array job, jobcommand gets it's task in $TASK"
+       if ( not self.setup ):
+          prog.error( "Initialize was NOT run first!" )
+       if ( ncpus < 1 ):
+          prog.error( "Number of processors must be one or greater" )
+       if ( self.mach == "local" ):
+          self.Wall_Seconds( prog, wall )
+
+       if ( not os.path.exists(curdir) ):
+          prog.error( "Input current directory does NOT exist: "+curdir )
+       if ( len(tasks) < 2 ):
+          prog.error( "An array job needs at least two tasks, use Submit for a single task" )
+       for task in tasks:
+          if ( str(task) == "" or str(task).find("\n") != -1 ):
+             prog.error( "Array job tasks must be non-empty and on a single line: "+repr(task) )
+
+       cmd    =  self.bsub[self.mach]
+       opts   =  ""
+       pid    = str(os.getpid())
+       # Each task writes to it's own output file, with the array index in the name
+       if ( self.bs_arridx[self.mach] != "" ):
+          stdout = str(jobname)+"."+pid+"."+self.bs_arridx[self.mach]+".stdout.out"
+       else:
+          stdout = str(jobname)+"."+pid+".stdout.out"
+       self.stdout = stdout
+       self.ntasks = len(tasks)
+       indices = "1-"+str(self.ntasks)
+       opts += self.bs_stdout[self.mach]+stdout+" "
+       if ( self.bs_array[self.mach] == "" ):
+          opts += self.bs_jobnam[self.mach]+"'"+str(jobname)+"["+indices+"]' "
+       else:
+          opts += self.bs_jobnam[self.mach]+str(jobname)+" "
+          opts += self.bs_array[self.mach]+indices+" "
+       if ( self.bs_curdir[self.mach] != "" ):
+          opts += self.bs_curdir[self.mach]+curdir+" "
+       opts += self.bs_wtime[self.mach]+wall+" "
+       if ( self.account != ""  and self.bs_accnt[self.mach] != "" ):
+          opts += self.bs_accnt[self.mach]+self.account+" "
+       opts +=  self._submit_opts( prog, profile, depends, ncpus )
+       # The manifest has one task per line, each array task runs the line for it's index
+       self.manifest = jobname+"."+pid+".manifest"
+       mf = open(self.manifest,"w")
+       for task in tasks:
+          mf.write( str(task)+"\n" )
+       mf.close()
+       # Array jobs always use a script so the task can be looked up from the manifest
+       self.jobscript = jobname+"."+pid+".job"
+       if ( os.path.exists( self.jobscript ) ):
+          os.system( "/bin/rm -rf "+self.jobscript )
+       js = open(self.jobscript,"w")
+       js.write( "#!/bin/sh\n" )
+       js.write( "cd "+curdir+"\n" )
+       js.write( self.taskvar+"=`sed -n \"${"+self.bs_arrenv[self.mach]+"}p\" "+os.path.abspath(self.manifest)+"`\n" )
+       js.write( jobcommand+"\n" )
+       js.close()
+       os.chmod(self.jobscript,0o555)
+       cmd  += " "+opts+os.path.abspath(self.jobscript)
+       if ( self.mach == "local" ):
+          cmd   = "for i in `seq 1 "+str(self.ntasks)+"`; do "+self.bs_arrenv[self.mach]+"=$i "+self.bsub[self.mach]+" "+ \
+                  os.path.abspath(self.jobscript)+" > "+self._task_outfile( "$i" )+" 2>&1; done"
+
+       for task in range(1, self.ntasks+1):
+          outfile = self._task_outfile( task )
+          if ( os.path.exists( outfile ) ):
+             os.system( "/bin/rm "+outfile )
+       if ( submit and self.mach == "local" ):
+          self._local_submit( prog, wall, ncpus, range(1, self.ntasks+1), depends )
+       elif ( submit ):
+          self._batch_submit( prog, cmd )
 
        self.submit = True
 
        return( cmd )
 
+   def Wall_Seconds( self, prog, wall ):
+       "Return the wallclock time in seconds from hours:minutes:seconds, hours:minutes or minutes"
+       try:
+          parts = [ int(part) for part in wall.split(":") ]
+       except ValueError:
+          parts = []
+       if ( len(parts) < 1 or len(parts) > 3 or min(parts) < 0 ):
+          prog.error( "Bad wallclock time (should be hours:minutes:seconds, hours:minutes or minutes): "+wall )
+       if ( len(parts) == 1 ): return( parts[0]*60 )
+       if ( len(parts) == 2 ): return( parts[0]*3600 + parts[1]*60 )
+       return( parts[0]*3600 + parts[1]*60 + parts[2] )
+
+   def _local_submit( self, prog, wall, ncpus, indices, depends=[] ):
+       "Queue the job script to run on the local machine, once for each array index (0 if NOT an array job)"
+       walltime = self.Wall_Seconds( prog, wall )
+       jobs     = [ self.jobs[jobid] for jobid in depends ]
+       if ( ncpus > self.maxcpus ):
+          prog.error( "Job asks for more processors than the local machine runs jobs on: "+str(ncpus) )
+       for index in indices:
+          env = dict( os.environ )
+          if ( index == 0 ):
+             outfile = self.stdout
+          else:
+             outfile = self._task_outfile( index )
+             env[self.bs_arrenv[self.mach]] = str(index)
+          outfile = os.path.abspath( outfile )
+          self.jobs[outfile] = self.pool.submit( self._local_run, os.path.abspath(self.jobscript), outfile, env, walltime, ncpus, jobs )
+
+   def _local_run( self, jobscript, outfile, env, walltime, ncpus, depends=[] ):
+       "Run a job script on the local machine when there are enough free processors, returning it's exit status"
+       import subprocess
+       # The jobs depended on were queued first, so they are already running (or done) and can be waited for
+       for job in depends:
+          if ( job.exception() != None or job.result() != 0 ):
+             out = open( outfile+".tmp", "w" )
+             out.write( "Job NOT run as a job it depends on failed\n" )
+             out.close()
+             os.rename( outfile+".tmp", outfile )
+             return( 1 )
+       with self.cpus:
+          self.cpus.wait_for( lambda: self.freecpus >= ncpus )
+          self.freecpus -= ncpus
+       try:
+          # The output file is only there once the job is done, like for a batch system
+          out  = open( outfile+".tmp", "w" )
+          proc = subprocess.Popen( [ self.bsub[self.mach], jobscript ], stdout=out, stderr=subprocess.STDOUT, \
+                                   env=env, start_new_session=True )
+          try:
+             rcode = proc.wait( timeout=walltime )
+          except subprocess.TimeoutExpired:
+             os.killpg( proc.pid, signal.SIGKILL )
+             rcode = proc.wait()
+             out.write( "\nJob killed after going over wallclock time of "+str(walltime)+" seconds\n" )
+          out.close()
+          os.rename( outfile+".tmp", outfile )
+       finally:
+          with self.cpus:
+             self.freecpus += ncpus
+             self.cpus.notify_all()
+       return( rcode )
+
+   def Get_ExitStatus( self, prog, task=None, wait=True ):
+       "Get the exit status of a job run on the local machine (None if it's still running and NOT waiting for it)"
+       if ( self.mach != "local" ):
+          prog.error( "The exit status is only known for jobs run on the local machine" )
+       outfile = os.path.abspath( self.Get_OutFilename( prog, task ) )
+       if ( outfile not in self.jobs ):
+          prog.error( "Job was NOT submitted to run on the local machine: "+outfile )
+       job = self.jobs[outfile]
+       if ( not wait and not job.done() ):
+          return( None )
+       return( job.result() )
+
+   def Wait( self, prog ):
+       "Wait for all the jobs submitted to the local machine, returning their exit status by output filename"
+       if ( self.mach != "local" ):
+          prog.error( "Can only wait for jobs run on the local machine" )
+       status = {}
+       for outfile in sorted( self.jobs ):
+          status[outfile] = self.jobs[outfile].result()
+       return( status )
+
    def SubmitCleanup( self, prog, rmout=False ):
        "Cleanup any files made in submit and reset output filename -- only DO AFTER BATCH HAS RUN!"
        if ( not self.setup  ):
           prog.error( "Initialize was NOT run first!" )
        if ( not self.submit ):
           prog.error( "Submit was NOT run first!" )
-       outfile = self.Get_OutFilename( prog )
-       if ( not os.path.exists(outfile) ):
-          prog.error( "SubmitCleanup called before batch output was returned" )
+       outfiles = self.Get_OutFilenames( prog )
+       for outfile in outfiles:
+          if ( not os.path.exists(outfile) ):
+             prog.error( "SubmitCleanup called before batch output was returned" )
 
-       if ( self.bs_script[self.mach] ):
+       if ( self.bs_script[self.mach] or self.ntasks > 0 ):
          os.system( "/bin/rm -rf "+self.jobscript )
+       if ( self.ntasks > 0 ):
+         os.system( "/bin/rm -f "+self.manifest )
        if ( rmout ):
-         os.system( "/bin/rm "+outfile )
+         for outfile in outfiles:
+            os.system( "/bin/rm "+outfile )
 
        self.submit = False
+       self.ntasks = 0
 
 #
 # Unit testing for above classes
 #
-import unittest
+import unittest, subprocess, tempfile, shutil
 
 class error_prog:
      def error( self, desc ):
@@ -165,6 +551,14 @@ class test_batchque(unittest.TestCase):
        self.assertTrue(keylist == str(self.que.bs_jobnam.keys()) )
        self.assertTrue(keylist == str(self.que.bs_accnt.keys())  )
        self.assertTrue(keylist == str(self.que.bs_curdir.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_array.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_arrenv.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_arridx.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_depend.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_depjob.keys())  )
+       self.assertTrue(keylist == str(self.que.bs_depsep.keys())  )
+       for profile in self.que.profiles:
+          self.assertTrue(keylist == str(self.que.profiles[profile].keys()) )
 
    def test_init( self ):
        "test initialization and submit"
@@ -188,6 +582,198 @@ class test_batchque(unittest.TestCase):
        print( "outfile: "+outfile )
        self.que.SubmitCleanup( self.prog, rmout=True )
 
+   def test_array( self ):
+       "test submitting a list of tasks as an array job"
+       tasks = [ "US-UMB", "US-Ha1", "BR-Sa1" ]
+       self.que.Initialize( self.prog, mach="cheyenne", account="account" )
+       self.assertRaises(SystemExit, self.que.SubmitArray, self.prog, "echo $TASK", [ "US-UMB" ], submit=False )
+       self.assertRaises(SystemExit, self.que.SubmitArray, self.prog, "echo $TASK", [ "US-UMB", "" ], submit=False )
+       for mach in self.que.opts.keys():
+          self.que.Initialize( self.prog, mach=mach )
+          cmd = self.que.SubmitArray( self.prog, "echo $TASK", tasks, jobname=mach, submit=False )
+          print( cmd+"\n" )
+          # One scheduler call for all of the tasks
+          self.assertEqual( cmd.count( self.que.bsub[mach] ), 1 )
+          if ( mach == "local" ):
+             self.assertTrue( cmd.find( "seq 1 3" ) != -1 )
+          else:
+             self.assertTrue( cmd.find( "1-3" ) != -1 )
+          self.assertRaises(SystemExit, self.que.Get_OutFilename, self.prog )
+          self.assertRaises(SystemExit, self.que.Get_OutFilename, self.prog, 4 )
+          outfiles = self.que.Get_OutFilenames( self.prog )
+          self.assertEqual( len(outfiles), 3 )
+          self.assertEqual( len(set(outfiles)), 3 )
+          self.assertTrue( outfiles[1].find( "2" ) != -1 )
+          # Run the job script as the batch system would for each index
+          for i in range(len(tasks)):
+             env = dict( os.environ )
+             env[self.que.bs_arrenv[mach]] = str(i+1)
+             output = subprocess.check_output( [ "./"+self.que.jobscript ], env=env )
+             self.assertEqual( output.decode().strip(), tasks[i] )
+          self.assertRaises(SystemExit, self.que.SubmitCleanup, self.prog )
+          for outfile in outfiles:
+             os.system( "touch "+outfile )
+          manifest = self.que.manifest
+          self.que.SubmitCleanup( self.prog, rmout=True )
+          self.assertTrue( not os.path.exists( manifest ) )
+          for outfile in outfiles:
+             self.assertTrue( not os.path.exists( outfile ) )
+       # Ask for more processors to run several tasks at once
+       mach = "edison"
+       self.que.Initialize( self.prog, mach=mach )
+       cmd = self.que.SubmitArray( self.prog, "echo $TASK", tasks, jobname=mach, submit=False, ncpus=4 )
+       self.assertTrue( cmd.find( "ppn=4" ) != -1 )
+       self.assertRaises(SystemExit, self.que.SubmitArray, self.prog, "echo $TASK", tasks, submit=False, ncpus=0 )
+       os.system( "/bin/rm -f "+self.que.jobscript+" "+self.que.manifest )
+       # A single task submission after an array job gets a single output file
+       self.que.Submit( self.prog, "ls", jobname=mach, submit=False )
+       self.assertRaises(SystemExit, self.que.Get_OutFilename, self.prog, 1 )
+       os.system( "touch "+self.que.Get_OutFilename( self.prog ) )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+
+   def test_local( self ):
+       "test running jobs on the local machine"
+       self.assertRaises(SystemExit, self.que.Initialize, self.prog, mach="local", maxcpus=0 )
+       self.que.Initialize( self.prog, mach="local", account="account", maxcpus=4 )
+       self.assertEqual( self.que.account, "" )
+       self.assertRaises(SystemExit, self.que.Wall_Seconds, self.prog, "--zztop" )
+       self.assertEqual( self.que.Wall_Seconds( self.prog, "02:00:00" ), 7200 )
+       self.assertEqual( self.que.Wall_Seconds( self.prog, "4:00" ), 14400 )
+       self.assertEqual( self.que.Wall_Seconds( self.prog, "10" ), 600 )
+       # Exit status and output of a job
+       self.que.Submit( self.prog, "echo local job; exit 3", jobname="local" )
+       self.assertEqual( self.que.Get_ExitStatus( self.prog ), 3 )
+       outfile = self.que.Get_OutFilename( self.prog )
+       self.assertEqual( open( outfile ).read(), "local job\n" )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       # A job that goes over it's wallclock time is killed
+       start = time.time()
+       self.que.Submit( self.prog, "sleep 30", jobname="local", wall="0:00:01" )
+       self.assertNotEqual( self.que.Get_ExitStatus( self.prog ), 0 )
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertTrue( open( self.que.Get_OutFilename( self.prog ) ).read().find( "wallclock" ) != -1 )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       self.assertRaises(SystemExit, self.que.Submit, self.prog, "ls", jobname="local", ncpus=5 )
+       # Array jobs run at the same time up to the number of processors
+       tasks = [ "US-UMB", "US-Ha1", "BR-Sa1", "BR-Sa3" ]
+       start = time.time()
+       self.que.SubmitArray( self.prog, "sleep 1; echo $TASK", tasks, jobname="local" )
+       self.assertEqual( self.que.Get_ExitStatus( self.prog, 2, wait=False ), None )
+       for task in range(1, len(tasks)+1):
+          self.assertEqual( self.que.Get_ExitStatus( self.prog, task ), 0 )
+          self.assertEqual( open( self.que.Get_OutFilename( self.prog, task ) ).read(), tasks[task-1]+"\n" )
+       self.assertLess( time.time() - start, 3.0 )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       # Jobs that ask for more processors wait for them
+       start = time.time()
+       self.que.SubmitArray( self.prog, "sleep 1", tasks[:2], jobname="local", ncpus=3 )
+       self.que.Get_ExitStatus( self.prog, 1 )
+       self.que.Get_ExitStatus( self.prog, 2 )
+       self.assertGreater( time.time() - start, 2.0 )
+       status = self.que.Wait( self.prog )
+       self.assertEqual( status[os.path.abspath( self.que.Get_OutFilename( self.prog, 2 ) )], 0 )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       # Exit status is only known on the local machine
+       self.que.Initialize( self.prog, mach="cheyenne" )
+       self.assertRaises(SystemExit, self.que.Get_ExitStatus, self.prog )
+       self.assertRaises(SystemExit, self.que.Wait, self.prog )
+
+   def test_depend( self ):
+       "test submitting jobs with a resource profile that depend on other jobs"
+       self.que.Initialize( self.prog, mach="cheyenne" )
+       cmd = self.que.Submit( self.prog, "ls", jobname="cheyenne", submit=False, profile="shared", \
+                              depends=[ "101.chadmin1", "102[].chadmin1" ] )
+       print( cmd+"\n" )
+       self.assertTrue( cmd.find( " -W depend=afterok:101.chadmin1:102[].chadmin1 " ) != -1 )
+       self.assertTrue( cmd.find( "mem=10GB -q share " ) != -1 )
+       os.system( "/bin/rm -f "+self.que.jobscript )
+       # Without a profile the basic options are used, and the big-memory profile is the same
+       self.assertEqual( self.que.profiles["bigmem"], self.que.opts )
+       cmd = self.que.Submit( self.prog, "ls", jobname="cheyenne", submit=False )
+       self.assertTrue( cmd.find( "depend" ) == -1 )
+       self.assertTrue( cmd.find( "mem=109GB -q regular " ) != -1 )
+       os.system( "/bin/rm -f "+self.que.jobscript )
+       self.assertRaises(SystemExit, self.que.Submit, self.prog, "ls", submit=False, profile="zztop" )
+       self.assertRaises(SystemExit, self.que.Submit, self.prog, "ls", submit=False, depends=[ "" ] )
+       self.que.Initialize( self.prog, mach="yellowstone" )
+       cmd = self.que.SubmitArray( self.prog, "echo $TASK", [ "US-UMB", "US-Ha1" ], jobname="yellowstone", submit=False, \
+                                   profile="bigmem", depends=[ "301", "302" ] )
+       print( cmd+"\n" )
+       self.assertTrue( cmd.find( " -w 'done(301) && done(302)' -ti " ) != -1 )
+       self.assertTrue( cmd.find( "-q geyser" ) != -1 )
+       os.system( "/bin/rm -f "+self.que.jobscript+" "+self.que.manifest )
+       # The job ids to depend on need the job to be submitted
+       self.assertRaises(SystemExit, self.que.Get_DependIDs, self.prog )
+       self.que.jobid  = "303"
+       self.que.ntasks = 2
+       self.que.submit = True
+       self.assertEqual( self.que.Get_DependIDs( self.prog ), [ "303" ] )
+       # Jobs on the local machine wait for the jobs they depend on, and are NOT run if one fails
+       tmpdir = tempfile.mkdtemp()
+       self.que.Initialize( self.prog, mach="local", maxcpus=1 )
+       self.assertRaises(SystemExit, self.que.Submit, self.prog, "ls", submit=False, depends=[ "zztop" ] )
+       self.que.SubmitArray( self.prog, "sleep 1; echo $TASK >> "+tmpdir+"/runs", [ "US-UMB", "US-Ha1" ], jobname="local" )
+       depends = self.que.Get_DependIDs( self.prog )
+       self.assertEqual( len(depends), 2 )
+       self.que.Submit( self.prog, "echo done >> "+tmpdir+"/runs", jobname="local_next", profile="shared", depends=depends )
+       self.assertEqual( self.que.Get_ExitStatus( self.prog ), 0 )
+       self.assertEqual( open( tmpdir+"/runs" ).read().split(), [ "US-UMB", "US-Ha1", "done" ] )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       self.que.Submit( self.prog, "exit 2", jobname="local_fail" )
+       depends = self.que.Get_DependIDs( self.prog )
+       self.que.Submit( self.prog, "echo never >> "+tmpdir+"/runs", jobname="local_next", depends=depends )
+       self.assertEqual( self.que.Get_ExitStatus( self.prog ), 1 )
+       self.assertTrue( open( self.que.Get_OutFilename( self.prog ) ).read().find( "depends on failed" ) != -1 )
+       self.assertEqual( open( tmpdir+"/runs" ).read().split(), [ "US-UMB", "US-Ha1", "done" ] )
+       self.que.SubmitCleanup( self.prog, rmout=True )
+       os.system( "/bin/rm -f local*."+str(os.getpid())+".*" )
+       shutil.rmtree( tmpdir )
+
+   def test_query( self ):
+       "test getting the job id and the status of jobs from the batch system"
+       self.que.Initialize( self.prog, mach="cheyenne" )
+       states = self.que.Parse_Query( self.prog, json.dumps( { "Jobs":{ \
+                   "101.chadmin1":{ "job_state":"F", "Exit_status":0 }, "102[1].chadmin1":{ "job_state":"X", "Exit_status":3 }, \
+                   "102[2].chadmin1":{ "job_state":"R" }, "103.chadmin1":{ "job_state":"Q" } } } ) )
+       self.assertEqual( states, { "101.chadmin1":( "DONE", 0 ), "102[1].chadmin1":( "DONE", 3 ), \
+                                   "102[2].chadmin1":( "RUNNING", None ), "103.chadmin1":( "QUEUED", None ) } )
+       self.assertEqual( self.que.Parse_Query( self.prog, "" ), {} )
+       self.assertRaises(SystemExit, self.que.Parse_Query, self.prog, "qstat: zztop" )
+       self.que.Initialize( self.prog, mach="edison" )
+       states = self.que.Parse_Query( self.prog, "Job Id: 201.edique02\n    job_state = C\n    exit_status = 1\n" + \
+                                                 "Job Id: 202[1].edique02\n    job_state = R\n" )
+       self.assertEqual( states, { "201.edique02":( "DONE", 1 ), "202[1].edique02":( "RUNNING", None ) } )
+       self.que.Initialize( self.prog, mach="yellowstone" )
+       states = self.que.Parse_Query( self.prog, "301,0,DONE,-\n302,2,EXIT,5\n302,3,PEND,-\n" )
+       self.assertEqual( states, { "301":( "DONE", 0 ), "302[2]":( "DONE", 5 ), "302[3]":( "QUEUED", None ) } )
+       # Submit and query with a stand-in for the batch system
+       tmpdir  = tempfile.mkdtemp()
+       qsub    = open( tmpdir+"/qsub", "w" )
+       qsub.write( "#!/bin/sh\necho 401[].chadmin1\n" )
+       qsub.close()
+       qstat   = open( tmpdir+"/qstat", "w" )
+       qstat.write( "#!/bin/sh\necho '{\"Jobs\":{\"401[1].chadmin1\":{\"job_state\":\"F\",\"Exit_status\":0}}}'\n" )
+       qstat.close()
+       os.chmod( tmpdir+"/qsub", 0o755 )
+       os.chmod( tmpdir+"/qstat", 0o755 )
+       path = os.environ["PATH"]
+       os.environ["PATH"] = tmpdir+":"+path
+       try:
+          self.que.Initialize( self.prog, mach="cheyenne" )
+          self.que.SubmitArray( self.prog, "echo $TASK", [ "US-UMB", "US-Ha1" ], jobname="cheyenne" )
+          self.assertEqual( self.que.Get_JobID( self.prog, 1 ), "401[1].chadmin1" )
+          states = self.que.Query( self.prog, [ "401[1].chadmin1", "401[2].chadmin1" ] )
+          self.assertEqual( states, { "401[1].chadmin1":( "DONE", 0 ) } )
+       finally:
+          os.environ["PATH"] = path
+          os.system( "/bin/rm -f "+self.que.jobscript+" "+self.que.manifest )
+          shutil.rmtree( tmpdir )
+       self.que.Initialize( self.prog, mach="yellowstone" )
+       self.que.jobid = "501"
+       self.que.ntasks = 0
+       self.que.submit = True
+       self.assertEqual( self.que.Get_JobID( self.prog ), "501" )
+
    def test_bad_submit( self ):
        "test bad submit"
        mach = "cheyenne"
@@ -204,17 +790,16 @@ class test_batchque(unittest.TestCase):
        for sname in startname:
           if ( host.startswith(sname) ):
              mach = startname[sname]
-       if ( mach != "" ):
-          if   ( mach == "yellowstone" ):
-             account = "CESM0008"
-          elif ( mach == "cheyenne" ):
-             account = "P93300606"
-          else:
-             account = ""
-          self.que.Initialize( self.prog, mach=mach, account=account )
+       if ( mach == "" ):
+          print( "Machine not known, so test submit to the local machine" )
+          mach = "local"
+       if   ( mach == "yellowstone" ):
+          account = "CESM0008"
+       elif ( mach == "cheyenne" ):
+          account = "P93300606"
        else:
-          print( "Machine not known, so NOT trying a test submit" )
-          return
+          account = ""
+       self.que.Initialize( self.prog, mach=mach, account=account )
 
        print( "Submit ls to batch queue" )
        # Submit and get the output filename
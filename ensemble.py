@@ -0,0 +1,321 @@
+#########################################################################################
+#
+# ensemble.py
+#
+# Python class for the members of an ensemble of surface datasets for a site, that
+# differ only in the PFT fractions and indices or the sand and clay percentages given
+# to mksurfdata.pl. The members are read from a table (a CSV file with a column for
+# each setting that is changed) or sampled from a spec of ranges, with a Latin
+# hypercube so the ranges are evenly covered for any number of members.
+#
+#  Table (settings NOT given use the site data):
+#
+#     member,soil_snd,soil_cly,pft_frc,pft_idx
+#     sandy,80,10,"70,30","7,1"
+#     clayey,20,60,"70,30","7,1"
+#
+#  Sampling spec (n members, ranges are lo:hi, lists of PFT indices are seperated by ";"
+#  and pft_frc=random samples the fractions for them). Clay is sampled in the part of it's
+#  range that keeps sand and clay from adding to more than 100:
+#
+#     n=20,seed=1,soil_snd=20:80,soil_cly=5:40,pft_idx=7;1,pft_frc=random
+#
+#########################################################################################
+import os, sys, re, csv, random
+
+class ensemble:
+#----------------------------------------------------------------------------------------
+# Class to handle the members of an ensemble
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   settings = [ "soil_snd", "soil_cly", "pft_frc", "pft_idx" ]
+   soil     = [ "soil_snd", "soil_cly" ]
+   pfts     = [ "pft_frc", "pft_idx" ]
+   maxsize  = 1000     # Most members allowed in an ensemble
+   prefix   = "member"
+
+   def Initialize( self, prog, spec ):
+      "Initialize the ensemble from a table file or a sampling spec"
+      if ( os.path.isfile( spec ) ):
+         self.members = self._table( prog, spec )
+      elif ( spec.find( "=" ) != -1 ):
+         self.members = self._sample( prog, spec )
+      else:
+         prog.error( "Ensemble is NOT a table file or a sampling spec (name=value,...): "+spec )
+      if ( len(self.members) == 0 ):
+         prog.error( "Ensemble does NOT have any members: "+spec )
+      if ( len(self.members) > self.maxsize ):
+         prog.error( "Ensemble has more than "+str(self.maxsize)+" members: "+spec )
+      names = [ member["member"] for member in self.members ]
+      for member in self.members:
+         self._check( prog, member )
+         if ( names.count( member["member"] ) > 1 ):
+            prog.error( "Ensemble member name is used more than once: "+member["member"] )
+      self.setup = True
+
+   def Members( self, prog ):
+      "Return the list of members, each a dictionary of the member name and the settings it changes"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      return( self.members )
+
+   def _list( self, prog, name, value ):
+      "Return a list of numbers from a value given as 70,30 or 70;30 or [70, 30]"
+      try:
+         return( [ float(item) for item in re.split( "[,; ]+", value.strip( " []" ) ) ] )
+      except ValueError:
+         prog.error( "Bad list of numbers for ensemble "+name+": "+value )
+
+   def _number( self, prog, name, value ):
+      "Return a number from a value"
+      try:
+         return( float(value) )
+      except ValueError:
+         prog.error( "Bad number for ensemble "+name+": "+value )
+
+   def _table( self, prog, filename ):
+      "Read the members from a table file"
+      infile = open( filename, "r" )
+      rows   = [ row for row in csv.DictReader( infile, skipinitialspace=True ) ]
+      infile.close()
+      members = []
+      for row in rows:
+         member = {}
+         for name in row:
+            if ( name == None or row[name] == None ):
+               prog.error( "Ensemble table has a row with the wrong number of columns: "+filename )
+            name = name.strip()
+            if ( name != "member" and name not in self.settings ):
+               prog.error( "Ensemble table has a column that is NOT a setting ("+",".join( self.settings )+"): "+name )
+         for name in row:
+            value = row[name].strip()
+            if ( name.strip() == "member" ):
+               member["member"] = value
+            elif ( name.strip() in self.pfts ):
+               member[name.strip()] = self._list( prog, name, value )
+            else:
+               member[name.strip()] = self._number( prog, name, value )
+         if ( member.get( "member", "" ) == "" ):
+            member["member"] = self.prefix+"%03d" % (len(members)+1)
+         members.append( member )
+      return( members )
+
+   def _sample( self, prog, spec ):
+      "Sample the members from a spec of ranges"
+      settings = {}
+      for item in spec.split( "," ):
+         if ( item.find( "=" ) == -1 ):
+            prog.error( "Bad format for ensemble sampling spec (should be name=value,...): "+spec )
+         ( name, value ) = [ part.strip() for part in item.split( "=", 1 ) ]
+         if ( name not in [ "n", "seed" ] + self.settings ):
+            prog.error( "Ensemble sampling spec has a name that is NOT n, seed or a setting: "+name )
+         settings[name] = value
+      if ( "n" not in settings or not settings["n"].isdigit() ):
+         prog.error( "Ensemble sampling spec needs the number of members (n=N): "+spec )
+      nmem  = int(settings["n"])
+      rand  = random.Random( settings.get( "seed" ) )
+      ranges = {}
+      for name in self.soil:
+         if ( name in settings ):
+            bounds = settings[name].split( ":" )
+            if ( len(bounds) == 1 ): bounds = bounds*2
+            ranges[name] = [ self._number( prog, name, bound ) for bound in bounds ]
+            if ( len(ranges[name]) != 2 or ranges[name][0] > ranges[name][1] ):
+               prog.error( "Bad range for ensemble "+name+" (should be lo:hi): "+settings[name] )
+      if ( len(ranges) == 2 ):
+         # Sand is kept low enough to leave room for the least clay
+         if ( ranges["soil_snd"][0] + ranges["soil_cly"][0] > 100.0 ):
+            prog.error( "Ensemble ranges for soil_snd and soil_cly always add to more than 100: "+spec )
+         ranges["soil_snd"][1] = min( ranges["soil_snd"][1], 100.0 - ranges["soil_cly"][0] )
+      pft_idx = None
+      if ( "pft_idx" in settings ):
+         pft_idx = self._list( prog, "pft_idx", settings["pft_idx"] )
+      if ( ("pft_frc" in settings) != (pft_idx != None) ):
+         prog.error( "Ensemble sampling spec needs both pft_frc and pft_idx or neither" )
+      members = []
+      # Latin hypercube: each range is split into n equal parts, and each member gets a
+      # different part for each setting (at a random place in it). The clay range of a member
+      # is cut off at 100 minus it's sand, so the parts of clay are of that range
+      strata = {}
+      for name in sorted( ranges ):
+         strata[name] = list( range( nmem ) )
+         rand.shuffle( strata[name] )
+      for n in range( nmem ):
+         member = { "member":self.prefix+"%03d" % (n+1) }
+         parts  = {}
+         for name in sorted( ranges ):
+            parts[name] = (strata[name][n] + rand.random())/nmem
+         for name in self.soil:
+            if ( name not in ranges ): continue
+            ( lo, hi ) = ranges[name]
+            if ( name == "soil_cly" and "soil_snd" in member ):
+               hi = min( hi, 100.0 - member["soil_snd"] )
+            member[name] = round( lo + (hi-lo)*parts[name], 2 )
+         if ( pft_idx != None ):
+            member["pft_idx"] = pft_idx
+            if ( settings["pft_frc"] == "random" ):
+               member["pft_frc"] = self._fractions( rand, len(pft_idx) )
+            else:
+               member["pft_frc"] = self._list( prog, "pft_frc", settings["pft_frc"] )
+         members.append( member )
+      return( members )
+
+   def _fractions( self, rand, npft ):
+      "Return random PFT fractions that add to 100 (uniform over all the possible fractions)"
+      cuts  = sorted( [ rand.random() for n in range( npft-1 ) ] )
+      frcs  = [ round( 100.0*(hi-lo), 2 ) for ( lo, hi ) in zip( [ 0.0 ]+cuts, cuts+[ 1.0 ] ) ]
+      frcs[-1] = round( 100.0 - sum( frcs[:-1] ), 2 )
+      return( frcs )
+
+   def _check( self, prog, member ):
+      "Check the settings for a member"
+      name = member["member"]
+      if ( not re.match( "^[A-Za-z0-9_.-]+$", name ) ):
+         prog.error( "Ensemble member name can only have letters, numbers, '_', '.' and '-': "+name )
+      for setting in self.soil:
+         if ( setting in member and (member[setting] < 0.0 or member[setting] > 100.0) ):
+            prog.error( "Ensemble member "+name+" "+setting+" is NOT between 0 and 100: "+str(member[setting]) )
+      if ( member.get( "soil_snd", 0.0 ) + member.get( "soil_cly", 0.0 ) > 100.0 ):
+         prog.error( "Ensemble member "+name+" has sand and clay that add to more than 100" )
+      if ( ("pft_frc" in member) != ("pft_idx" in member) ):
+         prog.error( "Ensemble member "+name+" needs both pft_frc and pft_idx or neither" )
+      if ( "pft_frc" in member ):
+         if ( len(member["pft_frc"]) != len(member["pft_idx"]) ):
+            prog.error( "Ensemble member "+name+" has a different number of pft_frc and pft_idx values" )
+         if ( abs( sum( member["pft_frc"] ) - 100.0 ) > 1.e-6 or min( member["pft_frc"] ) < 0.0 ):
+            prog.error( "Ensemble member "+name+" pft_frc values do NOT add to 100" )
+         for idx in member["pft_idx"]:
+            if ( idx < 0 or idx != int(idx) ):
+               prog.error( "Ensemble member "+name+" has a bad pft_idx: "+str(idx) )
+         member["pft_idx"] = [ int(idx) for idx in member["pft_idx"] ]
+
+   def Options( self, prog, member, soilopts, pftopts ):
+      "Return the site options for mksurfdata.pl for a member (the soil and PFT options given are used if it does NOT change them)"
+      if ( "soil_snd" in member or "soil_cly" in member ):
+         # Settings NOT changed by the member come from the site options
+         soil = dict( re.findall( "-(soil_cly|soil_snd) (\\S+)", soilopts ) )
+         for setting in self.soil:
+            if ( setting in member ): soil[setting] = str(member[setting])
+            if ( setting not in soil ):
+               prog.error( "Ensemble member "+member["member"]+" does NOT give "+setting+" and the site does NOT either" )
+         soilopts = " -soil_cly "+soil["soil_cly"]+" -soil_snd "+soil["soil_snd"]
+      if ( "pft_frc" in member ):
+         crop    = re.findall( " -(?:no-)?crop$", pftopts )
+         pftopts = " -pft_frc \""+str(member["pft_frc"])+"\" -pft_idx \""+str(member["pft_idx"])+"\""
+         if ( len(crop) > 0 ): pftopts += crop[0]
+      return( soilopts+pftopts )
+
+   def Settings( self, prog, member, site ):
+      "Return the settings for a member as a dictionary (the site settings given are used if it does NOT change them)"
+      settings = dict( site )
+      for setting in self.settings:
+         if ( setting in member ): settings[setting] = member[setting]
+      return( settings )
+
+   def Write( self, prog, filename, surffiles ):
+      "Write a table of the members with the surface dataset for each (keyed by member)"
+      output = open( filename+".tmp", "w" )
+      writer = csv.writer( output, lineterminator="\n" )
+      writer.writerow( [ "member" ] + self.settings + [ "surffile" ] )
+      for member in self.Members( prog ):
+         row = [ member["member"] ]
+         for setting in self.settings:
+            value = member.get( setting, "" )
+            if ( isinstance( value, list ) ): value = ",".join( [ str(item) for item in value ] )
+            row.append( value )
+         writer.writerow( row + [ surffiles.get( member["member"], "" ) ] )
+      output.close()
+      os.rename( filename+".tmp", filename )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil
+
+class error_prog:
+     def error( self, desc ):
+         print( "ERROR(test):: "+desc )
+         sys.exit( 100 )
+
+class test_ensemble(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = error_prog()
+       self.ens    = ensemble()
+       self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write( self, text ):
+       "Write an ensemble table"
+       filename = tempfile.mktemp( suffix=".csv", dir=self.tmpdir )
+       output   = open( filename, "w" )
+       output.write( text )
+       output.close()
+       return( filename )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.ens.Members, self.prog )
+       for spec in [ "zztop", "n=0", "soil_snd=10:20", "n=2,zztop=1", "n=2,soil_snd=30:20", "n=2,pft_idx=1;7", \
+                     "n=2,soil_snd=90,soil_cly=20", "n=1001", "n=2,pft_idx=1;7,pft_frc=50;40", \
+                     self.write( "member,soil_snd\nsandy,80\nsandy,70\n" ), self.write( "member,zztop\na,1\n" ), \
+                     self.write( "member,pft_frc,pft_idx\na,\"50,50\",\"1,-2\"\n" ), \
+                     self.write( "member,pft_frc,pft_idx\na,\"50,50\",7\n" ), self.write( "member,soil_snd\na b,80\n" ), \
+                     self.write( "member,soil_snd\na,zz\n" ), self.write( "member,soil_snd\na,10,20\n" ) ]:
+          self.assertRaises(SystemExit, ensemble().Initialize, self.prog, spec )
+
+   def test_table( self ):
+       "test reading a table of members"
+       self.ens.Initialize( self.prog, self.write( "member, soil_snd, pft_frc, pft_idx\nsandy,80,\"70,30\",\"7,1\"\n,20,[100],[7]\n" ) )
+       members = self.ens.Members( self.prog )
+       self.assertEqual( members[0], { "member":"sandy", "soil_snd":80.0, "pft_frc":[ 70.0, 30.0 ], "pft_idx":[ 7, 1 ] } )
+       self.assertEqual( members[1]["member"], "member002" )
+       siteopts = ( " -soil_cly 20.0 -soil_snd 50.0", " -pft_frc \"[100.0]\" -pft_idx \"[13]\" -no-crop" )
+       self.assertEqual( self.ens.Options( self.prog, members[0], *siteopts ), \
+                         " -soil_cly 20.0 -soil_snd 80.0 -pft_frc \"[70.0, 30.0]\" -pft_idx \"[7, 1]\" -no-crop" )
+       self.assertRaises(SystemExit, self.ens.Options, self.prog, members[0], "", "" )
+       site = { "soil_snd":50.0, "soil_cly":20.0, "pft_frc":[ 100.0 ], "pft_idx":[ 13 ] }
+       self.assertEqual( self.ens.Settings( self.prog, members[1], site ), \
+                         { "soil_snd":20.0, "soil_cly":20.0, "pft_frc":[ 100.0 ], "pft_idx":[ 7 ] } )
+       self.ens.Write( self.prog, self.tmpdir+"/members.csv", { "sandy":"surfdata_sandy.nc" } )
+       infile = open( self.tmpdir+"/members.csv", "r" )
+       self.assertEqual( infile.readlines()[1].strip(), "sandy,80.0,,\"70.0,30.0\",\"7,1\",surfdata_sandy.nc" )
+       infile.close()
+
+   def test_sample( self ):
+       "test sampling members"
+       self.ens.Initialize( self.prog, "n=10,seed=1,soil_snd=20:80,soil_cly=5:15,pft_idx=7;1;13,pft_frc=random" )
+       members = self.ens.Members( self.prog )
+       self.assertEqual( len(members), 10 )
+       # Each tenth of the range has one member
+       self.assertEqual( sorted( [ int((member["soil_snd"]-20.0)/6.0) for member in members ] ), list( range( 10 ) ) )
+       for member in members:
+          self.assertAlmostEqual( sum( member["pft_frc"] ), 100.0 )
+          self.assertEqual( member["pft_idx"], [ 7, 1, 13 ] )
+       # The same seed gives the same members
+       ens = ensemble()
+       ens.Initialize( self.prog, "n=10,seed=1,soil_snd=20:80,soil_cly=5:15,pft_idx=7;1;13,pft_frc=random" )
+       self.assertEqual( ens.Members( self.prog ), members )
+       # The spec in the documentation gives sand and clay that add to 100 or less for any seed
+       for seed in range( 1, 21 ):
+          ens.Initialize( self.prog, "n=20,seed="+str(seed)+",soil_snd=20:80,soil_cly=5:40,pft_idx=7;1,pft_frc=random" )
+          members = ens.Members( self.prog )
+          self.assertEqual( len(members), 20 )
+          for member in members:
+             self.assertLessEqual( member["soil_snd"] + member["soil_cly"], 100.0 )
+             self.assertTrue( 20.0 <= member["soil_snd"] <= 80.0 and 5.0 <= member["soil_cly"] <= 40.0 )
+       ens.Initialize( self.prog, "n=5,seed=1,soil_snd=50:99,soil_cly=10:60" )
+       for member in ens.Members( self.prog ):
+          self.assertLessEqual( member["soil_snd"], 90.0 )
+          self.assertLessEqual( member["soil_snd"] + member["soil_cly"], 100.0 )
+       self.assertRaises(SystemExit, ens.Initialize, self.prog, "n=5,soil_snd=60:80,soil_cly=50:60" )
+       ens.Initialize( self.prog, "n=2,soil_cly=30,pft_idx=7;1,pft_frc=60;40" )
+       self.assertEqual( ens.Members( self.prog )[1], { "member":"member002", "soil_cly":30.0, "pft_idx":[ 7, 1 ], \
+                                                        "pft_frc":[ 60.0, 40.0 ] } )
+
+if __name__ == '__main__':
+     unittest.main()
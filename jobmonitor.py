@@ -0,0 +1,305 @@
+#########################################################################################
+#
+# jobmonitor.py
+#
+# Python class to wait for many jobs submitted with batchque at the same time. The batch
+# system is asked for the status of all the jobs still running with one query each
+# interval (rather than a sleep loop for each job), and the output files are checked. Jobs
+# run on the local machine are seen as soon as they finish. Each job is handed back
+# with it's exit status as it completes, so follow up work can start right away. A job
+# the batch system no longer knows about that never wrote it's output is handed back as
+# lost. Jobs can be added after the jobs they depend on, so when a job fails the jobs
+# waiting on it (that the batch system won't run) are handed back as not run right away.
+#
+#########################################################################################
+import os, sys, time, asyncio
+
+class jobmonitor:
+#----------------------------------------------------------------------------------------
+# Class to handle monitoring of batch jobs
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   interval = 20.0     # Seconds between queries of the batch system
+   lost_intervals = 3  # Number of queries a job is missing from (without output) before it's lost
+
+   def Initialize( self, prog, que, interval=20.0 ):
+      "Initialize the monitor for jobs submitted with the given batchque"
+      if ( not que.setup ):
+         prog.error( "batchque Initialize was NOT run first!" )
+      if ( interval <= 0.0 ):
+         prog.error( "Interval to check jobs must be greater than zero" )
+      self.que      = que
+      self.interval = interval
+      self.jobs     = {}
+      self.setup    = True
+
+   def Add( self, prog, jobid, outfile, name=None, after=[] ):
+      "Add a job to monitor, by it's job id and output file (after is the list of jobs it depends on)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( jobid in self.jobs ):
+         prog.error( "Job is already being monitored: "+jobid )
+      for dep in after:
+         if ( dep not in self.jobs ):
+            prog.error( "Job depends on a job that is NOT being monitored: "+dep )
+      if ( name == None ): name = jobid
+      self.jobs[jobid] = { "jobid":jobid, "name":name, "outfile":os.path.abspath( outfile ), "after":list( after ) }
+
+   def AddSubmitted( self, prog, names=None, after=[] ):
+      "Add the job (or each task of the array job) last submitted with the batchque, names are given for each task"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( self.que.ntasks == 0 ):
+         tasks = [ None ]
+      else:
+         tasks = range( 1, self.que.ntasks+1 )
+      if ( names != None and len(names) != len(tasks) ):
+         prog.error( "Number of names does NOT match the number of jobs submitted" )
+      for n, task in enumerate( tasks ):
+         name = None
+         if ( names != None ): name = names[n]
+         self.Add( prog, self.que.Get_JobID( prog, task ), self.que.Get_OutFilename( prog, task ), name, after )
+
+   def Pending( self ):
+      "Return the number of jobs that have NOT completed"
+      if ( not self.setup ):
+         return( 0 )
+      return( len( [ job for job in self.jobs.values() if "status" not in job ] ) )
+
+   async def Events( self, prog ):
+      "Yield each job as it completes, with it's exit status (None if the batch system doesn't give it)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      loop    = asyncio.get_running_loop()
+      queue   = asyncio.Queue()
+      pending = set( [ jobid for jobid in self.jobs if "status" not in self.jobs[jobid] ] )
+      poller  = None
+      if ( self.que.mach == "local" ):
+         # Local jobs tell us when they are done
+         def done( job, jobid ):
+            status = None
+            if ( job.exception() == None ): status = job.result()
+            loop.call_soon_threadsafe( queue.put_nowait, ( jobid, status, None ) )
+         for jobid in pending:
+            if ( jobid not in self.que.jobs ):
+               prog.error( "Job was NOT submitted to run on the local machine: "+jobid )
+            self.que.jobs[jobid].add_done_callback( lambda job, jobid=jobid: done( job, jobid ) )
+      elif ( len(pending) > 0 ):
+         poller = asyncio.ensure_future( self._poll( prog, set(pending), queue ) )
+      try:
+         while ( len(pending) > 0 ):
+            get = asyncio.ensure_future( queue.get() )
+            waitfor = [ get ]
+            if ( poller != None ): waitfor.append( poller )
+            await asyncio.wait( waitfor, return_when=asyncio.FIRST_COMPLETED )
+            if ( not get.done() ):
+               # The poller can only finish early if there was an error
+               get.cancel()
+               poller.result()
+               prog.error( "Stopped checking jobs before they all completed" )
+            ( jobid, status, flag ) = get.result()
+            if ( jobid not in pending ): continue
+            pending.discard( jobid )
+            job = self.jobs[jobid]
+            job["status"] = status
+            if ( flag != None ): job[flag] = True
+            # The jobs waiting on a job that failed are NOT run by the batch system
+            if ( flag != None or status not in [ 0, None ] ):
+               for waiting in sorted( pending ):
+                  if ( jobid in self.jobs[waiting]["after"] ):
+                     queue.put_nowait( ( waiting, None, "not_run" ) )
+            yield( dict( job ) )
+      finally:
+         if ( poller != None and not poller.done() ): poller.cancel()
+
+   async def _poll( self, prog, pending, queue ):
+      "Query the batch system for all the pending jobs each interval, queueing the jobs that completed"
+      missing = {}
+      while ( len(pending) > 0 ):
+         # Run the query in a thread so jobs that completed can be handled while waiting for it
+         states = await asyncio.to_thread( self.que.Query, prog, sorted(pending) )
+         for jobid in sorted(pending):
+            state   = states.get( jobid )
+            outfile = os.path.exists( self.jobs[jobid]["outfile"] )
+            if ( state != None ):
+               missing.pop( jobid, None )
+            if ( state != None and state[0] == "DONE" ):
+               queue.put_nowait( ( jobid, state[1], None ) )
+               pending.discard( jobid )
+            elif ( state == None and outfile ):
+               # The batch system has forgotten the job, but it's output is there
+               queue.put_nowait( ( jobid, None, None ) )
+               pending.discard( jobid )
+            elif ( state == None ):
+               # Without the output the job is lost once it's been missing for a few queries
+               missing[jobid] = missing.get( jobid, 0 ) + 1
+               if ( missing[jobid] >= self.lost_intervals ):
+                  queue.put_nowait( ( jobid, None, "lost" ) )
+                  pending.discard( jobid )
+         if ( len(pending) > 0 ):
+            await asyncio.sleep( self.interval )
+
+   def Wait( self, prog, callback=None ):
+      "Wait for all of the jobs to complete (or be lost), calling callback with each job as it completes, returns them in order"
+      async def wait( ):
+         completed = []
+         async for job in self.Events( prog ):
+            completed.append( job )
+            if ( callback != None ): callback( job )
+         return( completed )
+      return( asyncio.run( wait() ) )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil
+from batchque import batchque
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_jobmonitor(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.que     = batchque()
+       self.monitor = jobmonitor()
+       self.tmpdir  = tempfile.mkdtemp()
+       self.cwd     = os.getcwd()
+       os.chdir( self.tmpdir )
+
+   def tearDown( self ):
+       os.chdir( self.cwd )
+       shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.monitor.Initialize, self.prog, self.que )
+       self.assertRaises(SystemExit, self.monitor.Add, self.prog, "101", "out" )
+       self.que.Initialize( self.prog, mach="cheyenne" )
+       self.assertRaises(SystemExit, self.monitor.Initialize, self.prog, self.que, interval=0.0 )
+       self.monitor.Initialize( self.prog, self.que )
+       self.monitor.Add( self.prog, "101", "out" )
+       self.assertRaises(SystemExit, self.monitor.Add, self.prog, "101", "out" )
+       self.assertEqual( self.monitor.Pending(), 1 )
+
+   def test_local( self ):
+       "test that local jobs are handed back as they complete with their exit status"
+       self.que.Initialize( self.prog, mach="local", maxcpus=3 )
+       self.monitor.Initialize( self.prog, self.que, interval=100.0 )
+       self.que.SubmitArray( self.prog, "sleep $TASK; exit $TASK", [ "2", "0", "1" ], jobname="local", curdir=self.tmpdir )
+       self.assertRaises(SystemExit, self.monitor.AddSubmitted, self.prog, names=[ "two" ] )
+       self.monitor.AddSubmitted( self.prog, names=[ "two", "zero", "one" ] )
+       self.que.Submit( self.prog, "exit 4", jobname="single", curdir=self.tmpdir )
+       self.monitor.AddSubmitted( self.prog )
+       self.assertEqual( self.monitor.Pending(), 4 )
+       start = time.time()
+       order = []
+       jobs  = self.monitor.Wait( self.prog, callback=lambda job: order.append( job["name"] ) )
+       # Doesn't wait for the interval
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertEqual( [ name for name in order if name in [ "zero", "one", "two" ] ], [ "zero", "one", "two" ] )
+       self.assertEqual( dict( [ ( job["name"], job["status"] ) for job in jobs ] )["two"], 2 )
+       self.assertEqual( [ job["status"] for job in jobs if job["name"] not in [ "zero", "one", "two" ] ], [ 4 ] )
+       self.assertEqual( self.monitor.Pending(), 0 )
+       self.assertEqual( self.monitor.Wait( self.prog ), [] )
+
+   def test_batch( self ):
+       "test that all the jobs are queried with one call each interval"
+       # Stand-in for qstat that counts the calls, says jobs are done once there output is there, and has forgotten job 99
+       qstat = open( self.tmpdir+"/qstat", "w" )
+       qstat.write( "#!/bin/sh\n" + \
+                    "echo call >> "+self.tmpdir+"/qstat.calls\n" + \
+                    "echo '{\"Jobs\":{'\n" + \
+                    "sep=''\n" + \
+                    "for job in $*; do\n" + \
+                    "   case $job in -*|99.*) continue;; esac\n" + \
+                    "   if [ -f "+self.tmpdir+"/out.$job ]; then state='\"F\",\"Exit_status\":0'; else state='\"R\"'; fi\n" + \
+                    "   echo \"$sep\\\"$job\\\":{\\\"job_state\\\":$state}\"; sep=','\n" + \
+                    "done\n" + \
+                    "echo '}}'\n" )
+       qstat.close()
+       os.chmod( self.tmpdir+"/qstat", 0o755 )
+       path = os.environ["PATH"]
+       os.environ["PATH"] = self.tmpdir+":"+path
+       try:
+          self.que.Initialize( self.prog, mach="cheyenne" )
+          self.monitor.Initialize( self.prog, self.que, interval=0.2 )
+          for n in range(50):
+             self.monitor.Add( self.prog, str(n)+".chadmin1", self.tmpdir+"/out."+str(n)+".chadmin1", name="site"+str(n) )
+          # A job the batch system has forgotten is done once it's output is there
+          self.monitor.Add( self.prog, "99.chadmin1", self.tmpdir+"/forgotten.out" )
+          open( self.tmpdir+"/forgotten.out", "w" ).close()
+          def finish( job ):
+             # Finish the rest of the jobs when the first one completes
+             for n in range(50):
+                open( self.tmpdir+"/out."+str(n)+".chadmin1", "w" ).close()
+          open( self.tmpdir+"/out.7.chadmin1", "w" ).close()
+          completed = []
+          def callback( job ):
+             if ( len(completed) == 0 ): finish( job )
+             completed.append( job )
+          self.monitor.Wait( self.prog, callback=callback )
+       finally:
+          os.environ["PATH"] = path
+       self.assertEqual( len(completed), 51 )
+       self.assertEqual( completed[0]["name"], "site7" )
+       self.assertEqual( completed[0]["status"], 0 )
+       self.assertEqual( [ job["status"] for job in completed if job["jobid"] == "99.chadmin1" ], [ None ] )
+       self.assertEqual( [ job for job in completed if job.get("lost") ], [] )
+       calls = open( self.tmpdir+"/qstat.calls" ).read().split()
+       self.assertEqual( len(calls), 2 )
+
+   def test_lost( self ):
+       "test that a job the batch system forgot without writing it's output is handed back as lost"
+       qstat = open( self.tmpdir+"/qstat", "w" )
+       qstat.write( "#!/bin/sh\necho '{\"Jobs\":{\"1.chadmin1\":{\"job_state\":\"F\",\"Exit_status\":0}}}'\n" )
+       qstat.close()
+       os.chmod( self.tmpdir+"/qstat", 0o755 )
+       path = os.environ["PATH"]
+       os.environ["PATH"] = self.tmpdir+":"+path
+       try:
+          self.que.Initialize( self.prog, mach="cheyenne" )
+          self.monitor.Initialize( self.prog, self.que, interval=0.1 )
+          self.monitor.Add( self.prog, "1.chadmin1", self.tmpdir+"/out.1", name="done" )
+          self.monitor.Add( self.prog, "2.chadmin1", self.tmpdir+"/out.2", name="deleted" )
+          self.assertRaises(SystemExit, self.monitor.Add, self.prog, "3.chadmin1", "out.3", after=[ "9.chadmin1" ] )
+          start = time.time()
+          completed = self.monitor.Wait( self.prog )
+       finally:
+          os.environ["PATH"] = path
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertEqual( [ ( job["name"], job["status"], job.get("lost", False) ) for job in completed ], \
+                         [ ( "done", 0, False ), ( "deleted", None, True ) ] )
+       self.assertEqual( self.monitor.Pending(), 0 )
+
+   def test_after( self ):
+       "test that the jobs waiting on a job that failed are handed back as NOT run"
+       # Job 1 fails, and the jobs after it are never run (so the batch system never shows them)
+       qstat = open( self.tmpdir+"/qstat", "w" )
+       qstat.write( "#!/bin/sh\necho '{\"Jobs\":{\"1.chadmin1\":{\"job_state\":\"F\",\"Exit_status\":1}}}'\n" )
+       qstat.close()
+       os.chmod( self.tmpdir+"/qstat", 0o755 )
+       path = os.environ["PATH"]
+       os.environ["PATH"] = self.tmpdir+":"+path
+       try:
+          self.que.Initialize( self.prog, mach="cheyenne" )
+          self.monitor.Initialize( self.prog, self.que, interval=100.0 )
+          self.monitor.Add( self.prog, "1.chadmin1", self.tmpdir+"/out.1", name="prep" )
+          self.monitor.Add( self.prog, "2.chadmin1", self.tmpdir+"/out.2", name="mapping", after=[ "1.chadmin1" ] )
+          self.monitor.Add( self.prog, "3.chadmin1", self.tmpdir+"/out.3", name="surfdata", after=[ "2.chadmin1" ] )
+          start = time.time()
+          completed = self.monitor.Wait( self.prog )
+       finally:
+          os.environ["PATH"] = path
+       # Without waiting for the next interval
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertEqual( [ ( job["name"], job["status"], job.get("not_run", False) ) for job in completed ], \
+                         [ ( "prep", 1, False ), ( "mapping", None, True ), ( "surfdata", None, True ) ] )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,270 @@
+#########################################################################################
+#
+# landusetimeseries.py
+#
+# Python class to convert the transition years files for sites (<site>_dynpftdata.txt)
+# to the landuse_timeseries text files mksurfdata.pl reads with -dynpft (the same text
+# that cnvrt_trnsyrs2_landuse_timeseries_txtfile.pl writes). Each transition table is
+# parsed and checked once, and the years of the sim_year_range are expanded from it
+# with NumPy. Several sites can be converted at once, and the results are kept keyed
+# by a hash of the file contents and the sim_year_range.
+#
+#########################################################################################
+import os, sys, hashlib
+
+class landusetimeseries:
+#----------------------------------------------------------------------------------------
+# Class to handle converting transition years files to landuse timeseries text files
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup   = False
+   maxlen  = 125       # Length of each line before the year
+   numpft  = 5         # Number of PFT fraction and index pairs
+   harvest = [ "har_vh1", "har_vh2", "har_sh1", "har_sh2", "har_sh3" ]
+   graze   = [ "graze" ]
+   maxpft  = 16        # Largest PFT index allowed
+   cache   = {}        # Converted text keyed by hash of the file and years (shared by all objects)
+
+   def Initialize( self, prog ):
+      "Initialize the landuse timeseries converter"
+      try:
+         import numpy
+      except ImportError:
+         prog.error( "The numpy python module is required to convert transition years files" )
+      self.np    = numpy
+      self.setup = True
+
+   def Header( self ):
+      "Return the list of columns expected in the transition years file"
+      pfts = []
+      for n in range( 1, self.numpft+1 ):
+         pfts = pfts + [ "pft_f"+str(n), "pft_c"+str(n) ]
+      return( [ "trans_year" ] + pfts + self.harvest + self.graze + [ "hold_harv", "hold_graze" ] )
+
+   def Key( self, text, sim_year_range ):
+      "Return the key for the converted text of the transition years file contents"
+      return( hashlib.sha1( (sim_year_range+"\n"+text).encode( "utf-8" ) ).hexdigest() )
+
+   def _years( self, prog, sim_year_range ):
+      "Return the start and end year of the sim_year_range"
+      years = sim_year_range.split( "-" )
+      if ( len(years) != 2 or not years[0].isdigit() or not years[1].isdigit() ):
+         prog.error( "bad format for sim_year_range (should be yyyy-yyyy): "+sim_year_range )
+      return( int(years[0]), int(years[1]) )
+
+   def _number( self, prog, filename, value ):
+      "Return the value in the transition years file as a number"
+      try:
+         return( float(value) )
+      except ValueError:
+         prog.error( "Bad number in transition years file "+filename+": "+value )
+
+   def _pftline( self, prog, filename, values ):
+      "Return the PFT fractions and indices for a transition year, stopping when the fractions reach 100"
+      frcs = []
+      idxs = []
+      sum  = 0.0
+      for n in range( self.numpft ):
+         frc = values[2*n]
+         idx = values[2*n+1]
+         if ( sum != 100.0 ):
+            frcs.append( frc )
+            idxs.append( idx )
+         sum += self._number( prog, filename, frc )
+         if ( self._number( prog, filename, idx ) < 0 or self._number( prog, filename, idx ) > self.maxpft ):
+            prog.error( "PFT index is out of range in "+filename+": "+idx )
+         if ( sum > 100.0 ):
+            prog.error( "Sum of PFT fractions exceeds 100 in "+filename+": "+str(sum) )
+      if ( sum != 100.0 ):
+         prog.error( "Sum of PFT fractions does NOT go to 100 in "+filename+": "+str(sum) )
+      return( "<pft_f>"+",".join( frcs )+"</pft_f><pft_i>"+",".join( idxs )+"</pft_i>" )
+
+   def _parse( self, prog, filename, text ):
+      "Parse and check the transition years file, returns the years, PFT lines, harvest and grazing tables and holds"
+      np     = self.np
+      lines  = [ line for line in text.splitlines() if line.strip() != "" ]
+      header = self.Header()
+      if ( len(lines) < 2 ):
+         prog.error( "Transition years file does NOT have any transition years: "+filename )
+      if ( [ name.strip() for name in lines[0].split( "," ) ] != header ):
+         prog.error( "Header of transition years file is NOT as expected ("+",".join( header )+"): "+filename )
+      rows = []
+      for line in lines[1:]:
+         row = [ value.strip() for value in line.split( "," ) ]
+         if ( len(row) != len(header) ):
+            prog.error( "Number of elements in line is incorrect in "+filename+": "+line )
+         rows.append( row )
+      table  = np.array( rows )
+      try:
+         years = table[:,0].astype( int )
+         land  = table[:,1+2*self.numpft:-2].astype( float )
+      except ValueError:
+         prog.error( "Bad number in transition years file: "+filename )
+      if ( np.any( np.diff( years ) <= 0 ) ):
+         prog.error( "Transition years are NOT increasing in: "+filename )
+      if ( np.any( (land < 0.0) | (land > 1.0) ) ):
+         prog.error( "Bad value for harvest or grazing (should be 0 to 1) in: "+filename )
+      pftlines = [ self._pftline( prog, filename, row[1:1+2*self.numpft] ) for row in rows ]
+      # Holds are true unless they are empty or 0 (so harvest and grazing go on after the transition year)
+      holds    = ( table[:,-2:] != "" ) & ( table[:,-2:] != "0" )
+      return( years, pftlines, table[:,1+2*self.numpft:-2], holds )
+
+   def _landline( self, name, values ):
+      "Return the harvest or grazing part of a line"
+      return( "<"+name+">"+",".join( values )+"</"+name+">" )
+
+   def _expand( self, prog, filename, text, sim_year_range ):
+      "Expand the transition years file over the sim_year_range, returns the text of the landuse timeseries file"
+      np = self.np
+      ( start_year, end_year ) = self._years( prog, sim_year_range )
+      ( years, pftlines, land, holds ) = self._parse( prog, filename, text )
+      nharv = len(self.harvest)
+      # Two lines for each transition year, with the harvest and grazing for the year
+      # and for the years after it (zero if they are NOT held)
+      outlines = []
+      for n in range( len(years) ):
+         harv = land[n,:nharv]
+         graz = land[n,nharv:]
+         after_harv = harv if holds[n,0] else [ "0" ]*nharv
+         after_graz = graz if holds[n,1] else [ "0" ]*len(self.graze)
+         for ( h, g ) in [ ( harv, graz ), ( after_harv, after_graz ) ]:
+            line = pftlines[n]+self._landline( "harv", h )+self._landline( "graz", g )
+            if ( len(line) > self.maxlen ):
+               prog.error( "line length is too long in "+filename+" = "+str(len(line)) )
+            outlines.append( line.ljust( self.maxlen )+" " )
+      outlines = np.array( outlines )
+      # Years from the start of the sim_year_range to the last transition year (years before
+      # the first transition year use it) and then from there to the end of the sim_year_range
+      outyears = np.concatenate( [ np.arange( start_year, years[-1]+1 ), np.arange( years[-1]+1, end_year+1 ) ] )
+      row      = np.maximum( np.searchsorted( years, outyears, side="right" ) - 1, 0 )
+      after    = ( outyears > years[row] ).astype( int )
+      return( "".join( np.char.add( np.char.add( outlines[2*row+after], outyears.astype( str ) ), "\n" ) ) )
+
+   def Convert( self, prog, sitefiles, sim_year_range ):
+      "Convert the transition years files (a dictionary of filenames keyed by site), returns the text for each site"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      self._years( prog, sim_year_range )
+      results = {}
+      for site in sorted( sitefiles ):
+         filename = sitefiles[site]
+         if ( not os.path.exists( filename ) ):
+            prog.error( "Transition years file does NOT exist: "+filename )
+         infile = open( filename, "r" )
+         text   = infile.read()
+         infile.close()
+         key = self.Key( text, sim_year_range )
+         if ( key not in self.cache ):
+            self.cache[key] = self._expand( prog, filename, text, sim_year_range )
+         results[site] = self.cache[key]
+      return( results )
+
+   def Write( self, prog, sitefiles, outfiles, sim_year_range ):
+      "Convert the transition years files and write the landuse timeseries text file for each site (keyed by site)"
+      results = self.Convert( prog, sitefiles, sim_year_range )
+      for site in sorted( results ):
+         output = open( outfiles[site]+".tmp", "w" )
+         output.write( results[site] )
+         output.close()
+         os.rename( outfiles[site]+".tmp", outfiles[site] )
+      return( [ outfiles[site] for site in sorted( results ) ] )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, subprocess
+
+class error_prog:
+     def error( self, desc ):
+         print( "ERROR(test):: "+desc )
+         sys.exit( 100 )
+
+class test_landusetimeseries(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.lu      = landusetimeseries()
+       self.tmpdir  = tempfile.mkdtemp()
+       self.sitedir = os.path.dirname( os.path.abspath( __file__ ) )+"/PTCLM_sitedata"
+       landusetimeseries.cache = {}
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write( self, name, rows ):
+       "Write a transition years file with the given rows"
+       filename = self.tmpdir+"/"+name+"_dynpftdata.txt"
+       output   = open( filename, "w" )
+       output.write( ",".join( self.lu.Header() )+"\n" )
+       for row in rows:
+          output.write( row+"\n" )
+       output.close()
+       return( filename )
+
+   def test_badinit( self ):
+       "test bad initialization and bad files"
+       self.assertRaises(SystemExit, self.lu.Convert, self.prog, {}, "1850-2000" )
+       try:
+          import numpy
+       except ImportError:
+          self.skipTest( "numpy is NOT available" )
+       self.lu.Initialize( self.prog )
+       self.assertRaises(SystemExit, self.lu.Convert, self.prog, {}, "1850" )
+       self.assertRaises(SystemExit, self.lu.Convert, self.prog, { "zztop":self.tmpdir+"/zztop.txt" }, "1850-2000" )
+       good = "100,7,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0"
+       for rows in [ [], [ "1850,"+good+",0" ], [ "1850,90,7,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0" ], \
+                     [ "1850,60,7,60,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0" ], [ "1850,100,17,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0" ], \
+                     [ "1850,100,7,0,0,0,0,0,0,0,0,1.5,0,0,0,0,0,0,0" ], [ "1850,"+good, "1849,"+good ], \
+                     [ "1850,100,7,0,0,0,0,0,0,0,0,zz,0,0,0,0,0,0,0" ] ]:
+          self.assertRaises(SystemExit, self.lu.Convert, self.prog, { "bad":self.write( "bad", rows ) }, "1850-2000" )
+
+   def test_convert( self ):
+       "test converting transition years files, and that harvest and grazing are only held if asked"
+       try:
+          import numpy
+       except ImportError:
+          self.skipTest( "numpy is NOT available" )
+       self.lu.Initialize( self.prog )
+       files = { "a":self.write( "a", [ "1850,50,1,50,7,0,0,0,0,0,0,0.50,0,0,0,0,0.1,0,1", \
+                                        "1852,100,7,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,0" ] ), \
+                 "b":self.write( "b", [ "1851,100,13,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0" ] ) }
+       results = self.lu.Convert( self.prog, files, "1850-1853" )
+       lines   = results["a"].splitlines()
+       self.assertEqual( [ line[self.lu.maxlen+1:] for line in lines ], [ "1850", "1851", "1852", "1853" ] )
+       self.assertEqual( lines[0][:self.lu.maxlen].rstrip(), "<pft_f>50,50</pft_f><pft_i>1,7</pft_i><harv>0.50,0,0,0,0</harv><graz>0.1</graz>" )
+       self.assertEqual( lines[1][:self.lu.maxlen].rstrip(), "<pft_f>50,50</pft_f><pft_i>1,7</pft_i><harv>0,0,0,0,0</harv><graz>0.1</graz>" )
+       self.assertEqual( lines[3][:self.lu.maxlen].rstrip(), "<pft_f>100</pft_f><pft_i>7</pft_i><harv>0,0,0,0,0</harv><graz>0</graz>" )
+       # Years before the first transition year use it
+       self.assertEqual( results["b"].splitlines()[0][:-5], results["b"].splitlines()[1][:-5] )
+       # Results are kept for the same file contents
+       self.assertEqual( len(self.lu.cache), 2 )
+       files["c"] = self.write( "c", [ "1851,100,13,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0" ] )
+       self.assertEqual( self.lu.Convert( self.prog, files, "1850-1853" )["c"], results["b"] )
+       self.assertEqual( len(self.lu.cache), 2 )
+       outfiles = self.lu.Write( self.prog, files, dict( [ ( site, self.tmpdir+"/"+site+".txt" ) for site in files ] ), "1850-1853" )
+       infile = open( outfiles[0], "r" )
+       self.assertEqual( infile.read(), results["a"] )
+       infile.close()
+
+   def test_perl( self ):
+       "test that the text is the same as from cnvrt_trnsyrs2_landuse_timeseries_txtfile.pl"
+       try:
+          import numpy
+       except ImportError:
+          self.skipTest( "numpy is NOT available" )
+       if ( shutil.which( "perl" ) == None ):
+          self.skipTest( "perl is NOT available" )
+       self.lu.Initialize( self.prog )
+       files = { "US-Ha1":self.sitedir+"/US-Ha1_dynpftdata.txt", \
+                 "held":self.write( "held", [ "1850,50,1,50,7,0,0,0,0,0,0,0.50,0,0,0,0,0.1,0,1", \
+                                              "1900,30,1,70,7,0,0,0,0,0,0,0,0.2,0,0,0,0,1,0" ] ) }
+       for years in [ "1850-2000", "1900-2010", "1800-1850", "2010-2020" ]:
+          results = self.lu.Convert( self.prog, files, years )
+          for site in files:
+             perl = subprocess.check_output( [ self.sitedir+"/cnvrt_trnsyrs2_landuse_timeseries_txtfile.pl", \
+                                               files[site], years ] ).decode( "utf-8" )
+             self.assertEqual( results[site], perl )
+
+if __name__ == '__main__':
+     unittest.main()
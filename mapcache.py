@@ -0,0 +1,300 @@
+#########################################################################################
+#
+# mapcache.py
+#
+# Python class to keep a persistent cache of the mapping files created by mkmapdata.sh
+# for a single point, so that they can be reused for later runs at the same point. The
+# cache is keyed by the point and the checksums of the raw grids mapped from.
+#
+#########################################################################################
+import os, sys, glob, json, time, shutil, hashlib, fcntl
+
+class mapcache:
+#----------------------------------------------------------------------------------------
+# Class to handle the mapping file cache
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup     = False
+   cachedir  = ""
+   maxsize   = 1000        # Maximum size of the cache in MB
+   ndigits   = 4           # Number of digits to round latitude and longitude to
+   indexfile = "mapcache_index.json"
+   lockfile  = ".mapcache.lock"
+
+   def Initialize( self, prog, cachedir, maxsize=1000 ):
+      "Initialize the mapping file cache"
+      if ( maxsize <= 0 ):
+         prog.error( "Size of the mapping file cache must be greater than zero: "+str(maxsize) )
+      self.cachedir = os.path.abspath( cachedir )
+      self.maxsize  = maxsize
+      if ( not os.path.isdir( self.cachedir ) ):
+         try:
+            os.makedirs( self.cachedir )
+         except OSError:
+            if ( not os.path.isdir( self.cachedir ) ):
+               prog.error( "Could NOT create mapping file cache directory: "+self.cachedir )
+      self.setup = True
+
+   def _lock( self, prog ):
+      "Get an exclusive lock on the cache so that concurrent jobs can share it"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      lock = open( self.cachedir+"/"+self.lockfile, "a" )
+      fcntl.flock( lock, fcntl.LOCK_EX )
+      return( lock )
+
+   def _unlock( self, lock ):
+      "Release the lock on the cache"
+      fcntl.flock( lock, fcntl.LOCK_UN )
+      lock.close()
+
+   def _read_index( self ):
+      "Read the index of the cache (must have the lock)"
+      index = { "entries":{}, "checksums":{} }
+      filename = self.cachedir+"/"+self.indexfile
+      if ( os.path.exists( filename ) ):
+         try:
+            infile = open( filename, "r" )
+            index.update( json.load( infile ) )
+            infile.close()
+         except ValueError:
+            print( "Mapping file cache index is corrupt and will be reset: "+filename )
+      return( index )
+
+   def _write_index( self, index ):
+      "Write the index of the cache (must have the lock)"
+      filename = self.cachedir+"/"+self.indexfile
+      outfile  = open( filename+".tmp", "w" )
+      json.dump( index, outfile, indent=1, sort_keys=True )
+      outfile.close()
+      os.rename( filename+".tmp", filename )
+
+   def _checksum( self, filename, checksums ):
+      "Return the checksum of a raw grid file, only recomputing it if the file changed"
+      stat = os.stat( filename )
+      prev = checksums.get( filename )
+      if ( prev != None and prev["size"] == stat.st_size and prev["mtime"] == stat.st_mtime ):
+         return( prev["md5"] )
+      md5 = hashlib.md5()
+      infile = open( filename, "rb" )
+      for block in iter( lambda: infile.read( 1048576 ), b"" ):
+         md5.update( block )
+      infile.close()
+      checksums[filename] = { "size":stat.st_size, "mtime":stat.st_mtime, "md5":md5.hexdigest() }
+      return( checksums[filename]["md5"] )
+
+   def Key( self, prog, lat, lon, rawgrids, mask="nomask", gridtype="regional" ):
+      "Return the cache key for the mapping files at this point from the list of raw grid files mapped from"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( len(rawgrids) == 0 ):
+         prog.error( "No raw grid files to make the cache key from" )
+      lock  = self._lock( prog )
+      index = self._read_index()
+      self._unlock( lock )
+      # Checksum the raw grids outside of the lock as it can take a while for large grids, the checksums
+      # are saved in the index so a grid is only read again when it's size or modification time changes
+      checksums = {}
+      for filename in sorted( rawgrids ):
+         if ( not os.path.exists( filename ) ):
+            prog.error( "Raw grid file for the mapping file cache does NOT exist: "+filename )
+         filename = os.path.abspath( filename )
+         checksums[filename] = self._checksum( filename, index["checksums"] )
+      lock  = self._lock( prog )
+      saved = self._read_index()
+      for filename in checksums:
+         saved["checksums"][filename] = index["checksums"][filename]
+      # Forget the checksums of grids that are no longer there
+      for filename in list( saved["checksums"] ):
+         if ( not os.path.exists( filename ) ):
+            del saved["checksums"][filename]
+      self._write_index( saved )
+      self._unlock( lock )
+      keydata = { "lat":round( float(lat), self.ndigits ), "lon":round( float(lon) % 360.0, self.ndigits ), \
+                  "mask":mask, "gridtype":gridtype, \
+                  "rawgrids":dict( [ ( os.path.basename(f), checksums[f] ) for f in checksums ] ) }
+      return( hashlib.sha1( json.dumps( keydata, sort_keys=True ).encode() ).hexdigest() )
+
+   def _mapname( self, filename, res ):
+      "Return the source grid part of a mapping filename created by mkmapdata.sh for res"
+      base = os.path.basename( filename )
+      end  = base.find( "_to_"+res+"_" )
+      if ( not base.startswith( "map_" ) or end == -1 ):
+         return( None )
+      return( base[4:end] )
+
+   def Restore( self, prog, key, mapdir, res, gdate ):
+      "Copy the cached mapping files for key into mapdir for the given res and date, return the files copied"
+      lock  = self._lock( prog )
+      index = self._read_index()
+      entry = index["entries"].get( key )
+      files = []
+      if ( entry != None ):
+         for name in entry["files"]:
+            if ( not os.path.exists( self.cachedir+"/"+key+"/"+name+".nc" ) ):
+               # The entry is incomplete, so drop it and treat this as a miss (removing the files
+               # already copied so they aren't mixed with the mapping files created in their place)
+               del index["entries"][key]
+               shutil.rmtree( self.cachedir+"/"+key, ignore_errors=True )
+               for mapfile in files:
+                  os.remove( mapfile )
+               files = []
+               break
+            mapfile = mapdir+"/map_"+name+"_to_"+res+"_nomask_aave_da_c"+gdate+".nc"
+            shutil.copyfile( self.cachedir+"/"+key+"/"+name+".nc", mapfile )
+            files.append( mapfile )
+         if ( key in index["entries"] ):
+            index["entries"][key]["last_used"] = time.time()
+         self._write_index( index )
+      self._unlock( lock )
+      return( files )
+
+   def Store( self, prog, key, mapdir, res, gdate ):
+      "Save the mapping files in mapdir for the given res and date to the cache under key"
+      names = {}
+      for filename in glob.glob( mapdir+"/map_*_to_"+res+"_nomask_aave_da_c"+gdate+".nc" ):
+         name = self._mapname( filename, res )
+         # Don't save the no-ocean map for the point itself
+         if ( name != None and not name.startswith( res+"_noocean" ) ):
+            names[name] = filename
+      if ( len(names) == 0 ):
+         prog.error( "No mapping files to save to the cache in: "+mapdir )
+      lock   = self._lock( prog )
+      index  = self._read_index()
+      tmpdir = self.cachedir+"/"+key+".tmp"
+      shutil.rmtree( tmpdir, ignore_errors=True )
+      os.makedirs( tmpdir )
+      size = 0
+      for name in sorted( names ):
+         shutil.copyfile( names[name], tmpdir+"/"+name+".nc" )
+         size += os.path.getsize( tmpdir+"/"+name+".nc" )
+      shutil.rmtree( self.cachedir+"/"+key, ignore_errors=True )
+      os.rename( tmpdir, self.cachedir+"/"+key )
+      index["entries"][key] = { "files":sorted( names ), "size":size, "last_used":time.time() }
+      self._evict( index, keep=key )
+      self._write_index( index )
+      self._unlock( lock )
+      return( sorted( names.values() ) )
+
+   def _evict( self, index, keep=None ):
+      "Remove the least recently used entries until the cache fits under maxsize (must have the lock)"
+      total = 0
+      for key in index["entries"]:
+         total += index["entries"][key]["size"]
+      lru = sorted( index["entries"], key=lambda k: index["entries"][k]["last_used"] )
+      for key in lru:
+         if ( total <= self.maxsize*1024*1024 ):
+            break
+         if ( key == keep ):
+            continue
+         total -= index["entries"][key]["size"]
+         del index["entries"][key]
+         shutil.rmtree( self.cachedir+"/"+key, ignore_errors=True )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_mapcache(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.cache   = mapcache()
+       self.tmpdir  = tempfile.mkdtemp()
+       self.griddir = self.tmpdir+"/grids"
+       self.mapdir  = self.tmpdir+"/1x1pt_US-UMB"
+       os.makedirs( self.griddir )
+       os.makedirs( self.mapdir )
+       self.grids   = []
+       for grid in [ "0.5x0.5_AVHRR", "3x3min_MODIS" ]:
+          self.grids.append( self.griddir+"/SCRIPgrid_"+grid+"_c110228.nc" )
+          self.write( self.grids[-1], grid )
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write( self, filename, text ):
+       outfile = open( filename, "w" )
+       outfile.write( text )
+       outfile.close()
+
+   def write_maps( self, res, gdate ):
+       for grid in [ "0.5x0.5_AVHRR", "3x3min_MODIS" ]:
+          self.write( self.mapdir+"/map_"+grid+"_to_"+res+"_nomask_aave_da_c"+gdate+".nc", grid+" map" )
+       self.write( self.mapdir+"/map_"+res+"_noocean_to_"+res+"_nomask_aave_da_"+gdate+".nc", "noocean" )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.cache.Key, self.prog, 45.0, 275.0, self.grids )
+       self.assertRaises(SystemExit, self.cache.Initialize, self.prog, self.tmpdir+"/cache", maxsize=0 )
+
+   def test_key( self ):
+       "test that the key depends on the rounded point and the raw grids"
+       self.cache.Initialize( self.prog, self.tmpdir+"/cache" )
+       key = self.cache.Key( self.prog, 45.5598, -84.7138, self.grids )
+       self.assertEqual( key, self.cache.Key( self.prog, 45.55980001, 275.2862, self.grids ) )
+       self.assertNotEqual( key, self.cache.Key( self.prog, 45.5598, 275.0, self.grids ) )
+       self.assertNotEqual( key, self.cache.Key( self.prog, 45.5598, -84.7138, self.grids, mask="navy" ) )
+       # Only the raw grids mapped from are in the key
+       self.write( self.griddir+"/SCRIPgrid_10x10min_nomask_c110228.nc", "grid NOT mapped from" )
+       self.assertEqual( key, self.cache.Key( self.prog, 45.5598, -84.7138, self.grids ) )
+       self.assertRaises(SystemExit, self.cache.Key, self.prog, 45.5598, -84.7138, [] )
+       self.assertRaises(SystemExit, self.cache.Key, self.prog, 45.5598, -84.7138, [ self.griddir+"/zztop.nc" ] )
+       # The checksums are saved, so a grid with the same size and time isn't read again (even by a new cache object)
+       stat = os.stat( self.grids[0] )
+       self.write( self.grids[0], "0.5x0.5_XXXXX" )
+       os.utime( self.grids[0], ns=( stat.st_atime_ns, stat.st_mtime_ns ) )
+       cache = mapcache()
+       cache.Initialize( self.prog, self.tmpdir+"/cache" )
+       self.assertEqual( key, cache.Key( self.prog, 45.5598, -84.7138, self.grids ) )
+       self.write( self.grids[0], "changed grid" )
+       self.assertNotEqual( key, self.cache.Key( self.prog, 45.5598, -84.7138, self.grids ) )
+
+   def test_store_restore( self ):
+       "test that stored files are restored for a different site and date at the same point"
+       self.cache.Initialize( self.prog, self.tmpdir+"/cache" )
+       key = self.cache.Key( self.prog, 45.5598, -84.7138, self.grids )
+       self.assertEqual( self.cache.Restore( self.prog, key, self.mapdir, "1x1pt_US-UMB", "140204" ), [] )
+       self.assertRaises(SystemExit, self.cache.Store, self.prog, key, self.mapdir, "1x1pt_US-UMB", "140204" )
+       self.write_maps( "1x1pt_US-UMB", "140204" )
+       stored = self.cache.Store( self.prog, key, self.mapdir, "1x1pt_US-UMB", "140204" )
+       self.assertEqual( len(stored), 2 )
+       files = self.cache.Restore( self.prog, key, self.mapdir, "1x1pt_US-XXX", "150101" )
+       self.assertEqual( sorted( [ os.path.basename(f) for f in files ] ), \
+                         [ "map_0.5x0.5_AVHRR_to_1x1pt_US-XXX_nomask_aave_da_c150101.nc", \
+                           "map_3x3min_MODIS_to_1x1pt_US-XXX_nomask_aave_da_c150101.nc" ] )
+       self.assertEqual( open( files[0], "r" ).read(), "0.5x0.5_AVHRR map" )
+       # An incomplete entry is a miss, and the files copied before it was found are removed
+       for filename in files: os.remove( filename )
+       os.remove( self.cache.cachedir+"/"+key+"/3x3min_MODIS.nc" )
+       self.assertEqual( self.cache.Restore( self.prog, key, self.mapdir, "1x1pt_US-XXX", "150101" ), [] )
+       self.assertEqual( glob.glob( self.mapdir+"/map_*_to_1x1pt_US-XXX_*" ), [] )
+       self.assertFalse( os.path.exists( self.cache.cachedir+"/"+key ) )
+
+   def test_evict( self ):
+       "test that the least recently used entries are evicted when the cache is full"
+       self.cache.Initialize( self.prog, self.tmpdir+"/cache", maxsize=1.0e-4 )
+       self.write_maps( "1x1pt_US-UMB", "140204" )
+       keys = []
+       for lon in [ 1.0, 2.0, 3.0 ]:
+          key = self.cache.Key( self.prog, 45.0, lon, self.grids )
+          self.cache.Store( self.prog, key, self.mapdir, "1x1pt_US-UMB", "140204" )
+          keys.append( key )
+          time.sleep( 0.01 )
+       # Using the first entry makes the second the least recently used
+       self.cache.Restore( self.prog, keys[0], self.mapdir, "1x1pt_US-UMB", "140204" )
+       key = self.cache.Key( self.prog, 45.0, 4.0, self.grids )
+       self.cache.Store( self.prog, key, self.mapdir, "1x1pt_US-UMB", "140204" )
+       self.assertEqual( self.cache.Restore( self.prog, keys[1], self.mapdir, "1x1pt_US-UMB", "140204" ), [] )
+       self.assertFalse( os.path.exists( self.cache.cachedir+"/"+keys[1] ) )
+       self.assertTrue( os.path.exists( self.cache.cachedir+"/"+key ) )
+
+if __name__ == '__main__':
+     unittest.main()
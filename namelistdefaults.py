@@ -0,0 +1,281 @@
+#########################################################################################
+#
+# namelistdefaults.py
+#
+# Python class to query the CTSM namelist defaults XML database in-process with the
+# same matching rules as bld/queryDefaultNamelist.pl. The XML files are parsed once
+# into an index (saved on disk until the XML files change) and results are memoized.
+#
+#########################################################################################
+import os, sys, shlex, pickle
+import xml.etree.ElementTree as ElementTree
+
+class namelistdefaults:
+#----------------------------------------------------------------------------------------
+# Class to handle queries of the namelist defaults database
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup      = False
+   ctsmdir    = ""
+   csmdata    = ""
+   indexfile  = ""
+   # Files relative to the CTSM root directory that make up the database
+   defaults   = [ "bld/namelist_files/namelist_defaults_ctsm.xml", \
+                  "bld/namelist_files/namelist_defaults_ctsm_tools.xml" ]
+   usrdefault = "bld/namelist_files/namelist_defaults_usr_files.xml"
+   definition = "bld/namelist_files/namelist_definition_ctsm.xml"
+
+   def Initialize( self, prog, ctsmdir, csmdata="", indexfile="" ):
+      "Initialize the namelist defaults database, reading the index from disk if it is current"
+      self.ctsmdir   = os.path.abspath( ctsmdir )
+      self.csmdata   = csmdata
+      self.indexfile = indexfile
+      self.memo      = {}
+      for xmlfile in self.defaults[0:1] + [ self.definition ]:
+         if ( not os.path.exists( self.ctsmdir+"/"+xmlfile ) ):
+            prog.error( "Namelist defaults file does NOT exist: "+self.ctsmdir+"/"+xmlfile )
+      files = {}
+      for xmlfile in self.defaults + [ self.usrdefault, self.definition ]:
+         if ( os.path.exists( self.ctsmdir+"/"+xmlfile ) ):
+            files[xmlfile] = os.path.getmtime( self.ctsmdir+"/"+xmlfile )
+      self.index = None
+      if ( self.indexfile != "" and os.path.exists( self.indexfile ) ):
+         try:
+            infile = open( self.indexfile, "rb" )
+            index  = pickle.load( infile )
+            infile.close()
+            if ( index["ctsmdir"] == self.ctsmdir and index["files"] == files ):
+               self.index = index
+         except Exception:
+            # A partly written or stale index (from an older version) is just remade
+            self.index = None
+      if ( self.index == None ):
+         self.index = self._parse( files )
+         if ( self.indexfile != "" ):
+            # Write to a temporary file for this process and move it into place so concurrent jobs see a whole index
+            tmpfile = self.indexfile+"."+str(os.getpid())+".tmp"
+            try:
+               outfile = open( tmpfile, "wb" )
+               pickle.dump( self.index, outfile )
+               outfile.close()
+               os.rename( tmpfile, self.indexfile )
+            except ( IOError, OSError ):
+               print( "Could NOT write namelist defaults index file: "+self.indexfile )
+               if ( os.path.exists( tmpfile ) ): os.remove( tmpfile )
+      self.setup = True
+
+   def _parse( self, files ):
+      "Parse the XML files into an index of the values and attributes for each variable"
+      index = { "ctsmdir":self.ctsmdir, "files":files, "values":{}, "usrvalues":{}, "pathnames":{} }
+      for xmlfile in sorted( files ):
+         if ( xmlfile == self.definition ):
+            continue
+         if ( xmlfile == self.usrdefault ):
+            values = index["usrvalues"]
+         else:
+            values = index["values"]
+         root = ElementTree.parse( self.ctsmdir+"/"+xmlfile ).getroot()
+         for node in root:
+            if ( not isinstance( node.tag, str ) ):
+               continue
+            text = "".join( node.itertext() ).strip()
+            values.setdefault( node.tag.lower(), [] ).append( ( dict( node.attrib ), text ) )
+      root = ElementTree.parse( self.ctsmdir+"/"+self.definition ).getroot()
+      for node in root.iter( "entry" ):
+         pathname = node.attrib.get( "input_pathname", "" )
+         if ( pathname != "" ):
+            index["pathnames"][node.attrib["id"].lower()] = pathname
+      return( index )
+
+   def _settings( self, res, usrname, options ):
+      "Return the attribute settings to match against from the query options"
+      settings = {}
+      if ( res != "" ):
+         settings["hgrid"] = res
+      if ( usrname != "" ):
+         settings["clm_usr_name"] = usrname
+      if ( options != "" ):
+         for opt in options.split( "," ):
+            if ( opt.find( "=" ) == -1 ):
+               return( None )
+            ( name, value ) = opt.split( "=", 1 )
+            settings[name] = value
+      return( settings )
+
+   def _match( self, nodes, settings ):
+      "Return the value of the node whose attributes all match and that matches the most attributes"
+      best    = -1
+      value   = None
+      for ( attrs, text ) in nodes:
+         nmatched = 0
+         for name in attrs:
+            if ( settings.get( name ) != attrs[name] ):
+               nmatched = -1
+               break
+            nmatched += 1
+         if ( nmatched > best ):
+            best  = nmatched
+            value = text
+      return( value )
+
+   def Query( self, prog, var, res="", usrname="", options="", onlyfiles=False, justvalue=False ):
+      "Query the database for the value of var, returns None if there is no value"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      key = ( var, res, usrname, options, onlyfiles, justvalue )
+      if ( key in self.memo ):
+         return( self.memo[key] )
+      settings = self._settings( res, usrname, options )
+      if ( settings == None ):
+         prog.error( "Bad format for query options (should be name=value,name=value): "+options )
+      name     = var.lower()
+      pathname = self.index["pathnames"].get( name, "" )
+      value    = None
+      if ( not onlyfiles or pathname != "" ):
+         # User named datasets are used before the standard ones
+         if ( usrname != "" ):
+            value = self._match( self.index["usrvalues"].get( name, [] ), settings )
+         if ( value == None ):
+            value = self._match( self.index["values"].get( name, [] ), settings )
+      if ( value != None ):
+         value = value.strip( "'\"" )
+         if ( pathname == "abs" and self.csmdata != "" ):
+            value = self.csmdata+"/"+value
+         if ( not justvalue ):
+            value = var+" = "+value
+      self.memo[key] = value
+      return( value )
+
+   def QueryArgs( self, prog, queryopts, var ):
+      "Query the database with queryDefaultNamelist.pl style options"
+      args   = shlex.split( queryopts )
+      kwargs = { "res":"", "usrname":"", "options":"", "onlyfiles":False, "justvalue":False }
+      i = 0
+      while ( i < len(args) ):
+         opt = args[i].lstrip( "-" )
+         if ( opt in [ "res", "usrname", "options" ] and i+1 < len(args) ):
+            kwargs[opt] = args[i+1]
+            i += 1
+         elif ( opt in [ "onlyfiles", "justvalue" ] ):
+            kwargs[opt] = True
+         elif ( opt != "silent" ):
+            prog.error( "Query option is NOT handled: "+args[i] )
+         i += 1
+      return( self.Query( prog, var, **kwargs ) )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, glob
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_namelistdefaults(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests with a small namelist database"
+       self.prog    = error_prog()
+       self.nml     = namelistdefaults()
+       self.ctsmdir = tempfile.mkdtemp()
+       os.makedirs( self.ctsmdir+"/bld/namelist_files" )
+       self.write( namelistdefaults.defaults[0], """<?xml version="1.0"?>
+<namelist_defaults>
+<fsurdat hgrid="0.9x1.25" sim_year="2000">lnd/clm2/surfdata/surfdata_0.9x1.25_simyr2000.nc</fsurdat>
+<fsurdat hgrid="0.9x1.25" sim_year="1850">lnd/clm2/surfdata/surfdata_0.9x1.25_simyr1850.nc</fsurdat>
+<mksrf_fsoitex>lnd/clm2/rawdata/mksrf_soitex.10level.nc</mksrf_fsoitex>
+<mksrf_fsoitex mask="navy">lnd/clm2/rawdata/mksrf_soitex_navy.nc</mksrf_fsoitex>
+<hist_mfilt>1</hist_mfilt>
+</namelist_defaults>
+""" )
+       self.write( namelistdefaults.usrdefault, """<?xml version="1.0"?>
+<namelist_defaults>
+<fsurdat clm_usr_name="1x1pt_US-UMB" sim_year="2000">lnd/clm2/surfdata/surfdata_1x1pt_US-UMB_simyr2000.nc</fsurdat>
+</namelist_defaults>
+""" )
+       self.write( namelistdefaults.definition, """<?xml version="1.0"?>
+<namelist_definition>
+<entry id="fsurdat" type="char*256" input_pathname="abs" category="datasets"/>
+<entry id="mksrf_fsoitex" type="char*256" input_pathname="abs" category="mksurfdata"/>
+<entry id="hist_mfilt" type="integer" category="history"/>
+</namelist_definition>
+""" )
+
+   def tearDown( self ):
+       shutil.rmtree( self.ctsmdir )
+
+   def write( self, filename, text ):
+       outfile = open( self.ctsmdir+"/"+filename, "w" )
+       outfile.write( text )
+       outfile.close()
+
+   def test_badinit( self ):
+       "test bad initialization and querying before initialization"
+       self.assertRaises(SystemExit, self.nml.Query, self.prog, "fsurdat" )
+       self.assertRaises(SystemExit, self.nml.Initialize, self.prog, self.ctsmdir+"/zztop" )
+       self.nml.Initialize( self.prog, self.ctsmdir )
+       self.assertRaises(SystemExit, self.nml.Query, self.prog, "fsurdat", options="sim_year" )
+       self.assertRaises(SystemExit, self.nml.QueryArgs, self.prog, "-zztop", "fsurdat" )
+
+   def test_query( self ):
+       "test the matching rules"
+       self.nml.Initialize( self.prog, self.ctsmdir, csmdata="/inputdata" )
+       self.assertEqual( self.nml.Query( self.prog, "fsurdat", res="0.9x1.25", options="sim_year=1850", justvalue=True ), \
+                         "/inputdata/lnd/clm2/surfdata/surfdata_0.9x1.25_simyr1850.nc" )
+       self.assertEqual( self.nml.Query( self.prog, "fsurdat", res="0.9x1.25", options="sim_year=2000" ), \
+                         "fsurdat = /inputdata/lnd/clm2/surfdata/surfdata_0.9x1.25_simyr2000.nc" )
+       # A node with an attribute that is not set does NOT match
+       self.assertEqual( self.nml.Query( self.prog, "fsurdat", options="sim_year=2000" ), None )
+       # The node that matches the most attributes is used
+       self.assertEqual( self.nml.Query( self.prog, "mksrf_fsoitex", options="mask=navy,sim_year=2000", justvalue=True ), \
+                         "/inputdata/lnd/clm2/rawdata/mksrf_soitex_navy.nc" )
+       self.assertEqual( self.nml.Query( self.prog, "mksrf_fsoitex", justvalue=True ), \
+                         "/inputdata/lnd/clm2/rawdata/mksrf_soitex.10level.nc" )
+       # User named datasets
+       self.assertEqual( self.nml.QueryArgs( self.prog, " -onlyfiles -res 1x1pt_US-UMB -usrname 1x1pt_US-UMB" + \
+                                             " -options mask=navy,sim_year=2000,sim_year_range=constant -justvalue", "fsurdat" ), \
+                         "/inputdata/lnd/clm2/surfdata/surfdata_1x1pt_US-UMB_simyr2000.nc" )
+       # Only files
+       self.assertEqual( self.nml.Query( self.prog, "hist_mfilt", justvalue=True ), "1" )
+       self.assertEqual( self.nml.Query( self.prog, "hist_mfilt", onlyfiles=True, justvalue=True ), None )
+
+   def test_index( self ):
+       "test that the index is saved to disk and remade when the XML files change"
+       indexfile = self.ctsmdir+"/nmlindex.pickle"
+       self.nml.Initialize( self.prog, self.ctsmdir, indexfile=indexfile )
+       self.assertTrue( os.path.exists( indexfile ) )
+       nml = namelistdefaults()
+       nml.Initialize( self.prog, self.ctsmdir, indexfile=indexfile )
+       self.assertEqual( nml.index, self.nml.index )
+       self.assertEqual( nml.Query( self.prog, "hist_mfilt", justvalue=True ), "1" )
+       self.write( namelistdefaults.defaults[0], """<?xml version="1.0"?>
+<namelist_defaults>
+<hist_mfilt>12</hist_mfilt>
+</namelist_defaults>
+""" )
+       mtime = os.path.getmtime( self.ctsmdir+"/"+namelistdefaults.defaults[0] ) + 10.0
+       os.utime( self.ctsmdir+"/"+namelistdefaults.defaults[0], ( mtime, mtime ) )
+       nml = namelistdefaults()
+       nml.Initialize( self.prog, self.ctsmdir, indexfile=indexfile )
+       self.assertEqual( nml.Query( self.prog, "hist_mfilt", justvalue=True ), "12" )
+       self.assertEqual( glob.glob( indexfile+".*" ), [] )
+
+   def test_badindex( self ):
+       "test that an index that is partly written or from something else is remade"
+       indexfile = self.ctsmdir+"/nmlindex.pickle"
+       self.nml.Initialize( self.prog, self.ctsmdir, indexfile=indexfile )
+       infile = open( indexfile, "rb" )
+       saved  = infile.read()
+       infile.close()
+       for contents in [ saved[0:len(saved)//2], pickle.dumps( [ "not", "an", "index" ] ), b"zztop" ]:
+          outfile = open( indexfile, "wb" )
+          outfile.write( contents )
+          outfile.close()
+          nml = namelistdefaults()
+          nml.Initialize( self.prog, self.ctsmdir, indexfile=indexfile )
+          self.assertEqual( nml.index, self.nml.index )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,381 @@
+#########################################################################################
+#
+# pointgrids.py
+#
+# Python class to write the grid and map files for single points that mknoocnmap.pl
+# writes with NCL (mkscripgrid.ncl and mkunitymap.ncl). The SCRIP grid files for the
+# grid cell around each point (with and without ocean), and the unity map from the
+# no ocean grid to the land grid, are written directly from the latitude and longitude.
+# Files for a list of points can be written with one call. The domain files that gen_domain
+# creates from the map are also written, for a point or a small number of points.
+#
+#########################################################################################
+import os, sys, math, time
+
+class pointgrids:
+#----------------------------------------------------------------------------------------
+# Class to handle writing grid and map files for single points
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup   = False
+   dx      = 0.1       # Size of the grid cell around the point in degrees (same as mknoocnmap.pl)
+   dy      = 0.1
+   format  = "NETCDF3_64BIT_OFFSET"
+   fminval = 1.0e-3    # Smallest fraction of a grid cell that is active (same as gen_domain)
+   eps     = 1.0e-12   # Tolerance for fractions outside of zero to one
+
+   def Initialize( self, prog, dx=0.1, dy=0.1 ):
+      "Initialize the point grid writer, with the size of the grid cell around each point"
+      if ( dx <= 0.0 or dy <= 0.0 ):
+         prog.error( "Size of the grid cell must be greater than zero" )
+      try:
+         import netCDF4
+      except ImportError:
+         prog.error( "The netCDF4 python module is required to write grid and map files" )
+      self.netCDF4 = netCDF4
+      self.dx      = dx
+      self.dy      = dy
+      self.setup   = True
+
+   def Filenames( self, res, cdate ):
+      "Return the names of the files mknoocnmap.pl writes for the resolution name and date"
+      return( { "scripgridfile":"SCRIPgrid_"+res+"_nomask_c"+cdate+".nc", \
+                "oceangridfile":"SCRIPgrid_"+res+"_noocean_c"+cdate+".nc", \
+                "mapfile":"map_"+res+"_noocean_to_"+res+"_nomask_aave_da_"+cdate+".nc" } )
+
+   def Corners( self, lat, lon ):
+      "Return the latitudes and longitudes of the corners of the grid cell (counter-clockwise from the south-west)"
+      return( [ lat-self.dy/2.0, lat-self.dy/2.0, lat+self.dy/2.0, lat+self.dy/2.0 ], \
+              [ lon-self.dx/2.0, lon+self.dx/2.0, lon+self.dx/2.0, lon-self.dx/2.0 ] )
+
+   def Area( self, lat ):
+      "Return the area of the grid cell in square radians"
+      south = math.radians( max( lat-self.dy/2.0, -90.0 ) )
+      north = math.radians( min( lat+self.dy/2.0,  90.0 ) )
+      return( math.radians( self.dx ) * ( math.sin( north ) - math.sin( south ) ) )
+
+   def _create( self, prog, filename ):
+      "Create a file, written to a temporary name until it is closed"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      return( self.netCDF4.Dataset( filename+".tmp", "w", format=self.format ) )
+
+   def _close( self, ncfile, filename ):
+      "Close a file, and move it to it's real name"
+      ncfile.close()
+      os.rename( filename+".tmp", filename )
+
+   def _variable( self, ncfile, name, dtype, dims, value, units=None ):
+      "Add a variable to a file"
+      var = ncfile.createVariable( name, dtype, dims )
+      if ( units != None ): var.units = units
+      var[:] = value
+      return( var )
+
+   def WriteSCRIPgrid( self, prog, filename, res, lat, lon, imask=1 ):
+      "Write a SCRIP grid file for the grid cell around the point (imask=0 for no ocean)"
+      ncfile = self._create( prog, filename )
+      ncfile.title        = "SCRIP grid file for "+res
+      ncfile.Conventions  = "SCRIP"
+      ncfile.date_created = time.strftime( "%a %b %d %H:%M:%S %Z %Y" )
+      ncfile.history      = time.strftime( "%a %b %d %Y" )+": create using PTCLM pointgrids.py"
+      if ( imask == 0 ): ncfile.comment = "Ocean is assumed to non-existant at this point"
+      ncfile.createDimension( "grid_size", 1 )
+      ncfile.createDimension( "grid_corners", 4 )
+      ncfile.createDimension( "grid_rank", 2 )
+      ( latv, lonv ) = self.Corners( lat, lon )
+      self._variable( ncfile, "grid_dims", "i4", ("grid_rank",), [ 1, 1 ] )
+      self._variable( ncfile, "grid_center_lat", "f8", ("grid_size",), [ lat ], units="degrees" )
+      self._variable( ncfile, "grid_center_lon", "f8", ("grid_size",), [ lon ], units="degrees" )
+      self._variable( ncfile, "grid_imask", "i4", ("grid_size",), [ imask ], units="unitless" )
+      self._variable( ncfile, "grid_corner_lat", "f8", ("grid_size","grid_corners"), [ latv ], units="degrees" )
+      self._variable( ncfile, "grid_corner_lon", "f8", ("grid_size","grid_corners"), [ lonv ], units="degrees" )
+      self._close( ncfile, filename )
+
+   def WriteGlobalGrid( self, prog, filename, nlon, nlat, lon0=0.0 ):
+      "Write a SCRIP grid file for a regular global latitude/longitude grid, with the first column starting at lon0"
+      if ( nlon < 1 or nlat < 1 ):
+         prog.error( "Number of longitudes and latitudes must be one or more" )
+      import numpy as np
+      dlon   = 360.0/nlon
+      dlat   = 180.0/nlat
+      ( clon, clat ) = np.meshgrid( lon0 + dlon*(np.arange( nlon ) + 0.5), -90.0 + dlat*(np.arange( nlat ) + 0.5) )
+      clat   = clat.ravel()
+      clon   = clon.ravel()
+      ncfile = self._create( prog, filename )
+      ncfile.title       = "SCRIP grid file for a regular "+str(nlon)+"x"+str(nlat)+" grid"
+      ncfile.Conventions = "SCRIP"
+      ncfile.history     = time.strftime( "%a %b %d %Y" )+": create using PTCLM pointgrids.py"
+      ncfile.createDimension( "grid_size", nlon*nlat )
+      ncfile.createDimension( "grid_corners", 4 )
+      ncfile.createDimension( "grid_rank", 2 )
+      self._variable( ncfile, "grid_dims", "i4", ("grid_rank",), [ nlon, nlat ] )
+      self._variable( ncfile, "grid_center_lat", "f8", ("grid_size",), clat, units="degrees" )
+      self._variable( ncfile, "grid_center_lon", "f8", ("grid_size",), clon, units="degrees" )
+      self._variable( ncfile, "grid_imask", "i4", ("grid_size",), 1, units="unitless" )
+      self._variable( ncfile, "grid_corner_lat", "f8", ("grid_size","grid_corners"), \
+                      np.stack( [ clat-dlat/2.0, clat-dlat/2.0, clat+dlat/2.0, clat+dlat/2.0 ], axis=1 ), units="degrees" )
+      self._variable( ncfile, "grid_corner_lon", "f8", ("grid_size","grid_corners"), \
+                      np.stack( [ clon-dlon/2.0, clon+dlon/2.0, clon+dlon/2.0, clon-dlon/2.0 ], axis=1 ), units="degrees" )
+      self._close( ncfile, filename )
+
+   def WriteUnityMap( self, prog, filename, lat, lon, gridfile_a, gridfile_b, mask_a=0, mask_b=1 ):
+      "Write the unity map between the grid files of the point (from the no ocean grid to the land grid)"
+      ncfile = self._create( prog, filename )
+      ncfile.title        = "SCRIP mapping file for unity map"
+      ncfile.map_method   = "Conservative remapping"
+      ncfile.conventions  = "NCAR-CSM"
+      ncfile.domain_a     = os.path.basename( gridfile_a )
+      ncfile.domain_b     = os.path.basename( gridfile_b )
+      ncfile.grid_file_src = os.path.basename( gridfile_a )
+      ncfile.grid_file_dst = os.path.basename( gridfile_b )
+      ncfile.history      = time.strftime( "%a %b %d %Y" )+": create using PTCLM pointgrids.py"
+      for ( dim, size ) in [ ( "n_a", 1 ), ( "n_b", 1 ), ( "n_s", 1 ), ( "nv_a", 4 ), ( "nv_b", 4 ), \
+                             ( "src_grid_rank", 2 ), ( "dst_grid_rank", 2 ) ]:
+         ncfile.createDimension( dim, size )
+      ( latv, lonv ) = self.Corners( lat, lon )
+      area = self.Area( lat )
+      self._variable( ncfile, "src_grid_dims", "i4", ("src_grid_rank",), [ 1, 1 ] )
+      self._variable( ncfile, "dst_grid_dims", "i4", ("dst_grid_rank",), [ 1, 1 ] )
+      for ( grid, mask ) in [ ( "a", mask_a ), ( "b", mask_b ) ]:
+         self._variable( ncfile, "yc_"+grid, "f8", ("n_"+grid,), [ lat ], units="degrees" )
+         self._variable( ncfile, "xc_"+grid, "f8", ("n_"+grid,), [ lon ], units="degrees" )
+         self._variable( ncfile, "yv_"+grid, "f8", ("n_"+grid,"nv_"+grid), [ latv ], units="degrees" )
+         self._variable( ncfile, "xv_"+grid, "f8", ("n_"+grid,"nv_"+grid), [ lonv ], units="degrees" )
+         self._variable( ncfile, "mask_"+grid, "i4", ("n_"+grid,), [ mask ], units="unitless" )
+         self._variable( ncfile, "area_"+grid, "f8", ("n_"+grid,), [ area ], units="square radians" )
+         self._variable( ncfile, "frac_"+grid, "f8", ("n_"+grid,), [ float(mask) ], units="unitless" )
+      self._variable( ncfile, "col", "i4", ("n_s",), [ 1 ] )
+      self._variable( ncfile, "row", "i4", ("n_s",), [ 1 ] )
+      self._variable( ncfile, "S", "f8", ("n_s",), [ 1.0 ] )
+      self._close( ncfile, filename )
+
+   def WriteNoOcean( self, prog, points, cdate ):
+      "Write the grid and map files for a list of points, each a dictionary of res, lat, lon and dir, returns the filenames for each"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      written = []
+      for point in points:
+         for name in [ "res", "lat", "lon", "dir" ]:
+            if ( name not in point ):
+               prog.error( "Point to write grid files for does NOT have "+name )
+         if ( not os.path.isdir( point["dir"] ) ):
+            prog.error( "Directory to write grid files to does NOT exist: "+point["dir"] )
+         files = {}
+         for ( name, filename ) in self.Filenames( point["res"], cdate ).items():
+            files[name] = os.path.abspath( point["dir"] )+"/"+filename
+         self.WriteSCRIPgrid( prog, files["scripgridfile"], point["res"], point["lat"], point["lon"], imask=1 )
+         self.WriteSCRIPgrid( prog, files["oceangridfile"], point["res"], point["lat"], point["lon"], imask=0 )
+         self.WriteUnityMap( prog, files["mapfile"], point["lat"], point["lon"], files["oceangridfile"], files["scripgridfile"] )
+         written.append( files )
+      return( written )
+
+   def ReadMap( self, prog, mapfile ):
+      "Read the grids, fractions and weights of a map file"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not os.path.exists( mapfile ) ):
+         prog.error( "Map file does NOT exist: "+mapfile )
+      try:
+         ncfile = self.netCDF4.Dataset( mapfile, "r" )
+         data   = {}
+         for name in [ "xc_a", "yc_a", "xv_a", "yv_a", "area_a", "mask_a", "frac_a", \
+                       "xc_b", "yc_b", "xv_b", "yv_b", "area_b", "S", "row", "col", "src_grid_dims", "dst_grid_dims" ]:
+            data[name] = ncfile.variables[name][:].tolist()
+         data["domain_a"] = getattr( ncfile, "domain_a", "" )
+         data["domain_b"] = getattr( ncfile, "domain_b", "" )
+         ncfile.close()
+      except ( OSError, KeyError ) as err:
+         prog.error( "Trouble reading map file "+mapfile+": "+str(err) )
+      return( data )
+
+   def WriteDomain( self, prog, filename, xc, yc, xv, yv, area, frac, dims, mapfile, mapdata, comment="" ):
+      "Write a domain file for the cells with the given centers, verticies, areas and active fractions"
+      for value in frac:
+         if ( value > 1.0+self.eps or value < 0.0-self.eps ):
+            prog.error( "Fraction is outside of zero to one for domain file: "+filename )
+      frac = [ min( max( value, 0.0 ), 1.0 ) for value in frac ]
+      mask = [ int( value > self.fminval ) for value in frac ]
+      if ( len(dims) == 1 ): dims = [ dims[0], 1 ]
+      ( ni, nj ) = dims
+      def grid( values ):
+         return( [ values[j*ni:(j+1)*ni] for j in range(nj) ] )
+      ncfile = self._create( prog, filename )
+      ncfile.title         = "CESM domain data:"
+      ncfile.Conventions   = "CF-1.0"
+      ncfile.source_code   = "PTCLM pointgrids.py (same as gen_domain)"
+      ncfile.history       = time.strftime( "%a %b %d %H:%M:%S %Y" )+": created by PTCLM pointgrids.py"
+      ncfile.source        = os.path.basename( mapfile )
+      ncfile.map_domain_a  = mapdata["domain_a"]
+      ncfile.map_domain_b  = mapdata["domain_b"]
+      ncfile.user_comment  = comment
+      ncfile.createDimension( "ni", ni )
+      ncfile.createDimension( "nj", nj )
+      ncfile.createDimension( "nv", len(xv[0]) )
+      var = self._variable( ncfile, "xc", "f8", ("nj","ni"), grid( xc ), units="degrees_east" )
+      var.long_name = "longitude of grid cell center"
+      var.bounds    = "xv"
+      var = self._variable( ncfile, "yc", "f8", ("nj","ni"), grid( yc ), units="degrees_north" )
+      var.long_name = "latitude of grid cell center"
+      var.bounds    = "yv"
+      var = self._variable( ncfile, "xv", "f8", ("nj","ni","nv"), grid( xv ), units="degrees_east" )
+      var.long_name = "longitude of grid cell verticies"
+      var = self._variable( ncfile, "yv", "f8", ("nj","ni","nv"), grid( yv ), units="degrees_north" )
+      var.long_name = "latitude of grid cell verticies"
+      var = self._variable( ncfile, "mask", "i4", ("nj","ni"), grid( mask ), units="unitless" )
+      var.long_name   = "domain mask"
+      var.note        = "unitless"
+      var.coordinates = "xc yc"
+      var.comment     = "0 value indicates cell is not active"
+      var = self._variable( ncfile, "area", "f8", ("nj","ni"), grid( area ), units="radian2" )
+      var.long_name   = "area of grid cell in radians squared"
+      var.coordinates = "xc yc"
+      var = self._variable( ncfile, "frac", "f8", ("nj","ni"), grid( frac ), units="unitless" )
+      var.long_name   = "fraction of grid cell that is active"
+      var.coordinates = "xc yc"
+      var.note        = "unitless"
+      var.filter1     = "error if frac> 1.0+eps or frac < 0.0-eps; eps = %.7E" % self.eps
+      var.filter2     = "limit frac to [fminval,fmaxval]; fminval= %.7E fmaxval=  1.000000" % self.fminval
+      self._close( ncfile, filename )
+
+   def WriteDomains( self, prog, mapfile, ocn_name, lnd_name, outdir, cdate, comment="" ):
+      "Write the land and ocean domain files that gen_domain writes for a map from the ocean to the land grid, returns the filenames"
+      data = self.ReadMap( prog, mapfile )
+      if ( len(data["xc_b"]) > 1000 ):
+         prog.error( "Map has too many points for the built-in domain writer (use gen_domain): "+mapfile )
+      # Fraction of each land grid cell that is ocean, from the ocean fractions on the ocean grid
+      ofrac = [ 0.0 ] * len(data["xc_b"])
+      for ( weight, row, col ) in zip( data["S"], data["row"], data["col"] ):
+         ofrac[row-1] += weight * data["frac_a"][col-1] * data["mask_a"][col-1]
+      lfrac = [ 1.0 - value for value in ofrac ]
+      files = { "lnd":outdir+"/domain.lnd."+lnd_name+"_"+ocn_name+"."+cdate+".nc", \
+                "ocnlnd":outdir+"/domain.ocn."+lnd_name+"_"+ocn_name+"."+cdate+".nc", \
+                "ocn":outdir+"/domain.ocn."+ocn_name+"."+cdate+".nc" }
+      for ( name, frac ) in [ ( "lnd", lfrac ), ( "ocnlnd", ofrac ) ]:
+         self.WriteDomain( prog, files[name], data["xc_b"], data["yc_b"], data["xv_b"], data["yv_b"], \
+                           data["area_b"], frac, data["dst_grid_dims"], mapfile, data, comment )
+      ofrac_a = [ frac*mask for ( frac, mask ) in zip( data["frac_a"], data["mask_a"] ) ]
+      self.WriteDomain( prog, files["ocn"], data["xc_a"], data["yc_a"], data["xv_a"], data["yv_a"], \
+                        data["area_a"], ofrac_a, data["src_grid_dims"], mapfile, data, comment )
+      return( files )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_pointgrids(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = error_prog()
+       self.grids  = pointgrids()
+       self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.grids.WriteNoOcean, self.prog, [], "200101" )
+       self.assertRaises(SystemExit, self.grids.Initialize, self.prog, dx=0.0 )
+
+   def test_area( self ):
+       "test the area of the grid cell"
+       self.grids.dx = 360.0
+       self.grids.dy = 180.0
+       self.assertAlmostEqual( self.grids.Area( 0.0 ), 4.0*math.pi )
+       self.grids.dx = 0.1
+       self.grids.dy = 0.1
+       self.assertAlmostEqual( self.grids.Area( 0.0 )/math.radians( 0.1 )**2, 1.0, places=5 )
+       self.assertLess( self.grids.Area( 60.0 ), self.grids.Area( 0.0 ) )
+       ( latv, lonv ) = self.grids.Corners( 45.0, 275.0 )
+       self.assertEqual( [ round(value, 2) for value in latv ], [ 44.95, 44.95, 45.05, 45.05 ] )
+       self.assertEqual( [ round(value, 2) for value in lonv ], [ 274.95, 275.05, 275.05, 274.95 ] )
+
+   def test_write( self ):
+       "test writing the grid and map files for several points"
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.grids.Initialize( self.prog )
+       points = []
+       for ( site, lat, lon ) in [ ( "US-UMB", 45.5598, 275.2909 ), ( "AU-Tum", -35.6566, 148.1517 ) ]:
+          os.makedirs( self.tmpdir+"/1x1pt_"+site )
+          points.append( { "res":"1x1pt_"+site, "lat":lat, "lon":lon, "dir":self.tmpdir+"/1x1pt_"+site } )
+       self.assertRaises(SystemExit, self.grids.WriteNoOcean, self.prog, [ { "res":"zztop" } ], "200101" )
+       written = self.grids.WriteNoOcean( self.prog, points, "200101" )
+       self.assertEqual( len(written), 2 )
+       self.assertEqual( written[1]["mapfile"], \
+                         self.tmpdir+"/1x1pt_AU-Tum/map_1x1pt_AU-Tum_noocean_to_1x1pt_AU-Tum_nomask_aave_da_200101.nc" )
+       self.assertEqual( sorted(os.listdir( self.tmpdir+"/1x1pt_US-UMB" )), \
+                         sorted([ os.path.basename(filename) for filename in written[0].values() ]) )
+       grid = netCDF4.Dataset( written[0]["scripgridfile"] )
+       self.assertEqual( float(grid.variables["grid_center_lat"][0]), 45.5598 )
+       self.assertEqual( int(grid.variables["grid_imask"][0]), 1 )
+       self.assertEqual( grid.variables["grid_corner_lon"].units, "degrees" )
+       grid.close()
+       ocean = netCDF4.Dataset( written[0]["oceangridfile"] )
+       self.assertEqual( int(ocean.variables["grid_imask"][0]), 0 )
+       ocean.close()
+       mapfile = netCDF4.Dataset( written[1]["mapfile"] )
+       self.assertEqual( float(mapfile.variables["yc_b"][0]), -35.6566 )
+       self.assertEqual( int(mapfile.variables["mask_a"][0]), 0 )
+       self.assertEqual( int(mapfile.variables["mask_b"][0]), 1 )
+       self.assertEqual( float(mapfile.variables["S"][0]), 1.0 )
+       self.assertEqual( mapfile.domain_a, os.path.basename( written[1]["oceangridfile"] ) )
+       mapfile.close()
+
+   def test_globalgrid( self ):
+       "test writing a regular global grid"
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.grids.Initialize( self.prog )
+       self.assertRaises(SystemExit, self.grids.WriteGlobalGrid, self.prog, self.tmpdir+"/grid.nc", 0, 1 )
+       self.grids.WriteGlobalGrid( self.prog, self.tmpdir+"/grid.nc", 36, 18, lon0=-180.0 )
+       grid = netCDF4.Dataset( self.tmpdir+"/grid.nc" )
+       self.assertEqual( list(grid.variables["grid_dims"][:]), [ 36, 18 ] )
+       self.assertEqual( float(grid.variables["grid_center_lon"][0]), -175.0 )
+       self.assertEqual( float(grid.variables["grid_center_lat"][36]), -75.0 )
+       self.assertEqual( list(grid.variables["grid_corner_lon"][1,:]), [ -170.0, -160.0, -160.0, -170.0 ] )
+       grid.close()
+
+   def test_domain( self ):
+       "test writing the domain files for a point"
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.grids.Initialize( self.prog )
+       point   = { "res":"1x1pt_US-UMB", "lat":45.5598, "lon":275.2909, "dir":self.tmpdir }
+       mapfile = self.grids.WriteNoOcean( self.prog, [ point ], "200101" )[0]["mapfile"]
+       self.assertRaises(SystemExit, self.grids.WriteDomains, self.prog, self.tmpdir+"/zztop.nc", "navy", "1x1pt_US-UMB", \
+                         self.tmpdir, "200101" )
+       files = self.grids.WriteDomains( self.prog, mapfile, "navy", "1x1pt_US-UMB", self.tmpdir, "200101", comment="test" )
+       self.assertEqual( files["lnd"], self.tmpdir+"/domain.lnd.1x1pt_US-UMB_navy.200101.nc" )
+       domain = netCDF4.Dataset( files["lnd"] )
+       self.assertEqual( domain.variables["xc"].shape, ( 1, 1 ) )
+       self.assertEqual( domain.variables["xv"].shape, ( 1, 1, 4 ) )
+       self.assertEqual( float(domain.variables["yc"][0,0]), 45.5598 )
+       self.assertEqual( float(domain.variables["frac"][0,0]), 1.0 )
+       self.assertEqual( int(domain.variables["mask"][0,0]), 1 )
+       self.assertAlmostEqual( float(domain.variables["area"][0,0]), self.grids.Area( 45.5598 ) )
+       self.assertEqual( domain.variables["area"].units, "radian2" )
+       self.assertEqual( domain.user_comment, "test" )
+       domain.close()
+       for name in [ "ocn", "ocnlnd" ]:
+          domain = netCDF4.Dataset( files[name] )
+          self.assertEqual( float(domain.variables["frac"][0,0]), 0.0 )
+          self.assertEqual( int(domain.variables["mask"][0,0]), 0 )
+          domain.close()
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,351 @@
+#########################################################################################
+#
+# pointmap.py
+#
+# Python class to create the mapping files from the raw dataset grids to the grid cell
+# of a single point, that mkmapdata.sh creates with ESMF regridding. Only the cells of the
+# raw grid that overlap the point are found (for regular latitude/longitude grids just
+# the rows and columns around the point are read), and the conservative area weights are
+# computed with NumPy. The map files have the full raw grid, so mksurfdata.pl can use them
+# with -usr_mapdir just like the ones from mkmapdata.sh.
+#
+#########################################################################################
+import os, sys, math, time
+
+class pointmap:
+#----------------------------------------------------------------------------------------
+# Class to handle creating mapping files to a single point
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   format   = "NETCDF3_64BIT_OFFSET"
+   chunk    = 1000000  # Number of raw grid cells to read or write at a time
+   gridinfo = {}       # Rows and columns of the raw grids read so far, keyed by filename (shared by all objects)
+   # Raw dataset grids mkmapdata.sh creates mapping files from (hgrid_lmask)
+   mapgrids = [ "0.5x0.5_nomask", "0.25x0.25_nomask", "0.125x0.125_nomask", "3x3min_nomask", \
+                "5x5min_nomask", "10x10min_nomask", "0.9x1.25_nomask", "1km-merge-10min_HYDRO1K-merge-nomask" ]
+
+   def Initialize( self, prog ):
+      "Initialize the mapping engine"
+      try:
+         import numpy, netCDF4
+      except ImportError:
+         prog.error( "The numpy and netCDF4 python modules are required to create mapping files" )
+      self.np      = numpy
+      self.netCDF4 = netCDF4
+      self.setup   = True
+
+   def GridQuery( self, name ):
+      "Return the hgrid and the query options for the raw grid of the given name (as mkmapdata.sh does)"
+      hgrid = name.rsplit( "_", 1 )[0]
+      lmask = name[len(hgrid)+1:]
+      return( hgrid, "lmask="+lmask+",glc_nec=10" )
+
+   def Filename( self, name, res, cdate ):
+      "Return the name of the mapping file from the raw grid to the resolution"
+      return( "map_"+name+"_to_"+res+"_nomask_aave_da_c"+cdate+".nc" )
+
+   def _degrees( self, var, values ):
+      "Return the values of a SCRIP grid variable in degrees"
+      if ( getattr( var, "units", "degrees" ).startswith( "rad" ) ):
+         return( self.np.degrees( values ) )
+      return( values )
+
+   def _bounds( self, latv, lonv, lon0 ):
+      "Return the south, north, west and east edges of cells from their corners, with longitudes near lon0"
+      np   = self.np
+      # Make the corners of each cell contiguous, then move the cell to be near lon0
+      lonv = lonv - 360.0*np.round( (lonv - lonv[...,:1])/360.0 )
+      lonv = lonv - 360.0*np.round( (lonv.mean( axis=-1, keepdims=True ) - lon0)/360.0 )
+      return( latv.min( axis=-1 ), latv.max( axis=-1 ), lonv.min( axis=-1 ), lonv.max( axis=-1 ) )
+
+   def _area( self, south, north, west, east ):
+      "Return the area of latitude/longitude boxes in square radians"
+      np = self.np
+      return( np.radians( east - west ) * np.abs( np.sin( np.radians( north ) ) - np.sin( np.radians( south ) ) ) )
+
+   def _overlap( self, box, south, north, west, east ):
+      "Return the area each latitude/longitude box overlaps the box of the point in square radians"
+      np = self.np
+      ( bsouth, bnorth, bwest, beast ) = box
+      dlon = np.clip( np.minimum( east, beast ) - np.maximum( west, bwest ), 0.0, None )
+      nlat = np.minimum( north, bnorth )
+      slat = np.maximum( south, bsouth )
+      dsin = np.clip( np.sin( np.radians( nlat ) ) - np.sin( np.radians( slat ) ), 0.0, None )
+      return( np.radians( dlon ) * dsin )
+
+   def _info( self, prog, ncfile, filename ):
+      "Return the size of the raw grid, and the center of each row and column if it is a regular grid"
+      stat = os.stat( filename )
+      info = self.gridinfo.get( filename )
+      if ( info != None and info["size"] == stat.st_size and info["mtime"] == stat.st_mtime ):
+         return( info )
+      np   = self.np
+      info = { "size":stat.st_size, "mtime":stat.st_mtime, "ncell":len(ncfile.dimensions["grid_size"]), "regular":False }
+      dims = ncfile.variables["grid_dims"][:]
+      if ( len(dims) == 2 and dims[0]*dims[1] == info["ncell"] and dims[0] > 1 and dims[1] > 1 ):
+         ( nlon, nlat ) = [ int(dim) for dim in dims ]
+         latvar = ncfile.variables["grid_center_lat"]
+         lonvar = ncfile.variables["grid_center_lon"]
+         lats   = self._degrees( latvar, np.asarray( latvar[0::nlon], dtype=float ) )
+         lons   = self._degrees( lonvar, np.asarray( lonvar[0:nlon], dtype=float ) )
+         # Regular if the first row has one latitude and the first column one longitude
+         row0   = self._degrees( latvar, np.asarray( latvar[0:nlon], dtype=float ) )
+         col0   = self._degrees( lonvar, np.asarray( lonvar[0::nlon], dtype=float ) )
+         if ( np.all( row0 == row0[0] ) and np.all( col0 == col0[0] ) ):
+            info.update( { "regular":True, "nlon":nlon, "nlat":nlat, "lats":lats, "lons":lons, \
+                           "dlat":float( np.max( np.abs( np.diff( lats ) ) ) ), \
+                           "dlon":float( np.max( np.abs( np.diff( lons ) ) ) ) } )
+      self.gridinfo[filename] = info
+      return( info )
+
+   def _candidates( self, prog, ncfile, info, box, lon0 ):
+      "Return the index of the raw grid cells that may overlap the box of the point"
+      np = self.np
+      ( bsouth, bnorth, bwest, beast ) = box
+      if ( info["regular"] ):
+         # Only the rows and columns next to the point need to be looked at
+         rows = np.nonzero( (info["lats"] >= bsouth - info["dlat"]) & (info["lats"] <= bnorth + info["dlat"]) )[0]
+         dist = np.abs( info["lons"] - 360.0*np.round( (info["lons"] - lon0)/360.0 ) - lon0 )
+         cols = np.nonzero( dist <= (beast - bwest)/2.0 + info["dlon"] )[0]
+         return( np.sort( (rows[:,None]*info["nlon"] + cols[None,:]).ravel() ) )
+      # Otherwise look at every cell, a chunk at a time
+      found  = []
+      latvar = ncfile.variables["grid_corner_lat"]
+      lonvar = ncfile.variables["grid_corner_lon"]
+      for start in range( 0, info["ncell"], self.chunk ):
+         end  = min( start+self.chunk, info["ncell"] )
+         latv = self._degrees( latvar, np.asarray( latvar[start:end,:], dtype=float ) )
+         near = np.nonzero( (latv.max( axis=1 ) >= bsouth) & (latv.min( axis=1 ) <= bnorth) )[0]
+         if ( len(near) == 0 ): continue
+         lonv = self._degrees( lonvar, np.asarray( lonvar[start:end,:], dtype=float )[near] )
+         ( south, north, west, east ) = self._bounds( latv[near], lonv, lon0 )
+         keep = np.nonzero( (east > bwest) & (west < beast) )[0]
+         found.append( near[keep] + start )
+      if ( len(found) == 0 ):
+         return( np.zeros( 0, dtype=int ) )
+      return( np.concatenate( found ) )
+
+   def Weights( self, prog, gridfile, lat, lon, latv, lonv ):
+      "Return the raw grid cells that overlap the point, with the weights and fraction of each cell used"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not os.path.exists( gridfile ) ):
+         prog.error( "Raw grid file does NOT exist: "+gridfile )
+      np     = self.np
+      box    = self._bounds( np.array( latv, dtype=float ), np.array( lonv, dtype=float ), lon )
+      area_b = float( self._area( *box ) )
+      ncfile = self.netCDF4.Dataset( gridfile, "r" )
+      try:
+         info  = self._info( prog, ncfile, gridfile )
+         cells = self._candidates( prog, ncfile, info, box, lon )
+         if ( len(cells) > 0 ):
+            clat = self._degrees( ncfile.variables["grid_corner_lat"], \
+                                  np.asarray( ncfile.variables["grid_corner_lat"][cells,:], dtype=float ) )
+            clon = self._degrees( ncfile.variables["grid_corner_lon"], \
+                                  np.asarray( ncfile.variables["grid_corner_lon"][cells,:], dtype=float ) )
+            if ( "grid_imask" in ncfile.variables ):
+               mask = np.asarray( ncfile.variables["grid_imask"][cells], dtype=int )
+            else:
+               mask = np.ones( len(cells), dtype=int )
+      except KeyError as err:
+         prog.error( "Raw grid file is NOT a SCRIP grid file "+gridfile+": "+str(err) )
+      ncfile.close()
+      weights = { "area_b":area_b, "col":np.zeros( 0, dtype=int ), "S":np.zeros( 0 ), "frac_a":np.zeros( 0 ) }
+      if ( len(cells) == 0 ):
+         return( weights )
+      ( south, north, west, east ) = self._bounds( clat, clon, lon )
+      overlap = self._overlap( box, south, north, west, east ) * ( mask != 0 )
+      used    = np.nonzero( overlap > area_b*1.e-12 )[0]
+      weights["col"]    = cells[used] + 1
+      weights["S"]      = overlap[used] / area_b
+      weights["frac_a"] = overlap[used] / self._area( south[used], north[used], west[used], east[used] )
+      return( weights )
+
+   def WriteMap( self, prog, mapfile, gridfile, dstgridfile ):
+      "Write the mapping file from a raw grid to the single point grid"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      np  = self.np
+      dst = self.netCDF4.Dataset( dstgridfile, "r" )
+      lat  = float( self._degrees( dst.variables["grid_center_lat"], dst.variables["grid_center_lat"][0] ) )
+      lon  = float( self._degrees( dst.variables["grid_center_lon"], dst.variables["grid_center_lon"][0] ) )
+      latv = self._degrees( dst.variables["grid_corner_lat"], np.asarray( dst.variables["grid_corner_lat"][0,:], dtype=float ) )
+      lonv = self._degrees( dst.variables["grid_corner_lon"], np.asarray( dst.variables["grid_corner_lon"][0,:], dtype=float ) )
+      dst.close()
+      weights = self.Weights( prog, gridfile, lat, lon, latv, lonv )
+      src     = self.netCDF4.Dataset( gridfile, "r" )
+      ncfile  = self.netCDF4.Dataset( mapfile+".tmp", "w", format=self.format )
+      ncfile.title         = "Mapping file from "+os.path.basename( gridfile )+" to "+os.path.basename( dstgridfile )
+      ncfile.map_method    = "Conservative remapping"
+      ncfile.normalization = "destarea"
+      ncfile.conventions   = "NCAR-CSM"
+      ncfile.domain_a      = os.path.basename( gridfile )
+      ncfile.domain_b      = os.path.basename( dstgridfile )
+      ncfile.grid_file_src = gridfile
+      ncfile.grid_file_dst = dstgridfile
+      ncfile.history       = time.strftime( "%a %b %d %Y" )+": created by PTCLM pointmap.py"
+      ncell = len(src.dimensions["grid_size"])
+      for ( dim, size ) in [ ( "n_a", ncell ), ( "n_b", 1 ), ( "n_s", len(weights["col"]) ), \
+                             ( "nv_a", len(src.dimensions["grid_corners"]) ), ( "nv_b", len(latv) ), \
+                             ( "src_grid_rank", len(src.dimensions["grid_rank"]) ), ( "dst_grid_rank", 2 ) ]:
+         ncfile.createDimension( dim, size )
+      def variable( name, dtype, dims, units=None ):
+         var = ncfile.createVariable( name, dtype, dims )
+         if ( units != None ): var.units = units
+         return( var )
+      variable( "src_grid_dims", "i4", ("src_grid_rank",) )[:] = src.variables["grid_dims"][:]
+      variable( "dst_grid_dims", "i4", ("dst_grid_rank",) )[:] = [ 1, 1 ]
+      variable( "yc_b", "f8", ("n_b",), "degrees" )[:] = [ lat ]
+      variable( "xc_b", "f8", ("n_b",), "degrees" )[:] = [ lon ]
+      variable( "yv_b", "f8", ("n_b","nv_b"), "degrees" )[:] = [ latv ]
+      variable( "xv_b", "f8", ("n_b","nv_b"), "degrees" )[:] = [ lonv ]
+      variable( "mask_b", "i4", ("n_b",), "unitless" )[:] = [ 1 ]
+      variable( "area_b", "f8", ("n_b",), "square radians" )[:] = [ weights["area_b"] ]
+      variable( "frac_b", "f8", ("n_b",), "unitless" )[:] = [ float( np.sum( weights["S"] ) ) ]
+      # The raw grid is copied a chunk at a time, as it can be very large
+      outvars = {}
+      for ( name, dims, units ) in [ ( "yc_a", ("n_a",), "degrees" ), ( "xc_a", ("n_a",), "degrees" ), \
+                                     ( "yv_a", ("n_a","nv_a"), "degrees" ), ( "xv_a", ("n_a","nv_a"), "degrees" ), \
+                                     ( "area_a", ("n_a",), "square radians" ), ( "frac_a", ("n_a",), "unitless" ) ]:
+         outvars[name] = variable( name, "f8", dims, units )
+      outvars["mask_a"] = variable( "mask_a", "i4", ("n_a",), "unitless" )
+      for start in range( 0, ncell, self.chunk ):
+         end  = min( start+self.chunk, ncell )
+         for ( outname, inname ) in [ ( "yc_a", "grid_center_lat" ), ( "xc_a", "grid_center_lon" ), \
+                                      ( "yv_a", "grid_corner_lat" ), ( "xv_a", "grid_corner_lon" ) ]:
+            outvars[outname][start:end] = self._degrees( src.variables[inname], np.asarray( src.variables[inname][start:end], dtype=float ) )
+         if ( "grid_imask" in src.variables ):
+            outvars["mask_a"][start:end] = src.variables["grid_imask"][start:end]
+         else:
+            outvars["mask_a"][start:end] = 1
+         if ( "grid_area" in src.variables ):
+            outvars["area_a"][start:end] = src.variables["grid_area"][start:end]
+         else:
+            corners = self._bounds( np.asarray( outvars["yv_a"][start:end], dtype=float ), \
+                                    np.asarray( outvars["xv_a"][start:end], dtype=float ), 0.0 )
+            outvars["area_a"][start:end] = self._area( *corners )
+         frac = np.zeros( end - start )
+         used = ( weights["col"] > start ) & ( weights["col"] <= end )
+         frac[weights["col"][used] - 1 - start] = weights["frac_a"][used]
+         outvars["frac_a"][start:end] = frac
+      variable( "col", "i4", ("n_s",) )[:] = weights["col"]
+      variable( "row", "i4", ("n_s",) )[:] = np.ones( len(weights["col"]), dtype=int )
+      variable( "S", "f8", ("n_s",) )[:] = weights["S"]
+      ncfile.close()
+      src.close()
+      os.rename( mapfile+".tmp", mapfile )
+
+   def WriteMaps( self, prog, gridfiles, dstgridfile, res, outdir, cdate ):
+      "Write the mapping files from each raw grid (a dictionary of grid files keyed by name) to the point, returns the filenames"
+      mapfiles = []
+      for name in sorted( gridfiles ):
+         mapfile = outdir+"/"+self.Filename( name, res, cdate )
+         self.WriteMap( prog, mapfile, gridfiles[name], dstgridfile )
+         mapfiles.append( mapfile )
+      return( mapfiles )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_pointmap(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = error_prog()
+       self.map    = pointmap()
+       self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write_grid( self, filename, nlon, nlat, lon0=0.0 ):
+       "Write a regular global SCRIP grid"
+       from pointgrids import pointgrids
+       grids = pointgrids()
+       grids.Initialize( self.prog )
+       grids.WriteGlobalGrid( self.prog, filename, nlon, nlat, lon0=lon0 )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.map.Weights, self.prog, "zztop.nc", 0.0, 0.0, [], [] )
+       self.assertEqual( self.map.GridQuery( "1km-merge-10min_HYDRO1K-merge-nomask" ), \
+                         ( "1km-merge-10min", "lmask=HYDRO1K-merge-nomask,glc_nec=10" ) )
+       self.assertEqual( self.map.GridQuery( "0.5x0.5_nomask" ), ( "0.5x0.5", "lmask=nomask,glc_nec=10" ) )
+
+   def test_weights( self ):
+       "test the overlap weights for points inside a cell, across cells and across the date line"
+       try:
+          import numpy as np
+       except ImportError:
+          self.skipTest( "numpy and netCDF4 are NOT available" )
+       self.map.Initialize( self.prog )
+       gridfile = self.tmpdir+"/grid.nc"
+       self.write_grid( gridfile, 36, 18 )
+       self.assertRaises(SystemExit, self.map.Weights, self.prog, self.tmpdir+"/zztop.nc", 0.0, 0.0, [], [] )
+       def box( lat, lon, d ):
+          return( [ lat-d, lat-d, lat+d, lat+d ], [ lon-d, lon+d, lon+d, lon-d ] )
+       # Inside one cell
+       weights = self.map.Weights( self.prog, gridfile, 45.0, 275.0, *box( 45.0, 275.0, 0.05 ) )
+       self.assertEqual( list(weights["col"]), [ 13*36 + 27 + 1 ] )
+       self.assertAlmostEqual( float(weights["S"][0]), 1.0 )
+       # On the corner of four cells (two on each side of the prime meridian)
+       weights = self.map.Weights( self.prog, gridfile, 0.0, 0.0, *box( 0.0, 0.0, 0.05 ) )
+       self.assertEqual( sorted(weights["col"]), [ 8*36+1, 8*36+36, 9*36+1, 9*36+36 ] )
+       self.assertAlmostEqual( float(np.sum( weights["S"] )), 1.0 )
+       for value in weights["S"]:
+          self.assertAlmostEqual( float(value), 0.25 )
+       # Same with longitudes given as -180 to 180 on the raw grid and the point
+       self.write_grid( gridfile, 36, 18, lon0=-180.0 )
+       weights2 = self.map.Weights( self.prog, gridfile, 0.0, 360.0, *box( 0.0, 360.0, 0.05 ) )
+       self.assertAlmostEqual( float(np.sum( weights2["S"] )), 1.0 )
+       self.assertEqual( len(weights2["col"]), 4 )
+       # Irregular grids look at every cell
+       self.map.chunk = 100
+       self.map.gridinfo[gridfile]["regular"] = False
+       weights3 = self.map.Weights( self.prog, gridfile, 0.0, 360.0, *box( 0.0, 360.0, 0.05 ) )
+       self.assertEqual( sorted(weights3["col"]), sorted(weights2["col"]) )
+
+   def test_write( self ):
+       "test writing the mapping files to a point"
+       try:
+          import numpy as np, netCDF4
+       except ImportError:
+          self.skipTest( "numpy and netCDF4 are NOT available" )
+       from pointgrids import pointgrids
+       self.map.Initialize( self.prog )
+       self.map.chunk = 500
+       grids = pointgrids()
+       grids.Initialize( self.prog )
+       point = { "res":"1x1pt_US-UMB", "lat":45.5598, "lon":275.2909, "dir":self.tmpdir }
+       dstgrid = grids.WriteNoOcean( self.prog, [ point ], "200101" )[0]["scripgridfile"]
+       gridfiles = {}
+       for ( name, nlon, nlat ) in [ ( "10x10_nomask", 36, 18 ), ( "1x1_nomask", 360, 180 ) ]:
+          gridfiles[name] = self.tmpdir+"/SCRIPgrid_"+name+".nc"
+          self.write_grid( gridfiles[name], nlon, nlat )
+       mapfiles = self.map.WriteMaps( self.prog, gridfiles, dstgrid, "1x1pt_US-UMB", self.tmpdir, "200101" )
+       self.assertEqual( [ os.path.basename(mapfile) for mapfile in mapfiles ], \
+                         [ "map_10x10_nomask_to_1x1pt_US-UMB_nomask_aave_da_c200101.nc", \
+                           "map_1x1_nomask_to_1x1pt_US-UMB_nomask_aave_da_c200101.nc" ] )
+       mapfile = netCDF4.Dataset( mapfiles[1] )
+       self.assertEqual( len(mapfile.dimensions["n_a"]), 360*180 )
+       self.assertEqual( list(mapfile.variables["src_grid_dims"][:]), [ 360, 180 ] )
+       self.assertAlmostEqual( float(mapfile.variables["frac_b"][0]), 1.0 )
+       self.assertAlmostEqual( float(np.sum( mapfile.variables["S"][:] )), 1.0 )
+       col = int(mapfile.variables["col"][0])
+       self.assertEqual( col, 135*360 + 275 + 1 )
+       self.assertAlmostEqual( float(mapfile.variables["yc_a"][col-1]), 45.5 )
+       self.assertGreater( float(mapfile.variables["frac_a"][col-1]), 0.0 )
+       self.assertEqual( float(np.sum( mapfile.variables["frac_a"][:] > 0.0 )), 1.0 )
+       self.assertAlmostEqual( float(np.sum( mapfile.variables["area_a"][:] )), 4.0*math.pi )
+       mapfile.close()
+
+if __name__ == '__main__':
+     unittest.main()
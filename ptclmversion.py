@@ -0,0 +1,87 @@
+#########################################################################################
+#
+# ptclmversion.py
+#
+# Python class to get the PTCLM version (the latest tag) from the top of the ChangeLog.
+# The version is saved once it's read, and only read again if the ChangeLog changes.
+#
+#########################################################################################
+import os, sys
+
+class ptclmversion:
+#----------------------------------------------------------------------------------------
+# Class to handle getting the version from the ChangeLog
+#----------------------------------------------------------------------------------------
+   # Class data
+   versions = {}       # Versions read so far, keyed by ChangeLog filename (shared by all objects)
+
+   def Get( self, prog, changelog ):
+      "Return the version tag from the given ChangeLog file"
+      if ( not os.path.exists( changelog ) ):
+         prog.error( "ChangeLog file does NOT exist: "+changelog )
+      changelog = os.path.abspath( changelog )
+      stat      = os.stat( changelog )
+      saved     = self.versions.get( changelog )
+      if ( saved != None and saved["size"] == stat.st_size and saved["mtime"] == stat.st_mtime ):
+         return( saved["version"] )
+      tagvers = ""
+      clog = open( changelog, "r" )
+      for line in clog:
+         if ( line.find("Tag: ",0) == 0 ):
+            tagvers = line[5:].rstrip( )
+            break
+      clog.close()
+      self.versions[changelog] = { "size":stat.st_size, "mtime":stat.st_mtime, "version":tagvers }
+      return( tagvers )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_ptclmversion(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.version = ptclmversion()
+       self.tmpdir  = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def test_get( self ):
+       "test getting the version from a ChangeLog"
+       self.assertRaises(SystemExit, self.version.Get, self.prog, self.tmpdir+"/ChangeLog" )
+       changelog = self.tmpdir+"/ChangeLog"
+       clog = open( changelog, "w" )
+       clog.write( "=====\nOriginator: erik\nTag: PTCLM2_20200902\nOne-line: Fix\n\nTag: PTCLM2_20200118\n" )
+       clog.close()
+       self.assertEqual( self.version.Get( self.prog, changelog ), "PTCLM2_20200902" )
+       # Other objects get the saved version
+       self.assertEqual( ptclmversion().Get( self.prog, changelog ), "PTCLM2_20200902" )
+       clog = open( changelog, "w" )
+       clog.write( "Tag: PTCLM2_20210101\nTag: PTCLM2_20200902\n" )
+       clog.close()
+       os.utime( changelog, (0, 0) )
+       self.assertEqual( self.version.Get( self.prog, changelog ), "PTCLM2_20210101" )
+
+   def test_repo( self ):
+       "test that the version of this ChangeLog is read the same way as before"
+       changelog = os.path.dirname( os.path.abspath( __file__ ) )+"/ChangeLog"
+       clog = open( changelog, "r" )
+       for line in clog:
+          if ( line.find("Tag: ",0) == 0 ):
+             n = line.count("")
+             tagvers = line[5:n-2]
+             break
+       clog.close()
+       self.assertEqual( self.version.Get( self.prog, changelog ), tagvers )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,326 @@
+#########################################################################################
+#
+# sitecatalog.py
+#
+# Python class for the catalog of PTCLM sites. Joins the sitedata, pftdata and soildata
+# files (and any <site>_dynpftdata.txt files) for a site group into one record per site,
+# and keeps it compiled in a SQLite database that is rebuilt when the files change.
+#
+#########################################################################################
+import os, sys, csv, glob, json, math, sqlite3, threading
+
+class sitecatalog:
+#----------------------------------------------------------------------------------------
+# Class to handle the site catalog
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   sitedir  = ""
+   group    = "PTCLMDATA"
+   dbfile   = ""
+   version  = 1            # Increment when the database layout changes
+   # Columns of the sitedata file and the type of each
+   fields   = [ ("site_code",str), ("name",str), ("state",str), ("lon",float), ("lat",float), \
+                ("elev",float), ("startyear",int), ("endyear",int), ("alignyear",int), \
+                ("timestep",int), ("campaign",str) ]
+   earthradius = 6371.22   # Radius of the earth in km
+
+   def Initialize( self, prog, sitedir, group="PTCLMDATA", dbfile="" ):
+      "Initialize the site catalog, rebuilding the database if the site files changed"
+      self.sitedir = os.path.abspath( sitedir )
+      self.group   = group
+      self.memo    = {}
+      # The catalog is shared by the threads of a process, so the connection is too (with it's queries locked)
+      self.lock    = threading.Lock()
+      sitefile     = self.sitedir+"/"+group+"_sitedata.txt"
+      if ( not os.path.exists( sitefile ) ):
+         prog.error( "Site data file does NOT exist: "+sitefile )
+      signature = json.dumps( [ self.version, self._signature() ] )
+      # Use an in-memory database if the database directory can NOT be written to
+      if ( dbfile == "" or not os.access( os.path.dirname( os.path.abspath(dbfile) ), os.W_OK ) ):
+         self.dbfile = ":memory:"
+      else:
+         self.dbfile = os.path.abspath( dbfile )
+      if ( self.dbfile != ":memory:" and os.path.exists( self.dbfile ) ):
+         self.db = sqlite3.connect( self.dbfile, check_same_thread=False )
+         try:
+            saved = self.db.execute( "SELECT value FROM meta WHERE key='signature'" ).fetchone()
+         except sqlite3.DatabaseError:
+            saved = None
+         if ( saved != None and saved[0] == signature ):
+            self.setup = True
+            return
+         self.db.close()
+      if ( self.dbfile == ":memory:" ):
+         self.db = sqlite3.connect( self.dbfile, check_same_thread=False )
+         self._build( prog, self.db, signature )
+      else:
+         # Build to a temporary file and move it into place so concurrent jobs see a whole database
+         tmpfile = self.dbfile+"."+str(os.getpid())+".tmp"
+         if ( os.path.exists( tmpfile ) ): os.remove( tmpfile )
+         db = sqlite3.connect( tmpfile )
+         self._build( prog, db, signature )
+         db.close()
+         os.rename( tmpfile, self.dbfile )
+         self.db = sqlite3.connect( self.dbfile, check_same_thread=False )
+      self.setup = True
+
+   def _signature( self ):
+      "Return the size and modification time of each of the site files"
+      files = [ self.sitedir+"/"+self.group+"_"+name+".txt" for name in [ "sitedata", "pftdata", "soildata" ] ]
+      files = files + sorted( glob.glob( self.sitedir+"/*_dynpftdata.txt" ) )
+      signature = []
+      for filename in files:
+         if ( os.path.exists( filename ) ):
+            stat = os.stat( filename )
+            signature.append( [ os.path.basename(filename), stat.st_size, stat.st_mtime ] )
+      return( signature )
+
+   def _read( self, name ):
+      "Read one of the site group files, returning the header row and a dictionary of rows by site"
+      filename = self.sitedir+"/"+self.group+"_"+name+".txt"
+      rows     = {}
+      header   = None
+      if ( os.path.exists( filename ) ):
+         infile = open( filename, "r", encoding="utf-8", errors="replace" )
+         for row in csv.reader( infile ):
+            if ( len(row) == 0 ):
+               continue
+            if ( header == None ):
+               header = row
+            elif ( row[0] not in rows ):
+               rows[row[0]] = row
+         infile.close()
+      return( header, rows )
+
+   def _build( self, prog, db, signature ):
+      "Build the database from the site files"
+      columns = ", ".join( [ field+" "+{str:"TEXT", float:"REAL", int:"INTEGER"}[ftype] \
+                             for ( field, ftype ) in self.fields[1:] ] )
+      db.execute( "CREATE TABLE sites (site_code TEXT PRIMARY KEY, "+columns+ \
+                  ", seq INTEGER, pft TEXT, soil TEXT, dynpftfile TEXT, lon180 REAL)" )
+      db.execute( "CREATE INDEX sites_campaign ON sites (campaign)" )
+      db.execute( "CREATE INDEX sites_state ON sites (state)" )
+      db.execute( "CREATE INDEX sites_latlon ON sites (lat, lon180)" )
+      db.execute( "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)" )
+      filename = self.sitedir+"/"+self.group+"_sitedata.txt"
+      infile   = open( filename, "r", encoding="utf-8", errors="replace" )
+      reader   = csv.reader( infile )
+      header   = next( reader )
+      ( pfthead,  pftrows  ) = self._read( "pftdata" )
+      ( soilhead, soilrows ) = self._read( "soildata" )
+      records = []
+      for row in reader:
+         if ( len(row) == 0 ):
+            continue
+         if ( len(row) != len(self.fields) ):
+            prog.error( "Wrong number of columns in "+filename+" for site: "+row[0] )
+         record = []
+         for i in range( len(self.fields) ):
+            try:
+               record.append( self.fields[i][1]( row[i] ) )
+            except ValueError:
+               prog.error( "Bad value for "+self.fields[i][0]+" in "+filename+" for site: "+row[0] )
+         pft  = None
+         soil = None
+         if ( row[0] in pftrows  ): pft  = json.dumps( pftrows[row[0]][1:11] )
+         if ( row[0] in soilrows ): soil = json.dumps( soilrows[row[0]][1:7] )
+         dynpftfile = self.sitedir+"/"+row[0]+"_dynpftdata.txt"
+         if ( not os.path.exists( dynpftfile ) ): dynpftfile = None
+         # Also keep the longitude in the range -180 to 180 for box queries
+         lon180 = ( record[3] + 180.0 ) % 360.0 - 180.0
+         records.append( tuple( record ) + ( len(records), pft, soil, dynpftfile, lon180 ) )
+      infile.close()
+      db.executemany( "INSERT OR IGNORE INTO sites VALUES ("+",".join( ["?"]*(len(self.fields)+5) )+")", records )
+      db.execute( "INSERT INTO meta VALUES ('signature', ?)", ( signature, ) )
+      db.execute( "INSERT INTO meta VALUES ('header', ?)", ( json.dumps( header ), ) )
+      db.commit()
+
+   def _record( self, row ):
+      "Convert a database row into a site record dictionary"
+      record = {}
+      for i in range( len(self.fields) ):
+         record[self.fields[i][0]] = row[i]
+      n = len(self.fields)
+      record["pft"]        = None
+      record["soil"]       = None
+      if ( row[n+1] != None ): record["pft"]  = json.loads( row[n+1] )
+      if ( row[n+2] != None ): record["soil"] = json.loads( row[n+2] )
+      record["dynpftfile"] = row[n+3]
+      return( record )
+
+   def _select( self, where="", args=() ):
+      "Return the site records that match the where clause in the order of the sitedata file"
+      with self.lock:
+         rows = self.db.execute( "SELECT * FROM sites "+where+" ORDER BY seq", args ).fetchall()
+      return( [ self._record( row ) for row in rows ] )
+
+   def Header( self, prog ):
+      "Return the header of the sitedata file as a site record"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      with self.lock:
+         header = json.loads( self.db.execute( "SELECT value FROM meta WHERE key='header'" ).fetchone()[0] )
+      return( dict( zip( [ field for ( field, ftype ) in self.fields ], header ) ) )
+
+   def Get( self, prog, site ):
+      "Return the record for the site, or None if the site is NOT in the catalog"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( site not in self.memo ):
+         records = self._select( "WHERE site_code = ?", ( site, ) )
+         if ( len(records) == 0 ):
+            return( None )
+         self.memo[site] = records[0]
+      return( self.memo[site] )
+
+   def Sites( self, prog, campaign=None, region=None, bbox=None ):
+      "Return the list of site records, optionally for a campaign, region, or box of (latS,latN,lonW,lonE)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      conditions = []
+      args       = []
+      if ( campaign != None ):
+         conditions.append( "campaign = ?" )
+         args.append( campaign )
+      if ( region != None ):
+         conditions.append( "state = ?" )
+         args.append( region )
+      if ( bbox != None ):
+         ( lats, latn, lonw, lone ) = bbox
+         lonw = ( lonw + 180.0 ) % 360.0 - 180.0
+         lone = ( lone + 180.0 ) % 360.0 - 180.0
+         conditions.append( "lat BETWEEN ? AND ?" )
+         args = args + [ lats, latn, lonw, lone ]
+         # A box that crosses the dateline has lonw > lone
+         if ( lonw <= lone ):
+            conditions.append( "lon180 BETWEEN ? AND ?" )
+         else:
+            conditions.append( "(lon180 >= ? OR lon180 <= ?)" )
+      where = ""
+      if ( len(conditions) > 0 ):
+         where = "WHERE "+" AND ".join( conditions )
+      return( self._select( where, tuple(args) ) )
+
+   def Nearest( self, prog, lat, lon, n=1 ):
+      "Return a list of the n nearest sites to the point as (site record, distance in km)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      distances = []
+      for record in self._select():
+         distances.append( ( record, self.Distance( lat, lon, record["lat"], record["lon"] ) ) )
+      # The sort is stable so sites at the same distance stay in sitedata file order
+      distances.sort( key=lambda d: d[1] )
+      return( distances[0:n] )
+
+   def Distance( self, lat1, lon1, lat2, lon2 ):
+      "Return the great circle distance in km between two points"
+      lat1 = math.radians( lat1 )
+      lat2 = math.radians( lat2 )
+      dlat = lat2 - lat1
+      dlon = math.radians( lon2 - lon1 )
+      a    = math.sin( dlat/2.0 )**2 + math.cos( lat1 )*math.cos( lat2 )*math.sin( dlon/2.0 )**2
+      return( 2.0*self.earthradius*math.asin( min( 1.0, math.sqrt( a ) ) ) )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, time
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_sitecatalog(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.catalog = sitecatalog()
+       self.sitedir = os.path.dirname( os.path.abspath( __file__ ) )+"/PTCLM_sitedata"
+       self.tmpdir  = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.catalog.Get, self.prog, "US-UMB" )
+       self.assertRaises(SystemExit, self.catalog.Initialize, self.prog, self.tmpdir )
+       self.assertRaises(SystemExit, self.catalog.Initialize, self.prog, self.sitedir, group="zztop" )
+
+   def test_get( self ):
+       "test getting a site compared to reading the files directly"
+       self.catalog.Initialize( self.prog, self.sitedir )
+       self.assertEqual( self.catalog.Get( self.prog, "zztop" ), None )
+       site = self.catalog.Get( self.prog, "US-UMB" )
+       self.assertEqual( site["lat"], 45.5598 )
+       self.assertEqual( site["lon"], -84.7138 )
+       self.assertEqual( site["startyear"], 1999 )
+       self.assertEqual( site["timestep"], 60 )
+       self.assertEqual( site["pft"], [ "100", "7", "0", "0", "0", "0", "0", "0", "0", "0" ] )
+       self.assertEqual( site["soil"], [ "-999", "1", "-999", "92.6", "0.6" ] )
+       self.assertEqual( site["dynpftfile"], None )
+       self.assertEqual( self.catalog.Get( self.prog, "US-Ha1" )["dynpftfile"], self.sitedir+"/US-Ha1_dynpftdata.txt" )
+       header = self.catalog.Header( self.prog )
+       self.assertEqual( header["site_code"], "site_code" )
+       self.assertEqual( header["campaign"],  "campaign" )
+       sites = [ site["site_code"] for site in self.catalog.Sites( self.prog ) ]
+       self.assertEqual( sites[0:3], [ "US-Blo", "US-CHATS", "US-FPe" ] )
+       self.assertEqual( len(sites), 43 )
+
+   def test_queries( self ):
+       "test the filtered and spatial queries"
+       self.catalog.Initialize( self.prog, self.sitedir )
+       for site in self.catalog.Sites( self.prog, campaign="LBA" ):
+          self.assertEqual( site["campaign"], "LBA" )
+       sites = [ site["site_code"] for site in self.catalog.Sites( self.prog, region="CAN", campaign="Fluxnet-Canada" ) ]
+       self.assertTrue( "CA-Let" in sites )
+       sites = [ site["site_code"] for site in self.catalog.Sites( self.prog, bbox=(45.0,46.0,275.0,276.0) ) ]
+       self.assertTrue( "US-UMB" in sites )
+       sites = [ site["site_code"] for site in self.catalog.Sites( self.prog, bbox=(45.0,46.0,-85.0,-84.0) ) ]
+       self.assertTrue( "US-UMB" in sites )
+       self.assertEqual( self.catalog.Sites( self.prog, bbox=(-90.0,90.0,179.0,-179.0) ), [] )
+       sites = [ site["site_code"] for site in self.catalog.Sites( self.prog, bbox=(45.0,46.0,270.0,-80.0) ) ]
+       self.assertEqual( sites, [ "US-UMB" ] )
+       ( site, distance ) = self.catalog.Nearest( self.prog, 45.56, 275.29 )[0]
+       self.assertEqual( site["site_code"], "US-UMB" )
+       self.assertTrue( distance < 1.0 )
+       self.assertEqual( len(self.catalog.Nearest( self.prog, 0.0, 0.0, n=3 )), 3 )
+
+   def test_threads( self ):
+       "test querying the catalog from threads other than the one that opened it"
+       import concurrent.futures
+       for dbfile in [ "", self.tmpdir+"/catalog.db" ]:
+          catalog = sitecatalog()
+          catalog.Initialize( self.prog, self.sitedir, dbfile=dbfile )
+          sites = [ site["site_code"] for site in catalog.Sites( self.prog ) ]
+          with concurrent.futures.ThreadPoolExecutor( max_workers=4 ) as pool:
+             lats = list( pool.map( lambda site: catalog.Get( self.prog, site )["lat"], sites ) )
+          self.assertEqual( lats, [ site["lat"] for site in catalog.Sites( self.prog ) ] )
+
+   def test_rebuild( self ):
+       "test that the database is saved and rebuilt when a site file changes"
+       sitedir = self.tmpdir+"/sitedata"
+       shutil.copytree( self.sitedir, sitedir )
+       dbfile  = self.tmpdir+"/catalog.db"
+       self.catalog.Initialize( self.prog, sitedir, dbfile=dbfile )
+       self.assertTrue( os.path.exists( dbfile ) )
+       self.assertEqual( self.catalog.Get( self.prog, "US-Blo" )["soil"][3], "60.0" )
+       catalog = sitecatalog()
+       catalog.Initialize( self.prog, sitedir, dbfile=dbfile )
+       self.assertEqual( catalog.Get( self.prog, "US-Blo" )["soil"][3], "60.0" )
+       soilfile = sitedir+"/PTCLMDATA_soildata.txt"
+       text = open( soilfile, "r" ).read().replace( "US-Blo,-999,1,-999,60.0", "US-Blo,-999,1,-999,61.0" )
+       outfile = open( soilfile, "w" )
+       outfile.write( text )
+       outfile.close()
+       mtime = os.path.getmtime( soilfile ) + 10.0
+       os.utime( soilfile, ( mtime, mtime ) )
+       catalog = sitecatalog()
+       catalog.Initialize( self.prog, sitedir, dbfile=dbfile )
+       self.assertEqual( catalog.Get( self.prog, "US-Blo" )["soil"][3], "61.0" )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,301 @@
+#########################################################################################
+#
+# stagegraph.py
+#
+# Python class to run the stages of PTCLMmkdata as a dependency graph. Each stage is
+# started as soon as the stages it depends on are done, so independent stages run at the
+# same time. If a stage fails, the stages still running are cancelled (the tools they
+# started are killed), no more stages are started, and the error from the stage that
+# failed is raised again. Stages and the commands they run can optionally be traced
+# (see stagetrace.py). A subset of the stages (with the stages they depend on) can be
+# selected to run, so the stages can be split between jobs.
+#
+#########################################################################################
+import os, sys, time, signal, subprocess, threading
+import concurrent.futures
+
+class stagegraph:
+#----------------------------------------------------------------------------------------
+# Class to handle the graph of stages
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup   = False
+   maxjobs = 4        # Maximum number of stages to run at the same time
+   trace   = None     # Object to trace stages and commands with (a stagetrace)
+
+   def Initialize( self, prog, maxjobs=4, trace=None ):
+      "Initialize an empty graph of stages"
+      if ( maxjobs < 1 ):
+         prog.error( "Number of stages to run at the same time must be one or greater" )
+      self.maxjobs   = maxjobs
+      self.trace     = trace
+      self.stages    = {}
+      self.order     = []
+      self.procs     = set()
+      self.lock      = threading.Lock()
+      self.cancelled = threading.Event()
+      self.failed    = []
+      self.errors    = {}
+      self.setup     = True
+
+   def Add( self, prog, name, func, depends=[] ):
+      "Add a stage, the stages it depends on must have been added already (func may return the files it creates)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( name in self.stages ):
+         prog.error( "Stage was already added: "+name )
+      for dep in depends:
+         if ( dep not in self.stages ):
+            prog.error( "Stage "+name+" depends on a stage that was NOT added: "+dep )
+      self.stages[name] = { "func":func, "depends":list(depends) }
+      self.order.append( name )
+
+   def Select( self, prog, names ):
+      "Only run the given stages and the stages they depend on, returns the stages that will be run in order"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      keep = set()
+      todo = list( names )
+      while ( len(todo) > 0 ):
+         name = todo.pop()
+         if ( name not in self.stages ):
+            prog.error( "Stage to run was NOT added: "+name+" (stages are: "+",".join(self.order)+")" )
+         if ( name in keep ): continue
+         keep.add( name )
+         todo.extend( self.stages[name]["depends"] )
+      self.order = [ name for name in self.order if name in keep ]
+      return( list( self.order ) )
+
+   def Call( self, prog, cmd, cwd=None ):
+      "Run a shell command (in cwd) and return it's exit status, the command is killed if the stages are cancelled"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      # Run in it's own process group so that the tool and anything it starts can be killed together.
+      # It's started with the lock held, so Cancel either sees it in procs or it isn't started at all
+      start = time.time()
+      with self.lock:
+         if ( self.cancelled.is_set() ):
+            return( -signal.SIGTERM )
+         proc = subprocess.Popen( cmd, shell=True, start_new_session=True, cwd=cwd )
+         self.procs.add( proc )
+      try:
+         # Wait with wait4 to get the resource usage of the command (and what it ran)
+         (pid, status, rusage) = os.wait4( proc.pid, 0 )
+         rcode = os.waitstatus_to_exitcode( status )
+         proc.returncode = rcode
+      finally:
+         with self.lock:
+            self.procs.discard( proc )
+      if ( self.trace != None ):
+         self.trace.Command( prog, cmd, start, time.time(), rusage, rcode )
+      return( rcode )
+
+   def Cancel( self ):
+      "Cancel the stages, killing any commands that are running"
+      if ( not self.setup ):
+         return
+      self.cancelled.set()
+      with self.lock:
+         for proc in self.procs:
+            try:
+               os.killpg( proc.pid, signal.SIGTERM )
+            except OSError:
+               pass
+
+   def _runstage( self, prog, name ):
+      "Run the function for a stage, returning True if it succeeded"
+      if ( self.trace != None ): self.trace.Begin( prog, name )
+      try:
+         outputs = self.stages[name]["func"]()
+         status  = True
+      except (Exception, SystemExit) as exc:
+         # Save the error so it can be raised again once the other stages are stopped
+         self.errors[name] = exc
+         outputs = None
+         status  = False
+      if ( self.trace != None ):
+         if ( status ):
+            self.trace.End( prog, "PASS", outputs or [] )
+         elif ( self.cancelled.is_set() ):
+            self.trace.End( prog, "CANCELLED" )
+         else:
+            self.trace.End( prog, "FAIL" )
+      return( status )
+
+   def Run( self, prog ):
+      "Run all of the stages, returning when they are done or one of them failed"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      pending = list( self.order )
+      done    = set()
+      running = {}
+      pool    = concurrent.futures.ThreadPoolExecutor( max_workers=self.maxjobs )
+      try:
+         while ( len(pending) > 0 or len(running) > 0 ):
+            # Start every stage whose dependencies are done
+            if ( not self.cancelled.is_set() ):
+               for name in list( pending ):
+                  if ( all( dep in done for dep in self.stages[name]["depends"] ) ):
+                     pending.remove( name )
+                     running[pool.submit( self._runstage, prog, name )] = name
+            else:
+               pending = []
+            if ( len(running) == 0 ):
+               break
+            finished, notdone = concurrent.futures.wait( running, return_when=concurrent.futures.FIRST_COMPLETED )
+            for future in finished:
+               name = running.pop( future )
+               if ( future.result() ):
+                  done.add( name )
+               else:
+                  if ( not self.cancelled.is_set() ):
+                     self.failed.append( name )
+                  self.Cancel()
+      except KeyboardInterrupt:
+         self.Cancel()
+         raise
+      finally:
+         pool.shutdown( wait=True )
+      if ( len(self.failed) > 0 ):
+         raise self.errors[self.failed[0]]
+      if ( len(done) != len(self.order) ):
+         prog.error( "Stages were cancelled before they all ran" )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, json
+from stagetrace import stagetrace
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_stagegraph(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = error_prog()
+       self.stages = stagegraph()
+       self.ran    = []
+
+   def stage( self, name, sleep=0.0 ):
+       "Return a stage function that records when it ran"
+       def func( ):
+          time.sleep( sleep )
+          self.ran.append( name )
+       return( func )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.stages.Add, self.prog, "noocean", self.stage("noocean") )
+       self.assertRaises(SystemExit, self.stages.Run, self.prog )
+       self.assertRaises(SystemExit, self.stages.Initialize, self.prog, maxjobs=0 )
+       self.stages.Initialize( self.prog )
+       self.stages.Add( self.prog, "noocean", self.stage("noocean") )
+       self.assertRaises(SystemExit, self.stages.Add, self.prog, "noocean", self.stage("noocean") )
+       self.assertRaises(SystemExit, self.stages.Add, self.prog, "domain", self.stage("domain"), depends=["zztop"] )
+
+   def test_order( self ):
+       "test that stages run after the stages they depend on and independent stages run at the same time"
+       self.stages.Initialize( self.prog )
+       self.stages.Add( self.prog, "noocean",    self.stage("noocean", 0.1) )
+       self.stages.Add( self.prog, "domain",     self.stage("domain",  0.3), depends=["noocean"] )
+       self.stages.Add( self.prog, "mapping",    self.stage("mapping", 0.1), depends=["noocean"] )
+       self.stages.Add( self.prog, "sitepft",    self.stage("sitepft") )
+       self.stages.Add( self.prog, "mksurfdata", self.stage("mksurfdata"), depends=["mapping", "sitepft"] )
+       start = time.time()
+       self.stages.Run( self.prog )
+       self.assertLess( time.time() - start, 0.5 )
+       self.assertEqual( self.ran[0], "sitepft" )
+       self.assertEqual( self.ran[1:], [ "noocean", "mapping", "mksurfdata", "domain" ] )
+
+   def test_select( self ):
+       "test running only some of the stages with the stages they depend on"
+       self.assertRaises(SystemExit, self.stages.Select, self.prog, [ "domain" ] )
+       self.stages.Initialize( self.prog )
+       self.stages.Add( self.prog, "noocean",    self.stage("noocean") )
+       self.stages.Add( self.prog, "domain",     self.stage("domain"),  depends=["noocean"] )
+       self.stages.Add( self.prog, "mapping",    self.stage("mapping"), depends=["noocean"] )
+       self.stages.Add( self.prog, "sitepft",    self.stage("sitepft") )
+       self.stages.Add( self.prog, "mksurfdata", self.stage("mksurfdata"), depends=["mapping", "sitepft"] )
+       self.assertRaises(SystemExit, self.stages.Select, self.prog, [ "zztop" ] )
+       self.assertEqual( self.stages.Select( self.prog, [ "sitepft", "domain" ] ), [ "noocean", "domain", "sitepft" ] )
+       self.stages.Run( self.prog )
+       self.assertEqual( sorted(self.ran), [ "domain", "noocean", "sitepft" ] )
+
+   def test_cancel( self ):
+       "test that a failing stage cancels the other stages and kills their commands"
+       def fail( ):
+          time.sleep( 0.2 )
+          self.prog.error( "mapping failed" )
+       def longcmd( ):
+          if ( self.stages.Call( self.prog, "sleep 30" ) != 0 ):
+             self.prog.error( "Error running command: sleep 30" )
+       self.stages.Initialize( self.prog )
+       self.stages.Add( self.prog, "domain",     longcmd )
+       self.stages.Add( self.prog, "mapping",    fail )
+       self.stages.Add( self.prog, "mksurfdata", self.stage("mksurfdata"), depends=["mapping"] )
+       start = time.time()
+       self.assertRaises(SystemExit, self.stages.Run, self.prog )
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertEqual( self.stages.failed, [ "mapping" ] )
+       self.assertEqual( self.ran, [] )
+       self.assertNotEqual( self.stages.Call( self.prog, "true" ), 0 )
+
+   def test_cancel_race( self ):
+       "test that commands started at the same time as the stages are cancelled are all killed"
+       self.stages.Initialize( self.prog, maxjobs=8 )
+       rcodes = []
+       def call( ):
+          rcodes.append( self.stages.Call( self.prog, "sleep 30" ) )
+       start   = time.time()
+       threads = [ threading.Thread( target=call ) for i in range(8) ]
+       for thread in threads: thread.start()
+       self.stages.Cancel()
+       for thread in threads: thread.join( 20.0 )
+       self.assertLess( time.time() - start, 10.0 )
+       self.assertEqual( len(rcodes), 8 )
+       self.assertTrue( all( rcode != 0 for rcode in rcodes ) )
+       self.assertEqual( len(self.stages.procs), 0 )
+
+   def test_trace( self ):
+       "test that stages and commands are traced"
+       tmpdir = tempfile.mkdtemp()
+       trace  = stagetrace()
+       trace.Initialize( self.prog, tmpdir, "US-UMB" )
+       def domain( ):
+          self.stages.Call( self.prog, "echo domain > "+tmpdir+"/domain.nc" )
+          return( [ tmpdir+"/domain.nc" ] )
+       self.stages.Initialize( self.prog, trace=trace )
+       self.stages.Add( self.prog, "domain", domain )
+       self.stages.Run( self.prog )
+       trace.Close()
+       infile = open( trace.tracefile, "r" )
+       events = [ json.loads( line ) for line in infile ]
+       infile.close()
+       shutil.rmtree( tmpdir )
+       self.assertEqual( [ e["name"] for e in events if e["ph"] == "X" ], [ "echo", "domain" ] )
+       self.assertEqual( events[-1]["args"]["output_bytes"], len("domain\n") )
+
+   def test_call( self ):
+       "test the exit status of commands"
+       self.stages.Initialize( self.prog )
+       self.assertEqual(    self.stages.Call( self.prog, "true" ),   0 )
+       self.assertNotEqual( self.stages.Call( self.prog, "exit 3" ), 0 )
+       tmpdir = tempfile.mkdtemp()
+       self.assertEqual( self.stages.Call( self.prog, "touch cwdfile", cwd=tmpdir ), 0 )
+       self.assertTrue( os.path.exists( tmpdir+"/cwdfile" ) )
+       shutil.rmtree( tmpdir )
+
+   def test_error( self ):
+       "test that the error from a failed stage is raised again"
+       def fail( ):
+          raise ValueError( "bad value in sitepft" )
+       self.stages.Initialize( self.prog )
+       self.stages.Add( self.prog, "sitepft", fail )
+       self.assertRaises(ValueError, self.stages.Run, self.prog )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,237 @@
+#########################################################################################
+#
+# stagemanifest.py
+#
+# Python class to keep a manifest of the stages run by PTCLMmkdata in a site's data
+# directory. For each stage the inputs (options, site data, tool versions and hashes of
+# input files) and output files are recorded, so that a stage whose inputs have NOT
+# changed and whose outputs are still in place can be skipped on a rerun.
+#
+#########################################################################################
+import os, sys, json, hashlib, threading
+
+class stagemanifest:
+#----------------------------------------------------------------------------------------
+# Class to handle the stage manifest
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   filename = "PTCLMmkdata_manifest.json"
+   record   = True      # Save stages to the manifest
+   skip     = True      # Allow stages that are up to date to be skipped
+
+   def Initialize( self, prog, data_dir, record=True, skip=True ):
+      "Initialize the stage manifest for a data directory"
+      if ( not os.path.isdir( data_dir ) ):
+         prog.error( "Data directory for the stage manifest does NOT exist: "+data_dir )
+      self.manifest = os.path.abspath( data_dir )+"/"+self.filename
+      self.record   = record
+      self.skip     = skip and record
+      self.data     = { "stages":{}, "filehashes":{} }
+      self.lock     = threading.RLock()   # Stages may be run at the same time
+      if ( self.record and os.path.exists( self.manifest ) ):
+         try:
+            infile = open( self.manifest, "r" )
+            self.data.update( json.load( infile ) )
+            infile.close()
+         except ValueError:
+            print( "Stage manifest is corrupt and will be reset: "+self.manifest )
+      self.setup = True
+
+   def _write( self ):
+      "Write the manifest out"
+      outfile = open( self.manifest+".tmp", "w" )
+      json.dump( self.data, outfile, indent=1, sort_keys=True )
+      outfile.close()
+      os.rename( self.manifest+".tmp", self.manifest )
+
+   def FileHash( self, prog, filename ):
+      "Return the md5 hash of a file, only recomputing it if the file changed"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not os.path.exists( filename ) ):
+         return( "" )
+      with self.lock:
+         return( self._filehash( filename ) )
+
+   def _filehash( self, filename ):
+      "Return the md5 hash of a file, using the saved value if the size and modification time match"
+      stat = os.stat( filename )
+      prev = self.data["filehashes"].get( filename )
+      if ( prev != None and prev["size"] == stat.st_size and prev["mtime"] == stat.st_mtime ):
+         return( prev["md5"] )
+      md5 = hashlib.md5()
+      infile = open( filename, "rb" )
+      for block in iter( lambda: infile.read( 1048576 ), b"" ):
+         md5.update( block )
+      infile.close()
+      self.data["filehashes"][filename] = { "size":stat.st_size, "mtime":stat.st_mtime, "md5":md5.hexdigest() }
+      return( md5.hexdigest() )
+
+   def _inputs_hash( self, prog, inputs, files ):
+      "Return the hash of the inputs to a stage including the hashes of the input files"
+      hashes = {}
+      for filename in files:
+         hashes[filename] = self.FileHash( prog, filename )
+      data = json.dumps( [ inputs, hashes ], sort_keys=True )
+      return( hashlib.sha1( data.encode() ).hexdigest() )
+
+   def _outfiles( self, outputs ):
+      "Return the list of output files from a dictionary of outputs"
+      files = []
+      for name in sorted( outputs ):
+         if ( isinstance( outputs[name], list ) ):
+            files = files + outputs[name]
+         elif ( outputs[name] != None ):
+            files.append( outputs[name] )
+      return( files )
+
+   def UpToDate( self, prog, stage, inputs, files=[] ):
+      "Return True if the stage was run before with the same inputs and the outputs are unchanged"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not self.skip or stage not in self.data["stages"] ):
+         return( False )
+      saved = self.data["stages"][stage]
+      if ( saved["inputs"] != self._inputs_hash( prog, inputs, files ) ):
+         return( False )
+      for filename in saved["outfiles"]:
+         if ( not os.path.exists( filename ) ):
+            return( False )
+         stat = os.stat( filename )
+         if ( [ stat.st_size, stat.st_mtime ] != saved["outfiles"][filename] ):
+            return( False )
+      return( True )
+
+   def OutputsInPlace( self, prog ):
+      "Return True if stages were recorded and the output files of every stage are unchanged"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( len(self.data["stages"]) == 0 ):
+         return( False )
+      for stage in self.data["stages"]:
+         for filename in self.data["stages"][stage]["outfiles"]:
+            if ( not os.path.exists( filename ) ):
+               return( False )
+            stat = os.stat( filename )
+            if ( [ stat.st_size, stat.st_mtime ] != self.data["stages"][stage]["outfiles"][filename] ):
+               return( False )
+      return( True )
+
+   def Outputs( self, prog, stage ):
+      "Return the dictionary of output files and values saved for the stage"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( stage not in self.data["stages"] ):
+         prog.error( "Stage is NOT in the manifest: "+stage )
+      outputs = dict( self.data["stages"][stage]["values"] )
+      outputs.update( self.data["stages"][stage]["outputs"] )
+      return( outputs )
+
+   def Record( self, prog, stage, inputs, files=[], outputs={}, values={} ):
+      "Record that the stage was run with these inputs and created these output files (and other values)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not self.record ):
+         return
+      outfiles = {}
+      for filename in self._outfiles( outputs ):
+         if ( not os.path.exists( filename ) ):
+            prog.error( "Output file for stage "+stage+" does NOT exist: "+filename )
+         stat = os.stat( filename )
+         outfiles[filename] = [ stat.st_size, stat.st_mtime ]
+      with self.lock:
+         self.data["stages"][stage] = { "inputs":self._inputs_hash( prog, inputs, files ), \
+                                        "description":inputs, "outputs":outputs, "values":values, \
+                                        "outfiles":outfiles }
+         self._write()
+
+   def Invalidate( self, prog, stage ):
+      "Remove a stage from the manifest so that it will be run again"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      with self.lock:
+         if ( stage in self.data["stages"] ):
+            del self.data["stages"][stage]
+            if ( self.record ): self._write()
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, time
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_stagemanifest(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog     = error_prog()
+       self.manifest = stagemanifest()
+       self.tmpdir   = tempfile.mkdtemp()
+       self.infile   = self.tmpdir+"/input.txt"
+       self.outfile  = self.tmpdir+"/output.nc"
+       self.write( self.infile,  "input" )
+       self.write( self.outfile, "output" )
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write( self, filename, text ):
+       outfile = open( filename, "w" )
+       outfile.write( text )
+       outfile.close()
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.manifest.UpToDate, self.prog, "domain", {} )
+       self.assertRaises(SystemExit, self.manifest.Initialize, self.prog, self.tmpdir+"/zztop" )
+       self.manifest.Initialize( self.prog, self.tmpdir )
+       self.assertRaises(SystemExit, self.manifest.Outputs, self.prog, "domain" )
+       self.assertRaises(SystemExit, self.manifest.Record, self.prog, "domain", {}, outputs={"file":"zztop.nc"} )
+
+   def test_uptodate( self ):
+       "test that a stage is only up to date when inputs and outputs are unchanged"
+       inputs = { "res":"1x1pt_US-UMB", "mask":"navy" }
+       self.manifest.Initialize( self.prog, self.tmpdir )
+       self.assertFalse( self.manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       self.manifest.Record( self.prog, "domain", inputs, [self.infile], { "domainfile":self.outfile }, { "gdate":"140204" } )
+       # Read the manifest back in as a new run would
+       manifest = stagemanifest()
+       manifest.Initialize( self.prog, self.tmpdir )
+       self.assertTrue( manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       self.assertEqual( manifest.Outputs( self.prog, "domain" ), { "domainfile":self.outfile, "gdate":"140204" } )
+       self.assertFalse( manifest.UpToDate( self.prog, "domain", { "res":"1x1pt_US-UMB", "mask":"gx1" }, [self.infile] ) )
+       self.assertFalse( manifest.UpToDate( self.prog, "mksurfdata", inputs, [self.infile] ) )
+       self.assertTrue( manifest.OutputsInPlace( self.prog ) )
+       # Changing an input file means the stage has to be rerun
+       self.write( self.infile, "changed input" )
+       self.assertFalse( manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       self.write( self.infile, "input" )
+       self.assertTrue( manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       # As does changing or removing an output file
+       self.write( self.outfile, "changed output" )
+       self.assertFalse( manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       os.remove( self.outfile )
+       self.assertFalse( manifest.UpToDate( self.prog, "domain", inputs, [self.infile] ) )
+       self.assertFalse( manifest.OutputsInPlace( self.prog ) )
+
+   def test_noskip( self ):
+       "test that stages are never skipped when skipping is off, and nothing is written when recording is off"
+       inputs = { "res":"1x1pt_US-UMB" }
+       self.manifest.Initialize( self.prog, self.tmpdir, skip=False )
+       self.manifest.Record( self.prog, "domain", inputs, [], { "domainfile":self.outfile } )
+       self.assertFalse( self.manifest.UpToDate( self.prog, "domain", inputs ) )
+       self.manifest.Invalidate( self.prog, "domain" )
+       self.assertRaises(SystemExit, self.manifest.Outputs, self.prog, "domain" )
+       os.remove( self.tmpdir+"/"+stagemanifest.filename )
+       manifest = stagemanifest()
+       manifest.Initialize( self.prog, self.tmpdir, record=False )
+       manifest.Record( self.prog, "domain", inputs, [], { "domainfile":self.outfile } )
+       self.assertFalse( os.path.exists( self.tmpdir+"/"+stagemanifest.filename ) )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,299 @@
+#########################################################################################
+#
+# stagetrace.py
+#
+# Python class to trace the stages of PTCLMmkdata and the commands they run. Each stage
+# and command is written as a Chrome trace event (one JSON object per line) to a trace
+# file in the site's data directory, with the wall time, CPU time of the child processes,
+# peak memory and the sizes of the files created. Traces from several sites can be merged
+# into one Chrome trace file (that can be viewed with chrome://tracing or Perfetto).
+#
+#########################################################################################
+import os, sys, json, time, threading, resource
+
+class stagetrace:
+#----------------------------------------------------------------------------------------
+# Class to handle tracing of stages
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup    = False
+   filename = "PTCLMmkdata_trace.jsonl"
+
+   def Initialize( self, prog, data_dir, site ):
+      "Initialize a new trace file for a site in the data directory"
+      if ( not os.path.isdir( data_dir ) ):
+         prog.error( "Data directory for the trace does NOT exist: "+data_dir )
+      self.tracefile = os.path.abspath( data_dir )+"/"+self.filename
+      self.site      = site
+      self.pid       = os.getpid()
+      self.lock      = threading.Lock()
+      self.local     = threading.local()
+      self.tids      = {}
+      self.totals    = {}
+      self.outfile   = open( self.tracefile, "w" )
+      self.setup     = True
+      self._write( { "name":"process_name", "ph":"M", "pid":self.pid, "tid":0, "args":{ "name":site } } )
+
+   def _write( self, event ):
+      "Write an event out to the trace file"
+      with self.lock:
+         self.outfile.write( json.dumps( event, sort_keys=True )+"\n" )
+         self.outfile.flush()
+
+   def _tid( self ):
+      "Return a small number for the current thread, naming the thread in the trace the first time"
+      ident = threading.get_ident()
+      with self.lock:
+         if ( ident not in self.tids ):
+            self.tids[ident] = len(self.tids) + 1
+            new = True
+         else:
+            new = False
+      if ( new ):
+         self._write( { "name":"thread_name", "ph":"M", "pid":self.pid, "tid":self.tids[ident], \
+                        "args":{ "name":threading.current_thread().name } } )
+      return( self.tids[ident] )
+
+   def Begin( self, prog, stage ):
+      "Start tracing a stage run by the current thread"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      self.local.stage  = stage
+      self.local.start  = time.time()
+      self.local.cpu    = time.thread_time()
+      # The child CPU and memory of the stage are shared, so worker threads of the stage can add to them
+      with self.lock:
+         self.totals[stage] = { "child":[ 0.0, 0.0 ], "maxrss":0 }
+
+   def Join( self, prog, stage ):
+      "Add the commands run by the current thread (a worker started by a stage) to the totals of the stage"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      self.local.joined = stage
+
+   def Command( self, prog, cmd, start, end, rusage, rcode ):
+      "Trace a command that was run, with the resource usage from waiting for it"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      args = { "cmd":cmd, "rcode":rcode }
+      if ( rusage != None ):
+         args["child_user_cpu"] = rusage.ru_utime
+         args["child_sys_cpu"]  = rusage.ru_stime
+         args["maxrss_kb"]      = rusage.ru_maxrss
+         # Add to the totals for the stage running this command (or the stage the thread joined)
+         stage = getattr( self.local, "stage", None )
+         if ( stage == None ): stage = getattr( self.local, "joined", None )
+         with self.lock:
+            if ( stage in self.totals ):
+               totals = self.totals[stage]
+               totals["child"][0] += rusage.ru_utime
+               totals["child"][1] += rusage.ru_stime
+               totals["maxrss"]    = max( totals["maxrss"], rusage.ru_maxrss )
+      self._write( { "name":os.path.basename( cmd.split(" ")[0] ), "cat":"command", "ph":"X", \
+                     "ts":int(start*1.e6), "dur":int((end-start)*1.e6), "pid":self.pid, "tid":self._tid(), \
+                     "args":args } )
+
+   def Running( self ):
+      "Return the name of the stage being traced by the current thread (None if there isn't one)"
+      if ( not self.setup ):
+         return( None )
+      return( getattr( self.local, "stage", None ) )
+
+   def End( self, prog, status, outputs=[] ):
+      "Finish tracing the stage run by the current thread, with the files it created"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( getattr( self.local, "stage", None ) == None ):
+         prog.error( "Begin was NOT run first!" )
+      end   = time.time()
+      sizes = {}
+      for filename in outputs:
+         if ( filename != None and os.path.exists( filename ) ):
+            sizes[filename] = os.path.getsize( filename )
+      with self.lock:
+         totals = self.totals.pop( self.local.stage )
+      args = { "status":status, "cpu":time.thread_time() - self.local.cpu, \
+               "child_user_cpu":totals["child"][0], "child_sys_cpu":totals["child"][1], \
+               "maxrss_kb":totals["maxrss"], \
+               "self_maxrss_kb":resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss, \
+               "outputs":sizes, "output_bytes":sum( sizes.values() ) }
+      self._write( { "name":self.local.stage, "cat":"stage", "ph":"X", \
+                     "ts":int(self.local.start*1.e6), "dur":int((end-self.local.start)*1.e6), \
+                     "pid":self.pid, "tid":self._tid(), "args":args } )
+      self.local.stage = None
+
+   def Close( self ):
+      "Close the trace file"
+      if ( self.setup ):
+         self.outfile.close()
+         self.setup = False
+
+   def Usage( self, prog, tracefile ):
+      "Return the wall time (seconds) and peak memory (kB) used by the stages of a trace file"
+      if ( not os.path.exists( tracefile ) ):
+         prog.error( "Trace file does NOT exist: "+tracefile )
+      start  = None
+      end    = None
+      maxrss = 0
+      infile = open( tracefile, "r" )
+      for line in infile:
+         if ( line.strip() == "" ): continue
+         event = json.loads( line )
+         if ( event.get("cat") == "stage" ):
+            # Stages run at the same time, so the wall time is from the first start to the last end
+            if ( start == None or event["ts"] < start ): start = event["ts"]
+            if ( end   == None or event["ts"]+event["dur"] > end ): end = event["ts"]+event["dur"]
+            maxrss = max( maxrss, event["args"]["maxrss_kb"], event["args"]["self_maxrss_kb"] )
+      infile.close()
+      if ( start == None ):
+         prog.error( "Trace file does NOT have any stages in it: "+tracefile )
+      return( { "wall":(end - start) / 1.e6, "maxrss_kb":maxrss } )
+
+   def Merge( self, prog, tracefiles, outfile ):
+      "Merge trace files from several sites into one Chrome trace file, returning a summary by stage"
+      events  = []
+      summary = {}
+      for n, tracefile in enumerate( tracefiles ):
+         if ( not os.path.exists( tracefile ) ):
+            prog.error( "Trace file does NOT exist: "+tracefile )
+         infile = open( tracefile, "r" )
+         for line in infile:
+            if ( line.strip() == "" ): continue
+            event = json.loads( line )
+            # Each site gets it's own process in the merged trace, even if process id's were reused
+            event["pid"] = n + 1
+            events.append( event )
+            if ( event.get("cat") == "stage" ):
+               stage = event["name"]
+               if ( stage not in summary ):
+                  summary[stage] = { "count":0, "wall":0.0, "child_cpu":0.0, "maxrss_kb":0, "output_bytes":0 }
+               summary[stage]["count"]        += 1
+               summary[stage]["wall"]         += event["dur"] / 1.e6
+               summary[stage]["child_cpu"]    += event["args"]["child_user_cpu"] + event["args"]["child_sys_cpu"]
+               summary[stage]["maxrss_kb"]     = max( summary[stage]["maxrss_kb"], event["args"]["maxrss_kb"] )
+               summary[stage]["output_bytes"] += event["args"]["output_bytes"]
+         infile.close()
+      output = open( outfile+".tmp", "w" )
+      json.dump( { "traceEvents":events, "displayTimeUnit":"ms" }, output )
+      output.close()
+      os.rename( outfile+".tmp", outfile )
+      return( summary )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, subprocess
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_stagetrace(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog   = error_prog()
+       self.trace  = stagetrace()
+       self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       self.trace.Close()
+       shutil.rmtree( self.tmpdir )
+
+   def events( self, tracefile ):
+       "Read the events from a trace file"
+       infile = open( tracefile, "r" )
+       events = [ json.loads( line ) for line in infile ]
+       infile.close()
+       return( events )
+
+   def run_stage( self, site ):
+       "Trace a stage for a site that runs one command and creates a file"
+       sitedir = self.tmpdir+"/1x1pt_"+site
+       os.mkdir( sitedir )
+       trace = stagetrace()
+       trace.Initialize( self.prog, sitedir, site )
+       outfile = sitedir+"/domain.nc"
+       trace.Begin( self.prog, "domain" )
+       start = time.time()
+       proc  = subprocess.Popen( "echo domain > "+outfile, shell=True )
+       (pid, status, rusage) = os.wait4( proc.pid, 0 )
+       proc.returncode = 0
+       trace.Command( self.prog, "gen_domain -m map.nc", start, time.time(), rusage, 0 )
+       trace.End( self.prog, "PASS", [ outfile, None ] )
+       trace.Close()
+       return( trace.tracefile )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.trace.Begin, self.prog, "domain" )
+       self.assertRaises(SystemExit, self.trace.Initialize, self.prog, self.tmpdir+"/zztop", "US-UMB" )
+       self.trace.Initialize( self.prog, self.tmpdir, "US-UMB" )
+       self.assertRaises(SystemExit, self.trace.End, self.prog, "PASS" )
+       self.assertEqual( self.trace.Running(), None )
+       self.trace.Begin( self.prog, "domain" )
+       self.assertEqual( self.trace.Running(), "domain" )
+
+   def test_trace( self ):
+       "test the events written for a stage and a command"
+       events = self.events( self.run_stage( "US-UMB" ) )
+       self.assertEqual( events[0]["args"]["name"], "US-UMB" )
+       command = [ e for e in events if e.get("cat") == "command" ][0]
+       stage   = [ e for e in events if e.get("cat") == "stage" ][0]
+       self.assertEqual( command["name"], "gen_domain" )
+       self.assertEqual( command["args"]["rcode"], 0 )
+       self.assertEqual( stage["name"], "domain" )
+       self.assertEqual( stage["args"]["status"], "PASS" )
+       self.assertEqual( stage["args"]["output_bytes"], len("domain\n") )
+       self.assertGreater( stage["args"]["maxrss_kb"], 0 )
+       # The command is inside of the stage
+       self.assertGreaterEqual( command["ts"], stage["ts"] )
+       self.assertLessEqual( command["ts"]+command["dur"], stage["ts"]+stage["dur"] )
+
+   def test_join( self ):
+       "test that commands run by worker threads that joined a stage add to it's totals"
+       trace = stagetrace()
+       trace.Initialize( self.prog, self.tmpdir, "US-UMB" )
+       self.assertRaises(SystemExit, stagetrace().Join, self.prog, "ensemble" )
+       trace.Begin( self.prog, "ensemble" )
+       def member( ):
+          trace.Join( self.prog, "ensemble" )
+          start = time.time()
+          proc  = subprocess.Popen( "python3 -c 'x = bytearray(50*1024*1024)'", shell=True )
+          (pid, status, rusage) = os.wait4( proc.pid, 0 )
+          trace.Command( self.prog, "mksurfdata.pl", start, time.time(), rusage, 0 )
+       worker = threading.Thread( target=member )
+       worker.start()
+       worker.join()
+       trace.End( self.prog, "PASS" )
+       trace.Close()
+       stage = [ e for e in self.events( trace.tracefile ) if e.get("cat") == "stage" ][0]
+       self.assertGreater( stage["args"]["maxrss_kb"], 50*1024 )
+
+   def test_usage( self ):
+       "test the wall time and memory used by a trace"
+       tracefile = self.run_stage( "US-UMB" )
+       usage = self.trace.Usage( self.prog, tracefile )
+       self.assertGreater( usage["wall"], 0.0 )
+       self.assertGreater( usage["maxrss_kb"], 0 )
+       self.assertRaises(SystemExit, self.trace.Usage, self.prog, self.tmpdir+"/zztop" )
+       self.trace.Initialize( self.prog, self.tmpdir, "US-UMB" )
+       self.trace.Close()
+       self.assertRaises(SystemExit, self.trace.Usage, self.prog, self.trace.tracefile )
+
+   def test_merge( self ):
+       "test merging the traces from several sites"
+       tracefiles = [ self.run_stage( "US-UMB" ), self.run_stage( "US-Ha1" ) ]
+       outfile = self.tmpdir+"/trace.json"
+       self.assertRaises(SystemExit, self.trace.Merge, self.prog, tracefiles+[self.tmpdir+"/zztop"], outfile )
+       summary = self.trace.Merge( self.prog, tracefiles, outfile )
+       self.assertEqual( list(summary.keys()), [ "domain" ] )
+       self.assertEqual( summary["domain"]["count"], 2 )
+       infile = open( outfile, "r" )
+       merged = json.load( infile )
+       infile.close()
+       self.assertEqual( sorted( set( e["pid"] for e in merged["traceEvents"] ) ), [ 1, 2 ] )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,533 @@
+#########################################################################################
+#
+# standintools.py
+#
+# Python class for stand-ins of the CTSM and CIME tools that PTCLMmkdata runs
+# (mknoocnmap.pl, gen_domain, mkmapdata.sh and mksurfdata.pl). A stand-in CTSM directory
+# tree is created that can be given to PTCLMmkdata with --ctsm_root (and --cime_root).
+# The stand-ins take the same arguments as the real tools and write small NetCDF files
+# with the same names, after waiting, using memory and failing as given in the
+# standin_tools.json file at the top of the tree. This lets PTCLMmkdata be run and
+# benchmarked without a built CTSM, NCL or the inputdata.
+#
+#########################################################################################
+import os, sys, re, json, glob, time, random
+from pointmap import pointmap
+
+class standintools:
+#----------------------------------------------------------------------------------------
+# Class to handle the stand-in tools
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup      = False
+   rootdir    = ""
+   configfile = "standin_tools.json"
+   # Location of each tool under the stand-in CTSM root directory
+   tools      = { "mknoocnmap":"tools/mkmapdata/mknoocnmap.pl", \
+                  "mkmapdata":"tools/mkmapdata/mkmapdata.sh", \
+                  "mksurfdata":"tools/mksurfdata_map/mksurfdata.pl", \
+                  "gen_domain":"cime/tools/mapping/gen_domain_files/gen_domain" }
+   # Default seconds each tool takes (in about the same proportion as the real tools)
+   latency    = { "mknoocnmap":0.2, "gen_domain":0.1, "mkmapdata":1.0, "mksurfdata":0.5 }
+   # Raw datasets mkmapdata.sh creates mapping files from (the same ones PTCLM writes maps for)
+   mapgrids   = pointmap.mapgrids
+   # Location of the raw grid files under the inputdata directory
+   gridsdir   = "lnd/clm2/mappingdata/grids"
+   dx         = 0.1        # Size of the grid cell around the point in degrees
+   natpft     = 15         # Number of natural PFT's on the surface dataset
+   nlevsoi    = 10         # Number of soil layers on the surface dataset
+
+   def Create( self, prog, rootdir, latency={}, memory={}, fail_rate={}, seed=None ):
+      "Create a stand-in CTSM directory tree, with the seconds, MB of memory and fraction of runs that fail for each tool"
+      for settings in [ latency, memory, fail_rate ]:
+         for tool in settings:
+            if ( tool not in self.tools ):
+               prog.error( "There is NO stand-in for the tool: "+tool )
+            if ( settings[tool] < 0.0 ):
+               prog.error( "Stand-in settings for "+tool+" can NOT be negative" )
+      for tool in fail_rate:
+         if ( fail_rate[tool] > 1.0 ):
+            prog.error( "Fraction of runs that fail can NOT be more than one for: "+tool )
+      rootdir = os.path.abspath( rootdir )
+      if ( os.path.exists( rootdir+"/"+self.configfile ) ):
+         prog.error( "Stand-in tools already exist in: "+rootdir )
+      ptclm_dir = os.path.dirname( os.path.abspath( __file__ ) )
+      config    = { "seed":seed, "tools":{} }
+      for tool in self.tools:
+         config["tools"][tool] = { "latency":latency.get( tool, self.latency[tool] ), \
+                                   "memory_mb":memory.get( tool, 0 ), "fail_rate":fail_rate.get( tool, 0.0 ) }
+         filename = rootdir+"/"+self.tools[tool]
+         os.makedirs( os.path.dirname( filename ), exist_ok=True )
+         output = open( filename, "w" )
+         output.write( "#!"+sys.executable+"\n" )
+         output.write( "# Stand-in for "+os.path.basename( filename )+" created by PTCLM standintools.py\n" )
+         output.write( "import sys\n" )
+         output.write( "sys.path.insert( 0, \""+ptclm_dir+"\" )\n" )
+         output.write( "from standintools import main\n" )
+         output.write( "sys.exit( main( \""+rootdir+"\", \""+tool+"\", sys.argv[1:] ) )\n" )
+         output.close()
+         os.chmod( filename, 0o755 )
+      # Other directories and files PTCLM checks for
+      os.makedirs( rootdir+"/tools/mkmapgrids", exist_ok=True )
+      os.makedirs( rootdir+"/doc", exist_ok=True )
+      output = open( rootdir+"/doc/ChangeLog", "w" )
+      output.write( "Tag name: standin_tools\n" )
+      output.close()
+      os.makedirs( rootdir+"/bin", exist_ok=True )
+      output = open( rootdir+"/bin/ncl", "w" )
+      output.write( "#!/bin/sh\n# Stand-in for ncl (mknoocnmap.pl checks that it is in the path)\nexit 0\n" )
+      output.close()
+      os.chmod( rootdir+"/bin/ncl", 0o755 )
+      # Namelist defaults with the raw grid files (that CreateInputdata writes)
+      os.makedirs( rootdir+"/bld/namelist_files", exist_ok=True )
+      output = open( rootdir+"/bld/namelist_files/namelist_defaults_ctsm.xml", "w" )
+      output.write( "<?xml version=\"1.0\"?>\n<namelist_defaults>\n</namelist_defaults>\n" )
+      output.close()
+      output = open( rootdir+"/bld/namelist_files/namelist_defaults_ctsm_tools.xml", "w" )
+      output.write( "<?xml version=\"1.0\"?>\n<namelist_defaults>\n" )
+      for grid in self.mapgrids:
+         ( hgrid, qopts ) = pointmap().GridQuery( grid )
+         lmask = qopts.split( "," )[0].split( "=" )[1]
+         output.write( "<scripgriddata hgrid=\""+hgrid+"\" lmask=\""+lmask+"\">"+self.Gridfile( grid )+"</scripgriddata>\n" )
+      output.write( "</namelist_defaults>\n" )
+      output.close()
+      output = open( rootdir+"/bld/namelist_files/namelist_definition_ctsm.xml", "w" )
+      output.write( "<?xml version=\"1.0\"?>\n<namelist_definition>\n" )
+      output.write( "<entry id=\"scripgriddata\" type=\"char*256\" input_pathname=\"abs\" category=\"mkmapdata\"/>\n" )
+      output.write( "</namelist_definition>\n" )
+      output.close()
+      output = open( rootdir+"/"+self.configfile, "w" )
+      json.dump( config, output, indent=1, sort_keys=True )
+      output.close()
+      return( rootdir )
+
+   def Gridfile( self, grid ):
+      "Return the raw grid file for the grid, relative to the inputdata directory"
+      return( self.gridsdir+"/SCRIPgrid_"+grid+"_standin.nc" )
+
+   def CreateInputdata( self, prog, inputdir, resolution=1.0 ):
+      "Create the raw grid files in an inputdata directory, as regular global grids of the given resolution in degrees"
+      if ( resolution <= 0.0 or (180.0/resolution) != int(180.0/resolution) ):
+         prog.error( "Resolution of the raw grids must divide evenly into 180 degrees: "+str(resolution) )
+      from pointgrids import pointgrids
+      grids = pointgrids()
+      grids.Initialize( prog )
+      inputdir = os.path.abspath( inputdir )
+      os.makedirs( inputdir+"/"+self.gridsdir, exist_ok=True )
+      nlat = int(180.0/resolution)
+      for grid in self.mapgrids:
+         gridfile = inputdir+"/"+self.Gridfile( grid )
+         if ( not os.path.exists( gridfile ) ):
+            grids.WriteGlobalGrid( prog, gridfile, 2*nlat, nlat )
+      return( inputdir )
+
+   def Initialize( self, prog, rootdir ):
+      "Initialize the stand-in tools in the given stand-in CTSM directory"
+      self.rootdir = os.path.abspath( rootdir )
+      filename     = self.rootdir+"/"+self.configfile
+      if ( not os.path.exists( filename ) ):
+         prog.error( "Stand-in tools configuration file does NOT exist: "+filename )
+      infile = open( filename, "r" )
+      try:
+         self.config = json.load( infile )
+      except ValueError:
+         prog.error( "Stand-in tools configuration file is corrupt: "+filename )
+      infile.close()
+      self.setup  = True
+
+   def parse_args( self, prog, args, flags=[] ):
+      "Parse tool arguments of the form -name value (or --name value), flags do NOT take a value"
+      opts = {}
+      i    = 0
+      while ( i < len(args) ):
+         arg = args[i]
+         if ( not arg.startswith( "-" ) ):
+            prog.error( "Unexpected argument: "+arg )
+         name = arg.lstrip( "-" )
+         if ( name in flags ):
+            opts[name] = True
+            i += 1
+         elif ( i+1 < len(args) and (not args[i+1].startswith( "-" ) or re.match( "^-[0-9.]", args[i+1] )) ):
+            opts[name] = args[i+1]
+            i += 2
+         else:
+            prog.error( "Option needs a value: "+arg )
+      return( opts )
+
+   def Run( self, prog, tool, args ):
+      "Run a stand-in tool with it's command line arguments, returns the exit status"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( tool not in self.tools ):
+         prog.error( "There is NO stand-in for the tool: "+tool )
+      settings = self.config["tools"][tool]
+      # Hold the memory for as long as the tool runs
+      memory   = b"\1" * int( settings["memory_mb"]*1024*1024 )
+      time.sleep( settings["latency"] )
+      # With a seed, the same command fails every time it is run
+      seed = self.config.get( "seed" )
+      if ( seed != None ): seed = str(seed)+" "+tool+" "+" ".join( args )
+      if ( random.Random( seed ).random() < settings["fail_rate"] ):
+         sys.stderr.write( "Stand-in "+tool+" failed (fail_rate="+str(settings["fail_rate"])+")\n" )
+         return( 1 )
+      getattr( self, "run_"+tool )( prog, args )
+      del memory
+      return( 0 )
+
+   ### THE TOOLS ########################################################################
+
+   def run_mknoocnmap( self, prog, args ):
+      "mknoocnmap.pl -p lat,lon -name res : SCRIP grid and no ocean map for a point"
+      opts = self.parse_args( prog, args, flags=[ "v", "verbose", "debug" ] )
+      if ( "p" not in opts or "name" not in opts ):
+         prog.error( "mknoocnmap.pl needs the -p and -name options" )
+      ( lat, lon ) = [ float(value) for value in opts["p"].split( "," ) ]
+      # Same files as PTCLMmkdata writes without running mknoocnmap.pl
+      from pointgrids import pointgrids
+      grids = pointgrids()
+      grids.Initialize( prog, dx=self.dx, dy=self.dx )
+      grids.WriteNoOcean( prog, [ { "res":opts["name"], "lat":lat, "lon":lon, "dir":os.getcwd() } ], time.strftime( "%y%m%d" ) )
+      print( "Successfully created the grid and map files for: "+opts["name"] )
+
+   def run_gen_domain( self, prog, args ):
+      "gen_domain -m mapfile -o ocn_name -l lnd_name -c comment : domain files from a map"
+      opts = self.parse_args( prog, args )
+      for name in [ "m", "o", "l" ]:
+         if ( name not in opts ):
+            prog.error( "gen_domain needs the -"+name+" option" )
+      # Same files as PTCLMmkdata writes without running gen_domain
+      from pointgrids import pointgrids
+      grids = pointgrids()
+      grids.Initialize( prog, dx=self.dx, dy=self.dx )
+      grids.WriteDomains( prog, opts["m"], opts["o"], opts["l"], os.getcwd(), time.strftime( "%y%m%d" ), \
+                          comment=opts.get( "c", "" ) )
+      print( "Successfully created domain files for: "+opts["l"] )
+
+   def run_mkmapdata( self, prog, args ):
+      "mkmapdata.sh --gridfile file --res res --gridtype regional : maps from each raw dataset to the grid"
+      opts = self.parse_args( prog, args, flags=[ "v", "verbose", "debug", "list", "fast", "batch" ] )
+      if ( "gridfile" not in opts or "res" not in opts ):
+         prog.error( "mkmapdata.sh needs the --gridfile and --res options" )
+      ( lat, lon ) = self.read_point( prog, opts["gridfile"], "grid_center_lat", "grid_center_lon" )
+      cdate = time.strftime( "%y%m%d" )
+      for grid in self.mapgrids:
+         self.write_map( prog, "map_"+grid+"_to_"+opts["res"]+"_nomask_aave_da_c"+cdate+".nc", lat, lon, nsrc=4 )
+         if ( "v" in opts ): print( "Created mapping file from "+grid+" to "+opts["res"] )
+      print( "Successfully created mapping files for: "+opts["res"] )
+
+   def run_mksurfdata( self, prog, args ):
+      "mksurfdata.pl -res usrspec -usr_gname res -usr_gdate date -usr_mapdir dir -y years ... : surface dataset"
+      opts = self.parse_args( prog, args, flags=[ "debug", "allownofile", "crop", "no-crop", "hirespft", \
+                                                  "merge_gis", "inlandwet", "exedir", "fast_maps", "no_surfdata" ] )
+      for name in [ "usr_gname", "usr_gdate", "usr_mapdir" ]:
+         if ( name not in opts ):
+            prog.error( "mksurfdata.pl needs the -"+name+" option" )
+      res   = opts["usr_gname"]
+      years = opts.get( "y", "2000" )
+      if ( opts.get( "crop", False ) ):
+         pftdesc = "78pfts_CMIP6"
+      else:
+         pftdesc = "16pfts_Irrig_CMIP6"
+      print( "mksurfdata.pl "+" ".join( args ) )
+      if ( opts.get( "debug", False ) ):
+         return
+      mapfiles = glob.glob( opts["usr_mapdir"]+"/map_*_to_"+res+"_nomask_aave_da_c"+opts["usr_gdate"]+".nc" )
+      if ( len(mapfiles) == 0 ):
+         prog.error( "No mapping files for "+res+" with date "+opts["usr_gdate"]+" in: "+opts["usr_mapdir"] )
+      ( lat, lon ) = self.read_point( prog, sorted(mapfiles)[0], "yc_b", "xc_b" )
+      cdate  = time.strftime( "%y%m%d" )
+      simyrs = years.split( "-" )
+      surffile = "surfdata_"+res+"_"+pftdesc+"_simyr"+simyrs[0]+"_c"+cdate
+      self.write_surfdata( prog, surffile+".nc", lat, lon, opts )
+      output = open( surffile+".log", "w" )
+      output.write( "Stand-in mksurfdata_map log for "+surffile+".nc\n" )
+      output.write( "mksurfdata.pl "+" ".join( args )+"\n" )
+      output.close()
+      if ( len(simyrs) == 2 ):
+         if ( years == "1850-2000" ): simyrs[1] = "2015"
+         dynfile = "landuse.timeseries_"+res+"_hist_"+pftdesc+"_simyr"+simyrs[0]+"-"+simyrs[1]+"_c"+cdate+".nc"
+         self.write_landuse_timeseries( prog, dynfile, surffile+".nc", int(simyrs[0]), int(simyrs[1]) )
+      print( "Successfully created surface dataset: "+surffile+".nc" )
+
+   ### NETCDF FILES #####################################################################
+
+   def netcdf( self, prog ):
+      "Return the netCDF4 module, which is needed to write the files"
+      try:
+         import netCDF4
+      except ImportError:
+         prog.error( "The netCDF4 python module is required for the stand-in tools" )
+      return( netCDF4 )
+
+   def corners( self, lat, lon ):
+      "Return the latitude and longitude of the corners of the grid cell around the point"
+      half = self.dx / 2.0
+      return( [ lat-half, lat-half, lat+half, lat+half ], [ lon-half, lon+half, lon+half, lon-half ] )
+
+   def read_point( self, prog, filename, latname, lonname ):
+      "Read the latitude and longitude of the point from a file written by another stand-in"
+      if ( not os.path.exists( filename ) ):
+         prog.error( "Input file does NOT exist: "+filename )
+      ncfile = self.netcdf( prog ).Dataset( filename, "r" )
+      try:
+         lat = float( ncfile.variables[latname][:].flat[0] )
+         lon = float( ncfile.variables[lonname][:].flat[0] )
+      except KeyError:
+         prog.error( "Input file does NOT have "+latname+" and "+lonname+": "+filename )
+      ncfile.close()
+      return( ( lat, lon ) )
+
+   def create( self, prog, filename, title ):
+      "Create a NetCDF file with the global attributes the tools write"
+      ncfile = self.netcdf( prog ).Dataset( filename, "w", format="NETCDF3_64BIT_OFFSET" )
+      ncfile.title   = title
+      ncfile.history = time.strftime( "%a %b %d %H:%M:%S %Y" )+": stand-in created by PTCLM standintools.py"
+      ncfile.source  = "PTCLM standintools.py"
+      return( ncfile )
+
+   def variable( self, ncfile, name, dtype, dims, value, units=None, long_name=None ):
+      "Add a variable to a NetCDF file"
+      var = ncfile.createVariable( name, dtype, dims )
+      if ( units     != None ): var.units     = units
+      if ( long_name != None ): var.long_name = long_name
+      var[:] = value
+      return( var )
+
+   def write_map( self, prog, filename, lat, lon, nsrc=1 ):
+      "Write a mapping file from nsrc source cells to the grid cell around the point"
+      ncfile = self.create( prog, filename, "Mapping file to a single point" )
+      ncfile.map_method = "Conservative remapping"
+      for ( dim, size ) in [ ( "n_a", nsrc ), ( "n_b", 1 ), ( "n_s", nsrc ), ( "nv_a", 4 ), ( "nv_b", 4 ), \
+                             ( "src_grid_rank", 1 ), ( "dst_grid_rank", 1 ) ]:
+         ncfile.createDimension( dim, size )
+      ( latv, lonv ) = self.corners( lat, lon )
+      self.variable( ncfile, "src_grid_dims", "i4", ("src_grid_rank",), [nsrc] )
+      self.variable( ncfile, "dst_grid_dims", "i4", ("dst_grid_rank",), [1] )
+      self.variable( ncfile, "yc_a", "f8", ("n_a",), [lat]*nsrc, units="degrees" )
+      self.variable( ncfile, "xc_a", "f8", ("n_a",), [lon]*nsrc, units="degrees" )
+      self.variable( ncfile, "yc_b", "f8", ("n_b",), [lat], units="degrees" )
+      self.variable( ncfile, "xc_b", "f8", ("n_b",), [lon], units="degrees" )
+      self.variable( ncfile, "yv_a", "f8", ("n_a","nv_a"), [latv]*nsrc, units="degrees" )
+      self.variable( ncfile, "xv_a", "f8", ("n_a","nv_a"), [lonv]*nsrc, units="degrees" )
+      self.variable( ncfile, "yv_b", "f8", ("n_b","nv_b"), [latv], units="degrees" )
+      self.variable( ncfile, "xv_b", "f8", ("n_b","nv_b"), [lonv], units="degrees" )
+      for grid in [ "a", "b" ]:
+         self.variable( ncfile, "mask_"+grid, "i4", ("n_"+grid,), 1, units="unitless" )
+         self.variable( ncfile, "frac_"+grid, "f8", ("n_"+grid,), 1.0, units="unitless" )
+      area = ( self.dx*3.14159265358979/180.0 )**2
+      self.variable( ncfile, "area_a", "f8", ("n_a",), area/nsrc, units="square radians" )
+      self.variable( ncfile, "area_b", "f8", ("n_b",), area, units="square radians" )
+      self.variable( ncfile, "col", "i4", ("n_s",), list( range( 1, nsrc+1 ) ) )
+      self.variable( ncfile, "row", "i4", ("n_s",), [1]*nsrc )
+      self.variable( ncfile, "S", "f8", ("n_s",), 1.0/nsrc )
+      ncfile.close()
+
+   def site_pfts( self, opts ):
+      "Return the percent of each natural PFT from the -pft_frc and -pft_idx options (all bare ground if NOT given)"
+      pct = [ 0.0 ] * self.natpft
+      if ( "pft_frc" in opts and "pft_idx" in opts ):
+         fracs = [ float(value) for value in opts["pft_frc"].strip( "[]" ).split( "," ) if value.strip() != "" ]
+         idxs  = [ int(value) for value in opts["pft_idx"].strip( "[]" ).split( "," ) if value.strip() != "" ]
+         for ( frac, idx ) in zip( fracs, idxs ):
+            if ( idx < self.natpft ): pct[idx] += frac
+      else:
+         pct[0] = 100.0
+      return( pct )
+
+   def write_surfdata( self, prog, filename, lat, lon, opts ):
+      "Write a surface dataset for the point, with the site PFT and soil from the options"
+      ncfile = self.create( prog, filename, "surface dataset" )
+      crop   = opts.get( "crop", False )
+      if ( crop ):
+         cft = 64
+      else:
+         cft = 2
+      for ( dim, size ) in [ ( "lsmlon", 1 ), ( "lsmlat", 1 ), ( "natpft", self.natpft ), ( "cft", cft ), \
+                             ( "nlevsoi", self.nlevsoi ), ( "time", 12 ) ]:
+         ncfile.createDimension( dim, size )
+      grid = ("lsmlat","lsmlon")
+      self.variable( ncfile, "LONGXY", "f8", grid, [[lon]], units="degrees east", long_name="longitude" )
+      self.variable( ncfile, "LATIXY", "f8", grid, [[lat]], units="degrees north", long_name="latitude" )
+      self.variable( ncfile, "LANDFRAC_PFT", "f8", grid, [[1.0]], units="unitless", long_name="land fraction from pft dataset" )
+      self.variable( ncfile, "PFTDATA_MASK", "i4", grid, [[1]], units="unitless", long_name="land mask from pft dataset" )
+      self.variable( ncfile, "AREA", "f8", grid, [[( self.dx*111.2 )**2]], units="km^2", long_name="area" )
+      for ( name, value ) in [ ( "PCT_NATVEG", 100.0 ), ( "PCT_CROP", 0.0 ), ( "PCT_LAKE", 0.0 ), \
+                               ( "PCT_WETLAND", 0.0 ), ( "PCT_GLACIER", 0.0 ), ( "PCT_URBAN", 0.0 ) ]:
+         self.variable( ncfile, name, "f8", grid, [[value]], units="unitless", long_name="total percent "+name[4:].lower() )
+      pct = self.site_pfts( opts )
+      self.variable( ncfile, "PCT_NAT_PFT", "f8", ("natpft",)+grid, [ [[value]] for value in pct ], \
+                     units="unitless", long_name="percent plant functional type on the natural veg landunit" )
+      cftpct = [ 0.0 ] * cft
+      cftpct[0] = 100.0
+      self.variable( ncfile, "PCT_CFT", "f8", ("cft",)+grid, [ [[value]] for value in cftpct ], \
+                     units="unitless", long_name="percent crop functional type on the crop landunit" )
+      sand = float( opts.get( "soil_snd", 43.0 ) )
+      clay = float( opts.get( "soil_cly", 18.0 ) )
+      self.variable( ncfile, "PCT_SAND", "f8", ("nlevsoi",)+grid, [ [[sand]] ]*self.nlevsoi, \
+                     units="unitless", long_name="percent sand" )
+      self.variable( ncfile, "PCT_CLAY", "f8", ("nlevsoi",)+grid, [ [[clay]] ]*self.nlevsoi, \
+                     units="unitless", long_name="percent clay" )
+      self.variable( ncfile, "ORGANIC", "f8", ("nlevsoi",)+grid, [ [[0.0]] ]*self.nlevsoi, \
+                     units="kg/m3 (assumed carbon content 0.58 gC per gOM)", long_name="organic matter density at soil levels" )
+      self.variable( ncfile, "MONTHLY_LAI", "f8", ("time","natpft")+grid, [ [ [[2.0*(value > 0.0)]] for value in pct ] ]*12, \
+                     units="m^2/m^2", long_name="monthly leaf area index" )
+      ncfile.close()
+
+   def write_landuse_timeseries( self, prog, filename, surffile, year1, year2 ):
+      "Write a landuse timeseries file for the years, with the PFT's of the surface dataset"
+      netCDF4 = self.netcdf( prog )
+      surf    = netCDF4.Dataset( surffile, "r" )
+      ncfile  = self.create( prog, filename, "landuse timeseries dataset" )
+      nyears  = year2 - year1 + 1
+      for ( dim, size ) in [ ( "lsmlon", 1 ), ( "lsmlat", 1 ), ( "natpft", len(surf.dimensions["natpft"]) ), \
+                             ( "cft", len(surf.dimensions["cft"]) ) ]:
+         ncfile.createDimension( dim, size )
+      ncfile.createDimension( "time", None )
+      self.variable( ncfile, "YEAR", "i4", ("time",), list( range( year1, year2+1 ) ), units="unitless", long_name="year" )
+      for name in [ "PCT_NAT_PFT", "PCT_CFT" ]:
+         values = surf.variables[name][:]
+         self.variable( ncfile, name, "f8", ("time",)+surf.variables[name].dimensions, [ values ]*nyears, \
+                        units="unitless", long_name=surf.variables[name].long_name )
+      for name in [ "PCT_NATVEG", "PCT_CROP" ]:
+         values = surf.variables[name][:]
+         self.variable( ncfile, name, "f8", ("time","lsmlat","lsmlon"), [ values ]*nyears, \
+                        units="unitless", long_name=surf.variables[name].long_name )
+      ncfile.close()
+      surf.close()
+
+class standin_prog:
+#----------------------------------------------------------------------------------------
+# Error handling for a stand-in tool run from the command line
+#----------------------------------------------------------------------------------------
+   def __init__( self, tool ):
+      self.name = tool
+
+   def error( self, desc ):
+      "error function to abort with a message"
+      sys.stderr.write( "ERROR(stand-in "+self.name+"):: "+desc+"\n" )
+      sys.exit( 1 )
+
+def main( rootdir, tool, args ):
+   "Run a stand-in tool from the command line, returns the exit status"
+   prog   = standin_prog( tool )
+   standin = standintools()
+   standin.Initialize( prog, rootdir )
+   return( standin.Run( prog, tool, args ) )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile, shutil, subprocess
+
+class error_prog:
+     def error( self, desc ):
+         print( desc )
+         sys.exit( 100 )
+
+class test_standintools(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.standin = standintools()
+       self.tmpdir  = tempfile.mkdtemp()
+       self.cwd     = os.getcwd()
+       self.rootdir = self.tmpdir+"/ctsm"
+       os.chdir( self.tmpdir )
+
+   def tearDown( self ):
+       os.chdir( self.cwd )
+       shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.standin.Initialize, self.prog, self.rootdir )
+       self.assertRaises(SystemExit, self.standin.Run, self.prog, "mkmapdata", [] )
+       self.assertRaises(SystemExit, self.standin.Create, self.prog, self.rootdir, latency={ "zztop":1.0 } )
+       self.assertRaises(SystemExit, self.standin.Create, self.prog, self.rootdir, memory={ "gen_domain":-1.0 } )
+       self.assertRaises(SystemExit, self.standin.Create, self.prog, self.rootdir, fail_rate={ "gen_domain":1.5 } )
+       self.standin.Create( self.prog, self.rootdir )
+       self.assertRaises(SystemExit, self.standin.Create, self.prog, self.rootdir )
+       self.standin.Initialize( self.prog, self.rootdir )
+       self.assertRaises(SystemExit, self.standin.Run, self.prog, "zztop", [] )
+       self.assertRaises(SystemExit, self.standin.parse_args, self.prog, [ "-name" ] )
+       self.assertRaises(SystemExit, self.standin.CreateInputdata, self.prog, self.tmpdir, resolution=0.7 )
+       self.assertEqual( self.standin.parse_args( self.prog, [ "-p", "-42.5,10", "-v", "--res", "1x1pt" ], flags=[ "v" ] ), \
+                         { "p":"-42.5,10", "v":True, "res":"1x1pt" } )
+
+   def test_tools( self ):
+       "test running the stand-in tools in order, as PTCLMmkdata does"
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.standin.Create( self.prog, self.rootdir, latency=dict( [ ( tool, 0.0 ) for tool in self.standin.tools ] ) )
+       cdate = time.strftime( "%y%m%d" )
+       res   = "1x1pt_US-UMB"
+       def run( tool, args ):
+          return( subprocess.call( [ self.rootdir+"/"+self.standin.tools[tool] ] + args, stdout=subprocess.DEVNULL ) )
+       self.assertEqual( run( "mknoocnmap", [ "-p", "45.5598,275.2909", "-name", res ] ), 0 )
+       mapfile = "map_"+res+"_noocean_to_"+res+"_nomask_aave_da_"+cdate+".nc"
+       self.assertTrue( os.path.exists( mapfile ) )
+       self.assertTrue( os.path.exists( "SCRIPgrid_"+res+"_noocean_c"+cdate+".nc" ) )
+       self.assertEqual( run( "gen_domain", [ "-m", mapfile, "-o", "navy", "-l", res, "-c", "comment" ] ), 0 )
+       domain = netCDF4.Dataset( "domain.lnd."+res+"_navy."+cdate+".nc" )
+       self.assertAlmostEqual( float(domain.variables["yc"][0,0]), 45.5598 )
+       domain.close()
+       self.assertEqual( run( "mkmapdata", [ "--gridfile", "SCRIPgrid_"+res+"_nomask_c"+cdate+".nc", "--res", res, \
+                                             "--gridtype", "regional", "-v" ] ), 0 )
+       self.assertEqual( len(glob.glob( "map_*_to_"+res+"_nomask_aave_da_c"+cdate+".nc" )), len(self.standin.mapgrids) )
+       # The raw grid files are found from the namelist defaults
+       from namelistdefaults import namelistdefaults
+       inputdir = self.standin.CreateInputdata( self.prog, self.tmpdir+"/inputdata", resolution=30.0 )
+       nmldefaults = namelistdefaults()
+       nmldefaults.Initialize( self.prog, self.rootdir, csmdata=inputdir )
+       ( hgrid, qopts ) = pointmap().GridQuery( "1km-merge-10min_HYDRO1K-merge-nomask" )
+       gridfile = nmldefaults.Query( self.prog, "scripgriddata", res=hgrid, options=qopts, justvalue=True )
+       grid = netCDF4.Dataset( gridfile )
+       self.assertEqual( list(grid.variables["grid_dims"][:]), [ 12, 6 ] )
+       grid.close()
+       args = [ "-res", "usrspec", "-usr_gname", res, "-usr_gdate", cdate, "-usr_mapdir", self.tmpdir, "-y", "1850-2000", \
+                "-soil_cly", "20.0", "-soil_snd", "50.0", "-pft_frc", "[70.0, 30.0]", "-pft_idx", "[7, 1]", "-no-crop" ]
+       self.assertEqual( run( "mksurfdata", args+[ "--debug", "--allownofile" ] ), 0 )
+       self.assertEqual( glob.glob( "surfdata_*" ), [] )
+       self.assertEqual( run( "mksurfdata", args ), 0 )
+       surffile = "surfdata_"+res+"_16pfts_Irrig_CMIP6_simyr1850_c"+cdate
+       self.assertTrue( os.path.exists( surffile+".log" ) )
+       surf = netCDF4.Dataset( surffile+".nc" )
+       self.assertEqual( float(surf.variables["PCT_NAT_PFT"][7,0,0]), 70.0 )
+       self.assertEqual( float(surf.variables["PCT_CLAY"][0,0,0]), 20.0 )
+       surf.close()
+       dyn = netCDF4.Dataset( "landuse.timeseries_"+res+"_hist_16pfts_Irrig_CMIP6_simyr1850-2015_c"+cdate+".nc" )
+       self.assertEqual( len(dyn.dimensions["time"]), 166 )
+       dyn.close()
+       # Missing inputs are errors
+       self.assertEqual( run( "gen_domain", [ "-m", "zztop.nc", "-o", "navy", "-l", res ] ), 1 )
+       self.assertEqual( run( "mksurfdata", [ "-usr_gname", "zztop", "-usr_gdate", cdate, "-usr_mapdir", self.tmpdir ] ), 1 )
+
+   def test_settings( self ):
+       "test the latency and failure rate of the stand-ins"
+       self.standin.Create( self.prog, self.rootdir, latency={ "gen_domain":0.5 }, fail_rate={ "mkmapdata":1.0 }, seed=1 )
+       self.standin.Initialize( self.prog, self.rootdir )
+       self.assertEqual( self.standin.config["tools"]["mkmapdata"]["latency"], self.standin.latency["mkmapdata"] )
+       start = time.time()
+       self.assertRaises(SystemExit, self.standin.Run, self.prog, "gen_domain", [ "-m", "zztop.nc", "-o", "navy", "-l", "res" ] )
+       self.assertGreaterEqual( time.time() - start, 0.5 )
+       self.standin.config["tools"]["mkmapdata"]["latency"] = 0.0
+       self.assertEqual( self.standin.Run( self.prog, "mkmapdata", [ "--gridfile", "zztop.nc", "--res", "res" ] ), 1 )
+       self.assertEqual( glob.glob( "map_*" ), [] )
+       # With a seed, each command either always fails or never does
+       self.standin.config["tools"]["gen_domain"] = { "latency":0.0, "memory_mb":1, "fail_rate":0.5 }
+       def status( n ):
+          try:
+             return( self.standin.Run( self.prog, "gen_domain", [ "-m", "zztop.nc", "-o", "navy", "-l", "res"+str(n) ] ) )
+          except SystemExit:
+             # Did NOT fail at random, so went on to find the map is missing
+             return( 0 )
+       first = [ status( n ) for n in range(16) ]
+       self.assertEqual( [ status( n ) for n in range(16) ], first )
+       self.assertIn( 0, first )
+       self.assertIn( 1, first )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -0,0 +1,228 @@
+#########################################################################################
+#
+# surfoverlay.py
+#
+# Python class to overlay the site PFT and soil values onto an existing surface dataset
+# (for example one created from the gridded data, or by a previous run), rather than
+# running mksurfdata.pl again. The file is copied and PCT_NAT_PFT/PCT_CFT, the landunit
+# percentages, PCT_SAND and PCT_CLAY are rewritten with NumPy, the same way mksurfdata_map
+# sets them for user given PFT's and soil texture. Everything else on the file (variables
+# indexed by PFT such as the monthly LAI, and all the metadata) is kept as it is.
+#
+#########################################################################################
+import os, sys, time, shutil
+
+class surfoverlay:
+#----------------------------------------------------------------------------------------
+# Class to handle overlaying site values onto a surface dataset
+#----------------------------------------------------------------------------------------
+   # Class data
+   setup     = False
+   landunits = [ "PCT_LAKE", "PCT_WETLAND", "PCT_GLACIER", "PCT_URBAN" ]  # Set to zero for user given PFT's
+   eps       = 1.0e-6    # Tolerance for percentages that add to 100
+
+   def Initialize( self, prog ):
+      "Initialize the surface dataset overlay"
+      try:
+         import numpy, netCDF4
+      except ImportError:
+         prog.error( "The numpy and netCDF4 python modules are required to overlay a surface dataset" )
+      self.np      = numpy
+      self.netCDF4 = netCDF4
+      self.setup   = True
+
+   def Filename( self, res, sim_year, cdate ):
+      "Return the name of the surface dataset with the site values overlaid"
+      return( "surfdata_"+res+"_overlay_simyr"+sim_year+"_c"+cdate+".nc" )
+
+   def _check( self, prog, ncfile, basefile ):
+      "Check that the base file has the variables that are overlaid"
+      for name in [ "PCT_NAT_PFT", "PCT_CFT", "PCT_NATVEG", "PCT_CROP", "PCT_SAND", "PCT_CLAY" ]:
+         if ( name not in ncfile.variables ):
+            prog.error( "Surface dataset to overlay does NOT have "+name+": "+basefile )
+
+   def _pfts( self, prog, ncfile, pft_frc, pft_idx ):
+      "Set the PFT and landunit percentages from the PFT fractions and indices (that add to 100)"
+      np     = self.np
+      natpft = ncfile.variables["PCT_NAT_PFT"].shape[0]
+      cft    = ncfile.variables["PCT_CFT"].shape[0]
+      if ( len(pft_frc) != len(pft_idx) or len(pft_frc) == 0 ):
+         prog.error( "Need the same number of PFT fractions and indices" )
+      if ( abs( sum( pft_frc ) - 100.0 ) > self.eps ):
+         prog.error( "PFT fractions do NOT add to 100: "+str(sum( pft_frc )) )
+      nat  = np.zeros( natpft )
+      crop = np.zeros( cft )
+      for ( frc, idx ) in zip( pft_frc, pft_idx ):
+         if ( idx < 0 or idx >= natpft+cft ):
+            prog.error( "PFT index is NOT on the surface dataset (natural PFT's 0-"+str(natpft-1)+" and crops "+ \
+                        str(natpft)+"-"+str(natpft+cft-1)+"): "+str(idx) )
+         if ( idx < natpft ):
+            nat[idx] += frc
+         else:
+            crop[idx-natpft] += frc
+      # Each landunit's types add to 100, an empty landunit is all bare soil or the first crop
+      # (as mksurfdata_map does)
+      pctnatveg = nat.sum()
+      pctcrop   = crop.sum()
+      if ( pctnatveg > 0.0 ): nat  = 100.0*nat/pctnatveg
+      else:                   nat[0]  = 100.0
+      if ( pctcrop > 0.0 ):   crop = 100.0*crop/pctcrop
+      else:                   crop[0] = 100.0
+      grid = ncfile.variables["PCT_NATVEG"].shape
+      ncfile.variables["PCT_NAT_PFT"][:] = np.broadcast_to( nat.reshape( (natpft,)+(1,)*len(grid) ), (natpft,)+grid )
+      ncfile.variables["PCT_CFT"][:]     = np.broadcast_to( crop.reshape( (cft,)+(1,)*len(grid) ), (cft,)+grid )
+      ncfile.variables["PCT_NATVEG"][:]  = pctnatveg
+      ncfile.variables["PCT_CROP"][:]    = pctcrop
+      for name in self.landunits:
+         if ( name in ncfile.variables ): ncfile.variables[name][:] = 0.0
+
+   def _soil( self, prog, ncfile, soil_snd, soil_cly ):
+      "Set the sand and clay percentages at all soil levels"
+      if ( soil_snd < 0.0 or soil_cly < 0.0 or soil_snd+soil_cly > 100.0 ):
+         prog.error( "Sand and clay percentages must be positive and add to 100 or less: "+str(soil_snd)+" "+str(soil_cly) )
+      ncfile.variables["PCT_SAND"][:] = soil_snd
+      ncfile.variables["PCT_CLAY"][:] = soil_cly
+
+   def _consistent( self, prog, ncfile, outfile ):
+      "Check the percentages are consistent (as mksurfdata_map requires)"
+      np    = self.np
+      total = ncfile.variables["PCT_NATVEG"][:] + ncfile.variables["PCT_CROP"][:]
+      for name in self.landunits:
+         if ( name in ncfile.variables ):
+            pct = ncfile.variables[name][:]
+            if ( pct.ndim > total.ndim ): pct = pct.sum( axis=0 )
+            total = total + pct
+      for ( name, pct ) in [ ( "landunits", total ), ( "PCT_NAT_PFT", ncfile.variables["PCT_NAT_PFT"][:].sum( axis=0 ) ), \
+                             ( "PCT_CFT", ncfile.variables["PCT_CFT"][:].sum( axis=0 ) ) ]:
+         if ( np.any( np.abs( pct - 100.0 ) > self.eps ) ):
+            prog.error( "Percentages of "+name+" do NOT add to 100 on: "+outfile )
+
+   def Write( self, prog, basefile, outfile, pft_frc=None, pft_idx=None, soil_snd=None, soil_cly=None ):
+      "Write a copy of the base surface dataset with the PFT and/or soil values overlaid (values NOT given are kept)"
+      if ( not self.setup ):
+         prog.error( "Initialize was NOT run first!" )
+      if ( not os.path.exists( basefile ) ):
+         prog.error( "Surface dataset to overlay does NOT exist: "+basefile )
+      if ( os.path.abspath( basefile ) == os.path.abspath( outfile ) ):
+         prog.error( "Surface dataset with the values overlaid can NOT replace the one it's from: "+basefile )
+      if ( (soil_snd == None) != (soil_cly == None) ):
+         prog.error( "Need both the sand and clay percentages to overlay them" )
+      shutil.copyfile( basefile, outfile+".tmp" )
+      try:
+         ncfile = self.netCDF4.Dataset( outfile+".tmp", "r+" )
+         ncfile.set_auto_mask( False )
+         self._check( prog, ncfile, basefile )
+         desc = []
+         if ( pft_frc != None ):
+            self._pfts( prog, ncfile, pft_frc, pft_idx )
+            desc.append( "pft_frc="+str(list(pft_frc))+" pft_idx="+str(list(pft_idx)) )
+         if ( soil_snd != None ):
+            self._soil( prog, ncfile, soil_snd, soil_cly )
+            desc.append( "soil_snd="+str(soil_snd)+" soil_cly="+str(soil_cly) )
+         self._consistent( prog, ncfile, outfile )
+         history = time.strftime( "%a %b %d %H:%M:%S %Y" )+": PTCLM surfoverlay.py "+" ".join( desc )+ \
+                   " overlaid on "+os.path.basename( basefile )
+         if ( "history" in ncfile.ncattrs() ): history = history+"\n"+ncfile.history
+         ncfile.history = history
+         ncfile.close()
+      except:
+         if ( os.path.exists( outfile+".tmp" ) ): os.remove( outfile+".tmp" )
+         raise
+      os.rename( outfile+".tmp", outfile )
+      return( outfile )
+
+#
+# Unit testing for above classes
+#
+import unittest, tempfile
+
+class error_prog:
+     def error( self, desc ):
+         print( "ERROR(test):: "+desc )
+         sys.exit( 100 )
+
+class test_surfoverlay(unittest.TestCase):
+
+   def setUp( self ):
+       "Setup tests"
+       self.prog    = error_prog()
+       self.overlay = surfoverlay()
+       self.tmpdir  = tempfile.mkdtemp()
+
+   def tearDown( self ):
+       shutil.rmtree( self.tmpdir )
+
+   def write_surfdata( self, filename ):
+       "Write a small surface dataset like mksurfdata_map does for a point"
+       import netCDF4
+       ncfile = netCDF4.Dataset( filename, "w", format="NETCDF3_64BIT_OFFSET" )
+       ncfile.history = "created by mksurfdata_map"
+       for ( dim, size ) in [ ( "lsmlon", 1 ), ( "lsmlat", 1 ), ( "natpft", 15 ), ( "cft", 2 ), ( "numurbl", 3 ), ( "nlevsoi", 10 ) ]:
+          ncfile.createDimension( dim, size )
+       grid = ("lsmlat","lsmlon")
+       for ( name, dims, value ) in [ ( "PCT_NATVEG", grid, 80.0 ), ( "PCT_CROP", grid, 10.0 ), ( "PCT_LAKE", grid, 5.0 ), \
+                                      ( "PCT_WETLAND", grid, 0.0 ), ( "PCT_GLACIER", grid, 0.0 ), \
+                                      ( "PCT_URBAN", ("numurbl",)+grid, [ [[5.0]], [[0.0]], [[0.0]] ] ), \
+                                      ( "PCT_NAT_PFT", ("natpft",)+grid, [ [[100.0]] ]+[ [[0.0]] ]*14 ), \
+                                      ( "PCT_CFT", ("cft",)+grid, [ [[40.0]], [[60.0]] ] ), \
+                                      ( "PCT_SAND", ("nlevsoi",)+grid, [ [[float(lev)]] for lev in range( 10 ) ] ), \
+                                      ( "PCT_CLAY", ("nlevsoi",)+grid, [ [[5.0]] ]*10 ) ]:
+          var = ncfile.createVariable( name, "f8", dims )
+          var.units = "unitless"
+          var[:] = value
+       ncfile.close()
+
+   def test_badinit( self ):
+       "test bad initialization"
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, "zztop.nc", "out.nc" )
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.overlay.Initialize( self.prog )
+       basefile = self.tmpdir+"/surfdata_base.nc"
+       outfile  = self.tmpdir+"/surfdata_out.nc"
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, outfile )
+       self.write_surfdata( basefile )
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, basefile, soil_snd=10.0, soil_cly=10.0 )
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, outfile, soil_snd=10.0 )
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, outfile, soil_snd=60.0, soil_cly=50.0 )
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, outfile, pft_frc=[ 50.0 ], pft_idx=[ 1 ] )
+       self.assertRaises(SystemExit, self.overlay.Write, self.prog, basefile, outfile, pft_frc=[ 100.0 ], pft_idx=[ 17 ] )
+       self.assertFalse( os.path.exists( outfile ) )
+       self.assertFalse( os.path.exists( outfile+".tmp" ) )
+
+   def test_overlay( self ):
+       "test overlaying PFT and soil values"
+       try:
+          import netCDF4
+       except ImportError:
+          self.skipTest( "netCDF4 is NOT available" )
+       self.overlay.Initialize( self.prog )
+       basefile = self.tmpdir+"/surfdata_base.nc"
+       self.write_surfdata( basefile )
+       outfile  = self.overlay.Write( self.prog, basefile, self.tmpdir+"/"+self.overlay.Filename( "1x1pt_US-UMB", "2000", "200101" ), \
+                                      pft_frc=[ 60.0, 20.0, 20.0 ], pft_idx=[ 7, 1, 16 ], soil_snd=40.0, soil_cly=30.0 )
+       self.assertEqual( os.path.basename( outfile ), "surfdata_1x1pt_US-UMB_overlay_simyr2000_c200101.nc" )
+       surf = netCDF4.Dataset( outfile )
+       self.assertEqual( float(surf.variables["PCT_NATVEG"][0,0]), 80.0 )
+       self.assertEqual( float(surf.variables["PCT_CROP"][0,0]), 20.0 )
+       self.assertEqual( float(surf.variables["PCT_LAKE"][0,0]), 0.0 )
+       self.assertEqual( list(surf.variables["PCT_URBAN"][:,0,0]), [ 0.0, 0.0, 0.0 ] )
+       self.assertEqual( float(surf.variables["PCT_NAT_PFT"][7,0,0]), 75.0 )
+       self.assertEqual( float(surf.variables["PCT_NAT_PFT"][1,0,0]), 25.0 )
+       self.assertEqual( float(surf.variables["PCT_NAT_PFT"][0,0,0]), 0.0 )
+       self.assertEqual( list(surf.variables["PCT_CFT"][:,0,0]), [ 0.0, 100.0 ] )
+       self.assertEqual( list(surf.variables["PCT_SAND"][:,0,0]), [ 40.0 ]*10 )
+       self.assertEqual( surf.variables["PCT_CLAY"].units, "unitless" )
+       self.assertTrue( surf.history.endswith( "\ncreated by mksurfdata_map" ) )
+       surf.close()
+       # Values that are NOT given are kept
+       outfile = self.overlay.Write( self.prog, basefile, self.tmpdir+"/surfdata_soil.nc", soil_snd=40.0, soil_cly=30.0 )
+       surf = netCDF4.Dataset( outfile )
+       self.assertEqual( float(surf.variables["PCT_NATVEG"][0,0]), 80.0 )
+       self.assertEqual( list(surf.variables["PCT_CFT"][:,0,0]), [ 40.0, 60.0 ] )
+       surf.close()
+
+if __name__ == '__main__':
+     unittest.main()
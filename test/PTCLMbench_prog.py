@@ -0,0 +1,413 @@
+#########################################################################################
+#
+# PTCLMbench_prog
+#
+# Top level class to define the PTCLMbench program. Parse's arguments and has Init,
+# run, and final methods to benchmark PTCLMmkdata in debug mode for the configurations
+# in the test list over the sites in the site catalog. The total and per-stage times,
+# number of processes started and peak memory of each run are saved in a results file
+# under the PTCLM version (the ChangeLog tag), and results can be compared to those of
+# an earlier version to find regressions.
+#
+#########################################################################################
+from PTCLMtestlist import PTCLMtestlistXML
+import os, sys, json, time, shutil, tempfile, subprocess
+sys.path.append( os.path.dirname( os.path.abspath( __file__ ) )+"/.." )
+from ptclmversion import ptclmversion
+
+class PTCLMbench_prog:
+#----------------------------------------------------------------------------------------
+# Class to handle command line input to the program
+#----------------------------------------------------------------------------------------
+   # Class data
+   name         = "PTCLMbench"
+   ptclm_dir    = os.path.abspath( os.path.dirname( os.path.abspath( __file__ ) )+"/.." )
+   testlist     = os.path.dirname( os.path.abspath( __file__ ) )+"/PTCLMtestlist.xml"
+   results_def  = os.path.dirname( os.path.abspath( __file__ ) )+"/PTCLMbench_results.json"
+   ctsmdir_def  = "../../../"
+   ctsmdir      = os.getenv("CTSM_ROOT", ctsmdir_def )
+   inputdir     = os.getenv("CSMDATA", " " )
+   sites        = "all"
+   configs      = "all"
+   count        = 1
+   threshold    = 0.10     # Fractional increase over the baseline that is a regression
+   debug        = True
+   parse_args   = False
+   setup        = False
+
+   # --  Error function ---------------------------------
+   def error( self, desc ):
+       "error function to abort with a message"
+       print( "ERROR("+self.name+"):: "+desc )
+       sys.exit(100)
+
+   def get_version( self ):
+      "Return the PTCLM version (ChangeLog tag)"
+      return( ptclmversion().Get( self, self.ptclm_dir+"/ChangeLog" ) )
+
+   def parse_cmdline_args( self ):
+      "Parse the command line arguments for the PTCLM benchmark script"
+      from optparse import OptionParser, OptionGroup
+
+      parser   = OptionParser( usage="%prog [options]" )
+      options = OptionGroup( parser, "Options" )
+      options.add_option("-r", "--ctsm_root", dest="ctsm_root", default=self.ctsmdir, \
+                        help="Location of CTSM root directory (also set with CTSM_ROOT env variable)")
+      options.add_option("-d", "--csmdata", dest="inputdir", default=self.inputdir, \
+                        help="Location of CESM inputdata directory (also set with CSMDATA env variable)")
+      options.add_option("-s", "--sites", dest="sites", default=self.sites, \
+                        help="Comma seperated list of sites to run (default all sites in the catalog)")
+      options.add_option("--configs", dest="configs", default=self.configs, \
+                        help="Comma seperated list of configurations to run, by the test id in "+ \
+                             "PTCLMtestlist.xml (default all of the RUN tests)")
+      options.add_option("-n", "--count", dest="count", type="int", default=self.count, \
+                        help="Number of times to run each case (the fastest time is kept)")
+      options.add_option("--results", dest="results", default=self.results_def, \
+                        help="Results file to save the benchmark results in")
+      options.add_option("--tag", dest="tag", default=" ", \
+                        help="Name to save the results under (default the ChangeLog tag)")
+      options.add_option("--compare", dest="compare", default=" ", \
+                        help="Compare the results to those saved under this tag and report regressions")
+      options.add_option("--threshold", dest="threshold", type="float", default=self.threshold, \
+                        help="Fractional increase over the compare results that is a regression (default 0.10)")
+      options.add_option("--no_debug", dest="debug", action="store_false", default=self.debug, \
+                        help="Run the tools rather than running PTCLMmkdata in debug mode")
+      options.add_option("--no_run", dest="run", action="store_false", default=True, \
+                        help="Do NOT run the benchmark, just compare results already saved")
+      parser.add_option_group(options)
+      versiongroup    = OptionGroup( parser, self.get_version() )
+      parser.add_option_group(versiongroup)
+      (options, args) = parser.parse_args()
+      if len(args) != 0:
+          parser.error("incorrect number of arguments")
+      if ( options.count < 1 ):
+          parser.error("count must be one or greater")
+      if ( options.threshold < 0.0 ):
+          parser.error("threshold can NOT be negative")
+      if ( not options.run and options.compare == " " ):
+          parser.error("no_run can only be used with compare")
+
+      self.ctsmdir    = options.ctsm_root
+      self.inputdir   = options.inputdir
+      self.sites      = options.sites
+      self.configs    = options.configs
+      self.count      = options.count
+      self.results    = options.results
+      self.compare    = options.compare
+      self.threshold  = options.threshold
+      self.run        = options.run
+      self.debug      = options.debug
+      self.tag        = options.tag
+      if ( self.tag == " " ): self.tag = self.get_version()
+      self.parse_args = True
+
+   def get_configs( self ):
+      "Return the configurations to run, the options of each RUN test in the test list keyed by test id"
+      from xml.sax import make_parser
+      handler = PTCLMtestlistXML()
+      xml     = make_parser()
+      xml.setContentHandler( handler )
+      xml.parse( self.testlist )
+      configs = {}
+      seen    = []
+      for test in handler.testlist:
+         if ( test['type'] != "RUN" ): continue
+         # Tests of different sites with the same options are the same configuration
+         opts = " ".join( test['opts'].split() )
+         if ( opts in seen ): continue
+         seen.append( opts )
+         name = test['id']
+         if ( name in configs ): name = name+"."+str(len(seen))
+         configs[name] = opts
+      return( configs )
+
+   def get_sites( self ):
+      "Return the list of sites in the site catalog"
+      from PTCLMmkdata_prog import PTCLMmkdata_prog, PTCLMmkdataError
+      prog = PTCLMmkdata_prog()
+      try:
+         prog.set_options( "all", mydatadir=self.workdir, quiet=True )
+         return( prog.get_SiteList() )
+      except PTCLMmkdataError as err:
+         self.error( str(err) )
+
+   def Initialize( self ):
+      "Initialize the PTCLM benchmark"
+      if ( not self.parse_args ):
+         self.error( "parse_cmdline_args was NOT run first" )
+      if ( self.run ):
+         if ( self.inputdir == " " or not os.path.isdir( self.inputdir ) ):
+            self.error( "CESM inputdata directory does NOT exist (set with -d or CSMDATA env variable): "+self.inputdir )
+         if ( not os.path.isdir( self.ctsmdir ) ):
+            self.error( "CTSM_root directory does NOT exist: "+self.ctsmdir )
+      self.workdir = tempfile.mkdtemp( prefix="PTCLMbench." )
+      self.runs    = {}
+      if ( self.run ):
+         configs = self.get_configs()
+         if ( self.configs == "all" ):
+            self.config_list = sorted( configs )
+         else:
+            self.config_list = self.configs.split( "," )
+         self.config_opts = {}
+         for config in self.config_list:
+            if ( config not in configs ):
+               self.error( "Configuration is NOT a RUN test in the test list: "+config )
+            self.config_opts[config] = configs[config]
+         allsites = self.get_sites()
+         if ( self.sites == "all" ):
+            self.site_list = allsites
+         else:
+            self.site_list = self.sites.split( "," )
+            for site in self.site_list:
+               if ( site not in allsites ):
+                  self.error( "Site is NOT in the site catalog: "+site )
+      self.setup = True
+
+   def RunCase( self, config, site ):
+      "Run PTCLMmkdata for a configuration and site, returning the time, stages, processes started and memory"
+      mydatadir = self.workdir+"/"+config
+      # Start each run from an empty data directory, as the stage manifest left by an earlier
+      # run would have PTCLMmkdata skip the stages that are up to date (and so time nothing)
+      if ( os.path.isdir( mydatadir ) ): shutil.rmtree( mydatadir )
+      cmd = [ sys.executable, self.ptclm_dir+"/PTCLMmkdata", "-s", site, "-d", self.inputdir, \
+              "--ctsm_root", self.ctsmdir, "--mydatadir", mydatadir ] + self.config_opts[config].split()
+      # In debug mode the tools aren't run, so use the mapping files of a fixed date
+      if ( self.debug ): cmd += [ "--debug", "--sdate", "140204", "--map_gdate", "140204" ]
+      start = time.time()
+      proc  = subprocess.Popen( cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT )
+      (pid, status, rusage) = os.wait4( proc.pid, 0 )
+      wall  = time.time() - start
+      proc.returncode = os.waitstatus_to_exitcode( status )
+      result = { "rcode":proc.returncode, "wall":wall, "stages":{}, "spawns":1, "maxrss_kb":rusage.ru_maxrss }
+      # Every command PTCLMmkdata runs is in the trace of the site
+      tracefile = mydatadir+"/1x1pt_"+site+"/PTCLMmkdata_trace.jsonl"
+      if ( os.path.exists( tracefile ) ):
+         infile = open( tracefile, "r" )
+         for line in infile:
+            if ( line.strip() == "" ): continue
+            event = json.loads( line )
+            if ( event.get("cat") == "stage" ):
+               result["stages"][event["name"]] = event["dur"] / 1.e6
+            elif ( event.get("cat") == "command" ):
+               result["spawns"] += 1
+               result["maxrss_kb"] = max( result["maxrss_kb"], event["args"].get( "maxrss_kb", 0 ) )
+         infile.close()
+         os.remove( tracefile )
+      return( result )
+
+   def Run( self ):
+      "Run the benchmark over all the configurations and sites"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      if ( not self.run ):
+         return
+      print( "Benchmark "+self.tag+": "+str(len(self.config_list))+" configurations for "+str(len(self.site_list))+ \
+             " sites ("+str(self.count)+" runs of each)\n" )
+      for config in self.config_list:
+         start = time.time()
+         nfail = 0
+         for site in self.site_list:
+            best = None
+            for i in range(self.count):
+               result = self.RunCase( config, site )
+               if ( best == None or result["wall"] < best["wall"] ): best = result
+            if ( best["rcode"] != 0 ): nfail += 1
+            self.runs[config+":"+site] = best
+         print( " %-30s %8.1f s  fail: %d" % ( config, time.time() - start, nfail ) )
+         sys.stdout.flush()
+
+   def Summary( self, runs ):
+      "Return the totals for each configuration and stage of a set of runs"
+      summary = {}
+      for key in runs:
+         run     = runs[key]
+         config  = key.split(":")[0]
+         names   = [ "config:"+config ] + [ "stage:"+stage for stage in run["stages"] ]
+         for name in names:
+            if ( name not in summary ):
+               summary[name] = { "count":0, "fail":0, "wall":0.0, "spawns":0, "maxrss_kb":0 }
+         total = summary["config:"+config]
+         total["count"]    += 1
+         total["wall"]     += run["wall"]
+         total["spawns"]   += run["spawns"]
+         total["maxrss_kb"] = max( total["maxrss_kb"], run["maxrss_kb"] )
+         if ( run["rcode"] != 0 ): total["fail"] += 1
+         for stage in run["stages"]:
+            summary["stage:"+stage]["count"] += 1
+            summary["stage:"+stage]["wall"]  += run["stages"][stage]
+      return( summary )
+
+   def ReadResults( self ):
+      "Read the results saved for each tag"
+      if ( not os.path.exists( self.results ) ):
+         return( {} )
+      infile = open( self.results, "r" )
+      try:
+         results = json.load( infile )
+      except ValueError:
+         self.error( "Results file is corrupt: "+self.results )
+      infile.close()
+      return( results )
+
+   def Finalize( self ):
+      "Save the results under the tag and print out a summary"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      shutil.rmtree( self.workdir )
+      if ( not self.run ):
+         return
+      results = self.ReadResults()
+      results[self.tag] = { "date":time.strftime( "%Y-%m-%d %H:%M:%S" ), "host":os.uname()[1], \
+                            "count":self.count, "runs":self.runs, "summary":self.Summary( self.runs ) }
+      output = open( self.results+".tmp", "w" )
+      json.dump( results, output, indent=1, sort_keys=True )
+      output.close()
+      os.rename( self.results+".tmp", self.results )
+      summary = results[self.tag]["summary"]
+      print( "\nSummary of "+self.tag+" saved in: "+self.results+"\n" )
+      print( " %-36s %6s %5s %10s %8s %12s" % ( "configuration/stage", "count", "fail", "wall(s)", "spawns", "max rss(MB)" ) )
+      for name in sorted( summary ):
+         total = summary[name]
+         print( " %-36s %6d %5d %10.2f %8d %12.1f" % ( name, total["count"], total["fail"], total["wall"], \
+                total["spawns"], total["maxrss_kb"]/1024.0 ) )
+
+   def Compare( self ):
+      "Compare the results to those of the compare tag, returns the list of regressions"
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      results = self.ReadResults()
+      for tag in [ self.compare, self.tag ]:
+         if ( tag not in results ):
+            self.error( "No results saved for tag "+tag+" in: "+self.results )
+      base  = results[self.compare]["summary"]
+      new   = results[self.tag]["summary"]
+      regressions = []
+      print( "\nCompare "+self.tag+" to "+self.compare+" (regression if more than "+ \
+             str(int(self.threshold*100))+"% higher)\n" )
+      print( " %-36s %-10s %12s %12s %8s" % ( "configuration/stage", "measure", self.compare[:12], self.tag[:12], "change" ) )
+      for name in sorted( base ):
+         if ( name not in new ):
+            print( " %-36s is NOT in the new results" % name )
+            continue
+         for measure in [ "wall", "spawns", "maxrss_kb", "fail" ]:
+            old = base[name][measure]
+            val = new[name][measure]
+            if ( old == 0 and val == 0 ): continue
+            # Failures and process counts don't depend on the machine, so any increase is a regression
+            if ( measure in [ "spawns", "fail" ] ):
+               regress = ( val > old )
+            else:
+               regress = ( val > old*(1.0 + self.threshold) )
+            if ( old != 0 ):
+               change = "%+7.1f%%" % ( (val - old)*100.0/old )
+            else:
+               change = "     new"
+            flag = ""
+            if ( regress ):
+               flag = "  REGRESSION"
+               regressions.append( name+" "+measure )
+            print( " %-36s %-10s %12.2f %12.2f %8s%s" % ( name, measure, old, val, change, flag ) )
+      print( "\nNumber of regressions = "+str(len(regressions)) )
+      return( regressions )
+
+#
+# Unit testing for above classes
+#
+import unittest
+
+class test_PTCLMbench_prog(unittest.TestCase):
+
+   def setUp( self ):
+     self.prog   = PTCLMbench_prog()
+     self.tmpdir = tempfile.mkdtemp()
+
+   def tearDown( self ):
+     shutil.rmtree( self.tmpdir )
+
+   def test_badinit( self ):
+     # Bad options will fail
+     for args in [ [ "--zztop" ], [ "--count", "0" ], [ "--threshold", "-1" ], [ "--no_run" ] ]:
+        sys.argv[1:] = args
+        self.assertRaises(SystemExit, PTCLMbench_prog().parse_cmdline_args )
+     # Test that doing stuff before parse_args fails
+     self.assertRaises(SystemExit, self.prog.Initialize )
+     self.assertRaises(SystemExit, self.prog.Run )
+     self.assertRaises(SystemExit, self.prog.Compare )
+     # Running needs the inputdata directory
+     sys.argv[1:] = [ "-d", self.tmpdir+"/zztop" ]
+     self.prog.parse_cmdline_args( )
+     self.assertRaises(SystemExit, self.prog.Initialize )
+
+   def test_configs( self ):
+     sys.argv[1:] = [ ]
+     self.prog.parse_cmdline_args( )
+     self.assertEqual( self.prog.tag, self.prog.get_version() )
+     configs = self.prog.get_configs()
+     # Each set of options is only run once
+     self.assertEqual( len(set(configs.values())), len(configs) )
+     self.assertEqual( configs["std_file_creation"], "--verbose" )
+     self.assertEqual( configs["noopt_file_creation"], "" )
+
+   def write_results( self, tag, runs ):
+     "Save a set of runs in the results file under a tag"
+     self.prog.tag   = tag
+     self.prog.run   = True
+     self.prog.runs  = runs
+     self.prog.count = 1
+     self.prog.workdir = tempfile.mkdtemp()
+     self.prog.setup = True
+     self.prog.Finalize()
+
+   def test_repeats( self ):
+     # Stand-in for PTCLMmkdata that skips it's commands when a stage manifest is there, like it does
+     ptclm = open( self.tmpdir+"/PTCLMmkdata", "w" )
+     ptclm.write( "import sys, os, json\n" + \
+                  "args = sys.argv[1:]\n" + \
+                  "sitedir = args[args.index('--mydatadir')+1]+'/1x1pt_'+args[args.index('-s')+1]\n" + \
+                  "if not os.path.isdir( sitedir ): os.makedirs( sitedir )\n" + \
+                  "trace = open( sitedir+'/PTCLMmkdata_trace.jsonl', 'w' )\n" + \
+                  "if not os.path.exists( sitedir+'/manifest' ):\n" + \
+                  "   for i in range(2): trace.write( json.dumps( { 'name':'cmd', 'cat':'command', 'args':{} } )+'\\n' )\n" + \
+                  "trace.write( json.dumps( { 'name':'domain', 'cat':'stage', 'dur':1000 } )+'\\n' )\n" + \
+                  "open( sitedir+'/manifest', 'w' ).close()\n" )
+     ptclm.close()
+     sys.argv[1:] = [ "-d", self.tmpdir, "-r", self.tmpdir, "-s", "US-UMB", "--configs", "std_file_creation", "-n", "3" ]
+     self.prog.parse_cmdline_args( )
+     self.prog.Initialize( )
+     self.prog.ptclm_dir = self.tmpdir
+     try:
+        # Every repeat runs the whole site
+        spawns = [ self.prog.RunCase( "std_file_creation", "US-UMB" )["spawns"] for i in range(3) ]
+        self.assertEqual( spawns, [ 3, 3, 3 ] )
+        self.prog.Run( )
+        self.assertEqual( self.prog.runs["std_file_creation:US-UMB"]["spawns"], 3 )
+     finally:
+        shutil.rmtree( self.prog.workdir )
+
+   def test_compare( self ):
+     sys.argv[1:] = [ "--results", self.tmpdir+"/results.json", "--compare", "PTCLM2_20200101", "--no_run" ]
+     self.prog.parse_cmdline_args( )
+     run = { "rcode":0, "wall":1.0, "stages":{ "noocean":0.2, "domain":0.5 }, "spawns":3, "maxrss_kb":1024 }
+     self.write_results( "PTCLM2_20200101", { "debug:US-UMB":run, "debug:US-Ha1":run } )
+     slower = dict( run )
+     slower["stages"] = { "noocean":0.2, "domain":0.9 }
+     slower["wall"]   = 1.05
+     self.write_results( "PTCLM2_20200902", { "debug:US-UMB":run, "debug:US-Ha1":slower } )
+     results = self.prog.ReadResults()
+     self.assertEqual( sorted(results), [ "PTCLM2_20200101", "PTCLM2_20200902" ] )
+     self.assertEqual( results["PTCLM2_20200902"]["summary"]["config:debug"]["spawns"], 6 )
+     # Only the stage that is slower by more than the threshold is a regression
+     self.assertEqual( self.prog.Compare(), [ "stage:domain wall" ] )
+     self.prog.threshold = 0.5
+     self.assertEqual( self.prog.Compare(), [] )
+     # More processes started or runs that fail are always regressions
+     more = dict( run )
+     more["spawns"] = 4
+     more["rcode"]  = 1
+     self.write_results( "PTCLM2_20200902", { "debug:US-UMB":run, "debug:US-Ha1":more } )
+     self.assertEqual( self.prog.Compare(), [ "config:debug spawns", "config:debug fail" ] )
+     self.prog.compare = "zztop"
+     self.assertRaises(SystemExit, self.prog.Compare )
+
+if __name__ == '__main__':
+     unittest.main()
@@ -4,10 +4,14 @@
 #
 # Top level class to define the PTCLMtesting program. Parse's arguments and has Init,
 # run, and final methods to setup, execute, and then display test results.
+# With --jobs the tests are run at the same time in a pool of processes, each test with
+# it's own working directory for it's log and output.
 #
 #########################################################################################
 from PTCLMtestlist import PTCLMtestlist
-import os, sys
+import os, sys, shutil
+sys.path.append( os.path.dirname( os.path.abspath( __file__ ) )+"/.." )
+from ptclmversion import ptclmversion
 
 class PTCLMtesting_prog:
 #----------------------------------------------------------------------------------------
@@ -17,6 +21,7 @@ class PTCLMtesting_prog:
    name         = "PTCLMtesting"
    cmdline      = ""
    redo_compare = False
+   jobs         = 1
    ctsmdir_def  = "../../../"
    ctsmdir      = os.getenv("CTSM_ROOT", ctsmdir_def )
    cimedir_def  = ctsmdir_def + "/cime"
@@ -46,16 +51,10 @@ class PTCLMtesting_prog:
                         help="Location of CIME root directory (also set with CIME_ROOT env variable)")
       options.add_option("--redo_compare_files", dest="redo_compare", action="store_true", default=self.redo_compare, \
                         help="Redo the compare files")
+      options.add_option("--jobs", dest="jobs", type="int", default=self.jobs, \
+                        help="Number of tests to run at the same time (each in it's own working directory)")
       parser.add_option_group(options)
-      tagvers = ""
-      clog = open( "../ChangeLog", "r" );
-      for line in clog:
-         if ( line.find("Tag: ",0) == 0 ): 
-            n = line.count("")
-            tagvers = line[5:n-2]
-            break
-
-      clog.close
+      tagvers = ptclmversion().Get( self, "../ChangeLog" )
       versiongroup    = OptionGroup( parser, tagvers )
       parser.add_option_group(versiongroup)
       (options, args) = parser.parse_args()
@@ -63,6 +62,9 @@ class PTCLMtesting_prog:
           parser.error("incorrect number of arguments")
    
       self.redo_compare = options.redo_compare
+      self.jobs         = options.jobs
+      if ( self.jobs < 1 ):
+          parser.error("jobs must be one or greater")
       self.ctsmdir      = options.ctsm_root
       self.cimedir      = options.cime_root
       self.parse_args   = True
@@ -103,26 +105,59 @@ class PTCLMtesting_prog:
       self.itest = 0
       self.setup = True
 
+   def Count( self, stat, comp ):
+      "Add the status and compare status of a test to the counts"
+      self.itest += 1
+      self.n_tests[stat] += 1
+      if   ( comp == "PASS" ):          self.n_tests['PASS-COMP']  += 1
+      elif ( comp == "NO-COMPS-DONE" ): self.n_tests[comp]         += 1
+      else:                             self.n_tests['FAIL-COMP']  += 1
+
    def Run( self ):
       "Run the testing"
       if ( not self.setup ):
          self.error( "Initialize was NOT run first" )
+      if ( self.jobs > 1 ):
+         self.RunParallel()
+         return
+
       for test in self.testlist.get_testlist():
-         self.itest += 1
          (stat,comp) = self.testlist.run_PTCLMtest( test, self.redo_compare_files() )
-         self.n_tests[stat] += 1
-         if   ( comp == "PASS" ):          self.n_tests['PASS-COMP']  += 1
-         elif ( comp == "NO-COMPS-DONE" ): self.n_tests[comp]         += 1
-         else:                             self.n_tests['FAIL-COMP']  += 1
+         self.Count( stat, comp )
 
       for test in self.testlist.get_failtestlist():
-         self.itest += 1
          (stat,comp) = self.testlist.run_PTCLMtest( test, self.redo_compare_files() )
-         self.n_tests[stat] += 1
-         if   ( comp == "PASS" ):          self.n_tests['PASS-COMP']  += 1
-         elif ( comp == "NO-COMPS-DONE" ): self.n_tests[comp]         += 1
-         else:                             self.n_tests['FAIL-COMP']  += 1
+         self.Count( stat, comp )
+
+   def workdir( self, itest, test ):
+      "Return the working directory for a test when tests are run at the same time"
+      return( os.path.abspath( self.testlist.testing_dir )+"/work/%03d.%s" % ( itest, test['id'] ) )
 
+   def RunParallel( self ):
+      "Run the tests at the same time in a pool of processes, showing the output of each test as it completes"
+      import concurrent.futures
+      if ( not self.setup ):
+         self.error( "Initialize was NOT run first" )
+      tests = self.testlist.get_testlist() + self.testlist.get_failtestlist()
+      print( "Run "+str(len(tests))+" tests with "+str(self.jobs)+" at a time\n" )
+      sys.stdout.flush()
+      with concurrent.futures.ProcessPoolExecutor( max_workers=self.jobs ) as pool:
+         futures = {}
+         for itest, test in enumerate( tests ):
+            workdir = self.workdir( itest+1, test )
+            if ( os.path.exists( workdir ) ): shutil.rmtree( workdir )
+            os.makedirs( workdir )
+            future = pool.submit( run_isolated_test, self.ctsm_root(), self.testlist.inputdatadir, test, \
+                                  self.redo_compare_files(), workdir )
+            futures[future] = workdir
+         for future in concurrent.futures.as_completed( futures ):
+            (stat,comp) = future.result()
+            # Show all the output of a test together
+            outfile = open( futures[future]+"/test.out", "r" )
+            print( outfile.read(), end="" )
+            outfile.close()
+            sys.stdout.flush()
+            self.Count( stat, comp )
 
    def Finalize( self ):
       "Finalize and print out results"
@@ -136,6 +171,30 @@ class PTCLMtesting_prog:
       print( "Number of tests without compare   = "+str(self.n_tests['NO-COMPS-DONE']) )
 
 
+def run_isolated_test( ctsmdir, inputdatadir, test, redo_comp_files, workdir ):
+   "Run a test in a process of the pool with it's log and output in it's working directory"
+   testlist = PTCLMtestlist()
+   testlist.Setup( ctsmdir )
+   testlist.inputdatadir = inputdatadir
+   # Commands the test runs write to the output file as well
+   sys.stdout.flush()
+   sys.stderr.flush()
+   output = open( workdir+"/test.out", "w" )
+   stdout = os.dup( 1 )
+   stderr = os.dup( 2 )
+   os.dup2( output.fileno(), 1 )
+   os.dup2( output.fileno(), 2 )
+   try:
+      return( testlist.run_PTCLMtest( test, redo_comp_files, workdir=workdir ) )
+   finally:
+      sys.stdout.flush()
+      sys.stderr.flush()
+      os.dup2( stdout, 1 )
+      os.dup2( stderr, 2 )
+      os.close( stdout )
+      os.close( stderr )
+      output.close()
+
 #
 # Unit testing for above classes
 #
@@ -163,6 +222,22 @@ class test_PTCLMtesting_prog(unittest.TestCase):
      self.prog.parse_cmdline_args( )
      self.assertRaises(SystemExit, self.prog.Run )
      self.assertRaises(SystemExit, self.prog.Finalize )
+     self.assertRaises(SystemExit, self.prog.RunParallel )
+     # Bad number of jobs
+     sys.argv[1:] = [ "--jobs", "0" ]
+     self.assertRaises(SystemExit, self.prog.parse_cmdline_args )
+
+   def test_count( self ):
+     # check that the counts are the same as when the tests are run one after the other
+     self.prog.n_tests = { 'PASS':0, 'FAIL':0, 'PASS-COMP':0, 'FAIL-COMP':0, 'NO-COMPS-DONE':0 }
+     self.prog.itest   = 0
+     for (stat,comp) in [ ("PASS","PASS"), ("PASS","FAIL-COMP"), ("FAIL","NO-COMPS-DONE"), ("PASS","FAIL-DNE"), ("PASS","BFAIL") ]:
+        self.prog.Count( stat, comp )
+     self.assertEqual( self.prog.itest, 5 )
+     self.assertEqual( self.prog.n_tests, { 'PASS':4, 'FAIL':1, 'PASS-COMP':1, 'FAIL-COMP':3, 'NO-COMPS-DONE':1 } )
+     sys.argv[1:] = [ "--jobs", "8" ]
+     self.prog.parse_cmdline_args( )
+     self.assertEqual( self.prog.jobs, 8 )
 
    def test_init( self ):
      # check that setting redo_compare_files works
@@ -35,11 +35,21 @@ class PTCLMtestlistXML( ContentHandler ):
 from   xml.sax         import make_parser
 import os
 import sys
+import re
+import glob
+import time
+import shutil
+import difflib
+sys.path.append( os.path.dirname( os.path.abspath( __file__ ) )+"/.." )
+from ptclmversion import ptclmversion
 class PTCLMtestlist:
    # Class data
    testlist     = "PTCLMtestlist.xml"
    testing_dir  = "testing_dir"
    inputdatadir = "/glade/p/cesmdata/cseg/inputdata"
+   # Identifying information to replace in files, found once and shared by all objects
+   # (keyed by the CTSM root and inputdata directories)
+   contexts     = {}
     
    # Construct the class
    def Setup( self, ctsmdir ):
@@ -64,35 +74,80 @@ class PTCLMtestlist:
      print( "Open file: "+self.testlist )
      self.testXML.parse( self.testlist )
 
-   # Replace specific identifyable information with generic
-   def ReplaceIDInfoInFile( self, filename, curdates=False ):
+   # Get the identifying information to replace with generic names (only found once)
+   def get_IDInfo( self ):
+     key = ( self.ctsmdir, self.inputdatadir )
+     if ( key in self.contexts ): return( self.contexts[key] )
+     ptclmdir = os.path.dirname( os.path.abspath( __file__ ) )+"/.."
+     sdate    = time.strftime( "%y%m%d" )
+     # In the order the replacements are done, without any that are empty
+     subs = []
+     for (name, value) in [ ( "$CTSMROOTDIR",  self.ctsmdir ), \
+                            ( "$CTSMROOTDIR",  os.path.abspath( self.ctsmdir ) ), \
+                            ( "$NCLPATH",      shutil.which( "ncl" ) or "" ), \
+                            ( "$DIN_LOC_ROOT", self.inputdatadir ), \
+                            ( "$PTCLMVERSION", ptclmversion().Get( self, ptclmdir+"/ChangeLog" ) ) ]:
+        if ( value != "" ): subs.append( (value, name) )
+     context = {}
+     for curdates in [ False, True ]:
+        table = dict( subs )
+        if ( curdates ): table[sdate] = "$YYMMDD"
+        # Longest first so a value that contains another one is replaced as a whole
+        pattern = re.compile( "|".join( [ re.escape(value) for value in sorted( table, key=len, reverse=True ) ] ) )
+        context[curdates] = ( pattern, table )
+     self.contexts[key] = context
+     return( context )
+
+   # Replace specific identifyable information with generic in a string (in one pass)
+   def ReplaceIDInfo( self, text, curdates=False ):
+     (pattern, table) = self.get_IDInfo()[curdates]
+     return( pattern.sub( lambda match: table[match.group(0)], text ) )
+
+   # Return the contents of a file with identifyable information replaced (the file is NOT changed)
+   def ReadIDInfoReplaced( self, filename, curdates=False ):
      if ( not os.path.exists( filename ) ): self.error("File does NOT exist to do replace operation in:"+filename)
-     outfilename = filename+".tmp"
-     infile  = open( filename,    "r" );
-     outfile = open( outfilename, "w" );
-     stdout  = os.popen( "cd "+self.ctsmdir+"; pwd" )
-     absctsmdir = stdout.read().rstrip( );
-     stdout  = os.popen( "date +%y%m%d" );
-     sdate   = stdout.read().rstrip( );
-     stdout  = os.popen( "../PTCLMmkdata --version" )
-     version = stdout.read().rstrip()
-     stdout  = os.popen( "which ncl" )
-     nclpath = stdout.read().rstrip( );
-     for line in infile:
-         line = line.replace( self.ctsmdir,      "$CTSMROOTDIR" );
-         line = line.replace( absctsmdir,        "$CTSMROOTDIR" );
-         line = line.replace( nclpath,           "$NCLPATH"     );
-         line = line.replace( self.inputdatadir, "$DIN_LOC_ROOT" );
-         line = line.replace( version,           "$PTCLMVERSION" );
-         if ( curdates ):
-            line = line.replace( sdate,     "$YYMMDD" );
-         outfile.write( line )
+     infile = open( filename, "r" )
+     text   = infile.read()
+     infile.close()
+     return( self.ReplaceIDInfo( text, curdates ) )
+
+   # Replace specific identifyable information with generic in a file
+   def ReplaceIDInfoInFile( self, filename, curdates=False ):
+     text    = self.ReadIDInfoReplaced( filename, curdates )
+     outfile = open( filename, "w" )
+     outfile.write( text )
+     outfile.close()
 
+   # Compare a file (with identifyable information replaced) to a compare file, printing a unified diff
+   # if they are different. Returns True if they are the same, and the replaced text of the file
+   def CompareFile( self, filename, cmpfile, curdates=False ):
+     if ( not os.path.exists( filename ) ):
+        print( "file to compare does NOT exist: "+filename )
+        return( False, "" )
+     text = self.ReadIDInfoReplaced( filename, curdates )
+     if ( not os.path.exists( cmpfile ) ):
+        print( "compare file does NOT exist: "+cmpfile )
+        return( False, text )
+     infile  = open( cmpfile, "r" )
+     cmptext = infile.read()
      infile.close()
+     if ( text == cmptext ):
+        return( True, text )
+     diff = difflib.unified_diff( text.splitlines(True), cmptext.splitlines(True), fromfile=filename, tofile=cmpfile )
+     for line in diff:
+        print( line, end="" if line.endswith("\n") else "\n" )
+     return( False, text )
+
+   # Write the replaced text of a file out as the new compare file
+   def WriteCompareFile( self, cmpfile, text ):
+     cmpdir = os.path.dirname( cmpfile )
+     if ( cmpdir != "" and not os.path.exists( cmpdir ) ):
+        print( "Create new file directory that does NOT exist\n" )
+        print( "mkdir -p "+cmpdir+"\n" )
+        os.makedirs( cmpdir, exist_ok=True )
+     outfile = open( cmpfile, "w" )
+     outfile.write( text )
      outfile.close()
-     os.system( "mv "+outfilename+" "+filename )
-     
-      
 
    # --  Error function ---------------------------------
    def error( self, desc ):
@@ -141,11 +196,12 @@ class PTCLMtestlist:
 
      return( opts )
 
-   # run the test
-   def run_PTCLMtest( self, test, redo_comp_files ):
+   # run the test (with it's log file in workdir if given, so that tests can run at the same time)
+   def run_PTCLMtest( self, test, redo_comp_files, workdir=None ):
      opts = self.get_PTCLMoptions( test )
      tid  = self.get_testID( test )
      tlog = "run.log"
+     if ( workdir != None ): tlog = workdir+"/"+tlog
      if ( self.IsNOTFailTest( test ) ):
         errcode =  os.system( "../PTCLMmkdata "+opts+" > "+tlog  )
      else:
@@ -164,10 +220,10 @@ class PTCLMtestlist:
      print( teststatus+" "+tid )
 
      overallcompstatus = "NO-COMPS-DONE"
-     if ( os.path.exists(tlog) ): self.ReplaceIDInfoInFile( tlog, curdates=True )   # Replace identifing info in the log file
      if ( test['resultfile'] != "" ):
-        dstat = os.system( "diff "+tlog+" "+test['resultfile']  )
-        if ( dstat == 0 ):
+        # Identifing info is replaced in the log file as it's compared
+        (same, text) = self.CompareFile( tlog, test['resultfile'], curdates=True )
+        if ( same ):
            compstatus = "PASS"
            desc       = " compare to result file"
         else:
@@ -175,22 +231,18 @@ class PTCLMtestlist:
            desc       = " different from result file: "+test['resultfile']
 
         if ( redo_comp_files ):
-           if ( not os.path.exists( test['resultfile'] ) ):
-              cmd = "mkdir "+os.path.dirname(test['resultfile'])
-              print( "Create new file directory that does NOT exist\n" )
-              print( cmd+"\n" )
-              os.system( cmd )
-           os.system( "cp "+tlog+" "+test['resultfile']  )
+           self.WriteCompareFile( test['resultfile'], text )
         overallcompstatus = compstatus
 
         print( compstatus+" "+tid+" "+desc )
 
      if ( test['compdir'] != "" ):
         testdir  = os.path.abspath(self.testing_dir)+"/"+test['id']
-        stdout   = os.popen("cd "+testdir+"/*"+test['site']+"; pwd")
-        testdir  = os.path.abspath( stdout.read().rstrip( ) )
-        os.system( "mv "+tlog+" "+testdir )
-        filelist = ["README.PTCLM", tlog, "user_nl_clm", "shell_commands" ]
+        sitedirs = glob.glob( testdir+"/*"+test['site'] )
+        if ( len(sitedirs) > 0 ): testdir = os.path.abspath( sitedirs[0] )
+        else:                     testdir = os.getcwd()
+        if ( os.path.exists( tlog ) ): os.replace( tlog, testdir+"/"+os.path.basename(tlog) )
+        filelist = ["README.PTCLM", os.path.basename(tlog), "user_nl_clm", "shell_commands" ]
         for file in filelist:
            srcfile = testdir+"/"+file
            cmpfile = "compdirs/"+test['compdir']+"/"+file
@@ -201,30 +253,25 @@ class PTCLMtestlist:
                  compstatus = "BFAIL"
                  desc       = "compare file does NOT exist: "+cmpfile
            else:
-              self.ReplaceIDInfoInFile( srcfile )   # Replace identifing info in the log file
-              dstat = os.system( "diff "+srcfile+" "+cmpfile )
+              # Replace identifing info in the file as it's compared (dates only for the log file)
+              (same, text) = self.CompareFile( srcfile, cmpfile, curdates=(file == os.path.basename(tlog)) )
 
-              if ( dstat == 0 ):
+              if ( same ):
                  compstatus = "PASS"
                  desc       = "same as comp directory file: "+cmpfile
               else:
                  compstatus = "FAIL-COMP"
                  desc       = "different from comp directory file: "+cmpfile
 
-           if ( redo_comp_files ):
-              if ( not os.path.exists( cmpfile ) ):
-                 cmd = "mkdir "+os.path.dirname(cmpfile)
-                 print( "Create new file directory that does NOT exist\n" )
-                 print( cmd+"\n" )
-                 os.system( cmd )
-              os.system( "cp "+srcfile+" "+cmpfile )
+           if ( redo_comp_files and os.path.exists( srcfile ) ):
+              self.WriteCompareFile( cmpfile, self.ReadIDInfoReplaced( srcfile, curdates=(file == os.path.basename(tlog)) ) )
                  
            if ( overallcompstatus == "PASS" or overallcompstatus == "NO-COMPS-DONE" ): overallcompstatus = compstatus
 
            print( compstatus+" "+tid+" "+desc+" "+file )
 
      if ( teststatus == "PASS" and overallcompstatus == "PASS" and os.path.exists( tlog ) ): 
-        os.system( "/bin/rm "+tlog )
+        os.remove( tlog )
 
      return( [teststatus, overallcompstatus] )
 #
@@ -333,6 +380,33 @@ class test_PTCLMtestlist(unittest.TestCase):
      tfile.close()
      os.system( "/bin/rm "+filename )
 
+   def test_CompareFile( self ):
+     filename = "testcompare.tmp"
+     cmpfile  = "testcompare.cmp.tmp"
+     stdout   = os.popen( "date +%y%m%d" );
+     sdate    = stdout.read().rstrip( );
+     text     = "file = '"+self.test.ctsmdir+"/surfdata_"+sdate+".nc'\n"
+     tfile = open( filename, "w" )
+     tfile.write( text )
+     tfile.close()
+     self.test.WriteCompareFile( cmpfile, "file = '$CTSMROOTDIR/surfdata_$YYMMDD.nc'\n" )
+     (same, replaced) = self.test.CompareFile( filename, cmpfile, curdates=True )
+     self.assertTrue( same )
+     self.assertEqual( replaced, "file = '$CTSMROOTDIR/surfdata_$YYMMDD.nc'\n" )
+     (same, replaced) = self.test.CompareFile( filename, cmpfile )
+     self.assertFalse( same )
+     (same, replaced) = self.test.CompareFile( "non-existant-file", cmpfile )
+     self.assertFalse( same )
+     # The file compared is NOT changed
+     tfile = open( filename, "r" )
+     self.assertEqual( tfile.read(), text )
+     tfile.close()
+     # The identifying information is only found once
+     other = PTCLMtestlist()
+     other.Setup( self.test.ctsmdir )
+     self.assertTrue( other.get_IDInfo() is self.test.get_IDInfo() )
+     os.system( "/bin/rm "+filename+" "+cmpfile )
+
 
 if __name__ == '__main__':
      unittest.main()